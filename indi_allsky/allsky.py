@@ -23,6 +23,7 @@ from .version import __version__
 from .version import __config_level__
 
 from .config import IndiAllSkyConfig
+from .sharedFrame import IndiAllSkySharedFrame
 
 from . import constants
 
@@ -634,6 +635,12 @@ class IndiAllSky(object):
 
             self._startup()
 
+            self._miscDb.initImageRollup()
+
+
+        # before the capture worker creates new frames
+        IndiAllSkySharedFrame.removeStale()
+
 
         while True:
             if self._shutdown:
@@ -0,0 +1,99 @@
+import cv2
+import logging
+
+
+logger = logging.getLogger('indi_allsky')
+
+
+class IndiAllSkyAlphaComposite(object):
+    # Blends a static overlay into 8-bit images with a fixed alpha mask.
+    #
+    #   result = image * (1 - alpha) + overlay * alpha
+    #
+    # Everything that does not change between frames is computed once.  Only the
+    # bounding box of the non-transparent alpha is processed.  A mask without partial
+    # transparency is a plain copy (or bitwise_and for a black overlay), otherwise the
+    # blend is done with saturated integer math from OpenCV, no full frame float
+    # buffers are allocated.
+
+    def __init__(self, alpha, overlay=None):
+        # alpha: uint8 (0-255), 0 is transparent
+        # overlay: BGR image with the same dimensions, None is black
+        self._shape = alpha.shape[:2]
+
+        self._roi = None
+        self._opaque_mask = None  # binary alpha
+        self._inv_alpha = None
+        self._overlay_premult = None
+
+
+        if not cv2.countNonZero(alpha):
+            logger.warning('Alpha mask is fully transparent')
+            return
+
+
+        x, y, w, h = cv2.boundingRect(alpha)
+        self._roi = (slice(y, y + h), slice(x, x + w))
+
+
+        alpha_roi = alpha[self._roi]
+
+        if isinstance(overlay, type(None)):
+            overlay_roi = None
+        else:
+            overlay_roi = overlay[self._roi][:, :, :3]
+
+
+        partial = cv2.countNonZero(cv2.inRange(alpha_roi, 1, 254))
+        if not partial:
+            if isinstance(overlay_roi, type(None)):
+                # pixels are kept where the alpha is 0
+                self._opaque_mask = cv2.merge([cv2.bitwise_not(alpha_roi)] * 3)
+            else:
+                self._opaque_mask = alpha_roi.copy()
+                self._overlay_premult = overlay_roi.copy()
+
+            return
+
+
+        alpha_roi_3 = cv2.merge([alpha_roi] * 3)
+
+        self._inv_alpha = cv2.bitwise_not(alpha_roi_3)
+
+        if not isinstance(overlay_roi, type(None)):
+            self._overlay_premult = cv2.multiply(overlay_roi, alpha_roi_3, scale=1 / 255)
+
+
+    @property
+    def shape(self):
+        return self._shape
+
+    @shape.setter
+    def shape(self, *args):
+        pass  # read only
+
+
+    def apply(self, image):
+        # image is modified in place
+        if isinstance(self._roi, type(None)):
+            return image
+
+
+        roi = image[self._roi]
+
+        if not isinstance(self._opaque_mask, type(None)):
+            if isinstance(self._overlay_premult, type(None)):
+                cv2.bitwise_and(roi, self._opaque_mask, dst=roi)
+            else:
+                cv2.copyTo(self._overlay_premult, self._opaque_mask, dst=roi)
+
+            return image
+
+
+        cv2.multiply(roi, self._inv_alpha, dst=roi, scale=1 / 255)
+
+        if not isinstance(self._overlay_premult, type(None)):
+            cv2.add(roi, self._overlay_premult, dst=roi)
+
+        return image
+
@@ -0,0 +1,275 @@
+import time
+from datetime import datetime
+from datetime import timezone
+import math
+import ephem
+import logging
+
+from . import constants
+
+from .flask import db
+from .flask.models import IndiAllSkyDbTleDataTable
+
+from sqlalchemy import func
+
+
+logger = logging.getLogger('indi_allsky')
+
+
+class IndiAllSkyAstrometry(object):
+    # Astrometric data is updated for every frame.  Most of the work does not need to
+    # be repeated that often:
+    #
+    # - TLE data is only parsed when the TLE table has changed
+    # - next pass predictions are kept until the satellite rises, the prediction only
+    #   changes when a pass starts
+    # - planets are computed once per time bucket
+    #
+    # Cached data is cleared when the location changes.
+
+    satellite_dict = {
+        'iss' : {
+            'title' : 'ISS (ZARYA)',
+            'group' : constants.SATELLITE_VISUAL,
+        },
+        'hst' : {
+            'title' : 'HST',
+            'group' : constants.SATELLITE_VISUAL,
+        },
+        'tiangong' : {
+            'title' : 'CSS (TIANHE)',
+            'group' : constants.SATELLITE_VISUAL,
+        },
+    }
+
+    planet_list = (
+        ('mercury', ephem.Mercury),
+        ('venus', ephem.Venus),
+        ('mars', ephem.Mars),
+        ('jupiter', ephem.Jupiter),
+        ('saturn', ephem.Saturn),
+    )
+
+    tle_check_period = 600  # seconds between checks for new TLE data
+    planet_period = 60  # planets move less than 0.25 degrees per minute
+    pass_retry_period = 3600  # satellites without a next pass
+
+
+    def __init__(self, config, position_av):
+        self.config = config
+        self.position_av = position_av  # lat, long, elev, ra, dec
+
+        self._obs = ephem.Observer()
+        self._obs.pressure = 0  # disable atmospheric refraction calcs
+
+        self._location = None
+
+        self._satellites = dict()
+        self._tle_id = -1  # newest TLE entry when satellites were loaded
+        self._tle_check_time = 0
+
+        self._next_pass = dict()
+
+        self._planet_data = dict()
+        self._planet_bucket = None
+
+
+    def update(self, astrometric_data, utcnow=None):
+        if isinstance(utcnow, type(None)):
+            utcnow = datetime.now(tz=timezone.utc)  # ephem expects UTC dates
+
+
+        self._updateLocation()
+
+        obs = self._obs
+        obs.date = utcnow
+
+        astrometric_data['sidereal_time'] = str(obs.sidereal_time())
+
+
+        sun = ephem.Sun()
+        sun.compute(obs)
+        astrometric_data['sun_alt'] = math.degrees(sun.alt)
+
+
+        moon = ephem.Moon()
+        moon.compute(obs)
+        moon_alt = math.degrees(moon.alt)
+        astrometric_data['moon_alt'] = moon_alt
+        astrometric_data['moon_phase'] = moon.moon_phase * 100.0
+
+        if moon_alt >= 0:
+            astrometric_data['moon_up'] = 'Yes'
+        else:
+            astrometric_data['moon_up'] = 'No'
+
+
+        astrometric_data.update(self._planets(utcnow))
+
+
+        # separation of 1-3 degrees means a possible eclipse
+        astrometric_data['sun_moon_sep'] = abs((ephem.separation(moon, sun) / (math.pi / 180)) - 180)
+
+
+        # satellites
+        self._loadSatellites()
+
+        for sat_key, sat in self._satellites.items():
+            sat.compute(obs)
+
+            sat_alt = math.degrees(sat.alt)
+            astrometric_data['{0:s}_alt'.format(sat_key)] = sat_alt
+
+            if sat_alt >= 0:
+                astrometric_data['{0:s}_up'.format(sat_key)] = '{0:0.0f}°'.format(sat_alt)
+            else:
+                astrometric_data['{0:s}_up'.format(sat_key)] = 'No'
+
+
+            rise_date, max_alt = self._nextPass(sat_key, sat)
+
+            if rise_date:
+                astrometric_data['{0:s}_next_h'.format(sat_key)] = (rise_date - utcnow.replace(tzinfo=None)).total_seconds() / 3600
+                astrometric_data['{0:s}_next_alt'.format(sat_key)] = max_alt
+            else:
+                astrometric_data['{0:s}_next_h'.format(sat_key)] = 0.0
+                astrometric_data['{0:s}_next_alt'.format(sat_key)] = 0.0
+
+
+    def _updateLocation(self):
+        location = (
+            round(self.position_av[0], 4),
+            round(self.position_av[1], 4),
+            round(self.position_av[2]),
+        )
+
+        if location == self._location:
+            return
+
+
+        if self._location:
+            logger.warning('Location changed, clearing astrometry cache')
+
+        self._obs.lat = math.radians(location[0])
+        self._obs.lon = math.radians(location[1])
+        self._obs.elevation = location[2]
+
+        self._location = location
+
+        self._next_pass.clear()
+        self._planet_bucket = None
+
+
+    def _planets(self, utcnow):
+        planet_bucket = int(utcnow.timestamp() / self.planet_period)
+        if planet_bucket == self._planet_bucket:
+            return self._planet_data
+
+
+        planet_data = dict()
+
+        for planet_key, planet_class in self.planet_list:
+            planet = planet_class()
+            planet.compute(self._obs)
+
+            planet_alt = math.degrees(planet.alt)
+            planet_data['{0:s}_alt'.format(planet_key)] = planet_alt
+
+            if planet_alt >= 0:
+                planet_data['{0:s}_up'.format(planet_key)] = 'Yes'
+            else:
+                planet_data['{0:s}_up'.format(planet_key)] = 'No'
+
+
+            if planet_key == 'venus':
+                planet_data['venus_phase'] = planet.phase
+
+
+        self._planet_data = planet_data
+        self._planet_bucket = planet_bucket
+
+        return planet_data
+
+
+    def _loadSatellites(self):
+        now = time.time()
+        if now - self._tle_check_time < self.tle_check_period:
+            return
+
+        self._tle_check_time = now
+
+
+        # TLE data is replaced when it is downloaded
+        tle_id = db.session.query(func.max(IndiAllSkyDbTleDataTable.id)).scalar()
+        if tle_id == self._tle_id:
+            return
+
+
+        satellites = dict()
+
+        for sat_key, sat_data in self.satellite_dict.items():
+            # there may be multiple satellites of the same name, usually pieces of the same rocket
+            sat_entry = IndiAllSkyDbTleDataTable.query\
+                .filter(IndiAllSkyDbTleDataTable.group == sat_data['group'])\
+                .filter(IndiAllSkyDbTleDataTable.title == sat_data['title'])\
+                .order_by(IndiAllSkyDbTleDataTable.id.desc())\
+                .first()
+
+
+            if not sat_entry:
+                logger.warning('Satellite data not found: %s', sat_data['title'])
+                continue
+
+            #logger.info('Found satellite data: %s', sat_name)
+
+            try:
+                sat = ephem.readtle(sat_entry.title, sat_entry.line1, sat_entry.line2)
+            except ValueError as e:
+                logger.error('Satellite TLE data error: %s', str(e))
+                continue
+
+            satellites[sat_key] = sat
+
+
+        logger.info('Loaded TLE data for %d satellites', len(satellites))
+
+        self._satellites = satellites
+        self._tle_id = tle_id
+
+        self._next_pass.clear()
+
+
+    def _nextPass(self, sat_key, sat):
+        # returns the next rise date and the max altitude of the pass
+        obs = self._obs
+
+        next_pass = self._next_pass.get(sat_key)
+        if next_pass and obs.date < next_pass['valid_until']:
+            return next_pass['rise_date'], next_pass['max_alt']
+
+
+        try:
+            rise_time, rise_az, max_alt_time, max_alt, set_time, set_az = obs.next_pass(sat)
+        except ValueError as e:
+            # satellite does not rise or set at this location
+            logger.error('%s next pass error: %s', sat_key.upper(), str(e))
+            rise_time = None
+
+
+        if rise_time and rise_time > obs.date:
+            # the next pass does not change until the satellite rises
+            next_pass = {
+                'rise_date'   : rise_time.datetime(),
+                'max_alt'     : math.degrees(max_alt),
+                'valid_until' : rise_time,
+            }
+        else:
+            next_pass = {
+                'rise_date'   : None,
+                'max_alt'     : 0.0,
+                'valid_until' : ephem.Date(obs.date + (self.pass_retry_period * ephem.second)),
+            }
+
+        self._next_pass[sat_key] = next_pass
+
+        return next_pass['rise_date'], next_pass['max_alt']
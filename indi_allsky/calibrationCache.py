@@ -0,0 +1,162 @@
+from collections import OrderedDict
+import logging
+
+from .flask.models import IndiAllSkyDbStateTable
+
+from sqlalchemy.orm.exc import NoResultFound
+
+
+logger = logging.getLogger('indi_allsky')
+
+
+class IndiAllSkyCalibrationCache(object):
+    # miscDb updates this state key when the dark/bpm tables are modified
+    state_key = 'CALIBRATION_UPDATED'
+
+
+    def __init__(self, config):
+        self.config = config
+
+        self._max_bytes = int(self.config.get('IMAGE_CALIBRATE_CACHE_MB', 128)) * 1024 * 1024
+
+        # key -> master dark
+        self._cache = OrderedDict()
+        self._cache_bytes = 0
+
+        self._version = None
+
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._invalidations = 0
+
+
+    @property
+    def enabled(self):
+        return self._max_bytes > 0
+
+    @enabled.setter
+    def enabled(self, *args):
+        pass  # read only
+
+
+    @property
+    def stats(self):
+        total = self._hits + self._misses
+
+        if total:
+            hit_rate = self._hits / total
+        else:
+            hit_rate = 0.0
+
+        return {
+            'entries'       : len(self._cache),
+            'bytes'         : self._cache_bytes,
+            'max_bytes'     : self._max_bytes,
+            'hits'          : self._hits,
+            'misses'        : self._misses,
+            'hit_rate'      : round(hit_rate, 3),
+            'evictions'     : self._evictions,
+            'invalidations' : self._invalidations,
+        }
+
+    @stats.setter
+    def stats(self, *args):
+        pass  # read only
+
+
+    def key(self, bpm_entry, dark_frame_entry):
+        # the bad pixel map is optional
+        if bpm_entry:
+            bpm_id = bpm_entry.id
+        else:
+            bpm_id = None
+
+        return (bpm_id, dark_frame_entry.id)
+
+
+    def checkVersion(self):
+        if not self.enabled:
+            return
+
+
+        try:
+            state = IndiAllSkyDbStateTable.query\
+                .filter(IndiAllSkyDbStateTable.key == self.state_key)\
+                .one()
+
+            version = state.value
+        except NoResultFound:
+            version = None
+
+
+        if version != self._version:
+            if self._cache:
+                logger.warning('Calibration frames updated, flushing master dark cache')
+                self._invalidations += 1
+
+            self.clear()
+            self._version = version
+
+
+    def get(self, key):
+        # returns a tuple of (found, master_dark)
+        try:
+            master_dark = self._cache[key]
+        except KeyError:
+            self._misses += 1
+            return False, None
+
+        self._cache.move_to_end(key)
+        self._hits += 1
+
+        return True, master_dark
+
+
+    def put(self, key, master_dark):
+        if not self.enabled:
+            return
+
+
+        if key in self._cache:
+            self._remove(key)
+
+
+        entry_bytes = master_dark.nbytes
+
+        if entry_bytes > self._max_bytes:
+            logger.warning('Master dark (%d bytes) exceeds cache size, not caching', entry_bytes)
+            return
+
+
+        while self._cache_bytes + entry_bytes > self._max_bytes:
+            old_key = next(iter(self._cache))
+            self._remove(old_key)
+            self._evictions += 1
+
+
+        self._cache[key] = master_dark
+        self._cache_bytes += entry_bytes
+
+
+    def _remove(self, key):
+        master_dark = self._cache.pop(key)
+        self._cache_bytes -= master_dark.nbytes
+
+
+    def clear(self):
+        self._cache.clear()
+        self._cache_bytes = 0
+
+
+    def logStats(self):
+        stats = self.stats
+        logger.info(
+            'Master dark cache: %d entries, %0.1f MB, %d hits, %d misses (%0.1f%%)',
+            stats['entries'],
+            stats['bytes'] / 1024 / 1024,
+            stats['hits'],
+            stats['misses'],
+            stats['hit_rate'] * 100,
+        )
+
@@ -12,6 +12,8 @@ import PyIndi
 
 from .fake_indi import FakeIndiCcd
 
+from ..sharedFrame import IndiAllSkySharedFrame
+
 #from ..flask import db
 from ..flask import create_app
 
@@ -112,6 +114,8 @@ class IndiClient(PyIndi.BaseClient):
 
         self._filename_t = 'ccd{0:d}_{1:s}.{2:s}'
 
+        self._shared_frame = None  # frames are written to temp files unless enabled
+
         self._timeout = 10.0
         self._exposure = 0.0
 
@@ -197,6 +201,25 @@ class IndiClient(PyIndi.BaseClient):
     def filename_t(self, new_filename_t):
         self._filename_t = str(new_filename_t)
 
+    @property
+    def shared_memory(self):
+        return bool(self._shared_frame)
+
+    @shared_memory.setter
+    def shared_memory(self, new_shared_memory):
+        if not new_shared_memory:
+            self._shared_frame = None
+            return
+
+        shared_frame = IndiAllSkySharedFrame(self.config)
+
+        if not shared_frame.available:
+            logger.warning('Shared memory not available, frames will be written to temp files')
+            self._shared_frame = None
+            return
+
+        self._shared_frame = shared_frame
+
 
     @property
     def libcamera_bit_depth(self):
@@ -297,17 +320,26 @@ class IndiClient(PyIndi.BaseClient):
         blobfile = io.BytesIO(imgdata)
         hdulist = fits.open(blobfile)
 
-        try:
-            f_tmpfile = tempfile.NamedTemporaryFile(mode='w+b', delete=False, suffix='.fit')
-            f_tmpfile_p = Path(f_tmpfile.name)
+        shared_frame = None
+        if self._shared_frame:
+            try:
+                f_tmpfile_p, shared_frame = self._shared_frame.export(hdulist, imgdata)
+            except (OSError, ValueError) as e:
+                logger.error('Unable to use shared memory, writing temp file: %s', str(e))
 
-            hdulist.writeto(f_tmpfile)
 
-            f_tmpfile.flush()
-            f_tmpfile.close()
-        except OSError as e:
-            logger.error('OSError: %s', str(e))
-            return
+        if not shared_frame:
+            try:
+                f_tmpfile = tempfile.NamedTemporaryFile(mode='w+b', delete=False, suffix='.fit')
+                f_tmpfile_p = Path(f_tmpfile.name)
+
+                hdulist.writeto(f_tmpfile)
+
+                f_tmpfile.flush()
+                f_tmpfile.close()
+            except OSError as e:
+                logger.error('OSError: %s', str(e))
+                return
 
 
         #elapsed_s = time.time() - start
@@ -325,6 +357,9 @@ class IndiClient(PyIndi.BaseClient):
             'filename_t'  : self._filename_t,
         }
 
+        if shared_frame:
+            jobdata['shared_frame'] = shared_frame
+
         ### Not using DB task queue to reduce DB I/O
         #with app.app_context():
         #    task = IndiAllSkyDbTaskQueueTable(
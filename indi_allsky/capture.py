@@ -557,6 +557,10 @@ class CaptureWorker(Process):
         )
 
 
+        # pass frames to the image worker in shared memory
+        self.indiclient.shared_memory = self.config.get('IMAGE_SHARED_MEMORY', True)
+
+
         # set indi server localhost and port
         self.indiclient.setServer(self.config['INDI_SERVER'], self.config['INDI_PORT'])
 
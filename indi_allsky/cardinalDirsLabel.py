@@ -1,12 +1,10 @@
 import math
 from pathlib import Path
-import numpy
 import cv2
-from PIL import Image
-from PIL import ImageFont
-from PIL import ImageDraw
 import logging
 
+from .textOverlay import IndiAllSkyTextOverlay
+
 logger = logging.getLogger('indi_allsky')
 
 
@@ -62,6 +60,8 @@ class IndiAllskyCardinalDirsLabel(object):
         base_path  = Path(__file__).parent
         self.font_path  = base_path.joinpath('fonts')
 
+        self._text_overlay = IndiAllSkyTextOverlay()
+
 
     @property
     def az(self):
@@ -285,8 +285,7 @@ class IndiAllskyCardinalDirsLabel(object):
 
 
     def applyLabels_pillow(self, image, coord_dict):
-        img_rgb = Image.fromarray(cv2.cvtColor(image, cv2.COLOR_BGR2RGB))
-        width, height  = img_rgb.size  # backwards from opencv
+        height, width = image.shape[:2]
 
 
         if self.config['TEXT_PROPERTIES']['PIL_FONT_FILE'] == 'custom':
@@ -297,9 +296,6 @@ class IndiAllskyCardinalDirsLabel(object):
 
         pillow_font_size = self.config.get('CARDINAL_DIRS', {}).get('PIL_FONT_SIZE', 30)
 
-        font = ImageFont.truetype(str(pillow_font_file_p), pillow_font_size)
-        draw = ImageDraw.Draw(img_rgb)
-
         color_rgb = list(self.config['CARDINAL_DIRS']['FONT_COLOR'])  # RGB for pillow
 
 
@@ -324,19 +320,19 @@ class IndiAllskyCardinalDirsLabel(object):
                 y = height - self.bottom_offset
 
 
-            draw.text(
-                (x, y),
+            self._text_overlay.drawText(
+                image,
                 k,
-                fill=tuple(color_rgb),
-                font=font,
+                pillow_font_file_p,
+                pillow_font_size,
+                (x, y),
+                color_rgb,
                 stroke_width=stroke_width,
-                stroke_fill=(0, 0, 0),
                 anchor='mm',  # middle-middle
             )
 
 
-        # convert back to numpy array
-        return cv2.cvtColor(numpy.array(img_rgb), cv2.COLOR_RGB2BGR)
+        return image
 
 
     def drawCircle(self, image):
@@ -471,8 +467,7 @@ class IndiAllskyCardinalDirsLabel(object):
 
 
     def panorama_label_pillow(self, image, coord_dict):
-        img_rgb = Image.fromarray(cv2.cvtColor(image, cv2.COLOR_BGR2RGB))
-        width, height  = img_rgb.size  # backwards from opencv
+        height, width = image.shape[:2]
 
 
         if self.config['TEXT_PROPERTIES']['PIL_FONT_FILE'] == 'custom':
@@ -483,9 +478,6 @@ class IndiAllskyCardinalDirsLabel(object):
 
         pillow_font_size = self.config.get('FISH2PANO', {}).get('PIL_FONT_SIZE', 30)
 
-        font = ImageFont.truetype(str(pillow_font_file_p), pillow_font_size)
-        draw = ImageDraw.Draw(img_rgb)
-
         color_rgb = list(self.config['CARDINAL_DIRS']['FONT_COLOR'])  # RGB for pillow
 
 
@@ -510,17 +502,17 @@ class IndiAllskyCardinalDirsLabel(object):
                 y = height - self.bottom_offset
 
 
-            draw.text(
-                (x, y),
+            self._text_overlay.drawText(
+                image,
                 k,
-                fill=tuple(color_rgb),
-                font=font,
+                pillow_font_file_p,
+                pillow_font_size,
+                (x, y),
+                color_rgb,
                 stroke_width=stroke_width,
-                stroke_fill=(0, 0, 0),
                 anchor='mm',  # middle-middle
             )
 
 
-        # convert back to numpy array
-        return cv2.cvtColor(numpy.array(img_rgb), cv2.COLOR_RGB2BGR)
+        return image
 
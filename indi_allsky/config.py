@@ -7,6 +7,8 @@ import io
 import json
 import tempfile
 import random
+import copy
+import threading
 from pathlib import Path
 from collections import OrderedDict
 from prettytable import PrettyTable
@@ -147,12 +149,17 @@ class IndiAllSkyConfigBase(object):
         "STARTRAILS_MIN_STARS"  : 0,
         "STARTRAILS_TIMELAPSE"  : True,
         "STARTRAILS_TIMELAPSE_MINFRAMES" : 250,
+        "STARTRAILS_TIMELAPSE_STREAM"    : True,
         "STARTRAILS_SUN_ALT_THOLD"       : -15.0,
         "STARTRAILS_MOONMODE_THOLD"      : True,
         "STARTRAILS_MOON_ALT_THOLD"      : 91.0,
         "STARTRAILS_MOON_PHASE_THOLD"    : 101.0,
         "STARTRAILS_USE_DB_DATA"         : True,
+        "KEOGRAM_STARTRAILS_INCREMENTAL" : False,
+        "FRAME_DECODE_WORKERS"           : 0,  # 0 = automatic
+        "FRAME_DECODE_PREFETCH"          : 4,
         "IMAGE_CALIBRATE_DARK"  : True,
+        "IMAGE_CALIBRATE_CACHE_MB" : 128,
         "IMAGE_EXIF_PRIVACY"    : False,
         "IMAGE_FILE_TYPE" : "jpg",  # jpg, png, or tif
         "IMAGE_FILE_COMPRESSION" : {
@@ -213,9 +220,13 @@ class IndiAllSkyConfigBase(object):
         },
         "IMAGE_EXPIRE_DAYS"     : 30,
         "TIMELAPSE_EXPIRE_DAYS" : 365,
+        "EXPIRE_BATCH_SIZE"     : 500,
+        "EXPIRE_TIME_BUDGET"    : 300,
         "IMAGE_QUEUE_MAX"       : 3,
         "IMAGE_QUEUE_MIN"       : 1,
         "IMAGE_QUEUE_BACKOFF"   : 0.5,
+        "IMAGE_WRITER_QUEUE"    : 3,
+        "IMAGE_SHARED_MEMORY"   : True,
         "FFMPEG_FRAMERATE" : 25,
         "FFMPEG_BITRATE"   : "5000k",
         "FFMPEG_VFSCALE"   : "",
@@ -498,7 +509,25 @@ class IndiAllSkyConfigBase(object):
 
 class IndiAllSkyConfig(IndiAllSkyConfigBase):
 
-    def __init__(self):
+    # process wide cache of the decrypted config, keyed on the config id
+    _cache_lock = threading.Lock()
+    _cache_entry = None  # (config_id, config_level, config)
+
+
+    def __init__(self, cached=False):
+        if cached:
+            config_id, config_level, config = self._getCachedConfig()
+
+            self._config_id = config_id
+            self._config_level = config_level
+            self._config = copy.deepcopy(config)  # callers are allowed to modify the config
+            return
+
+
+        self._loadConfig()
+
+
+    def _loadConfig(self):
         self._config = self.base_config.copy()  # populate initial values
 
         # fetch latest config
@@ -512,6 +541,36 @@ class IndiAllSkyConfig(IndiAllSkyConfigBase):
         self._config = self._decrypt_passwords()
 
 
+    def _getCachedConfig(self):
+        # only the id of the latest config is queried if the cache is current
+        latest_config_id = db.session.query(IndiAllSkyDbConfigTable.id)\
+            .order_by(IndiAllSkyDbConfigTable.createDate.desc())\
+            .limit(1)\
+            .scalar()
+
+        with self._cache_lock:
+            cache_entry = IndiAllSkyConfig._cache_entry
+
+        if cache_entry and cache_entry[0] == latest_config_id:
+            return cache_entry
+
+
+        self._loadConfig()
+
+        cache_entry = (self._config_id, self._config_level, copy.deepcopy(self._config))
+
+        with self._cache_lock:
+            IndiAllSkyConfig._cache_entry = cache_entry
+
+        return cache_entry
+
+
+    @classmethod
+    def clearCache(cls):
+        with cls._cache_lock:
+            cls._cache_entry = None
+
+
     @property
     def config(self):
         return self._config
@@ -583,6 +642,8 @@ class IndiAllSkyConfig(IndiAllSkyConfigBase):
         db.session.add(config_entry)
         db.session.commit()
 
+        self.clearCache()
+
         return config_entry
 
 
@@ -31,6 +31,9 @@ ENDPOINT_V1 = {
     THUMBNAIL       : 'sync/v1/thumbnail',
 }
 
+ENDPOINT_V1_BATCH = 'sync/v1/batch'
+ENDPOINT_V1_CHECK = 'sync/v1/check'
+
 
 # File transfers
 TRANSFER_UPLOAD  = 501
@@ -1057,6 +1057,8 @@ class IndiAllSkyDarks(object):
         dark_frames_all.delete()
         db.session.commit()
 
+        self._miscDb.setCalibrationUpdated()
+
 
 
     def getCcdTemperature(self):
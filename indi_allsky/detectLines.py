@@ -3,6 +3,8 @@ import cv2
 import numpy
 import logging
 
+from .frameAnalysis import IndiAllSkyFrameAnalysis
+
 
 logger = logging.getLogger('indi_allsky')
 
@@ -32,7 +34,7 @@ class IndiAllskyDetectLines(object):
         self._sqm_gradient_mask = None
 
 
-    def detectLines(self, original_img):
+    def detectLines(self, original_img, analysis=None):
         if isinstance(self._sqm_mask, type(None)):
             # This only needs to be done once if a mask is not provided
             self._generateSqmMask(original_img)
@@ -42,16 +44,15 @@ class IndiAllskyDetectLines(object):
             self._generateSqmGradientMask(original_img)
 
 
-        # apply the gradient to the image
-        masked_img = (original_img * self._sqm_gradient_mask).astype(numpy.uint8)
+        if isinstance(analysis, type(None)):
+            analysis = IndiAllSkyFrameAnalysis()
 
-        #cv2.imwrite('/tmp/masked.jpg', masked_img, [cv2.IMWRITE_JPEG_QUALITY, 90])  # debugging
 
+        # apply the gradient to the grayscale image, line detection is the last stage using the full frame
+        img_gray = analysis.takeGray(original_img)
+        cv2.multiply(img_gray, self._sqm_gradient_mask, dst=img_gray, scale=1 / 255)
 
-        if len(original_img.shape) == 2:
-            img_gray = masked_img
-        else:
-            img_gray = cv2.cvtColor(masked_img, cv2.COLOR_BGR2GRAY)
+        #cv2.imwrite('/tmp/masked.jpg', img_gray, [cv2.IMWRITE_JPEG_QUALITY, 90])  # debugging
 
 
 
@@ -140,16 +141,7 @@ class IndiAllskyDetectLines(object):
             )
 
         # blur the mask to prevent mask edges from being detected as lines
-        blur_mask = cv2.blur(self._sqm_mask, (self.mask_blur_kernel_size, self.mask_blur_kernel_size), cv2.BORDER_DEFAULT)
-
-        if len(img.shape) == 2:
-            # mono
-            mask = blur_mask
-        else:
-            # color
-            mask = cv2.cvtColor(blur_mask, cv2.COLOR_GRAY2BGR)
-
-        self._sqm_gradient_mask = (mask / 255).astype(numpy.float32)
+        self._sqm_gradient_mask = cv2.blur(self._sqm_mask, (self.mask_blur_kernel_size, self.mask_blur_kernel_size), cv2.BORDER_DEFAULT)
 
 
     def _drawLines(self, img, lines):
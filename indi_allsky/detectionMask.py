@@ -0,0 +1,291 @@
+import hashlib
+import tempfile
+import threading
+from pathlib import Path
+import cv2
+import numpy
+import logging
+
+from .maskProcessing import MaskProcessor
+
+
+logger = logging.getLogger('indi_allsky')
+
+
+class IndiAllSkyDetectionMask(object):
+    # The detection mask is decoded and transformed once for each mask file, transform
+    # config and binning.  The results are saved as .npy files next to the mask so the
+    # image worker, video worker and web processes memory map the same data instead of
+    # decoding and transforming the image again.
+    #
+    # Masks returned are read only, make a copy before modifying.
+
+    # transformed masks must match the post-processed images
+    transform_keys = (
+        'IMAGE_ROTATE',
+        'IMAGE_ROTATE_ANGLE',
+        'IMAGE_FLIP_V',
+        'IMAGE_FLIP_H',
+        'IMAGE_CROP_ROI',
+        'IMAGE_SCALE',
+    )
+
+    _cache = dict()  # shared by all instances in the process
+    _cache_lock = threading.Lock()
+
+
+    def __init__(self, config, bin_v):
+        self.config = config
+        self.bin_v = bin_v
+
+
+    def load(self, transform=True):
+        # uint8 mask, non-zero values are kept
+        entry = self._getEntry(transform)
+        if not entry:
+            return None
+
+        return entry['mask']
+
+
+    def numpyMask(self, transform=True):
+        # boolean mask for numpy.ma, True values will be masked
+        entry = self._getEntry(transform)
+        if not entry:
+            return None
+
+        return entry['numpy_mask']
+
+
+    def bbox(self, transform=True):
+        # (x1, y1, x2, y2) bounding box of the unmasked area
+        entry = self._getEntry(transform)
+        if not entry:
+            return None
+
+        return entry['bbox']
+
+
+    @classmethod
+    def clearCache(cls):
+        with cls._cache_lock:
+            cls._cache.clear()
+
+
+    def _getEntry(self, transform):
+        detect_mask_p = self._getMaskPath()
+        if not detect_mask_p:
+            return None
+
+
+        try:
+            mask_stat = detect_mask_p.stat()
+        except PermissionError as e:
+            logger.error(str(e))
+            return None
+
+
+        if transform:
+            transform_config = tuple(str(self.config.get(k)) for k in self.transform_keys)
+        else:
+            transform_config = None
+
+
+        cache_key = (
+            str(detect_mask_p),
+            mask_stat.st_mtime_ns,
+            mask_stat.st_size,
+            transform_config,
+            self.bin_v.value,
+        )
+
+
+        with self._cache_lock:
+            entry = self._cache.get(cache_key)
+            if entry:
+                return entry
+
+
+            entry = self._loadEntry(detect_mask_p, cache_key)
+            if not entry:
+                return None
+
+
+            # previous versions of the mask are replaced
+            for k in [k for k in self._cache.keys() if k[0] == cache_key[0] and k[1:3] != cache_key[1:3]]:
+                del self._cache[k]
+
+            self._cache[cache_key] = entry
+
+
+        return entry
+
+
+    def _getMaskPath(self):
+        detect_mask = self.config.get('DETECT_MASK', '')
+
+        if not detect_mask:
+            logger.warning('No detection mask defined')
+            return None
+
+
+        detect_mask_p = Path(detect_mask)
+
+        try:
+            if not detect_mask_p.exists():
+                logger.error('%s does not exist', detect_mask_p)
+                return None
+
+
+            if not detect_mask_p.is_file():
+                logger.error('%s is not a file', detect_mask_p)
+                return None
+
+        except PermissionError as e:
+            logger.error(str(e))
+            return None
+
+
+        return detect_mask_p
+
+
+    def _loadEntry(self, detect_mask_p, cache_key):
+        key_hash = hashlib.md5(repr(cache_key).encode()).hexdigest()
+
+        mask_cache_p = detect_mask_p.parent.joinpath('.{0:s}.{1:s}.npy'.format(detect_mask_p.name, key_hash))
+        numpy_mask_cache_p = detect_mask_p.parent.joinpath('.{0:s}.{1:s}.bool.npy'.format(detect_mask_p.name, key_hash))
+
+
+        try:
+            mask_data = numpy.load(str(mask_cache_p), mmap_mode='r')
+            numpy_mask = numpy.load(str(numpy_mask_cache_p), mmap_mode='r')
+
+            logger.info('Loaded detection mask: %s (%s)', detect_mask_p, mask_cache_p.name)
+        except FileNotFoundError:
+            mask_data, numpy_mask = self._buildMask(detect_mask_p, bool(cache_key[3]))
+            if isinstance(mask_data, type(None)):
+                return None
+
+            self._saveMask(detect_mask_p, mask_cache_p, mask_data)
+            self._saveMask(detect_mask_p, numpy_mask_cache_p, numpy_mask)
+        except (OSError, ValueError) as e:
+            logger.error('Unable to load mask cache %s: %s', mask_cache_p, str(e))
+
+            mask_data, numpy_mask = self._buildMask(detect_mask_p, bool(cache_key[3]))
+            if isinstance(mask_data, type(None)):
+                return None
+
+
+        bbox = cv2.boundingRect(numpy.asarray(mask_data))
+        if bbox[2] and bbox[3]:
+            bbox = (bbox[0], bbox[1], bbox[0] + bbox[2], bbox[1] + bbox[3])
+        else:
+            # everything is masked
+            bbox = (0, 0, 0, 0)
+
+
+        return {
+            'mask'       : mask_data,
+            'numpy_mask' : numpy_mask,
+            'bbox'       : bbox,
+        }
+
+
+    def _buildMask(self, detect_mask_p, transform):
+        mask_data = cv2.imread(str(detect_mask_p), cv2.IMREAD_GRAYSCALE)  # mono
+        if isinstance(mask_data, type(None)):
+            logger.error('%s is not a valid image', detect_mask_p)
+            return None, None
+
+
+        logger.info('Loaded detection mask: %s', detect_mask_p)
+
+        ### any compression artifacts will be set to black
+        #mask_data[mask_data < 255] = 0  # did not quite work
+
+
+        if transform:
+            mask_processor = MaskProcessor(
+                self.config,
+                self.bin_v,
+            )
+
+
+            # masks need to be rotated, flipped, cropped for post-processed images
+            mask_processor.image = mask_data
+
+
+            if self.config.get('IMAGE_ROTATE'):
+                mask_processor.rotate_90()
+
+
+            # rotation
+            if self.config.get('IMAGE_ROTATE_ANGLE'):
+                mask_processor.rotate_angle()
+
+
+            # verticle flip
+            if self.config.get('IMAGE_FLIP_V'):
+                mask_processor.flip_v()
+
+
+            # horizontal flip
+            if self.config.get('IMAGE_FLIP_H'):
+                mask_processor.flip_h()
+
+
+            # crop
+            if self.config.get('IMAGE_CROP_ROI'):
+                mask_processor.crop_image()
+
+
+            # scale
+            if self.config.get('IMAGE_SCALE') and self.config['IMAGE_SCALE'] != 100:
+                mask_processor.scale_image()
+
+
+            mask_data = numpy.ascontiguousarray(mask_processor.image)
+
+
+        # True values will be masked
+        numpy_mask = mask_data == 0
+
+        mask_data.flags.writeable = False
+        numpy_mask.flags.writeable = False
+
+        return mask_data, numpy_mask
+
+
+    def _saveMask(self, detect_mask_p, cache_p, data):
+        tmp_p = None
+
+        try:
+            with tempfile.NamedTemporaryFile(dir=str(cache_p.parent), prefix='.', suffix='.tmp', delete=False) as f_tmp:
+                tmp_p = Path(f_tmp.name)
+                numpy.save(f_tmp, data)
+
+            tmp_p.chmod(0o644)
+            tmp_p.replace(cache_p)
+        except OSError as e:
+            # not fatal, the mask is kept in memory
+            logger.warning('Unable to save mask cache %s: %s', cache_p, str(e))
+
+            if tmp_p:
+                try:
+                    tmp_p.unlink()
+                except OSError:
+                    pass
+
+            return
+
+
+        # remove cache files from older versions of the mask
+        mask_mtime = detect_mask_p.stat().st_mtime
+
+        for old_p in detect_mask_p.parent.glob('.{0:s}.*.npy'.format(detect_mask_p.name)):
+            try:
+                if old_p.stat().st_mtime < mask_mtime:
+                    logger.info('Removing old mask cache: %s', old_p)
+                    old_p.unlink()
+            except OSError:
+                pass
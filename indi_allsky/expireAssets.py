@@ -0,0 +1,202 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+import logging
+
+from .flask import db
+
+from .flask.models import IndiAllSkyDbFileBase
+from .flask.models import IndiAllSkyDbThumbnailTable
+
+from sqlalchemy.orm.attributes import InstrumentedAttribute
+
+
+logger = logging.getLogger('indi_allsky')
+
+
+class IndiAllSkyExpireAssets(object):
+    # Expired entries are deleted in batches.  Files (and thumbnails) are removed by a
+    # small thread pool, then the rows for the batch are deleted with a single statement
+    # per table in one transaction.  The DB is only locked for the duration of the
+    # delete statements, not while files are removed.
+    #
+    # A pass stops when the time budget is exhausted, the remaining entries are expired
+    # by the next pass.
+
+    unlink_threads = 4
+
+
+    def __init__(self, config, time_budget=None):
+        self.config = config
+
+        self._batch_size = max(int(self.config.get('EXPIRE_BATCH_SIZE', 500)), 1)
+
+        if isinstance(time_budget, type(None)):
+            self._time_budget = int(self.config.get('EXPIRE_TIME_BUDGET', 300))
+        else:
+            self._time_budget = int(time_budget)
+
+        self._start_time = time.time()
+
+        self._complete = True
+        self._stopped = False
+
+        self._deleted = 0
+        self._failed = 0
+
+
+    @property
+    def complete(self):
+        # False if the pass was stopped by the time budget
+        return self._complete
+
+    @complete.setter
+    def complete(self, *args):
+        pass  # read only
+
+
+    @property
+    def deleted(self):
+        return self._deleted
+
+    @deleted.setter
+    def deleted(self, *args):
+        pass  # read only
+
+
+    @property
+    def failed(self):
+        return self._failed
+
+    @failed.setter
+    def failed(self, *args):
+        pass  # read only
+
+
+    def stop(self):
+        # the current batch is finished before stopping
+        self._stopped = True
+
+
+    def expire(self, table, *filters):
+        # Returns the number of entries deleted and the newest createDate deleted
+
+        # the thumbnail table has a virtual thumbnail_uuid property
+        has_thumbnails = isinstance(getattr(table, 'thumbnail_uuid', None), InstrumentedAttribute)
+
+        table_deleted = 0
+        max_createDate = None
+        last_id = 0
+
+
+        with ThreadPoolExecutor(max_workers=self.unlink_threads, thread_name_prefix='ExpireAssets') as executor:
+            while True:
+                if self._stopped:
+                    self._complete = False
+                    break
+
+
+                if self._time_budget and time.time() - self._start_time > self._time_budget:
+                    logger.warning('Expiration time budget exceeded (%ds), continuing next pass', self._time_budget)
+                    self._complete = False
+                    break
+
+
+                if has_thumbnails:
+                    batch_query = db.session.query(
+                        table.id,
+                        table.filename,
+                        table.createDate,
+                        IndiAllSkyDbThumbnailTable.id.label('thumbnail_id'),
+                        IndiAllSkyDbThumbnailTable.filename.label('thumbnail_filename'),
+                    )\
+                        .outerjoin(IndiAllSkyDbThumbnailTable, table.thumbnail_uuid == IndiAllSkyDbThumbnailTable.uuid)
+                else:
+                    batch_query = db.session.query(
+                        table.id,
+                        table.filename,
+                        table.createDate,
+                    )
+
+
+                # keyset pagination skips entries that could not be removed
+                batch = batch_query\
+                    .filter(table.id > last_id)\
+                    .filter(*filters)\
+                    .order_by(table.id.asc())\
+                    .limit(self._batch_size)\
+                    .all()
+
+                # end the read transaction before removing files
+                db.session.commit()
+
+                if not batch:
+                    break
+
+                last_id = batch[-1].id
+
+
+                batch_start = time.time()
+
+                # paths are resolved here, the app context is not available in the pool threads
+                file_list = list()
+                for entry in batch:
+                    if has_thumbnails and entry.thumbnail_filename:
+                        # thumbnails are removed before the entry
+                        file_list.append((IndiAllSkyDbFileBase.filesystemPath(entry.thumbnail_filename), IndiAllSkyDbFileBase.filesystemPath(entry.filename)))
+                    else:
+                        file_list.append((IndiAllSkyDbFileBase.filesystemPath(entry.filename),))
+
+                results = executor.map(self._unlinkFiles, file_list)
+
+                delete_id_list = list()
+                delete_thumbnail_id_list = list()
+                for entry, success in zip(batch, results):
+                    if not success:
+                        self._failed += 1
+                        continue
+
+                    delete_id_list.append(entry.id)
+
+                    if has_thumbnails and entry.thumbnail_id:
+                        delete_thumbnail_id_list.append(entry.thumbnail_id)
+
+                    if isinstance(max_createDate, type(None)) or entry.createDate > max_createDate:
+                        max_createDate = entry.createDate
+
+
+                if delete_thumbnail_id_list:
+                    db.session.query(IndiAllSkyDbThumbnailTable)\
+                        .filter(IndiAllSkyDbThumbnailTable.id.in_(delete_thumbnail_id_list))\
+                        .delete(synchronize_session=False)
+
+                if delete_id_list:
+                    db.session.query(table)\
+                        .filter(table.id.in_(delete_id_list))\
+                        .delete(synchronize_session=False)
+
+                db.session.commit()
+
+
+                table_deleted += len(delete_id_list)
+
+                batch_elapsed_s = time.time() - batch_start
+                logger.info('Removed %d old %s entries in %0.4f s', len(delete_id_list), table.__name__, batch_elapsed_s)
+
+
+        self._deleted += table_deleted
+
+        return table_deleted, max_createDate
+
+
+    def _unlinkFiles(self, file_list):
+        try:
+            for filename_p in file_list:
+                try:
+                    filename_p.unlink()
+                except FileNotFoundError:
+                    pass
+        except OSError as e:
+            logger.error('Cannot remove file: %s', str(e))
+            return False
+
+        return True
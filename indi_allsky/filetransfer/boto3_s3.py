@@ -15,9 +15,15 @@ logger = logging.getLogger('indi_allsky')
 
 
 class boto3_s3(GenericFileTransfer):
+
+    # the client keeps a pool of https connections
+    reusable = True
+
+
     def __init__(self, *args, **kwargs):
         super(boto3_s3, self).__init__(*args, **kwargs)
 
+        self.client = None
         self._port = 443
 
 
@@ -63,7 +69,12 @@ class boto3_s3(GenericFileTransfer):
     def close(self):
         super(boto3_s3, self).close()
 
-        self.client.close()
+        if self.client:
+            self.client.close()
+
+
+    def alive(self):
+        return bool(self.client)
 
 
     def put(self, *args, **kwargs):
@@ -16,3 +16,7 @@ class PermissionFailure(Exception):
 
 class CertificateValidationFailure(Exception):
     pass
+
+
+class BatchNotSupported(TransferFailure):
+    pass
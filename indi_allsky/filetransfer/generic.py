@@ -5,6 +5,11 @@ logger = logging.getLogger('indi_allsky')
 
 
 class GenericFileTransfer(object):
+
+    # clients that can stay connected between transfers
+    reusable = False
+
+
     def __init__(self, *args, **kwargs):
         self.config = args[0]
         self.delete = kwargs.get('delete', False)
@@ -56,6 +61,11 @@ class GenericFileTransfer(object):
         pass
 
 
+    def alive(self):
+        # health check before a connected client is reused
+        return False
+
+
     def put(self, *args, **kwargs):
         if self.delete:
             # perform delete instead of upload
@@ -6,6 +6,7 @@ from .exceptions import ConnectionFailure
 from pathlib import Path
 import ssl
 import io
+import threading
 import socket
 import time
 import logging
@@ -14,20 +15,27 @@ logger = logging.getLogger('indi_allsky')
 
 
 class paho_mqtt(GenericFileTransfer):
+
+    # the broker connection is kept open between transfers
+    reusable = True
+
+
     def __init__(self, *args, **kwargs):
         super(paho_mqtt, self).__init__(*args, **kwargs)
 
+        self.client = None
         self._port = 1883
 
-        self.mq_transport = None
-        self.mq_hostname = None
-        self.mq_auth = None
-        self.mq_tls = None
+        self._connected = threading.Event()
+        self._connect_rc = None
 
 
     def connect(self, *args, **kwargs):
         super(paho_mqtt, self).connect(*args, **kwargs)
 
+        import paho.mqtt.client as mqtt
+
+
         transport = kwargs['transport']
         hostname = kwargs['hostname']
         username = kwargs['username']
@@ -36,39 +44,82 @@ class paho_mqtt(GenericFileTransfer):
         cert_bypass = kwargs.get('cert_bypass')
 
 
-        self.mq_transport = transport
-        self.mq_hostname = hostname
+        self.client = mqtt.Client(
+            mqtt.CallbackAPIVersion.VERSION2,
+            client_id='',
+            transport=transport,
+        )
+        self.client.connect_timeout = self.connect_timeout
+        self.client.on_connect = self._on_connect
+        self.client.on_disconnect = self._on_disconnect
 
-        if tls:
-            self.mq_tls = {
-                'ca_certs'    : '/etc/ssl/certs/ca-certificates.crt',
-                'cert_reqs'   : ssl.CERT_REQUIRED,
-                'insecure'    : False,
-            }
 
+        if tls:
             if cert_bypass:
-                self.mq_tls['cert_reqs'] = ssl.CERT_NONE
-                self.mq_tls['insecure'] = True
-
+                self.client.tls_set(ca_certs='/etc/ssl/certs/ca-certificates.crt', cert_reqs=ssl.CERT_NONE)
+                self.client.tls_insecure_set(True)
+            else:
+                self.client.tls_set(ca_certs='/etc/ssl/certs/ca-certificates.crt', cert_reqs=ssl.CERT_REQUIRED)
 
 
         if username:
-            self.mq_auth = {
-                'username' : username,
-                'password' : password,
-            }
+            self.client.username_pw_set(username, password=password)
+
+
+        self._connected.clear()
+        self._connect_rc = None
+
+        try:
+            self.client.connect(hostname, port=self._port, keepalive=60)
+        except socket.gaierror as e:
+            raise ConnectionFailure(str(e)) from e
+        except socket.timeout as e:
+            raise ConnectionFailure(str(e)) from e
+        except ssl.SSLCertVerificationError as e:
+            raise ConnectionFailure(str(e)) from e
+        except ConnectionRefusedError as e:
+            raise ConnectionFailure(str(e)) from e
+        except OSError as e:
+            raise ConnectionFailure(str(e)) from e
+
+        self.client.loop_start()
+
+
+        # wait for the broker to accept the connection
+        if not self._connected.wait(timeout=self.connect_timeout):
+            raise ConnectionFailure('Timeout waiting for MQTT broker')
+
+        if self._connect_rc.is_failure:
+            raise AuthenticationFailure(str(self._connect_rc))
+
+
+    def _on_connect(self, client, userdata, flags, reason_code, properties):
+        self._connect_rc = reason_code
+        self._connected.set()
+
+
+    def _on_disconnect(self, client, userdata, flags, reason_code, properties):
+        if reason_code.is_failure:
+            logger.warning('MQTT broker disconnected: %s', str(reason_code))
 
 
     def close(self):
         super(paho_mqtt, self).close()
 
+        if self.client:
+            self.client.disconnect()
+            self.client.loop_stop()
 
-    def put(self, *args, **kwargs):
-        super(paho_mqtt, self).put(*args, **kwargs)
 
-        import paho.mqtt.publish as publish
-        from paho.mqtt import MQTTException
+    def alive(self):
+        if not self.client:
+            return False
 
+        return self.client.is_connected()
+
+
+    def put(self, *args, **kwargs):
+        super(paho_mqtt, self).put(*args, **kwargs)
 
         local_file = kwargs['local_file']
         base_topic = kwargs['base_topic']
@@ -104,27 +155,31 @@ class paho_mqtt(GenericFileTransfer):
 
         start = time.time()
 
-        try:
-            publish.multiple(
-                message_list,
-                transport=self.mq_transport,
-                hostname=self.mq_hostname,
-                port=self._port,
-                client_id='',
-                keepalive=60,
-                auth=self.mq_auth,
-                tls=self.mq_tls,
+        info_list = list()
+        for message in message_list:
+            info = self.client.publish(
+                message['topic'],
+                payload=message['payload'],
+                qos=message['qos'],
+                retain=message['retain'],
             )
-        except socket.gaierror as e:
-            raise ConnectionFailure(str(e)) from e
-        except socket.timeout as e:
-            raise ConnectionFailure(str(e)) from e
-        except ssl.SSLCertVerificationError as e:
-            raise ConnectionFailure(str(e)) from e
-        except ConnectionRefusedError as e:
-            raise ConnectionFailure(str(e)) from e
-        except MQTTException as e:
-            raise AuthenticationFailure(str(e)) from e
+
+            if info.rc != 0:
+                raise ConnectionFailure('MQTT publish failed: {0:d}'.format(info.rc))
+
+            info_list.append(info)
+
+
+        # wait for all messages to be sent
+        publish_timeout = start + self.timeout
+        for info in info_list:
+            try:
+                info.wait_for_publish(timeout=max(publish_timeout - time.time(), 0.1))
+            except (ValueError, RuntimeError) as e:
+                raise ConnectionFailure(str(e)) from e
+
+            if not info.is_published():
+                raise ConnectionFailure('Timeout publishing MQTT messages')
 
         upload_elapsed_s = time.time() - start
         local_file_size = local_file_p.stat().st_size
@@ -12,6 +12,10 @@ logger = logging.getLogger('indi_allsky')
 
 
 class paramiko_sftp(GenericFileTransfer):
+
+    reusable = True
+
+
     def __init__(self, *args, **kwargs):
         super(paramiko_sftp, self).__init__(*args, **kwargs)
 
@@ -82,6 +86,25 @@ class paramiko_sftp(GenericFileTransfer):
             self.client.close()
 
 
+    def alive(self):
+        import paramiko
+
+
+        if not self.client or not self.sftp:
+            return False
+
+        transport = self.client.get_transport()
+        if not transport or not transport.is_active():
+            return False
+
+        try:
+            transport.send_ignore()
+        except (paramiko.ssh_exception.SSHException, OSError, EOFError):
+            return False
+
+        return True
+
+
     def put(self, *args, **kwargs):
         super(paramiko_sftp, self).put(*args, **kwargs)
 
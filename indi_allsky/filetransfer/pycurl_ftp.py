@@ -13,6 +13,11 @@ logger = logging.getLogger('indi_allsky')
 
 
 class pycurl_ftp(GenericFileTransfer):
+
+    # connections are cached by the curl handle
+    reusable = True
+
+
     def __init__(self, *args, **kwargs):
         super(pycurl_ftp, self).__init__(*args, **kwargs)
 
@@ -76,6 +81,10 @@ class pycurl_ftp(GenericFileTransfer):
             self.client.close()
 
 
+    def alive(self):
+        return bool(self.client)
+
+
     def put(self, *args, **kwargs):
         super(pycurl_ftp, self).put(*args, **kwargs)
 
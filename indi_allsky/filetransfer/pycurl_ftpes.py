@@ -14,6 +14,11 @@ logger = logging.getLogger('indi_allsky')
 
 
 class pycurl_ftpes(GenericFileTransfer):
+
+    # connections are cached by the curl handle
+    reusable = True
+
+
     def __init__(self, *args, **kwargs):
         super(pycurl_ftpes, self).__init__(*args, **kwargs)
 
@@ -86,6 +91,10 @@ class pycurl_ftpes(GenericFileTransfer):
             self.client.close()
 
 
+    def alive(self):
+        return bool(self.client)
+
+
     def put(self, *args, **kwargs):
         super(pycurl_ftpes, self).put(*args, **kwargs)
 
@@ -14,6 +14,11 @@ logger = logging.getLogger('indi_allsky')
 
 
 class pycurl_ftps(GenericFileTransfer):
+
+    # connections are cached by the curl handle
+    reusable = True
+
+
     def __init__(self, *args, **kwargs):
         super(pycurl_ftps, self).__init__(*args, **kwargs)
 
@@ -83,6 +88,10 @@ class pycurl_ftps(GenericFileTransfer):
             self.client.close()
 
 
+    def alive(self):
+        return bool(self.client)
+
+
     def put(self, *args, **kwargs):
         super(pycurl_ftps, self).put(*args, **kwargs)
 
@@ -14,6 +14,11 @@ logger = logging.getLogger('indi_allsky')
 
 
 class pycurl_sftp(GenericFileTransfer):
+
+    # connections are cached by the curl handle
+    reusable = True
+
+
     def __init__(self, *args, **kwargs):
         super(pycurl_sftp, self).__init__(*args, **kwargs)
 
@@ -100,6 +105,10 @@ class pycurl_sftp(GenericFileTransfer):
             self.client.close()
 
 
+    def alive(self):
+        return bool(self.client)
+
+
     def put(self, *args, **kwargs):
         super(pycurl_sftp, self).put(*args, **kwargs)
 
@@ -14,6 +14,11 @@ logger = logging.getLogger('indi_allsky')
 
 
 class pycurl_webdav_https(GenericFileTransfer):
+
+    # connections are cached by the curl handle
+    reusable = True
+
+
     def __init__(self, *args, **kwargs):
         super(pycurl_webdav_https, self).__init__(*args, **kwargs)
 
@@ -87,6 +92,10 @@ class pycurl_webdav_https(GenericFileTransfer):
             self.client.close()
 
 
+    def alive(self):
+        return bool(self.client)
+
+
     def put(self, *args, **kwargs):
         super(pycurl_webdav_https, self).put(*args, **kwargs)
 
@@ -15,6 +15,10 @@ logger = logging.getLogger('indi_allsky')
 
 
 class python_ftpes(GenericFileTransfer):
+
+    reusable = True
+
+
     def __init__(self, *args, **kwargs):
         super(python_ftpes, self).__init__(*args, **kwargs)
 
@@ -57,7 +61,23 @@ class python_ftpes(GenericFileTransfer):
         super(python_ftpes, self).close()
 
         if self.client:
-            self.client.quit()
+            try:
+                self.client.quit()
+            except ftplib.all_errors:
+                # connection already closed by the server
+                self.client.close()
+
+
+    def alive(self):
+        if not self.client:
+            return False
+
+        try:
+            self.client.voidcmd('NOOP')
+        except ftplib.all_errors:
+            return False
+
+        return True
 
 
     def put(self, *args, **kwargs):
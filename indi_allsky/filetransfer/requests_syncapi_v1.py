@@ -3,6 +3,7 @@ from .generic import GenericFileTransfer
 from .exceptions import ConnectionFailure
 from .exceptions import CertificateValidationFailure
 from .exceptions import TransferFailure
+from .exceptions import BatchNotSupported
 #from .exceptions import PermissionFailure
 
 from pathlib import Path
@@ -27,24 +28,31 @@ logger = logging.getLogger('indi_allsky')
 
 class requests_syncapi_v1(GenericFileTransfer):
 
+    # the session keeps the https connection open between transfers
+    reusable = True
+
     time_skew = 300  # number of seconds the client is allowed to deviate from server
 
+    chunk_size = 1048576
+
 
     def __init__(self, *args, **kwargs):
         super(requests_syncapi_v1, self).__init__(*args, **kwargs)
 
         self.client = None
         self._port = 443
-        self.url = None
+        self.base_url = None
         self.apikey = None
 
+        self._check_supported = True  # older servers cannot check for existing files
+
 
     def connect(self, *args, **kwargs):
         super(requests_syncapi_v1, self).connect(*args, **kwargs)
 
         ### The full connect and transfer happens under the put() function
 
-        endpoint_url = kwargs['hostname']
+        base_url = kwargs['hostname']
         self.username = kwargs['username']
         self.apikey = kwargs['apikey']
         cert_bypass = kwargs.get('cert_bypass')
@@ -56,10 +64,10 @@ class requests_syncapi_v1(GenericFileTransfer):
             self.verify = True
 
 
-        self.url = endpoint_url
+        self.base_url = base_url.rstrip('/')
 
 
-        self.client = requests
+        self.client = requests.Session()
 
 
         if cert_bypass:
@@ -70,35 +78,40 @@ class requests_syncapi_v1(GenericFileTransfer):
     def close(self):
         super(requests_syncapi_v1, self).close()
 
+        if self.client:
+            self.client.close()
+
+
+    def alive(self):
+        return bool(self.client)
+
 
     def put(self, *args, **kwargs):
         super(requests_syncapi_v1, self).put(*args, **kwargs)
 
+        endpoint = kwargs['endpoint']
         metadata = kwargs['metadata']
         local_file = kwargs['local_file']
         empty_file = kwargs['empty_file']
 
 
-        #logger.info('requests URL: %s', self.url)
+        url = '{0:s}/{1:s}'.format(self.base_url, endpoint)
+        #logger.info('requests URL: %s', url)
 
-        # cameras do not have files
-        if str(local_file) == 'camera':
-            local_file_p = Path('bogus.ext')
-            local_file_size = 1024  # fake
-            f_media = io.BytesIO(b'')  # no data
-            metadata['file_size'] = 0
-        else:
-            # all other entry types
-            local_file_p = Path(local_file)
 
-            if not empty_file:
-                local_file_size = local_file_p.stat().st_size
-                metadata['file_size'] = local_file_size  # needed to validate
-                f_media = io.open(str(local_file_p), 'rb')
-            else:
-                local_file_size = 1024  # fake
-                f_media = io.BytesIO(b'')  # no data
-                metadata['file_size'] = 0
+        check_endpoint = kwargs.get('check_endpoint')
+        if check_endpoint and not empty_file and str(local_file) != 'camera':
+            check_list = self._check(check_endpoint, [{'type' : metadata['type'], 'metadata' : metadata, 'local_file' : local_file}])
+
+            if check_list and check_list[0].get('exists'):
+                logger.info('Server already has %s, skipping upload', Path(local_file).name)
+                return {
+                    'id'  : check_list[0]['id'],
+                    'url' : check_list[0]['url'],
+                }
+
+
+        local_file_p, local_file_size, f_media = self._openMedia(local_file, metadata, empty_file)
 
 
         json_metadata = json.dumps(metadata)
@@ -122,21 +135,8 @@ class requests_syncapi_v1(GenericFileTransfer):
         mp_enc = MultipartEncoder(fields=fields)
 
 
-        time_floor = math.floor(time.time() / self.time_skew)
-
-        # data is received as bytes
-        hmac_message = str(time_floor).encode() + json_metadata.encode()
-
-        message_hmac = hmac.new(
-            self.apikey.encode(),
-            msg=hmac_message,
-            digestmod=hashlib.sha3_512,
-        ).hexdigest()
-
-
         headers = {
-            'Authorization' : 'Bearer {0:s}:{1:s}'.format(self.username, message_hmac),
-            'Connection'    : 'close',  # no need for keep alives
+            'Authorization' : self._authorization(json_metadata),
             'Content-Type'  : mp_enc.content_type,
         }
 
@@ -146,7 +146,7 @@ class requests_syncapi_v1(GenericFileTransfer):
         try:
             # put allows overwrites
             r = self.client.put(
-                self.url,
+                url,
                 data=mp_enc,
                 headers=headers,
                 verify=self.verify,
@@ -181,3 +181,263 @@ class requests_syncapi_v1(GenericFileTransfer):
 
         return json.loads(r.text)
 
+
+    def putBatch(self, *args, **kwargs):
+        # Upload multiple entries with a single request, returns the results for each item
+        item_list = kwargs['item_list']  # list of dicts with type, metadata, and local_file
+        empty_file = kwargs['empty_file']
+
+
+        url = '{0:s}/{1:s}'.format(self.base_url, kwargs['endpoint'])
+
+
+        result_list = [None] * len(item_list)
+
+        check_endpoint = kwargs.get('check_endpoint')
+        if check_endpoint and not empty_file:
+            check_list = self._check(check_endpoint, item_list)
+
+            if check_list:
+                for i, check in enumerate(check_list):
+                    if check.get('exists'):
+                        result_list[i] = {
+                            'id'  : check['id'],
+                            'url' : check['url'],
+                        }
+
+
+        upload_index_list = [i for i, result in enumerate(result_list) if not result]
+
+        if len(upload_index_list) < len(item_list):
+            logger.info('Server already has %d of %d entries, skipping upload', len(item_list) - len(upload_index_list), len(item_list))
+
+        if not upload_index_list:
+            return result_list
+
+
+        logger.info('Uploading %d entries in batch', len(upload_index_list))
+
+        fields = dict()
+        batch_items = list()
+        batch_size = 0
+
+        for i in upload_index_list:
+            item = item_list[i]
+
+            local_file_p, local_file_size, f_media = self._openMedia(item['local_file'], item['metadata'], empty_file)
+
+            media_name = 'media_{0:d}'.format(i)
+
+            fields[media_name] = (
+                local_file_p.name,  # need file extension from original file
+                f_media,
+                'application/octet-stream',
+            )
+
+            batch_items.append({
+                'type'     : item['type'],
+                'metadata' : item['metadata'],
+                'media'    : media_name,
+            })
+
+            batch_size += local_file_size
+
+
+        json_metadata = json.dumps({'items' : batch_items})
+        f_metadata = io.StringIO(json_metadata)
+
+        fields['metadata'] = (
+            'metadata.json',
+            f_metadata,
+            'application/json',
+        )
+
+
+        mp_enc = MultipartEncoder(fields=fields)
+
+        headers = {
+            'Authorization' : self._authorization(json_metadata),
+            'Content-Type'  : mp_enc.content_type,
+        }
+
+
+        start = time.time()
+
+        try:
+            r = self.client.put(
+                url,
+                data=mp_enc,
+                headers=headers,
+                verify=self.verify,
+                timeout=(self.connect_timeout, self.timeout)
+            )
+        except socket.gaierror as e:
+            raise ConnectionFailure(str(e)) from e
+        except socket.timeout as e:
+            raise ConnectionFailure(str(e)) from e
+        except requests.exceptions.ConnectTimeout as e:
+            raise ConnectionFailure(str(e)) from e
+        except requests.exceptions.ConnectionError as e:
+            raise ConnectionFailure(str(e)) from e
+        except requests.exceptions.ReadTimeout as e:
+            raise ConnectionFailure(str(e)) from e
+        except ssl.SSLCertVerificationError as e:
+            raise CertificateValidationFailure(str(e)) from e
+        except requests.exceptions.SSLError as e:
+            raise CertificateValidationFailure(str(e)) from e
+        finally:
+            for field in fields.values():
+                field[1].close()  # media and metadata
+
+
+        if r.status_code in (404, 405):
+            # older servers do not have the batch endpoint
+            raise BatchNotSupported('Sync batch endpoint not available: {0:d}'.format(r.status_code))
+
+        if r.status_code >= 400:
+            raise TransferFailure('Sync error: {0:d}'.format(r.status_code))
+
+
+        upload_elapsed_s = time.time() - start
+        logger.info('Batch transferred in %0.4f s (%0.2f kB/s)', upload_elapsed_s, batch_size / upload_elapsed_s / 1024)
+
+
+        for i, result in zip(upload_index_list, json.loads(r.text)['results']):
+            result_list[i] = result
+
+
+        return result_list
+
+
+    def _check(self, endpoint, item_list):
+        # Sends the size and hash of the files, the server reports which files it already has.
+        # Returns the results for each item, or None if the server cannot check files.
+        if not self._check_supported:
+            return None
+
+
+        url = '{0:s}/{1:s}'.format(self.base_url, endpoint)
+
+        check_items = list()
+        for item in item_list:
+            local_file_p = Path(item['local_file'])
+
+            item['metadata']['file_size'] = local_file_p.stat().st_size
+            item['metadata']['sha256'] = self._fileDigest(local_file_p)  # verified by the server on upload
+
+            check_items.append({
+                'type'     : item['type'],
+                'metadata' : item['metadata'],
+                'suffix'   : local_file_p.suffix,
+            })
+
+
+        json_metadata = json.dumps({'items' : check_items})
+        f_metadata = io.StringIO(json_metadata)
+
+        mp_enc = MultipartEncoder(fields={
+            'metadata' : (
+                'metadata.json',
+                f_metadata,
+                'application/json',
+            ),
+        })
+
+        headers = {
+            'Authorization' : self._authorization(json_metadata),
+            'Content-Type'  : mp_enc.content_type,
+        }
+
+
+        try:
+            r = self.client.post(
+                url,
+                data=mp_enc,
+                headers=headers,
+                verify=self.verify,
+                timeout=(self.connect_timeout, self.timeout)
+            )
+        except socket.gaierror as e:
+            raise ConnectionFailure(str(e)) from e
+        except socket.timeout as e:
+            raise ConnectionFailure(str(e)) from e
+        except requests.exceptions.ConnectTimeout as e:
+            raise ConnectionFailure(str(e)) from e
+        except requests.exceptions.ConnectionError as e:
+            raise ConnectionFailure(str(e)) from e
+        except requests.exceptions.ReadTimeout as e:
+            raise ConnectionFailure(str(e)) from e
+        except ssl.SSLCertVerificationError as e:
+            raise CertificateValidationFailure(str(e)) from e
+        except requests.exceptions.SSLError as e:
+            raise CertificateValidationFailure(str(e)) from e
+        finally:
+            f_metadata.close()
+
+
+        if r.status_code in (404, 405):
+            logger.warning('Sync server cannot check for existing files: %d', r.status_code)
+            self._check_supported = False
+            return None
+
+        if r.status_code >= 400:
+            raise TransferFailure('Sync error: {0:d}'.format(r.status_code))
+
+
+        return json.loads(r.text)['results']
+
+
+    def _fileDigest(self, local_file_p):
+        file_hash = hashlib.sha256()
+
+        with io.open(str(local_file_p), 'rb') as f_file:
+            while True:
+                chunk = f_file.read(self.chunk_size)
+                if not chunk:
+                    break
+
+                file_hash.update(chunk)
+
+
+        return file_hash.hexdigest()
+
+
+    def _openMedia(self, local_file, metadata, empty_file):
+        # cameras do not have files
+        if str(local_file) == 'camera':
+            local_file_p = Path('bogus.ext')
+            local_file_size = 1024  # fake
+            f_media = io.BytesIO(b'')  # no data
+            metadata['file_size'] = 0
+        else:
+            # all other entry types
+            local_file_p = Path(local_file)
+
+            if not empty_file:
+                local_file_size = local_file_p.stat().st_size
+                metadata['file_size'] = local_file_size  # needed to validate
+                f_media = io.open(str(local_file_p), 'rb')
+            else:
+                local_file_size = 1024  # fake
+                f_media = io.BytesIO(b'')  # no data
+                metadata['file_size'] = 0
+
+
+        return local_file_p, local_file_size, f_media
+
+
+    def _authorization(self, json_metadata):
+        time_floor = math.floor(time.time() / self.time_skew)
+
+        # data is received as bytes
+        hmac_message = str(time_floor).encode() + json_metadata.encode()
+
+        message_hmac = hmac.new(
+            self.apikey.encode(),
+            msg=hmac_message,
+            digestmod=hashlib.sha3_512,
+        ).hexdigest()
+
+
+        return 'Bearer {0:s}:{1:s}'.format(self.username, message_hmac)
+
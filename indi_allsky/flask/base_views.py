@@ -44,12 +44,17 @@ from .miscDb import miscDb
 class BaseView(View):
     decorators = [login_optional]  # auth based on app.config['INDI_ALLSKY_AUTH_ALL_VIEWS']
 
+    # sun set dates are shared between requests
+    _sun_set_cache = dict()
+
+
     def __init__(self, **kwargs):
         super(BaseView, self).__init__(**kwargs)
         from ..config import IndiAllSkyConfig  # prevent circular import
 
         # not catching exception
-        self._indi_allsky_config_obj = IndiAllSkyConfig()
+        # the decrypted config is cached until a new config is saved
+        self._indi_allsky_config_obj = IndiAllSkyConfig(cached=True)
 
         self.indi_allsky_config = self._indi_allsky_config_obj.config
 
@@ -198,6 +203,19 @@ class BaseView(View):
             elevation = 0
 
 
+        # the next sun set does not change until it has passed
+        cache_key = (self.camera.id, latitude, longitude, elevation, self.camera.nightSunAlt)
+
+        try:
+            sun_set_date, expire_date = self._sun_set_cache[cache_key]
+
+            if utcnow.replace(tzinfo=None) < expire_date:
+                self.sun_set_date = sun_set_date
+                return
+        except KeyError:
+            pass
+
+
         obs = ephem.Observer()
         obs.lon = math.radians(longitude)
         obs.lat = math.radians(latitude)
@@ -225,88 +243,23 @@ class BaseView(View):
             self.sun_set_date = None
 
 
-    def _load_detection_mask(self):
-        import cv2
-        from multiprocessing import Value
-        from ..maskProcessing import MaskProcessor
-
-
-        detect_mask = self.indi_allsky_config.get('DETECT_MASK', '')
-
-        if not detect_mask:
-            app.logger.warning('No detection mask defined')
-            return
-
-
-        detect_mask_p = Path(detect_mask)
-
-        try:
-            if not detect_mask_p.exists():
-                app.logger.error('%s does not exist', detect_mask_p)
-                return
-
-
-            if not detect_mask_p.is_file():
-                app.logger.error('%s is not a file', detect_mask_p)
-                return
-
-        except PermissionError as e:
-            app.logger.error(str(e))
-            return
-
-        mask_data = cv2.imread(str(detect_mask_p), cv2.IMREAD_GRAYSCALE)  # mono
-        if isinstance(mask_data, type(None)):
-            app.logger.error('%s is not a valid image', detect_mask_p)
-            return
-
+        if self.sun_set_date:
+            expire_date = self.sun_set_date
+        else:
+            # check again later for polar regions
+            expire_date = utcnow.replace(tzinfo=None) + timedelta(hours=1)
 
-        app.logger.info('Loaded detection mask: %s', detect_mask_p)
+        self._sun_set_cache[cache_key] = (self.sun_set_date, expire_date)
 
-        ### any compression artifacts will be set to black
-        #mask_data[mask_data < 255] = 0  # did not quite work
 
+    def _load_detection_mask(self):
+        # returns the detection mask service, masks are transformed for post-processed images
+        from multiprocessing import Value
+        from ..detectionMask import IndiAllSkyDetectionMask
 
         bin_v = Value('i', 1)  # always assume bin 1
-        mask_processor = MaskProcessor(
-            self.indi_allsky_config,
-            bin_v,
-        )
-
-
-        # masks need to be rotated, flipped, cropped for post-processed images
-        mask_processor.image = mask_data
-
-
-        if self.indi_allsky_config.get('IMAGE_ROTATE'):
-            mask_processor.rotate_90()
-
-
-        # rotation
-        if self.indi_allsky_config.get('IMAGE_ROTATE_ANGLE'):
-            mask_processor.rotate_angle()
-
-
-        # verticle flip
-        if self.indi_allsky_config.get('IMAGE_FLIP_V'):
-            mask_processor.flip_v()
-
-
-        # horizontal flip
-        if self.indi_allsky_config.get('IMAGE_FLIP_H'):
-            mask_processor.flip_h()
-
-
-        # crop
-        if self.indi_allsky_config.get('IMAGE_CROP_ROI'):
-            mask_processor.crop_image()
-
-
-        # scale
-        if self.indi_allsky_config['IMAGE_SCALE'] and self.indi_allsky_config['IMAGE_SCALE'] != 100:
-            mask_processor.scale_image()
-
 
-        return mask_processor.image
+        return IndiAllSkyDetectionMask(self.indi_allsky_config, bin_v)
 
 
 class TemplateView(BaseView):
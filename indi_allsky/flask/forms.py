@@ -5,6 +5,7 @@ import re
 import json
 import time
 from datetime import datetime
+from datetime import timedelta
 import tempfile
 import subprocess
 
@@ -42,6 +43,7 @@ from flask import current_app as app
 
 from .models import IndiAllSkyDbCameraTable
 from .models import IndiAllSkyDbImageTable
+from .models import IndiAllSkyDbImageRollupTable
 from .models import IndiAllSkyDbVideoTable
 from .models import IndiAllSkyDbKeogramTable
 from .models import IndiAllSkyDbStarTrailsTable
@@ -51,6 +53,7 @@ from .models import IndiAllSkyDbRawImageTable
 from .models import IndiAllSkyDbPanoramaImageTable
 from .models import IndiAllSkyDbPanoramaVideoTable
 from .models import IndiAllSkyDbThumbnailTable
+from .models import IndiAllSkyDbStateTable
 
 from . import db
 
@@ -914,6 +917,50 @@ def IMAGE_QUEUE_BACKOFF_validator(form, field):
         raise ValidationError('Backoff multiplier must be greater than 0')
 
 
+def IMAGE_WRITER_QUEUE_validator(form, field):
+    if not isinstance(field.data, int):
+        raise ValidationError('Please enter valid number')
+
+    if field.data < 0:
+        raise ValidationError('Writer queue size must be 0 or greater')
+
+    if field.data > 10:
+        raise ValidationError('Writer queue size must be 10 or less')
+
+
+def FRAME_DECODE_WORKERS_validator(form, field):
+    if not isinstance(field.data, int):
+        raise ValidationError('Please enter valid number')
+
+    if field.data < 0:
+        raise ValidationError('Workers must be 0 or greater')
+
+    if field.data > 16:
+        raise ValidationError('Workers must be 16 or less')
+
+
+def FRAME_DECODE_PREFETCH_validator(form, field):
+    if not isinstance(field.data, int):
+        raise ValidationError('Please enter valid number')
+
+    if field.data < 0:
+        raise ValidationError('Prefetch must be 0 or greater')
+
+    if field.data > 64:
+        raise ValidationError('Prefetch must be 64 or less')
+
+
+def IMAGE_CALIBRATE_CACHE_MB_validator(form, field):
+    if not isinstance(field.data, int):
+        raise ValidationError('Please enter valid number')
+
+    if field.data < 0:
+        raise ValidationError('Cache size must be 0 or greater')
+
+    if field.data > 4096:
+        raise ValidationError('Cache size must be less than 4096')
+
+
 def IMAGE_FILE_TYPE_validator(form, field):
     if field.data not in ('jpg', 'png', 'tif', 'webp'):
         raise ValidationError('Please select a valid file type')
@@ -1274,6 +1321,25 @@ def TIMELAPSE_EXPIRE_DAYS_validator(form, field):
         raise ValidationError('Timelapse Expiration must be 1 or greater')
 
 
+def EXPIRE_BATCH_SIZE_validator(form, field):
+    if not isinstance(field.data, int):
+        raise ValidationError('Please enter valid number')
+
+    if field.data < 1:
+        raise ValidationError('Batch size must be 1 or greater')
+
+    if field.data > 5000:
+        raise ValidationError('Batch size must be 5000 or less')
+
+
+def EXPIRE_TIME_BUDGET_validator(form, field):
+    if not isinstance(field.data, int):
+        raise ValidationError('Please enter valid number')
+
+    if field.data < 0:
+        raise ValidationError('Time budget must be 0 or greater')
+
+
 def FFMPEG_FRAMERATE_validator(form, field):
     # guessing
     if field.data < 10:
@@ -2930,8 +2996,13 @@ class IndiAllskyConfigForm(FlaskForm):
     STARTRAILS_MIN_STARS             = IntegerField('Star Trails Minimum Stars', validators=[STARTRAILS_MIN_STARS_validator])
     STARTRAILS_TIMELAPSE             = BooleanField('Star Trails Timelapse')
     STARTRAILS_TIMELAPSE_MINFRAMES   = IntegerField('Star Trails Timelapse Minimum Frames', validators=[DataRequired(), STARTRAILS_TIMELAPSE_MINFRAMES_validator])
+    STARTRAILS_TIMELAPSE_STREAM      = BooleanField('Stream Star Trails Timelapse')
     STARTRAILS_USE_DB_DATA           = BooleanField('Star Trails Use Existing Data')
+    KEOGRAM_STARTRAILS_INCREMENTAL   = BooleanField('Incremental Keogram/Star Trails')
+    FRAME_DECODE_WORKERS             = IntegerField('Image Decode Workers', validators=[FRAME_DECODE_WORKERS_validator])
+    FRAME_DECODE_PREFETCH            = IntegerField('Image Decode Prefetch', validators=[FRAME_DECODE_PREFETCH_validator])
     IMAGE_CALIBRATE_DARK             = BooleanField('Apply Dark Calibration Frames')
+    IMAGE_CALIBRATE_CACHE_MB         = IntegerField('Dark Frame Cache (MB)', validators=[IMAGE_CALIBRATE_CACHE_MB_validator])
     IMAGE_SAVE_FITS_PRE_DARK         = BooleanField('Save FITS Pre-Calibration')
     IMAGE_EXIF_PRIVACY               = BooleanField('Enable EXIF Privacy')
     IMAGE_FILE_TYPE                  = SelectField('Image file type', choices=IMAGE_FILE_TYPE_choices, validators=[DataRequired(), IMAGE_FILE_TYPE_validator])
@@ -2960,6 +3031,8 @@ class IndiAllskyConfigForm(FlaskForm):
     IMAGE_QUEUE_MAX                  = IntegerField('Image Queue Maximum', validators=[IMAGE_QUEUE_MAX_validator])
     IMAGE_QUEUE_MIN                  = IntegerField('Image Queue Minimum', validators=[IMAGE_QUEUE_MIN_validator])
     IMAGE_QUEUE_BACKOFF              = FloatField('Image Queue Backoff Multiplier', validators=[IMAGE_QUEUE_BACKOFF_validator])
+    IMAGE_WRITER_QUEUE               = IntegerField('Image Writer Queue', validators=[IMAGE_WRITER_QUEUE_validator])
+    IMAGE_SHARED_MEMORY              = BooleanField('Shared Memory Frames')
     FISH2PANO__ENABLE                = BooleanField('Enable Fisheye to Panoramic')
     FISH2PANO__DIAMETER              = IntegerField('Diameter', validators=[DataRequired(), FISH2PANO__DIAMETER_validator])
     FISH2PANO__OFFSET_X              = IntegerField('X Offset', validators=[FISH2PANO__OFFSET_X_validator])
@@ -2989,6 +3062,8 @@ class IndiAllskyConfigForm(FlaskForm):
     IMAGE_EXPIRE_DAYS                = IntegerField('Image expiration (days)', validators=[DataRequired(), IMAGE_EXPIRE_DAYS_validator])
     THUMBNAILS__IMAGES_AUTO          = BooleanField('Auto Generate Image Thumbnails')
     TIMELAPSE_EXPIRE_DAYS            = IntegerField('Timelapse expiration (days)', validators=[DataRequired(), TIMELAPSE_EXPIRE_DAYS_validator])
+    EXPIRE_BATCH_SIZE                = IntegerField('Expiration batch size', validators=[DataRequired(), EXPIRE_BATCH_SIZE_validator])
+    EXPIRE_TIME_BUDGET               = IntegerField('Expiration time budget', validators=[EXPIRE_TIME_BUDGET_validator])
     FFMPEG_FRAMERATE                 = IntegerField('FFMPEG Framerate', validators=[DataRequired(), FFMPEG_FRAMERATE_validator])
     FFMPEG_BITRATE                   = StringField('FFMPEG Bitrate', validators=[DataRequired(), FFMPEG_BITRATE_validator])
     FFMPEG_VFSCALE                   = SelectField('FFMPEG Scaling', choices=FFMPEG_VFSCALE_choices, validators=[FFMPEG_VFSCALE_validator])
@@ -3623,6 +3698,116 @@ class IndiAllskyConfigForm(FlaskForm):
         return result
 
 
+class IndiAllskyImageRollup(object):
+    # Year/month/day/hour selectors from the hourly image summary table instead of the image table
+    state_key = 'IMAGE_ROLLUP'
+
+
+    def __init__(self, camera_id, detections_count, thumbnails=False):
+        self.camera_id = camera_id
+        self.detections_count = detections_count
+        self.thumbnails = thumbnails  # only include images with thumbnails
+
+
+    @classmethod
+    def available(cls):
+        # the summary is only used after the initial build is complete
+        state = IndiAllSkyDbStateTable.query\
+            .filter(IndiAllSkyDbStateTable.key == cls.state_key)\
+            .first()
+
+        return bool(state)
+
+
+    def _query(self, *entities, thumbnails=True):
+        if self.thumbnails and thumbnails:
+            if self.detections_count:
+                count_column = IndiAllSkyDbImageRollupTable.thumbnail_detections
+            else:
+                count_column = IndiAllSkyDbImageRollupTable.thumbnails
+        else:
+            if self.detections_count:
+                count_column = IndiAllSkyDbImageRollupTable.detections
+            else:
+                count_column = IndiAllSkyDbImageRollupTable.count
+
+
+        rollup_query = db.session.query(*entities)\
+            .filter(IndiAllSkyDbImageRollupTable.camera_id == self.camera_id)\
+            .filter(count_column > 0)
+
+
+        return rollup_query
+
+
+    def getYears(self):
+        # the gallery does not check for thumbnails when selecting the year
+        years_query = self._query(IndiAllSkyDbImageRollupTable.year, thumbnails=False)\
+            .distinct()\
+            .order_by(IndiAllSkyDbImageRollupTable.year.desc())
+
+
+        year_choices = []
+        for y in years_query:
+            entry = (y.year, str(y.year))
+            year_choices.append(entry)
+
+
+        return year_choices
+
+
+    def getMonths(self, year):
+        months_query = self._query(IndiAllSkyDbImageRollupTable.month)\
+            .filter(IndiAllSkyDbImageRollupTable.year == year)\
+            .distinct()\
+            .order_by(IndiAllSkyDbImageRollupTable.month.desc())
+
+
+        month_choices = []
+        for m in months_query:
+            month_name = datetime.strptime('{0} {1}'.format(year, m.month), '%Y %m')\
+                .strftime('%B')
+            entry = (m.month, month_name)
+            month_choices.append(entry)
+
+
+        return month_choices
+
+
+    def getDays(self, year, month):
+        days_query = self._query(IndiAllSkyDbImageRollupTable.day)\
+            .filter(IndiAllSkyDbImageRollupTable.year == year)\
+            .filter(IndiAllSkyDbImageRollupTable.month == month)\
+            .distinct()\
+            .order_by(IndiAllSkyDbImageRollupTable.day.desc())
+
+
+        day_choices = []
+        for d in days_query:
+            entry = (d.day, str(d.day))
+            day_choices.append(entry)
+
+
+        return day_choices
+
+
+    def getHours(self, year, month, day):
+        hours_query = self._query(IndiAllSkyDbImageRollupTable.hour)\
+            .filter(IndiAllSkyDbImageRollupTable.year == year)\
+            .filter(IndiAllSkyDbImageRollupTable.month == month)\
+            .filter(IndiAllSkyDbImageRollupTable.day == day)\
+            .order_by(IndiAllSkyDbImageRollupTable.hour.desc())
+
+
+        hour_choices = []
+        for h in hours_query:
+            entry = (h.hour, str(h.hour))
+            hour_choices.append(entry)
+
+
+        return hour_choices
+
+
 class IndiAllskyImageViewer(FlaskForm):
     YEAR_SELECT          = SelectField('Year', choices=[], validators=[])
     MONTH_SELECT         = SelectField('Month', choices=[], validators=[])
@@ -3640,8 +3825,17 @@ class IndiAllskyImageViewer(FlaskForm):
         self.camera_id = kwargs.get('camera_id')
         self.local = kwargs.get('local')
 
+        # the summary does not track remote assets
+        if self.local and IndiAllskyImageRollup.available():
+            self._rollup = IndiAllskyImageRollup(self.camera_id, self.detections_count)
+        else:
+            self._rollup = None
+
 
     def getYears(self):
+        if self._rollup:
+            return self._rollup.getYears()
+
         createDate_year = extract('year', IndiAllSkyDbImageTable.createDate).label('createDate_year')
 
         years_query = db.session.query(
@@ -3682,6 +3876,9 @@ class IndiAllskyImageViewer(FlaskForm):
 
 
     def getMonths(self, year):
+        if self._rollup:
+            return self._rollup.getMonths(year)
+
         createDate_year = extract('year', IndiAllSkyDbImageTable.createDate).label('createDate_year')
         createDate_month = extract('month', IndiAllSkyDbImageTable.createDate).label('createDate_month')
 
@@ -3727,6 +3924,9 @@ class IndiAllskyImageViewer(FlaskForm):
 
 
     def getDays(self, year, month):
+        if self._rollup:
+            return self._rollup.getDays(year, month)
+
         createDate_year = extract('year', IndiAllSkyDbImageTable.createDate).label('createDate_year')
         createDate_month = extract('month', IndiAllSkyDbImageTable.createDate).label('createDate_month')
         createDate_day = extract('day', IndiAllSkyDbImageTable.createDate).label('createDate_day')
@@ -3773,6 +3973,9 @@ class IndiAllskyImageViewer(FlaskForm):
 
 
     def getHours(self, year, month, day):
+        if self._rollup:
+            return self._rollup.getHours(year, month, day)
+
         createDate_year = extract('year', IndiAllSkyDbImageTable.createDate).label('createDate_year')
         createDate_month = extract('month', IndiAllSkyDbImageTable.createDate).label('createDate_month')
         createDate_day = extract('day', IndiAllSkyDbImageTable.createDate).label('createDate_day')
@@ -3822,10 +4025,9 @@ class IndiAllskyImageViewer(FlaskForm):
 
 
     def getImages(self, year, month, day, hour):
-        createDate_year = extract('year', IndiAllSkyDbImageTable.createDate).label('createDate_year')
-        createDate_month = extract('month', IndiAllSkyDbImageTable.createDate).label('createDate_month')
-        createDate_day = extract('day', IndiAllSkyDbImageTable.createDate).label('createDate_day')
-        createDate_hour = extract('hour', IndiAllSkyDbImageTable.createDate).label('createDate_hour')
+        # a date range can use the createDate index
+        hour_start = datetime(int(year), int(month), int(day), int(hour))
+        hour_end = hour_start + timedelta(hours=1)
 
         images_query = db.session.query(
             IndiAllSkyDbImageTable,
@@ -3835,10 +4037,8 @@ class IndiAllskyImageViewer(FlaskForm):
                 and_(
                     IndiAllSkyDbCameraTable.id == self.camera_id,
                     IndiAllSkyDbImageTable.detections >= self.detections_count,
-                    createDate_year == year,
-                    createDate_month == month,
-                    createDate_day == day,
-                    createDate_hour == hour,
+                    IndiAllSkyDbImageTable.createDate >= hour_start,
+                    IndiAllSkyDbImageTable.createDate < hour_end,
                 )
         )
 
@@ -3993,8 +4193,17 @@ class IndiAllskyGalleryViewer(FlaskForm):
         self.camera_id = kwargs.get('camera_id')
         self.local = kwargs.get('local')
 
+        # the summary does not track remote assets
+        if self.local and IndiAllskyImageRollup.available():
+            self._rollup = IndiAllskyImageRollup(self.camera_id, self.detections_count, thumbnails=True)
+        else:
+            self._rollup = None
+
 
     def getYears(self):
+        if self._rollup:
+            return self._rollup.getYears()
+
         createDate_year = extract('year', IndiAllSkyDbImageTable.createDate).label('createDate_year')
 
         years_query = db.session.query(
@@ -4039,6 +4248,9 @@ class IndiAllskyGalleryViewer(FlaskForm):
 
 
     def getMonths(self, year):
+        if self._rollup:
+            return self._rollup.getMonths(year)
+
         createDate_year = extract('year', IndiAllSkyDbImageTable.createDate).label('createDate_year')
         createDate_month = extract('month', IndiAllSkyDbImageTable.createDate).label('createDate_month')
 
@@ -4085,6 +4297,9 @@ class IndiAllskyGalleryViewer(FlaskForm):
 
 
     def getDays(self, year, month):
+        if self._rollup:
+            return self._rollup.getDays(year, month)
+
         createDate_year = extract('year', IndiAllSkyDbImageTable.createDate).label('createDate_year')
         createDate_month = extract('month', IndiAllSkyDbImageTable.createDate).label('createDate_month')
         createDate_day = extract('day', IndiAllSkyDbImageTable.createDate).label('createDate_day')
@@ -4132,6 +4347,9 @@ class IndiAllskyGalleryViewer(FlaskForm):
 
 
     def getHours(self, year, month, day):
+        if self._rollup:
+            return self._rollup.getHours(year, month, day)
+
         createDate_year = extract('year', IndiAllSkyDbImageTable.createDate).label('createDate_year')
         createDate_month = extract('month', IndiAllSkyDbImageTable.createDate).label('createDate_month')
         createDate_day = extract('day', IndiAllSkyDbImageTable.createDate).label('createDate_day')
@@ -4182,10 +4400,9 @@ class IndiAllskyGalleryViewer(FlaskForm):
 
 
     def getImages(self, year, month, day, hour):
-        createDate_year = extract('year', IndiAllSkyDbImageTable.createDate).label('createDate_year')
-        createDate_month = extract('month', IndiAllSkyDbImageTable.createDate).label('createDate_month')
-        createDate_day = extract('day', IndiAllSkyDbImageTable.createDate).label('createDate_day')
-        createDate_hour = extract('hour', IndiAllSkyDbImageTable.createDate).label('createDate_hour')
+        # a date range can use the createDate index
+        hour_start = datetime(int(year), int(month), int(day), int(hour))
+        hour_end = hour_start + timedelta(hours=1)
 
         images_query = db.session.query(
             IndiAllSkyDbImageTable,
@@ -4197,10 +4414,8 @@ class IndiAllskyGalleryViewer(FlaskForm):
                 and_(
                     IndiAllSkyDbCameraTable.id == self.camera_id,
                     IndiAllSkyDbImageTable.detections >= self.detections_count,
-                    createDate_year == year,
-                    createDate_month == month,
-                    createDate_day == day,
-                    createDate_hour == hour,
+                    IndiAllSkyDbImageTable.createDate >= hour_start,
+                    IndiAllSkyDbImageTable.createDate < hour_end,
                 )
         )
 
@@ -1,3 +1,4 @@
+import time
 from datetime import datetime
 from datetime import timedelta
 from pathlib import Path
@@ -6,8 +7,6 @@ import logging
 #from pprint import pformat
 
 import cv2
-import PIL
-from PIL import Image
 
 from cryptography.fernet import Fernet
 
@@ -16,6 +15,7 @@ from . import db
 
 from .models import IndiAllSkyDbCameraTable
 from .models import IndiAllSkyDbImageTable
+from .models import IndiAllSkyDbImageRollupTable
 from .models import IndiAllSkyDbBadPixelMapTable
 from .models import IndiAllSkyDbDarkFrameTable
 from .models import IndiAllSkyDbVideoTable
@@ -32,9 +32,16 @@ from .models import IndiAllSkyDbStateTable
 
 #from .models import NotificationCategory
 
+from sqlalchemy import func
+from sqlalchemy import extract
+from sqlalchemy import case
+from sqlalchemy import and_
+from sqlalchemy.sql.expression import null as sa_null
 from sqlalchemy.orm.exc import NoResultFound
+from sqlalchemy.exc import IntegrityError
 
 from .. import constants
+from ..resizePyramid import IndiAllSkyResizePyramid
 #from ..exceptions import BadImage
 
 logger = logging.getLogger('indi_allsky')
@@ -44,6 +51,10 @@ class miscDb(object):
     def __init__(self, config):
         self.config = config
 
+        # entries are flushed instead of committed during a batch
+        self._batch = False
+        self._batch_rollup = dict()
+
 
         if self.config.get('IMAGE_FOLDER'):
             self.image_dir = Path(self.config['IMAGE_FOLDER']).absolute()
@@ -52,6 +63,45 @@ class miscDb(object):
 
 
 
+    def startBatch(self):
+        self._batch = True
+        self._batch_rollup.clear()
+
+
+        if db.engine.dialect.name == 'sqlite':
+            # pysqlite only starts a transaction before data is changed, a savepoint in the
+            # batch would start its own transaction and commit it when it is released
+            connection = db.session.connection()
+            if not connection.connection.dbapi_connection.in_transaction:
+                connection.exec_driver_sql('BEGIN')
+
+
+    def commitBatch(self):
+        self._batch = False
+
+        # the image summary is updated once for the batch, in the same transaction
+        for camera_id, (start_date, end_date) in self._batch_rollup.items():
+            self.updateImageRollup(camera_id=camera_id, start_date=start_date, end_date=end_date, commit=False)
+
+        self._batch_rollup.clear()
+
+        db.session.commit()
+
+
+    def rollbackBatch(self):
+        self._batch = False
+        self._batch_rollup.clear()
+
+        db.session.rollback()
+
+
+    def commit(self):
+        if self._batch:
+            db.session.flush()
+        else:
+            db.session.commit()
+
+
     def addCamera(self, metadata):
         now = datetime.now()
 
@@ -257,11 +307,130 @@ class miscDb(object):
         )
 
         db.session.add(image)
-        db.session.commit()
+        db.session.flush()
+
+
+        if self._batch:
+            start_date, end_date = self._batch_rollup.get(camera_id, (createDate, createDate))
+            self._batch_rollup[camera_id] = (min(start_date, createDate), max(end_date, createDate))
+        else:
+            # the image summary is committed with the image
+            self.updateImageRollup(camera_id=camera_id, start_date=createDate, end_date=createDate)
 
         return image
 
 
+    def initImageRollup(self, force=False):
+        # The selectors use the image table until the summary is built
+        if not force:
+            try:
+                self.getState('IMAGE_ROLLUP')
+                return
+            except NoResultFound:
+                pass
+
+
+        logger.warning('Building image summary table, this may take a while')
+        rollup_start = time.time()
+
+        self.updateImageRollup()
+
+        rollup_elapsed_s = time.time() - rollup_start
+        logger.info('Image summary built in %0.4f s', rollup_elapsed_s)
+
+        self.setState('IMAGE_ROLLUP', int(time.time()))
+
+
+    def updateImageRollup(self, camera_id=None, start_date=None, end_date=None, commit=True):
+        # Recalculate the hourly image summary for the hours between start_date and end_date
+        # All cameras and all hours are rebuilt if not defined
+        # Pending changes in the session are committed with the summary
+
+        rollup_delete_query = IndiAllSkyDbImageRollupTable.query
+        rollup_image_query_filters = list()
+
+        if camera_id:
+            rollup_delete_query = rollup_delete_query\
+                .filter(IndiAllSkyDbImageRollupTable.camera_id == camera_id)
+            rollup_image_query_filters.append(IndiAllSkyDbImageTable.camera_id == camera_id)
+
+        if start_date:
+            start_hour = start_date.replace(minute=0, second=0, microsecond=0)
+
+            rollup_delete_query = rollup_delete_query\
+                .filter(IndiAllSkyDbImageRollupTable.createDate >= start_hour)
+            rollup_image_query_filters.append(IndiAllSkyDbImageTable.createDate >= start_hour)
+
+        if end_date:
+            end_hour = end_date.replace(minute=0, second=0, microsecond=0) + timedelta(hours=1)
+
+            rollup_delete_query = rollup_delete_query\
+                .filter(IndiAllSkyDbImageRollupTable.createDate < end_hour)
+            rollup_image_query_filters.append(IndiAllSkyDbImageTable.createDate < end_hour)
+
+
+        createDate_year = extract('year', IndiAllSkyDbImageTable.createDate).label('createDate_year')
+        createDate_month = extract('month', IndiAllSkyDbImageTable.createDate).label('createDate_month')
+        createDate_day = extract('day', IndiAllSkyDbImageTable.createDate).label('createDate_day')
+        createDate_hour = extract('hour', IndiAllSkyDbImageTable.createDate).label('createDate_hour')
+
+        rollup_image_query = db.session.query(
+            IndiAllSkyDbImageTable.camera_id,
+            createDate_year,
+            createDate_month,
+            createDate_day,
+            createDate_hour,
+            func.count(IndiAllSkyDbImageTable.id).label('image_count'),
+            func.sum(case((IndiAllSkyDbImageTable.detections > 0, 1), else_=0)).label('detection_count'),
+            func.sum(case((IndiAllSkyDbImageTable.thumbnail_uuid != sa_null(), 1), else_=0)).label('thumbnail_count'),
+            func.sum(case((and_(IndiAllSkyDbImageTable.detections > 0, IndiAllSkyDbImageTable.thumbnail_uuid != sa_null()), 1), else_=0)).label('thumbnail_detection_count'),
+            func.min(IndiAllSkyDbImageTable.id).label('image_min_id'),
+            func.max(IndiAllSkyDbImageTable.id).label('image_max_id'),
+        )\
+            .filter(*rollup_image_query_filters)\
+            .group_by(
+                IndiAllSkyDbImageTable.camera_id,
+                createDate_year,
+                createDate_month,
+                createDate_day,
+                createDate_hour,
+            )
+
+
+        for i in range(2):
+            # another process may update the same hour at the same time
+            # a savepoint so a conflict does not roll back the other pending changes
+            try:
+                with db.session.begin_nested():
+                    rollup_delete_query.delete(synchronize_session=False)
+
+                    for r in rollup_image_query:
+                        rollup = IndiAllSkyDbImageRollupTable(
+                            camera_id=r.camera_id,
+                            createDate=datetime(int(r.createDate_year), int(r.createDate_month), int(r.createDate_day), int(r.createDate_hour)),
+                            year=int(r.createDate_year),
+                            month=int(r.createDate_month),
+                            day=int(r.createDate_day),
+                            hour=int(r.createDate_hour),
+                            count=r.image_count,
+                            detections=int(r.detection_count or 0),
+                            thumbnails=int(r.thumbnail_count or 0),
+                            thumbnail_detections=int(r.thumbnail_detection_count or 0),
+                            min_id=r.image_min_id,
+                            max_id=r.image_max_id,
+                        )
+
+                        db.session.add(rollup)
+
+                break
+            except IntegrityError as e:
+                logger.warning('Image rollup update conflict: %s', str(e))
+
+
+        if commit:
+            db.session.commit()
+
+
     def addDarkFrame(self, filename, camera_id, metadata):
 
         ### expected metadata
@@ -323,6 +492,8 @@ class miscDb(object):
         db.session.add(dark)
         db.session.commit()
 
+        self.setCalibrationUpdated()
+
         return dark
 
 
@@ -386,6 +557,8 @@ class miscDb(object):
         db.session.add(bpm)
         db.session.commit()
 
+        self.setCalibrationUpdated()
+
         return bpm
 
 
@@ -436,7 +609,7 @@ class miscDb(object):
         )
 
         db.session.add(video)
-        db.session.commit()
+        self.commit()
 
         return video
 
@@ -488,7 +661,7 @@ class miscDb(object):
         )
 
         db.session.add(panorama_video)
-        db.session.commit()
+        self.commit()
 
         return panorama_video
 
@@ -541,7 +714,7 @@ class miscDb(object):
         )
 
         db.session.add(keogram)
-        db.session.commit()
+        self.commit()
 
         return keogram
 
@@ -595,7 +768,7 @@ class miscDb(object):
         )
 
         db.session.add(startrail)
-        db.session.commit()
+        self.commit()
 
         return startrail
 
@@ -647,7 +820,7 @@ class miscDb(object):
         )
 
         db.session.add(startrail_video)
-        db.session.commit()
+        self.commit()
 
         return startrail_video
 
@@ -705,7 +878,7 @@ class miscDb(object):
         )
 
         db.session.add(fits_image)
-        db.session.commit()
+        self.commit()
 
         return fits_image
 
@@ -763,7 +936,7 @@ class miscDb(object):
         )
 
         db.session.add(raw_image)
-        db.session.commit()
+        self.commit()
 
         return raw_image
 
@@ -821,7 +994,7 @@ class miscDb(object):
         )
 
         db.session.add(panorama_image)
-        db.session.commit()
+        self.commit()
 
         return panorama_image
 
@@ -911,6 +1084,11 @@ class miscDb(object):
         db.session.commit()
 
 
+    def setCalibrationUpdated(self):
+        # flushes the master dark caches in running processes
+        self.setState('CALIBRATION_UPDATED', int(time.time() * 1000))
+
+
     def setEncryptedState(self, key, value):
         self.setState(key, value, encrypted=True)
 
@@ -949,7 +1127,9 @@ class miscDb(object):
         db.session.commit()
 
 
-    def addThumbnail(self, entry, entry_metadata, camera_id, thumbnail_metadata, new_width=150, numpy_data=None):
+    def addThumbnail(self, entry, entry_metadata, camera_id, thumbnail_metadata, new_width=150, numpy_data=None, write_file=True):
+        # numpy_data is the decoded image, the file is only read when it is not available
+        # if write_file is False, the caller writes the file with writeThumbnail()
         if entry.thumbnail_uuid:
             return
 
@@ -1021,25 +1201,18 @@ class miscDb(object):
                 logger.error('Cannot create thumbnail: File not found: %s', filename_p)
                 return
 
-            try:
-                img = Image.open(str(filename_p))
-            except PIL.UnidentifiedImageError:
+            numpy_data = cv2.imread(str(filename_p), cv2.IMREAD_COLOR)
+            if isinstance(numpy_data, type(None)):
                 logger.error('Cannot create thumbnail:  Bad Image')
                 return
-        else:
-            img = Image.fromarray(cv2.cvtColor(numpy_data, cv2.COLOR_BGR2RGB))
 
 
-        width, height = img.size
+        height, width = numpy_data.shape[:2]
 
         if new_width < width:
-            scale = new_width / width
-            new_height = int(height * scale)
-
-            thumbnail_data = img.resize((new_width, new_height))
+            new_height = max(int(height * new_width / width), 1)
         else:
             # keep the same dimensions
-            thumbnail_data = img
             new_width = width
             new_height = height
 
@@ -1052,7 +1225,8 @@ class miscDb(object):
         thumbnail_metadata['height'] = new_height
 
 
-        thumbnail_data.save(str(thumbnail_filename_p), quality=75)
+        if write_file:
+            self.writeThumbnail(numpy_data, thumbnail_filename_p, new_width)
 
 
         thumbnail_entry = IndiAllSkyDbThumbnailTable(
@@ -1070,11 +1244,30 @@ class miscDb(object):
 
         db.session.add(thumbnail_entry)
         entry.thumbnail_uuid = thumbnail_uuid_str
-        db.session.commit()
+
+
+        if isinstance(entry, IndiAllSkyDbImageTable):
+            # the image summary is committed with the thumbnail
+            db.session.flush()
+            self.updateImageRollup(camera_id=camera_id, start_date=entry.createDate, end_date=entry.createDate)
+        else:
+            db.session.commit()
+
 
         return thumbnail_entry
 
 
+    @staticmethod
+    def writeThumbnail(numpy_data, thumbnail_filename_p, new_width):
+        # does not use the DB, can be called from the image writer thread
+        if not isinstance(numpy_data, IndiAllSkyResizePyramid):
+            numpy_data = IndiAllSkyResizePyramid(numpy_data)
+
+        thumbnail_data = numpy_data.resize(new_width)
+
+        cv2.imwrite(str(thumbnail_filename_p), thumbnail_data, [cv2.IMWRITE_JPEG_QUALITY, 75])
+
+
     def addThumbnailImageAuto(self, *args, **kwargs):
         if not self.config.get('THUMBNAILS', {}).get('IMAGES_AUTO', True):
             return
@@ -1122,7 +1315,7 @@ class miscDb(object):
         )
 
         db.session.add(thumbnail_entry)
-        db.session.commit()
+        self.commit()
 
         return thumbnail_entry
 
@@ -17,6 +17,7 @@ __all__ = (
     'IndiAllSkyDbCameraTable',
     'IndiAllSkyDbThumbnailTable',
     'IndiAllSkyDbImageTable',
+    'IndiAllSkyDbImageRollupTable',
     'IndiAllSkyDbBadPixelMapTable',
     'IndiAllSkyDbDarkFrameTable',
     'IndiAllSkyDbVideoTable',
@@ -89,6 +90,7 @@ class IndiAllSkyDbCameraTable(db.Model):
 
     thumbnails = db.relationship('IndiAllSkyDbThumbnailTable', back_populates='camera')
     images = db.relationship('IndiAllSkyDbImageTable', back_populates='camera')
+    imagerollups = db.relationship('IndiAllSkyDbImageRollupTable', back_populates='camera')
     videos = db.relationship('IndiAllSkyDbVideoTable', back_populates='camera')
     keograms = db.relationship('IndiAllSkyDbKeogramTable', back_populates='camera')
     startrails = db.relationship('IndiAllSkyDbStarTrailsTable', back_populates='camera')
@@ -151,9 +153,14 @@ class IndiAllSkyDbFileBase(db.Model):
 
 
     def getFilesystemPath(self):
-        filename_p = Path(self.filename)
+        return self.filesystemPath(self.filename)
+
 
-        if self.filename.startswith('/'):
+    @staticmethod
+    def filesystemPath(filename):
+        filename_p = Path(filename)
+
+        if filename.startswith('/'):
             # filename is already fully qualified
             return filename_p
 
@@ -286,6 +293,35 @@ class IndiAllSkyDbImageTable(IndiAllSkyDbFileBase):
         return '<Image {0:s}>'.format(self.filename)
 
 
+class IndiAllSkyDbImageRollupTable(db.Model):
+    # hourly summary of the image table for the year/month/day/hour selectors
+    __tablename__ = 'imagerollup'
+
+    id = db.Column(db.Integer, primary_key=True)
+    createDate = db.Column(db.DateTime(), nullable=False, index=True)  # start of the hour
+    year = db.Column(db.Integer, nullable=False, index=True)
+    month = db.Column(db.Integer, nullable=False)
+    day = db.Column(db.Integer, nullable=False)
+    hour = db.Column(db.Integer, nullable=False)
+    count = db.Column(db.Integer, server_default='0', nullable=False)
+    detections = db.Column(db.Integer, server_default='0', nullable=False)  # images with detections
+    thumbnails = db.Column(db.Integer, server_default='0', nullable=False)  # images with thumbnails
+    thumbnail_detections = db.Column(db.Integer, server_default='0', nullable=False)
+    min_id = db.Column(db.Integer, nullable=True)
+    max_id = db.Column(db.Integer, nullable=True)
+    camera_id = db.Column(db.Integer, db.ForeignKey('camera.id'), nullable=False)
+    camera = db.relationship('IndiAllSkyDbCameraTable', back_populates='imagerollups')
+
+    __table_args__ = (
+        db.UniqueConstraint('camera_id', 'createDate', name='uq_imagerollup_camera_id_createDate'),
+        db.Index('idx_imagerollup_camera_id_year_month_day', 'camera_id', 'year', 'month', 'day'),
+    )
+
+
+    def __repr__(self):
+        return '<ImageRollup {0:d} {1:s}>'.format(self.camera_id, self.createDate.strftime('%Y-%m-%d %H'))
+
+
 class IndiAllSkyDbDarkFrameTable(IndiAllSkyDbFileBase):
     __tablename__ = 'darkframe'
 
@@ -607,15 +643,19 @@ class IndiAllSkyDbTaskQueueTable(db.Model):
         self.state = TaskQueueState.RUNNING
         db.session.commit()
 
-    def setSuccess(self, result):
+    def setSuccess(self, result, commit=True):
         self.state = TaskQueueState.SUCCESS
         self.result = result
-        db.session.commit()
 
-    def setFailed(self, result):
+        if commit:
+            db.session.commit()
+
+    def setFailed(self, result, commit=True):
         self.state = TaskQueueState.FAILED
         self.result = result
-        db.session.commit()
+
+        if commit:
+            db.session.commit()
 
     def setExpired(self):
         self.state = TaskQueueState.EXPIRED
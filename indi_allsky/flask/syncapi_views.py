@@ -6,6 +6,7 @@ from pathlib import Path
 import hashlib
 import hmac
 import json
+import io
 import tempfile
 import shutil
 
@@ -56,6 +57,17 @@ class SyncApiBaseView(BaseView):
 
     time_skew = 300  # number of seconds the client is allowed to deviate from server
 
+    chunk_size = 1048576
+
+    tmp_stale_period = 86400  # seconds, temp files left by interrupted uploads
+    tmp_check_period = 3600
+    _tmp_check_time = 0
+
+    _media_moves = None  # temp file to file name, set for batch entries
+
+    # identify the entry or are converted by the server, not compared when checking for existing files
+    metadata_check_skip = ('id', 'filename', 'camera_id', 'createDate', 'dayDate')
+
 
     def __init__(self, **kwargs):
         super(SyncApiBaseView, self).__init__(**kwargs)
@@ -66,6 +78,18 @@ class SyncApiBaseView(BaseView):
             self.image_dir = Path(__file__).parent.parent.parent.joinpath('html', 'images').absolute()
 
 
+    @classmethod
+    def batchHandler(cls, batch_view):
+        # handles entries for the batch view without setting up another view
+        handler = cls.__new__(cls)
+        handler.indi_allsky_config = batch_view.indi_allsky_config
+        handler._miscDb = batch_view._miscDb
+        handler.image_dir = batch_view.image_dir
+        handler._media_moves = batch_view._media_moves
+
+        return handler
+
+
     def dispatch_request(self):
         try:
             #time.sleep(10)  # testing
@@ -95,32 +119,40 @@ class SyncApiBaseView(BaseView):
     def post(self, overwrite=False):
         metadata = self.saveMetadata(request.files['metadata'])
 
-        tmp_media_file_p = self.saveMedia(request.files['media'])
+        tmp_media_file_p, media_sha256 = self.saveMedia(request.files['media'])
 
 
-        media_file_size = tmp_media_file_p.stat().st_size
-        if media_file_size != metadata.get('file_size', -1):
-            tmp_media_file_p.unlink()
-            raise AuthenticationFailure('Media file size does not match')
+        try:
+            media_file_size = tmp_media_file_p.stat().st_size
+            if media_file_size != metadata.get('file_size', -1):
+                raise AuthenticationFailure('Media file size does not match')
 
 
-        try:
-            camera = self.getCamera(metadata)
-        except NoResultFound:
-            app.logger.error('Camera not found: %s', metadata['camera_uuid'])
-            return jsonify({'error' : 'camera not found'}), 400
+            # older clients do not send a hash
+            if metadata.get('sha256') and media_sha256 != metadata['sha256']:
+                raise AuthenticationFailure('Media file hash does not match')
 
 
-        try:
-            file_entry = self.processPost(camera, metadata, tmp_media_file_p, overwrite=overwrite)
-        except EntryExists:
-            return jsonify({'error' : 'file_exists'}), 400
+            try:
+                camera = self.getCamera(metadata)
+            except NoResultFound:
+                app.logger.error('Camera not found: %s', metadata['camera_uuid'])
+                return jsonify({'error' : 'camera not found'}), 400
 
 
-        return jsonify({
-            'id'   : file_entry.id,
-            'url'  : str(file_entry.getUrl(local=True)),
-        })
+            try:
+                file_entry = self.processPost(camera, metadata, tmp_media_file_p, overwrite=overwrite)
+            except EntryExists:
+                return jsonify({'error' : 'file_exists'}), 400
+
+
+            return jsonify({
+                'id'   : file_entry.id,
+                'url'  : str(file_entry.getUrl(local=True)),
+            })
+        finally:
+            # the temp file is renamed into place when the entry is stored
+            self.removeTempFile(tmp_media_file_p)
 
 
     def put(self, overwrite=True):
@@ -172,27 +204,8 @@ class SyncApiBaseView(BaseView):
         # offset createDate to account for difference between local and remote sites
         metadata['createDate'] += (metadata['utc_offset'] - datetime.now().astimezone().utcoffset().total_seconds())
 
-        d_dayDate = datetime.strptime(metadata['dayDate'], '%Y%m%d').date()
-
-        date_folder = self.image_dir.joinpath('ccd_{0:s}'.format(camera.uuid), d_dayDate.strftime('%Y%m%d'))
-        if not date_folder.exists():
-            date_folder.mkdir(mode=0o755, parents=True)
-
-
-        if metadata['night']:
-            timeofday_str = 'night'
-        else:
-            timeofday_str = 'day'
+        filename_p = self.getFilePath(camera, metadata, tmp_file_p.suffix)
 
-        filename_p = date_folder.joinpath(
-            self.filename_t.format(
-                camera.id,
-                'timelapse',
-                d_dayDate.strftime('%Y%m%d'),
-                timeofday_str,
-                tmp_file_p.suffix,  # suffix includes dot
-            )
-        )
 
         if not filename_p.exists():
             try:
@@ -203,7 +216,7 @@ class SyncApiBaseView(BaseView):
 
                 app.logger.warning('Removing orphaned video entry')
                 db.session.delete(old_entry)
-                db.session.commit()
+                self._miscDb.commit()
             except NoResultFound:
                 pass
 
@@ -212,7 +225,7 @@ class SyncApiBaseView(BaseView):
                 raise EntryExists()
 
             app.logger.warning('Replacing file')
-            filename_p.unlink()
+            self.removeReplacedFile(filename_p)
 
             try:
                 old_entry = self.model.query\
@@ -221,7 +234,7 @@ class SyncApiBaseView(BaseView):
 
                 app.logger.warning('Removing old entry')
                 db.session.delete(old_entry)
-                db.session.commit()
+                self._miscDb.commit()
             except NoResultFound:
                 pass
 
@@ -243,19 +256,78 @@ class SyncApiBaseView(BaseView):
         )
 
 
+        self.moveMedia(tmp_file_p, filename_p)
+
+        app.logger.info('Uploaded file: %s', filename_p)
+
+        return new_entry
+
+
+    def moveMedia(self, tmp_file_p, filename_p):
+        if not isinstance(self._media_moves, type(None)):
+            # batch entries are moved after the batch is committed
+            self._media_moves[tmp_file_p] = filename_p
+            return
+
+        self.renameMedia(tmp_file_p, filename_p)
+
+
+    def removeReplacedFile(self, filename_p):
+        if not isinstance(self._media_moves, type(None)):
+            # batch entries replace the file after the batch is committed
+            return
+
+        filename_p.unlink()
+
+
+    def renameMedia(self, tmp_file_p, filename_p):
         tmp_file_size = tmp_file_p.stat().st_size
-        if tmp_file_size != 0:
-            # only copy file if it is not empty
+        if tmp_file_size == 0:
+            # only move file if it is not empty
             # if the empty file option is selected, this can be expected
-            shutil.copy2(str(tmp_file_p), str(filename_p))
-            filename_p.chmod(0o644)
+            tmp_file_p.unlink()
 
+            # a replaced file is removed
+            try:
+                filename_p.unlink()
+            except FileNotFoundError:
+                pass
 
-        tmp_file_p.unlink()
+            return
 
-        app.logger.info('Uploaded file: %s', filename_p)
 
-        return new_entry
+        filename_dir_p = filename_p.parent
+        if not filename_dir_p.exists():
+            filename_dir_p.mkdir(mode=0o755, parents=True)
+
+        shutil.move(str(tmp_file_p), str(filename_p))  # rename, temp file is on the same filesystem
+        filename_p.chmod(0o644)
+
+
+    def getFilePath(self, camera, metadata, suffix, create=True):
+        d_dayDate = datetime.strptime(metadata['dayDate'], '%Y%m%d').date()
+
+        date_folder = self.image_dir.joinpath('ccd_{0:s}'.format(camera.uuid), d_dayDate.strftime('%Y%m%d'))
+        if create and not date_folder.exists():
+            date_folder.mkdir(mode=0o755, parents=True)
+
+
+        if metadata['night']:
+            timeofday_str = 'night'
+        else:
+            timeofday_str = 'day'
+
+        filename_p = date_folder.joinpath(
+            self.filename_t.format(
+                camera.id,
+                'timelapse',
+                d_dayDate.strftime('%Y%m%d'),
+                timeofday_str,
+                suffix,  # suffix includes dot
+            )
+        )
+
+        return filename_p
 
 
     def deleteFile(self, entry_id, camera_id):
@@ -270,6 +342,8 @@ class SyncApiBaseView(BaseView):
 
             entry.deleteFile()
 
+            entry_createDate = entry.createDate
+
             app.logger.warning('Deleting entry %d', entry.id)
             db.session.delete(entry)
             db.session.commit()
@@ -277,6 +351,10 @@ class SyncApiBaseView(BaseView):
             raise EntryMissing()
 
 
+        if self.model == IndiAllSkyDbImageTable:
+            self._miscDb.updateImageRollup(camera_id=camera_id, start_date=entry_createDate, end_date=entry_createDate)
+
+
     def getEntry(self, metadata, camera):
         try:
             entry = self.model.query\
@@ -304,17 +382,148 @@ class SyncApiBaseView(BaseView):
 
 
     def saveMedia(self, media_file):
+        # The media is hashed while it is written to a temporary file in the image folder,
+        # the file is moved into place with a rename instead of another copy
         media_file_p = Path(media_file.filename)  # need this for the extension
         #app.logger.info('File: %s', media_file_p)
 
-        f_tmp_media = tempfile.NamedTemporaryFile(mode='wb', delete=False, suffix=media_file_p.suffix)
-        f_tmp_media.close()
+        if not self.image_dir.exists():
+            self.image_dir.mkdir(mode=0o755, parents=True)
+
+
+        self.removeStaleTempFiles()
+
+
+        media_hash = hashlib.sha256()
+
+        with tempfile.NamedTemporaryFile(mode='wb', dir=str(self.image_dir), prefix='.sync_', suffix=media_file_p.suffix, delete=False) as f_tmp_media:
+            while True:
+                chunk = media_file.stream.read(self.chunk_size)
+                if not chunk:
+                    break
+
+                media_hash.update(chunk)
+                f_tmp_media.write(chunk)
+
 
         tmp_media_p = Path(f_tmp_media.name)
 
-        media_file.save(str(tmp_media_p))
+        return tmp_media_p, media_hash.hexdigest()
+
+
+    def removeTempFile(self, tmp_file_p):
+        try:
+            tmp_file_p.unlink()
+        except FileNotFoundError:
+            pass
+
+
+    def removeStaleTempFiles(self):
+        # temp files are left behind if the server is stopped during an upload
+        now = time.time()
+
+        if now < SyncApiBaseView._tmp_check_time + self.tmp_check_period:
+            return
+
+        SyncApiBaseView._tmp_check_time = now
+
+
+        for tmp_file_p in self.image_dir.glob('.sync_*'):
+            try:
+                if tmp_file_p.stat().st_mtime > now - self.tmp_stale_period:
+                    continue
+
+                app.logger.warning('Removing stale upload temp file: %s', tmp_file_p)
+                tmp_file_p.unlink()
+            except FileNotFoundError:
+                pass
+
+
+    def fileDigest(self, file_p):
+        file_hash = hashlib.sha256()
+
+        with io.open(str(file_p), 'rb') as f_file:
+            while True:
+                chunk = f_file.read(self.chunk_size)
+                if not chunk:
+                    break
+
+                file_hash.update(chunk)
+
+
+        return file_hash.hexdigest()
+
+
+    def checkEntry(self, camera, metadata, suffix):
+        # Returns the existing entry if the file on the server has the same content
+        metadata = metadata.copy()  # createDate is updated
+
+        # offset createDate to account for difference between local and remote sites
+        metadata['createDate'] += (metadata['utc_offset'] - datetime.now().astimezone().utcoffset().total_seconds())
+
+        filename_p = self.getFilePath(camera, metadata, suffix, create=False)  # folders are not created for a check
+
+
+        try:
+            if filename_p.stat().st_size != metadata['file_size']:
+                raise EntryMissing()
+        except FileNotFoundError:
+            raise EntryMissing()
+
+
+        entry = self.model.query\
+            .filter(self.model.filename == str(filename_p))\
+            .first()
+
+        if not entry:
+            raise EntryMissing()
+
+
+        if not self.metadataMatches(entry, metadata):
+            # metadata only updates (exclude flag, detections, kpindex) are uploaded again
+            raise EntryMissing()
+
+
+        # hash is checked last, the file must be read
+        if self.fileDigest(filename_p) != metadata['sha256']:
+            raise EntryMissing()
+
+
+        return entry
+
+
+    def metadataMatches(self, entry, metadata):
+        # compares the metadata with the columns of the existing entry
+        column_list = self.model.__table__.columns.keys()
+
+        for key, value in metadata.items():
+            if key in self.metadata_check_skip:
+                continue
+
+            if key not in column_list:
+                continue
+
+
+            entry_value = getattr(entry, key)
+
+            if not value and not entry_value:
+                # 0, False and None are stored interchangeably
+                continue
+
+            if isinstance(value, float) or isinstance(entry_value, float):
+                try:
+                    if math.isclose(float(value), float(entry_value), rel_tol=1e-6):
+                        continue
+                except (TypeError, ValueError):
+                    pass
+
+                return False
 
-        return tmp_media_p
+            if value != entry_value:
+                return False
+
+
+        return True
 
 
     #def put(self):
@@ -391,7 +600,7 @@ class SyncApiBaseView(BaseView):
         if camera.utc_offset != metadata['utc_offset']:
             # update utc offset
             camera.utc_offset = int(metadata['utc_offset'])
-            db.session.commit()
+            self._miscDb.commit()
 
 
         return camera
@@ -475,11 +684,7 @@ class SyncApiImageView(SyncApiBaseView):
         # offset createDate to account for difference between local and remote sites
         image_metadata['createDate'] += (image_metadata['utc_offset'] - datetime.now().astimezone().utcoffset().total_seconds())
 
-        camera_createDate = datetime.fromtimestamp(image_metadata['createDate'])
-        folder = self.getImageFolder(camera_createDate, image_metadata['night'], camera)
-
-        date_str = camera_createDate.strftime('%Y%m%d_%H%M%S')
-        image_file_p = folder.joinpath(self.filename_t.format(camera.id, date_str, tmp_file_p.suffix))  # suffix includes dot
+        image_file_p = self.getFilePath(camera, image_metadata, tmp_file_p.suffix)
 
 
         if not image_file_p.exists():
@@ -491,7 +696,7 @@ class SyncApiImageView(SyncApiBaseView):
 
                 app.logger.warning('Removing orphaned image entry')
                 db.session.delete(old_image_entry)
-                db.session.commit()
+                self._miscDb.commit()
             except NoResultFound:
                 pass
 
@@ -501,7 +706,7 @@ class SyncApiImageView(SyncApiBaseView):
                 raise EntryExists()
 
             app.logger.warning('Replacing image')
-            image_file_p.unlink()
+            self.removeReplacedFile(image_file_p)
 
             try:
                 old_image_entry = self.model.query\
@@ -510,7 +715,7 @@ class SyncApiImageView(SyncApiBaseView):
 
                 app.logger.warning('Removing old image entry')
                 db.session.delete(old_image_entry)
-                db.session.commit()
+                self._miscDb.commit()
             except NoResultFound:
                 pass
 
@@ -523,22 +728,24 @@ class SyncApiImageView(SyncApiBaseView):
         )
 
 
-        tmp_file_size = tmp_file_p.stat().st_size
-        if tmp_file_size != 0:
-            # only copy file if it is not empty
-            # if the empty file option is selected, this can be expected
-            shutil.copy2(str(tmp_file_p), str(image_file_p))
-            image_file_p.chmod(0o644)
-
-
-        tmp_file_p.unlink()
+        self.moveMedia(tmp_file_p, image_file_p)
 
         app.logger.info('Uploaded image: %s', image_file_p)
 
         return new_entry
 
 
-    def getImageFolder(self, exp_date, night, camera):
+    def getFilePath(self, camera, image_metadata, suffix, create=True):
+        camera_createDate = datetime.fromtimestamp(image_metadata['createDate'])
+        folder = self.getImageFolder(camera_createDate, image_metadata['night'], camera, create=create)
+
+        date_str = camera_createDate.strftime('%Y%m%d_%H%M%S')
+        image_file_p = folder.joinpath(self.filename_t.format(camera.id, date_str, suffix))  # suffix includes dot
+
+        return image_file_p
+
+
+    def getImageFolder(self, exp_date, night, camera, create=True):
         if night:
             # images should be written to previous day's folder until noon
             day_ref = exp_date - timedelta(hours=12)
@@ -556,14 +763,14 @@ class SyncApiImageView(SyncApiBaseView):
             timeofday_str,
         )
 
-        if not day_folder.exists():
+        if create and not day_folder.exists():
             day_folder.mkdir(mode=0o755, parents=True)
 
 
         hour_str = exp_date.strftime('%d_%H')
 
         hour_folder = day_folder.joinpath('{0:s}'.format(hour_str))
-        if not hour_folder.exists():
+        if create and not hour_folder.exists():
             hour_folder.mkdir(mode=0o755)
 
         return hour_folder
@@ -648,6 +855,59 @@ class SyncApiThumbnailView(SyncApiBaseView):
         # offset createDate to account for difference between local and remote sites
         thumbnail_metadata['createDate'] += (thumbnail_metadata['utc_offset'] - datetime.now().astimezone().utcoffset().total_seconds())
 
+        thumbnail_file_p = self.getFilePath(camera, thumbnail_metadata, tmp_file_p.suffix)
+
+
+        if not thumbnail_file_p.exists():
+            try:
+                # delete old entry if it exists
+                old_thumbnail_entry = self.model.query\
+                    .filter(self.model.filename == str(thumbnail_file_p))\
+                    .one()
+
+                app.logger.warning('Removing orphaned thumbnail entry')
+                db.session.delete(old_thumbnail_entry)
+                self._miscDb.commit()
+            except NoResultFound:
+                pass
+
+
+        else:
+            if not overwrite:
+                raise EntryExists()
+
+            app.logger.warning('Replacing image')
+            self.removeReplacedFile(thumbnail_file_p)
+
+            try:
+                old_image_entry = self.model.query\
+                    .filter(self.model.filename == str(thumbnail_file_p))\
+                    .one()
+
+                app.logger.warning('Removing old image entry')
+                db.session.delete(old_image_entry)
+                self._miscDb.commit()
+            except NoResultFound:
+                pass
+
+
+        addFunction_method = getattr(self._miscDb, self.add_function)
+        new_entry = addFunction_method(
+            thumbnail_file_p,
+            camera.id,
+            thumbnail_metadata,
+        )
+
+
+        self.moveMedia(tmp_file_p, thumbnail_file_p)
+
+        app.logger.info('Uploaded thumbnail: %s', thumbnail_file_p)
+
+        return new_entry
+
+
+    def getFilePath(self, camera_notUsed, thumbnail_metadata, suffix, create=True):
+        # the thumbnail folder is created when the file is moved
         camera_createDate = datetime.fromtimestamp(thumbnail_metadata['createDate'])
 
         d_dayDate = datetime.strptime(thumbnail_metadata['dayDate'], '%Y%m%d').date()
@@ -689,68 +949,235 @@ class SyncApiThumbnailView(SyncApiBaseView):
             )
 
 
-        thumbnail_file_p = thumbnail_dir_p.joinpath(self.filename_t.format(thumbnail_metadata['uuid'], tmp_file_p.suffix))  # suffix includes dot
+        thumbnail_file_p = thumbnail_dir_p.joinpath(self.filename_t.format(thumbnail_metadata['uuid'], suffix))  # suffix includes dot
 
+        return thumbnail_file_p
 
-        if not thumbnail_file_p.exists():
-            try:
-                # delete old entry if it exists
-                old_thumbnail_entry = self.model.query\
-                    .filter(self.model.filename == str(thumbnail_file_p))\
-                    .one()
 
-                app.logger.warning('Removing orphaned thumbnail entry')
-                db.session.delete(old_thumbnail_entry)
-                db.session.commit()
-            except NoResultFound:
-                pass
+class SyncApiBatchView(SyncApiBaseView):
+    # Multiple entries are uploaded in a single request.  The metadata part contains
+    # a list of items with the type, metadata and the name of the media part for each
+    # entry.  The request is authenticated once and all entries are stored in a
+    # single transaction.  Results are returned for each item.
 
+    decorators = []
 
-        else:
-            if not overwrite:
-                raise EntryExists()
+    max_items = 100
 
-            app.logger.warning('Replacing image')
-            thumbnail_file_p.unlink()
+    view_classes = {
+        constants.IMAGE           : SyncApiImageView,
+        constants.VIDEO           : SyncApiVideoView,
+        constants.KEOGRAM         : SyncApiKeogramView,
+        constants.STARTRAIL       : SyncApiStartrailView,
+        constants.STARTRAIL_VIDEO : SyncApiStartrailVideoView,
+        constants.RAW_IMAGE       : SyncApiRawImageView,
+        constants.FITS_IMAGE      : SyncApiFitsImageView,
+        constants.PANORAMA_IMAGE  : SyncApiPanoramaImageView,
+        constants.PANORAMA_VIDEO  : SyncApiPanoramaVideoView,
+        constants.THUMBNAIL       : SyncApiThumbnailView,
+    }
+
+
+    def post(self, overwrite=False):
+        batch_metadata = self.saveMetadata(request.files['metadata'])
+
+        item_list = batch_metadata.get('items', [])
+
+        if len(item_list) > self.max_items:
+            return jsonify({'error' : 'too many items'}), 400
+
+
+        camera_dict = dict()
+        result_list = list()
+
+        self._media_moves = dict()
+
+        self._miscDb.startBatch()
+
+        try:
+            for item in item_list:
+                move_count = len(self._media_moves)
+
+                try:
+                    # a failed entry only rolls back its own savepoint
+                    with db.session.begin_nested():
+                        result_list.append(self.processItem(item, camera_dict, overwrite=overwrite))
+                except Exception as e:
+                    app.logger.error('Batch entry failed: %s', str(e))
+
+                    for tmp_file_p in list(self._media_moves.keys())[move_count:]:
+                        self._media_moves.pop(tmp_file_p)
+                        self.removeTempFile(tmp_file_p)
+
+                    result_list.append({'error' : 'entry failed'})
+
+
+            self._miscDb.commitBatch()
+        except Exception:
+            self._miscDb.rollbackBatch()
+
+            for tmp_file_p in self._media_moves.keys():
+                self.removeTempFile(tmp_file_p)
+
+            raise
+
+
+        # files are moved into place once the entries are committed
+        for tmp_file_p, filename_p in self._media_moves.items():
+            self.renameMedia(tmp_file_p, filename_p)
+
+
+        app.logger.info('Uploaded %d batch entries', len([r for r in result_list if 'id' in r]))
+
+        return jsonify({
+            'results' : result_list,
+        })
+
+
+    def processItem(self, item, camera_dict, overwrite=False):
+        try:
+            view_class = self.view_classes[item['type']]
+        except KeyError:
+            return {'error' : 'invalid type'}
+
+
+        media_file = request.files.get(item['media'])
+        if not media_file:
+            return {'error' : 'media missing'}
+
+
+        metadata = item['metadata']
+
+        tmp_media_file_p, media_sha256 = self.saveMedia(media_file)
+
+
+        try:
+            media_file_size = tmp_media_file_p.stat().st_size
+            if media_file_size != metadata.get('file_size', -1):
+                return {'error' : 'file size mismatch'}
+
+
+            if metadata.get('sha256') and media_sha256 != metadata['sha256']:
+                return {'error' : 'hash mismatch'}
+
+
+            camera = camera_dict.get(metadata['camera_uuid'])
+            if not camera:
+                try:
+                    camera = self.getCamera(metadata)
+                except NoResultFound:
+                    app.logger.error('Camera not found: %s', metadata['camera_uuid'])
+                    return {'error' : 'camera not found'}
+
+                camera_dict[metadata['camera_uuid']] = camera
+
+
+            handler = view_class.batchHandler(self)
 
             try:
-                old_image_entry = self.model.query\
-                    .filter(self.model.filename == str(thumbnail_file_p))\
-                    .one()
+                file_entry = handler.processPost(camera, metadata, tmp_media_file_p, overwrite=overwrite)
+            except EntryExists:
+                return {'error' : 'file_exists'}
 
-                app.logger.warning('Removing old image entry')
-                db.session.delete(old_image_entry)
-                db.session.commit()
+
+            return {
+                'id'   : file_entry.id,
+                'url'  : str(file_entry.getUrl(local=True)),
+            }
+        finally:
+            # the temp file is renamed into place after the batch is committed
+            if tmp_media_file_p not in self._media_moves:
+                self.removeTempFile(tmp_media_file_p)
+
+
+    def get(self):
+        return jsonify({'error' : 'not_implemented'}), 400
+
+
+    def delete(self):
+        return jsonify({'error' : 'not_implemented'}), 400
+
+
+class SyncApiCheckView(SyncApiBaseView):
+    # The client sends the size and SHA-256 hash of the files before uploading.  Entries
+    # where the server already has a file with the same content and the same metadata
+    # are not uploaded again.
+
+    decorators = []
+
+    max_items = 500
+
+
+    def post(self):
+        check_metadata = self.saveMetadata(request.files['metadata'])
+
+        item_list = check_metadata.get('items', [])
+
+        if len(item_list) > self.max_items:
+            return jsonify({'error' : 'too many items'}), 400
+
+
+        camera_dict = dict()
+        result_list = list()
+
+        for item in item_list:
+            result_list.append(self.checkItem(item, camera_dict))
+
+
+        return jsonify({
+            'results' : result_list,
+        })
+
+
+    def checkItem(self, item, camera_dict):
+        try:
+            view_class = SyncApiBatchView.view_classes[item['type']]
+        except KeyError:
+            return {'error' : 'invalid type'}
+
+
+        metadata = item['metadata']
+
+        if not metadata.get('sha256'):
+            return {'exists' : False}
+
+
+        camera = camera_dict.get(metadata['camera_uuid'])
+        if not camera:
+            try:
+                camera = self.getCamera(metadata)
             except NoResultFound:
-                pass
+                app.logger.error('Camera not found: %s', metadata['camera_uuid'])
+                return {'error' : 'camera not found'}
 
+            camera_dict[metadata['camera_uuid']] = camera
 
-        addFunction_method = getattr(self._miscDb, self.add_function)
-        new_entry = addFunction_method(
-            thumbnail_file_p,
-            camera.id,
-            thumbnail_metadata,
-        )
 
+        handler = view_class.batchHandler(self)
 
-        tmp_file_size = tmp_file_p.stat().st_size
-        if tmp_file_size != 0:
-            # only copy file if it is not empty
-            # if the empty file option is selected, this can be expected
+        try:
+            file_entry = handler.checkEntry(camera, metadata, item['suffix'])
+        except EntryMissing:
+            return {'exists' : False}
 
-            thumbnail_dir_p = thumbnail_file_p.parent
-            if not thumbnail_dir_p.exists():
-                thumbnail_dir_p.mkdir(mode=0o755, parents=True)
 
-            shutil.copy2(str(tmp_file_p), str(thumbnail_file_p))
-            thumbnail_file_p.chmod(0o644)
+        return {
+            'exists' : True,
+            'id'     : file_entry.id,
+            'url'    : str(file_entry.getUrl(local=True)),
+        }
 
 
-        tmp_file_p.unlink()
+    def put(self):
+        return jsonify({'error' : 'not_implemented'}), 400
 
-        app.logger.info('Uploaded thumbnail: %s', thumbnail_file_p)
 
-        return new_entry
+    def get(self):
+        return jsonify({'error' : 'not_implemented'}), 400
+
+
+    def delete(self):
+        return jsonify({'error' : 'not_implemented'}), 400
 
 
 class EntryExists(Exception):
@@ -776,4 +1203,5 @@ bp_syncapi_allsky.add_url_rule('/sync/v1/fitsimage', view_func=SyncApiFitsImageV
 bp_syncapi_allsky.add_url_rule('/sync/v1/panoramaimage', view_func=SyncApiPanoramaImageView.as_view('syncapi_v1_panoramaimage_view'), methods=['GET', 'POST', 'PUT', 'DELETE'])
 bp_syncapi_allsky.add_url_rule('/sync/v1/panoramavideo', view_func=SyncApiPanoramaVideoView.as_view('syncapi_v1_panorama_video_view'), methods=['GET', 'POST', 'PUT', 'DELETE'])
 bp_syncapi_allsky.add_url_rule('/sync/v1/thumbnail', view_func=SyncApiThumbnailView.as_view('syncapi_v1_thumbnail_view'), methods=['GET', 'POST', 'PUT', 'DELETE'])
-
+bp_syncapi_allsky.add_url_rule('/sync/v1/batch', view_func=SyncApiBatchView.as_view('syncapi_v1_batch_view'), methods=['POST', 'PUT'])
+bp_syncapi_allsky.add_url_rule('/sync/v1/check', view_func=SyncApiCheckView.as_view('syncapi_v1_check_view'), methods=['POST'])
@@ -6,6 +6,7 @@ import json
 import time
 import math
 import base64
+import zlib
 from pathlib import Path
 import socket
 import ipaddress
@@ -363,6 +364,50 @@ class JsonLatestPanoramaView(JsonLatestImageView):
     latest_image_t = 'images/panorama.{0}'
 
 
+class LatestKeogramView(IndexView):
+    title = 'Keogram'
+    latest_image_view = 'indi_allsky.js_latest_keogram_view'
+
+
+class JsonLatestKeogramView(JsonView):
+    latest_image_t = 'images/latest_keogram.{0}'
+
+
+    def get_objects(self):
+        data = {
+            'latest_image' : {
+                'url' : None,
+                'message' : 'Keogram not available',
+            },
+        }
+
+
+        if not self.indi_allsky_config.get('KEOGRAM_STARTRAILS_INCREMENTAL'):
+            data['latest_image']['message'] = 'Incremental keogram disabled'
+            return data
+
+
+        if self.web_nonlocal_images:
+            if not self.verify_admin_network():
+                # only show locally hosted assets if coming from admin networks
+                return data
+
+
+        # keogram is updated as images are captured
+        latest_keogram_uri = Path(self.latest_image_t.format(self.indi_allsky_config.get('IMAGE_FILE_TYPE', 'jpg')))
+
+        # same folder the image URLs are served from
+        image_dir = Path(app.config['INDI_ALLSKY_IMAGE_FOLDER']).absolute()
+        latest_keogram_p = image_dir.joinpath(latest_keogram_uri.name)
+
+        if latest_keogram_p.exists():
+            data['latest_image']['url'] = '{0:s}?{1:d}'.format(str(latest_keogram_uri), int(latest_keogram_p.stat().st_mtime))
+            data['latest_image']['message'] = ''
+
+
+        return data
+
+
 class LatestRawImageView(IndexView):
     title = 'RAW Image'
     latest_image_view = 'indi_allsky.js_latest_rawimage_view'
@@ -1133,6 +1178,11 @@ class JsonChartView(JsonView):
             return chart_data
 
 
+        if latest_image.data and latest_image.data.get('histogram'):
+            # use histogram calculated when the image was processed
+            return self.loadHistogram(chart_data, latest_image.data['histogram'])
+
+
         latest_image_p = latest_image.getFilesystemPath()
         if not latest_image_p.exists():
             app.logger.error('Image does not exist: %s', latest_image_p)
@@ -1160,9 +1210,15 @@ class JsonChartView(JsonView):
         numpy_mask = numpy.full(image_data.shape[:2], True, numpy.bool_)
 
 
-        _sqm_mask = self._load_detection_mask()
+        detection_mask = self._load_detection_mask()
+        _numpy_mask = detection_mask.numpyMask()
 
-        if isinstance(_sqm_mask, type(None)):
+        if not isinstance(_numpy_mask, type(None)) and _numpy_mask.shape[:2] != image_data.shape[:2]:
+            app.logger.error('Detection mask dimensions do not match image, using SQM ROI for histogram')
+            _numpy_mask = None
+
+
+        if isinstance(_numpy_mask, type(None)):
             sqm_roi = self.indi_allsky_config.get('SQM_ROI', [])
 
             try:
@@ -1182,8 +1238,13 @@ class JsonChartView(JsonView):
             # True values will be masked
             numpy_mask[y1:y2, x1:x2] = False
         else:
+            # only the area inside the bounding box of the mask is used
+            x1, y1, x2, y2 = detection_mask.bbox()
+
+            image_data = image_data[y1:y2, x1:x2]
+
             # True values will be masked
-            numpy_mask = _sqm_mask == 0
+            numpy_mask = _numpy_mask[y1:y2, x1:x2]
 
 
         if len(image_data.shape) == 2:
@@ -1222,6 +1283,24 @@ class JsonChartView(JsonView):
         return chart_data
 
 
+    def loadHistogram(self, chart_data, histogram):
+        import numpy
+
+        counts = numpy.frombuffer(zlib.decompress(base64.b64decode(histogram['counts'])), dtype='<u4')
+        counts = counts.reshape((len(histogram['channels']), 256))
+
+        for col, h_numpy in zip(histogram['channels'], counts):
+            for x, val in enumerate(h_numpy.tolist()):
+                h_data = {
+                    'x' : str(x),
+                    'y' : val,
+                }
+                chart_data['histogram'][col].append(h_data)
+
+
+        return chart_data
+
+
 class ConfigView(FormView):
     decorators = [login_required]
 
@@ -1324,8 +1403,13 @@ class ConfigView(FormView):
             'STARTRAILS_MIN_STARS'           : self.indi_allsky_config.get('STARTRAILS_MIN_STARS', 0),
             'STARTRAILS_TIMELAPSE'           : self.indi_allsky_config.get('STARTRAILS_TIMELAPSE', True),
             'STARTRAILS_TIMELAPSE_MINFRAMES' : self.indi_allsky_config.get('STARTRAILS_TIMELAPSE_MINFRAMES', 250),
+            'STARTRAILS_TIMELAPSE_STREAM'    : self.indi_allsky_config.get('STARTRAILS_TIMELAPSE_STREAM', True),
             'STARTRAILS_USE_DB_DATA'         : self.indi_allsky_config.get('STARTRAILS_USE_DB_DATA', True),
+            'KEOGRAM_STARTRAILS_INCREMENTAL' : self.indi_allsky_config.get('KEOGRAM_STARTRAILS_INCREMENTAL', False),
+            'FRAME_DECODE_WORKERS'           : self.indi_allsky_config.get('FRAME_DECODE_WORKERS', 0),
+            'FRAME_DECODE_PREFETCH'          : self.indi_allsky_config.get('FRAME_DECODE_PREFETCH', 4),
             'IMAGE_CALIBRATE_DARK'           : self.indi_allsky_config.get('IMAGE_CALIBRATE_DARK', True),
+            'IMAGE_CALIBRATE_CACHE_MB'       : self.indi_allsky_config.get('IMAGE_CALIBRATE_CACHE_MB', 128),
             'IMAGE_SAVE_FITS_PRE_DARK'       : self.indi_allsky_config.get('IMAGE_SAVE_FITS_PRE_DARK', False),
             'IMAGE_EXIF_PRIVACY'             : self.indi_allsky_config.get('IMAGE_EXIF_PRIVACY', False),
             'IMAGE_FILE_TYPE'                : self.indi_allsky_config.get('IMAGE_FILE_TYPE', 'jpg'),
@@ -1377,8 +1461,12 @@ class ConfigView(FormView):
             'IMAGE_QUEUE_MAX'                : self.indi_allsky_config.get('IMAGE_QUEUE_MAX', 3),
             'IMAGE_QUEUE_MIN'                : self.indi_allsky_config.get('IMAGE_QUEUE_MIN', 1),
             'IMAGE_QUEUE_BACKOFF'            : self.indi_allsky_config.get('IMAGE_QUEUE_BACKOFF', 0.5),
+            'IMAGE_WRITER_QUEUE'             : self.indi_allsky_config.get('IMAGE_WRITER_QUEUE', 3),
+            'IMAGE_SHARED_MEMORY'            : self.indi_allsky_config.get('IMAGE_SHARED_MEMORY', True),
             'THUMBNAILS__IMAGES_AUTO'        : self.indi_allsky_config.get('THUMBNAILS', {}).get('IMAGES_AUTO', True),
             'TIMELAPSE_EXPIRE_DAYS'          : self.indi_allsky_config.get('TIMELAPSE_EXPIRE_DAYS', 365),
+            'EXPIRE_BATCH_SIZE'              : self.indi_allsky_config.get('EXPIRE_BATCH_SIZE', 500),
+            'EXPIRE_TIME_BUDGET'             : self.indi_allsky_config.get('EXPIRE_TIME_BUDGET', 300),
             'FFMPEG_FRAMERATE'               : self.indi_allsky_config.get('FFMPEG_FRAMERATE', 25),
             'FFMPEG_BITRATE'                 : self.indi_allsky_config.get('FFMPEG_BITRATE', '5000k'),
             'FFMPEG_VFSCALE'                 : self.indi_allsky_config.get('FFMPEG_VFSCALE', ''),
@@ -2020,8 +2108,13 @@ class AjaxConfigView(BaseView):
         self.indi_allsky_config['STARTRAILS_MIN_STARS']                 = int(request.json['STARTRAILS_MIN_STARS'])
         self.indi_allsky_config['STARTRAILS_TIMELAPSE']                 = bool(request.json['STARTRAILS_TIMELAPSE'])
         self.indi_allsky_config['STARTRAILS_TIMELAPSE_MINFRAMES']       = int(request.json['STARTRAILS_TIMELAPSE_MINFRAMES'])
+        self.indi_allsky_config['STARTRAILS_TIMELAPSE_STREAM']          = bool(request.json['STARTRAILS_TIMELAPSE_STREAM'])
         self.indi_allsky_config['STARTRAILS_USE_DB_DATA']               = bool(request.json['STARTRAILS_USE_DB_DATA'])
+        self.indi_allsky_config['KEOGRAM_STARTRAILS_INCREMENTAL']       = bool(request.json['KEOGRAM_STARTRAILS_INCREMENTAL'])
+        self.indi_allsky_config['FRAME_DECODE_WORKERS']                 = int(request.json['FRAME_DECODE_WORKERS'])
+        self.indi_allsky_config['FRAME_DECODE_PREFETCH']                = int(request.json['FRAME_DECODE_PREFETCH'])
         self.indi_allsky_config['IMAGE_CALIBRATE_DARK']                 = bool(request.json['IMAGE_CALIBRATE_DARK'])
+        self.indi_allsky_config['IMAGE_CALIBRATE_CACHE_MB']             = int(request.json['IMAGE_CALIBRATE_CACHE_MB'])
         self.indi_allsky_config['IMAGE_SAVE_FITS_PRE_DARK']             = bool(request.json['IMAGE_SAVE_FITS_PRE_DARK'])
         self.indi_allsky_config['IMAGE_EXIF_PRIVACY']                   = bool(request.json['IMAGE_EXIF_PRIVACY'])
         self.indi_allsky_config['IMAGE_FILE_TYPE']                      = str(request.json['IMAGE_FILE_TYPE'])
@@ -2075,8 +2168,12 @@ class AjaxConfigView(BaseView):
         self.indi_allsky_config['IMAGE_QUEUE_MAX']                      = int(request.json['IMAGE_QUEUE_MAX'])
         self.indi_allsky_config['IMAGE_QUEUE_MIN']                      = int(request.json['IMAGE_QUEUE_MIN'])
         self.indi_allsky_config['IMAGE_QUEUE_BACKOFF']                  = float(request.json['IMAGE_QUEUE_BACKOFF'])
+        self.indi_allsky_config['IMAGE_WRITER_QUEUE']                   = int(request.json['IMAGE_WRITER_QUEUE'])
+        self.indi_allsky_config['IMAGE_SHARED_MEMORY']                  = bool(request.json['IMAGE_SHARED_MEMORY'])
         self.indi_allsky_config['THUMBNAILS']['IMAGES_AUTO']            = bool(request.json['THUMBNAILS__IMAGES_AUTO'])
         self.indi_allsky_config['TIMELAPSE_EXPIRE_DAYS']                = int(request.json['TIMELAPSE_EXPIRE_DAYS'])
+        self.indi_allsky_config['EXPIRE_BATCH_SIZE']                    = int(request.json['EXPIRE_BATCH_SIZE'])
+        self.indi_allsky_config['EXPIRE_TIME_BUDGET']                   = int(request.json['EXPIRE_TIME_BUDGET'])
         self.indi_allsky_config['FFMPEG_FRAMERATE']                     = int(request.json['FFMPEG_FRAMERATE'])
         self.indi_allsky_config['FFMPEG_BITRATE']                       = str(request.json['FFMPEG_BITRATE'])
         self.indi_allsky_config['FFMPEG_VFSCALE']                       = str(request.json['FFMPEG_VFSCALE'])
@@ -3914,6 +4011,10 @@ class AjaxSystemInfoView(BaseView):
         self._deleteAssets(IndiAllSkyDbPanoramaVideoTable, panorama_video_id_list)
 
 
+        if image_id_list:
+            self._miscDb.updateImageRollup(camera_id=camera_id)
+
+
         return file_count
 
 
@@ -4223,6 +4324,11 @@ class AjaxSystemInfoView(BaseView):
         # finalize transaction
         db.session.commit()
 
+
+        if image_notfound_list:
+            self._miscDb.updateImageRollup()
+
+
         return message_list
 
 
@@ -6540,6 +6646,8 @@ bp_allsky.add_url_rule('/', view_func=IndexView.as_view('index_view', template_n
 bp_allsky.add_url_rule('/js/latest', view_func=JsonLatestImageView.as_view('js_latest_image_view'))
 bp_allsky.add_url_rule('/panorama', view_func=LatestPanoramaView.as_view('latest_panorama_view', template_name='index.html'))
 bp_allsky.add_url_rule('/js/latest_panorama', view_func=JsonLatestPanoramaView.as_view('js_latest_panorama_view'))
+bp_allsky.add_url_rule('/keogram', view_func=LatestKeogramView.as_view('latest_keogram_view', template_name='index.html'))
+bp_allsky.add_url_rule('/js/latest_keogram', view_func=JsonLatestKeogramView.as_view('js_latest_keogram_view'))
 bp_allsky.add_url_rule('/raw', view_func=LatestRawImageView.as_view('latest_rawimage_view', template_name='index.html'))
 bp_allsky.add_url_rule('/js/latest_rawimage', view_func=JsonLatestRawImageView.as_view('js_latest_rawimage_view'))
 
@@ -0,0 +1,172 @@
+import time
+import cv2
+import logging
+
+
+logger = logging.getLogger('indi_allsky')
+
+
+class IndiAllSkyFrameAnalysis(object):
+    # Derived data for the analysis stages of a single frame.  Everything is computed
+    # the first time it is requested and shared by the following stages, the grayscale
+    # conversion is done once instead of once per stage.
+    #
+    # Data is cached for the most recent source array, a new array (the image changes
+    # during processing) replaces the derived data of the previous array.  Derived data
+    # is not updated when the source array is modified in place (detections drawn on
+    # the image).
+    #
+    # Create a new instance for every frame.
+
+    def __init__(self):
+        self._source = None
+        self._source_cache = dict()
+
+        self._stage_times = dict()  # insertion order is kept
+        self._derived_elapsed_s = 0.0
+
+
+    def _cache(self, data):
+        # the previous array and its derived data (the 16-bit frame) are released
+        if data is not self._source:
+            self._source = data
+            self._source_cache = dict()
+
+        return self._source_cache
+
+
+    def gray(self, data):
+        if len(data.shape) == 2:
+            # mono
+            return data
+
+
+        cache = self._cache(data)
+
+        try:
+            return cache['gray']
+        except KeyError:
+            pass
+
+
+        derived_start = time.time()
+
+        data_gray = cv2.cvtColor(data, cv2.COLOR_BGR2GRAY)
+        cache['gray'] = data_gray
+
+        self._derived_elapsed_s += time.time() - derived_start
+
+        return data_gray
+
+
+    def takeGray(self, data):
+        # the grayscale data is removed from the cache and owned by the caller, for the
+        # last stage that needs the full frame.  Later stages convert only their region.
+        if len(data.shape) == 2:
+            # mono, the source is not modified
+            return data.copy()
+
+
+        data_gray = self.gray(data)
+
+        del self._source_cache['gray']
+
+        return data_gray
+
+
+    def grayRoi(self, data, roi):
+        # roi is x, y, w, h
+        x, y, w, h = roi
+
+        if len(data.shape) == 2:
+            # mono
+            return data[y:y + h, x:x + w]
+
+
+        cache = self._cache(data)
+
+        if 'gray' in cache:
+            return cache['gray'][y:y + h, x:x + w]
+
+
+        roi_key = ('gray_roi', x, y, w, h)
+
+        try:
+            return cache[roi_key]
+        except KeyError:
+            pass
+
+
+        # only the region is converted
+        derived_start = time.time()
+
+        data_gray = cv2.cvtColor(data[y:y + h, x:x + w], cv2.COLOR_BGR2GRAY)
+        cache[roi_key] = data_gray
+
+        self._derived_elapsed_s += time.time() - derived_start
+
+        return data_gray
+
+
+    def mean(self, data, mask=None):
+        # grayscale mean
+        cache = self._cache(data)
+
+        mean_key = ('mean', id(mask))
+
+        try:
+            return cache[mean_key][0]
+        except KeyError:
+            pass
+
+
+        data_gray = self.gray(data)
+
+        derived_start = time.time()
+
+        mean = cv2.mean(src=data_gray, mask=mask)[0]
+        cache[mean_key] = (mean, mask)  # mask is referenced so the id is not reused
+
+        self._derived_elapsed_s += time.time() - derived_start
+
+        return mean
+
+
+    def channelMeans(self, data, mask=None):
+        # BGR order, a single value for mono
+        cache = self._cache(data)
+
+        means_key = ('channel_means', id(mask))
+
+        try:
+            return cache[means_key][0]
+        except KeyError:
+            pass
+
+
+        derived_start = time.time()
+
+        if len(data.shape) == 2:
+            channels = 1
+        else:
+            channels = data.shape[2]
+
+        channel_means = cv2.mean(src=data, mask=mask)[:channels]
+        cache[means_key] = (channel_means, mask)
+
+        self._derived_elapsed_s += time.time() - derived_start
+
+        return channel_means
+
+
+    def addStageTime(self, stage, elapsed_s):
+        self._stage_times[stage] = self._stage_times.get(stage, 0.0) + elapsed_s
+
+
+    def logStageTimes(self):
+        if not self._stage_times:
+            return
+
+        stage_str = ', '.join(['{0:s} {1:0.4f} s'.format(k, v) for k, v in self._stage_times.items()])
+
+        logger.info('Frame analysis: %s, derived data %0.4f s', stage_str, self._derived_elapsed_s)
@@ -0,0 +1,154 @@
+import os
+import time
+import psutil
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy
+import cv2
+import PIL
+from PIL import Image
+import logging
+
+
+logger = logging.getLogger('indi_allsky')
+
+
+class IndiAllSkyFrameDecoder(object):
+    # Decodes an ordered list of images on a thread pool, frames are returned in order.
+    # OpenCV and Pillow release the GIL while decoding.
+
+    low_memory_mb = 1024  # serial decode below this amount of memory
+
+    def __init__(self, config):
+        self.config = config
+
+        self._workers = int(self.config.get('FRAME_DECODE_WORKERS', 0))
+        if self._workers <= 0:
+            # automatic
+            self._workers = self.autoWorkers()
+
+        self._prefetch = int(self.config.get('FRAME_DECODE_PREFETCH', 4))
+
+        self.decoded_count = 0
+        self.wait_elapsed_s = 0  # time the consumer spent waiting on frames
+
+
+    @property
+    def workers(self):
+        return self._workers
+
+    @workers.setter
+    def workers(self, new_workers):
+        self._workers = int(new_workers)
+
+
+    def autoWorkers(self):
+        # leave a core for the keogram/star trail processing
+        cpu_count = os.cpu_count() or 1
+
+        memory_info = psutil.virtual_memory()
+        memory_total_mb = memory_info[0] / 1024.0 / 1024.0
+
+        if cpu_count <= 1 or memory_total_mb < self.low_memory_mb:
+            # decoded frames are held in memory
+            return 1
+
+        return max(1, min(4, cpu_count - 1))
+
+
+    @property
+    def prefetch(self):
+        return self._prefetch
+
+    @prefetch.setter
+    def prefetch(self, new_prefetch):
+        self._prefetch = int(new_prefetch)
+
+
+    def decode(self, entries, path_func=None):
+        # Yields (entry, file_p, image) tuples in the same order as entries
+        # image is None if the file could not be read
+        #
+        # path_func is called in the calling thread, DB objects are never passed to the pool
+
+        if isinstance(path_func, type(None)):
+            path_func = lambda x: x  # noqa: E731
+
+
+        if self._workers <= 1:
+            for entry in entries:
+                file_p = path_func(entry)
+
+                wait_start = time.time()
+                image = self.decodeFile(file_p)
+                self.wait_elapsed_s += time.time() - wait_start
+
+                self.decoded_count += 1
+                yield entry, file_p, image
+
+            return
+
+
+        # decoded frames held in memory are limited to the number of workers + prefetch
+        window = self._workers + max(self._prefetch, 0)
+
+        executor = ThreadPoolExecutor(max_workers=self._workers, thread_name_prefix='FrameDecode')
+        pending = deque()
+
+        try:
+            for entry in entries:
+                file_p = path_func(entry)
+                pending.append((entry, file_p, executor.submit(self.decodeFile, file_p)))
+
+                if len(pending) >= window:
+                    yield self._next(pending)
+
+
+            while pending:
+                yield self._next(pending)
+        finally:
+            # consumer stopped early
+            for entry, file_p, future in pending:
+                future.cancel()
+
+            executor.shutdown(wait=True)
+
+
+    def _next(self, pending):
+        entry, file_p, future = pending.popleft()
+
+        wait_start = time.time()
+        image = future.result()
+        self.wait_elapsed_s += time.time() - wait_start
+
+        self.decoded_count += 1
+
+        return entry, file_p, image
+
+
+    def decodeFile(self, file_p):
+        if not file_p.exists():
+            logger.error('File not found: %s', file_p)
+            return None
+
+        if file_p.stat().st_size == 0:
+            return None
+
+
+        if file_p.suffix in ('.png',):
+            # opencv is faster than Pillow with PNG
+            image = cv2.imread(str(file_p), cv2.IMREAD_COLOR)
+
+            if isinstance(image, type(None)):
+                logger.error('Unable to read %s', file_p)
+                return None
+        else:
+            try:
+                with Image.open(str(file_p)) as img:
+                    image = cv2.cvtColor(numpy.array(img), cv2.COLOR_RGB2BGR)
+            except PIL.UnidentifiedImageError:
+                logger.error('Unable to read %s', file_p)
+                return None
+
+
+        return image
@@ -1,4 +1,5 @@
 import io
+import os
 import json
 import re
 from pathlib import Path
@@ -31,17 +32,22 @@ from fractions import Fraction
 from . import constants
 
 from .processing import ImageProcessor
+from .rollingProducts import IndiAllSkyRollingProducts
+from .imageWriter import IndiAllSkyImageWriter
+from .frameAnalysis import IndiAllSkyFrameAnalysis
+from .sharedFrame import IndiAllSkySharedFrame
 from .miscUpload import miscUpload
 
 from .flask import create_app
 from .flask import db
 from .flask.miscDb import miscDb
 
-from .flask.models import TaskQueueState
-from .flask.models import TaskQueueQueue
 from .flask.models import IndiAllSkyDbCameraTable
 from .flask.models import IndiAllSkyDbImageTable
-from .flask.models import IndiAllSkyDbTaskQueueTable
+from .flask.models import IndiAllSkyDbThumbnailTable
+from .flask.models import IndiAllSkyDbFitsImageTable
+from .flask.models import IndiAllSkyDbRawImageTable
+from .flask.models import IndiAllSkyDbPanoramaImageTable
 
 from sqlalchemy import func
 #from sqlalchemy.orm.exc import NoResultFound
@@ -158,7 +164,17 @@ class ImageWorker(Process):
         )
 
         self._miscDb = miscDb(self.config)
-        self._miscUpload = miscUpload(self.config, self.upload_q)
+        # upload tasks for each frame are queued together
+        self._miscUpload = miscUpload(self.config, self.upload_q, batch=True)
+
+
+        self._image_writer = IndiAllSkyImageWriter(self.config)
+
+
+        if self.config.get('KEOGRAM_STARTRAILS_INCREMENTAL'):
+            self._rolling = IndiAllSkyRollingProducts(self.config, self.bin_v, image_writer=self._image_writer)
+        else:
+            self._rolling = None
 
 
         self._libcamera_raw = False
@@ -229,24 +245,69 @@ class ImageWorker(Process):
         #raise Exception('Test exception handling in worker')
 
         while True:
+            if self._image_writer.pending:
+                # check back soon for completed writes
+                get_timeout = 0.5
+            else:
+                get_timeout = 23  # prime number
+
+
             try:
-                i_dict = self.image_q.get(timeout=23)  # prime number
+                i_dict = self.image_q.get(timeout=get_timeout)
             except queue.Empty:
+                if self._image_writer.pending:
+                    with app.app_context():
+                        self._image_writer.processCompleted()
+                        self._miscUpload.flush()
+
                 continue
 
 
             if i_dict.get('stop'):
+                self._stopImageWriter()
+
+                if self._rolling:
+                    self._rolling.checkpoint()
+
                 logger.warning('Goodbye')
                 return
 
             if self._shutdown:
+                # the job is discarded
+                self._removeSharedFrame(i_dict)
+
+                self._stopImageWriter()
+
+                if self._rolling:
+                    self._rolling.checkpoint()
+
                 logger.warning('Goodbye')
                 return
 
 
             # new context for every task, reduces the effects of caching
             with app.app_context():
-                self.processImage(i_dict)
+                try:
+                    self.processImage(i_dict)
+                finally:
+                    # the frame is normally removed after it is loaded
+                    self._removeSharedFrame(i_dict)
+
+                self._image_writer.processCompleted()
+
+                self._miscUpload.flush()
+
+
+    def _removeSharedFrame(self, i_dict):
+        if i_dict.get('shared_frame'):
+            IndiAllSkySharedFrame.remove(i_dict['filename'])
+
+
+    def _stopImageWriter(self):
+        # all pending files must be written before exiting
+        with app.app_context():
+            self._image_writer.shutdown()
+            self._miscUpload.flush()
 
 
     def processImage(self, i_dict):
@@ -282,6 +343,7 @@ class ImageWorker(Process):
         exp_elapsed = i_dict['exp_elapsed']
         camera_id = i_dict['camera_id']
         filename_t = i_dict.get('filename_t')
+        shared_frame = i_dict.get('shared_frame')  # frame data in shared memory
 
 
         # libcamera
@@ -331,7 +393,7 @@ class ImageWorker(Process):
 
 
         try:
-            i_ref = self.image_processor.add(filename_p, exposure, exp_date, exp_elapsed, camera)
+            i_ref = self.image_processor.add(filename_p, exposure, exp_date, exp_elapsed, camera, shared_frame=shared_frame)
         except BadImage as e:
             logger.error('Bad Image: %s', str(e))
             filename_p.unlink()
@@ -342,6 +404,10 @@ class ImageWorker(Process):
         filename_p.unlink()  # original file is no longer needed
 
 
+        # derived data shared by the analysis stages of this frame
+        self.image_processor.analysis = IndiAllSkyFrameAnalysis()
+
+
         self.image_count += 1
 
 
@@ -621,6 +687,8 @@ class ImageWorker(Process):
         self.image_processor.label_image()
 
 
+        self.image_processor.analysis.logStageTimes()
+
         processing_elapsed_s = time.time() - processing_start
         logger.info('Image processed in %0.4f s', processing_elapsed_s)
 
@@ -633,7 +701,7 @@ class ImageWorker(Process):
 
         self.write_status_json(i_ref, adu, adu_average)  # write json status file
 
-        latest_file, new_filename = self.write_img(self.image_processor.image, i_ref, camera, jpeg_exif=jpeg_exif)
+        latest_file, new_filename, write_job = self.write_img(self.image_processor.image, i_ref, camera, jpeg_exif=jpeg_exif)
 
         if new_filename:
             image_metadata = {
@@ -674,6 +742,9 @@ class ImageWorker(Process):
             for i, v in enumerate(self.sensors_user_av):
                 image_add_data['sensor_user_{0:d}'.format(i)] = v
 
+            # precalculated for the charts
+            image_add_data['histogram'] = self.image_processor.calculateHistogram()
+
             image_metadata['data'] = image_add_data
 
 
@@ -700,13 +771,34 @@ class ImageWorker(Process):
                 camera.id,
                 image_thumbnail_metadata,
                 numpy_data=self.image_processor.image,
+                write_file=False,
             )
+
+
+            # entries are looked up again when the file is written
+            image_entry_id = image_entry.id
+
+            if image_thumbnail_entry:
+                image_thumbnail_entry_id = image_thumbnail_entry.id
+
+                # thumbnail is resized and encoded by the image writer from the final image
+                thumbnail_job = self._image_writer.submit(
+                    'thumbnail',
+                    self._miscDb.writeThumbnail,
+                    self.image_processor.image,
+                    self.image_dir.joinpath(image_thumbnail_entry.filename),
+                    image_thumbnail_entry.width,
+                )
+            else:
+                image_thumbnail_entry_id = None
+                thumbnail_job = None
         else:
             # images not being saved
-            image_entry = None
+            image_entry_id = None
             image_metadata = {}
-            image_thumbnail_entry = None
+            image_thumbnail_entry_id = None
             image_thumbnail_metadata = {}
+            thumbnail_job = None
 
 
         if latest_file:
@@ -833,18 +925,130 @@ class ImageWorker(Process):
                 upload_filename = latest_file
 
 
-            ### upload thumbnail first
-            if image_thumbnail_entry:
-                self._miscUpload.syncapi_thumbnail(image_thumbnail_entry, image_thumbnail_metadata)  # syncapi before s3
-                self._miscUpload.s3_upload_thumbnail(image_thumbnail_entry, image_thumbnail_metadata)
+            # uploads are queued after the files are written
+            write_job.addCallback(
+                self._imageWritten,
+                image_entry_id,
+                image_metadata,
+                image_thumbnail_entry_id,
+                image_thumbnail_metadata,
+                thumbnail_job,
+                upload_filename,
+                mq_topic_latest,
+                mqtt_data,
+                camera.id,
+                self.image_processor.image,
+                i_ref,
+                adu,
+                adu_average,
+            )
+            write_job.addErrback(
+                self._imageWriteFailed,
+                image_entry_id,
+                image_thumbnail_entry_id,
+                thumbnail_job,
+            )
+
+
+    def _imageWriteFailed(self, e, image_entry_id, image_thumbnail_entry_id, thumbnail_job):
+        # the entries are added before the file is written
+        # the timelapse file may belong to another frame, only the entries are removed
+        if image_thumbnail_entry_id:
+            thumbnail_job.wait()
+
+            thumbnail_entry = IndiAllSkyDbThumbnailTable.query.get(image_thumbnail_entry_id)
+            if thumbnail_entry:
+                logger.error('Image was not written, removing thumbnail entry')
+                thumbnail_entry.deleteAsset()
+                db.session.delete(thumbnail_entry)
+
+
+        if image_entry_id:
+            image_entry = IndiAllSkyDbImageTable.query.get(image_entry_id)
+            if image_entry:
+                logger.error('Image was not written, removing image entry')
+                db.session.delete(image_entry)
+
+
+        db.session.commit()
+
+
+    def _removeThumbnailEntry(self, thumbnail_entry_id, image_entry, image_metadata):
+        # the thumbnail row is added before the file is written
+        logger.error('Thumbnail was not written, removing thumbnail entry')
+
+        thumbnail_entry = IndiAllSkyDbThumbnailTable.query.get(thumbnail_entry_id)
+        if thumbnail_entry:
+            db.session.delete(thumbnail_entry)
+
+        if image_entry:
+            image_entry.thumbnail_uuid = None
+
+        image_metadata.pop('thumbnail_uuid', None)
+
+        db.session.commit()
+
+
+    def _imageWritten(
+        self,
+        result,
+        image_entry_id,
+        image_metadata,
+        image_thumbnail_entry_id,
+        image_thumbnail_metadata,
+        thumbnail_job,
+        upload_filename,
+        mq_topic_latest,
+        mqtt_data,
+        camera_id,
+        image_data,
+        i_ref,
+        adu,
+        adu_average,
+    ):
+        # called from the image worker after the image writer has finished
+
+        if image_entry_id:
+            image_entry = IndiAllSkyDbImageTable.query.get(image_entry_id)
+        else:
+            image_entry = None
 
 
-            self._miscUpload.syncapi_image(image_entry, image_metadata)  # syncapi before s3
-            self._miscUpload.s3_upload_image(image_entry, image_metadata)
-            self._miscUpload.mqtt_publish_image(upload_filename, mq_topic_latest, mqtt_data)
-            self._miscUpload.upload_image(image_entry)
+        # the thumbnail is written after the image, it is not uploaded if it failed
+        if image_thumbnail_entry_id and thumbnail_job.wait():
+            image_thumbnail_entry = IndiAllSkyDbThumbnailTable.query.get(image_thumbnail_entry_id)
+        else:
+            image_thumbnail_entry = None
+
+            if image_thumbnail_entry_id:
+                self._removeThumbnailEntry(image_thumbnail_entry_id, image_entry, image_metadata)
+
+
+        if self._rolling and image_entry:
+            camera = IndiAllSkyDbCameraTable.query.get(camera_id)
+
+            self._rolling.processImage(
+                image_entry,
+                upload_filename,
+                camera,
+                image_data,
+                adu,
+                len(i_ref['stars']),
+            )
 
-            self.upload_metadata(i_ref, adu, adu_average)
+
+        ### upload thumbnail first
+        if image_thumbnail_entry:
+            self._miscUpload.syncapi_thumbnail(image_thumbnail_entry, image_thumbnail_metadata)  # syncapi before s3
+            self._miscUpload.s3_upload_thumbnail(image_thumbnail_entry, image_thumbnail_metadata)
+
+
+        self._miscUpload.syncapi_image(image_entry, image_metadata)  # syncapi before s3
+        self._miscUpload.s3_upload_image(image_entry, image_metadata)
+        self._miscUpload.mqtt_publish_image(upload_filename, mq_topic_latest, mqtt_data)
+        self._miscUpload.upload_image(image_entry)
+
+        self.upload_metadata(i_ref, adu, adu_average)
 
 
     def decdeg2dms(self, dd):
@@ -935,15 +1139,7 @@ class ImageWorker(Process):
             'remove_local' : True,
         }
 
-        upload_task = IndiAllSkyDbTaskQueueTable(
-            queue=TaskQueueQueue.UPLOAD,
-            state=TaskQueueState.QUEUED,
-            data=jobdata,
-        )
-        db.session.add(upload_task)
-        db.session.commit()
-
-        self.upload_q.put({'task_id' : upload_task.id})
+        self._miscUpload.addTask(jobdata)
 
 
 
@@ -1001,12 +1197,9 @@ class ImageWorker(Process):
         image_height, image_width = data.shape[:2]
 
 
-        f_tmpfile = tempfile.NamedTemporaryFile(mode='w+b', delete=False, suffix='.fit')
-
-        i_ref['hdulist'].writeto(f_tmpfile)
-        f_tmpfile.close()
-
-        tmpfile_p = Path(f_tmpfile.name)
+        # serialize now, the hdulist is modified by calibration
+        fits_bytes = io.BytesIO()
+        i_ref['hdulist'].writeto(fits_bytes)
 
 
         date_str = i_ref['exp_date'].strftime('%Y%m%d_%H%M%S')
@@ -1060,17 +1253,29 @@ class ImageWorker(Process):
 
         if filename.exists():
             logger.error('File exists: %s (skipping)', filename)
-            tmpfile_p.unlink()
             return
 
 
-        shutil.copy2(str(tmpfile_p), str(filename))
-        filename.chmod(0o644)
+        write_job = self._image_writer.submit('fits', self._writeBytesJob, fits_bytes.getbuffer(), filename)
+        write_job.addCallback(self._fitsWritten, fits_entry.id, fits_metadata)
+        write_job.addErrback(self._removeWriteFailedEntry, IndiAllSkyDbFitsImageTable, fits_entry.id)
 
-        # set mtime to original exposure time
-        #os.utime(str(filename), (i_ref['exp_date'].timestamp(), i_ref['exp_date'].timestamp()))
 
-        tmpfile_p.unlink()
+    def _removeWriteFailedEntry(self, e, table, entry_id):
+        # the entry is added before the file is written
+        entry = table.query.get(entry_id)
+        if not entry:
+            return
+
+        logger.error('File was not written, removing entry: %s', entry.filename)
+        db.session.delete(entry)
+        db.session.commit()
+
+
+    def _fitsWritten(self, result, fits_entry_id, fits_metadata):
+        fits_entry = IndiAllSkyDbFitsImageTable.query.get(fits_entry_id)
+        if not fits_entry:
+            return
 
         self._miscUpload.s3_upload_fits(fits_entry, fits_metadata)
         self._miscUpload.upload_fits_image(fits_entry)
@@ -1085,12 +1290,6 @@ class ImageWorker(Process):
             return
 
 
-        f_tmpfile = tempfile.NamedTemporaryFile(mode='w+b', delete=False, suffix='.{0}'.format(self.config['IMAGE_EXPORT_RAW']))
-        f_tmpfile.close()
-
-        tmpfile_name = Path(f_tmpfile.name)
-
-
         data = self.image_processor.non_stacked_image
         image_height, image_width = data.shape[:2]
         max_bit_depth = self.image_processor.max_bit_depth
@@ -1117,45 +1316,22 @@ class ImageWorker(Process):
             scaled_data = self.image_processor._flip(scaled_data, 1)
 
 
-        write_img_start = time.time()
-
         if self.config['IMAGE_EXPORT_RAW'] in ('jpg', 'jpeg'):
-            if i_ref['image_bitpix'] == 8:
-                scaled_data_8 = scaled_data
-            else:
+            if i_ref['image_bitpix'] != 8:
                 # jpeg has to be 8 bits
                 logger.info('Resampling image from %d to 8 bits', i_ref['image_bitpix'])
 
                 #div_factor = int((2 ** max_bit_depth) / 255)
-                #scaled_data_8 = (scaled_data / div_factor).astype(numpy.uint8)
+                #scaled_data = (scaled_data / div_factor).astype(numpy.uint8)
 
                 # shifting is 5x faster than division
                 shift_factor = max_bit_depth - 8
-                scaled_data_8 = numpy.right_shift(scaled_data, shift_factor).astype(numpy.uint8)
-
-            if len(scaled_data_8.shape) == 2:
-                img = Image.fromarray(scaled_data_8)
-            else:
-                img = Image.fromarray(cv2.cvtColor(scaled_data_8, cv2.COLOR_BGR2RGB))
-
-            img.save(str(tmpfile_name), quality=self.config['IMAGE_FILE_COMPRESSION']['jpg'], exif=jpeg_exif)
-        elif self.config['IMAGE_EXPORT_RAW'] in ('png',):
-            # Pillow does not support 16-bit RGB data
-            # opencv is faster than Pillow with PNG
-            cv2.imwrite(str(tmpfile_name), scaled_data, [cv2.IMWRITE_PNG_COMPRESSION, self.config['IMAGE_FILE_COMPRESSION']['png']])
-        elif self.config['IMAGE_EXPORT_RAW'] in ('jp2',):
-            cv2.imwrite(str(tmpfile_name), scaled_data)
-        elif self.config['IMAGE_EXPORT_RAW'] in ('webp',):
-            cv2.imwrite(str(tmpfile_name), scaled_data, [cv2.IMWRITE_WEBP_QUALITY, 101])  # lossless
-        elif self.config['IMAGE_EXPORT_RAW'] in ('tif', 'tiff'):
-            # Pillow does not support 16-bit RGB data
-            cv2.imwrite(str(tmpfile_name), scaled_data, [cv2.IMWRITE_TIFF_COMPRESSION, 5])  # LZW
+                scaled_data = numpy.right_shift(scaled_data, shift_factor).astype(numpy.uint8)
+        elif self.config['IMAGE_EXPORT_RAW'] in ('png', 'jp2', 'webp', 'tif', 'tiff'):
+            pass
         else:
             raise Exception('Unknown file type: %s', self.config['IMAGE_EXPORT_RAW'])
 
-        write_img_elapsed_s = time.time() - write_img_start
-        logger.info('Raw image written in %0.4f s', write_img_elapsed_s)
-
 
 
         export_dir = Path(self.config['IMAGE_EXPORT_FOLDER'])
@@ -1236,22 +1412,59 @@ class ImageWorker(Process):
 
         if filename.exists():
             logger.error('File exists: %s (skipping)', filename)
-            tmpfile_name.unlink()
             return
 
 
-        shutil.copy2(str(tmpfile_name), str(filename))
-        filename.chmod(0o644)
+        write_job = self._image_writer.submit(
+            'raw',
+            self._writeImageJob,
+            self._encodeRawImage,
+            scaled_data,
+            self.config['IMAGE_EXPORT_RAW'],
+            jpeg_exif,
+            filename_p=filename,
+        )
+        write_job.addCallback(self._rawWritten, raw_entry.id, raw_metadata)
+        write_job.addErrback(self._removeWriteFailedEntry, IndiAllSkyDbRawImageTable, raw_entry.id)
 
-        tmpfile_name.unlink()
 
-        # set mtime to original exposure time
-        #os.utime(str(filename), (i_ref['exp_date'].timestamp(), i_ref['exp_date'].timestamp()))
+    def _rawWritten(self, result, raw_entry_id, raw_metadata):
+        raw_entry = IndiAllSkyDbRawImageTable.query.get(raw_entry_id)
+        if not raw_entry:
+            return
 
         self._miscUpload.s3_upload_raw(raw_entry, raw_metadata)
         self._miscUpload.upload_raw_image(raw_entry)
 
 
+    def _encodeRawImage(self, data, tmpfile_name, file_type, jpeg_exif):
+        write_img_start = time.time()
+
+        if file_type in ('jpg', 'jpeg'):
+            if len(data.shape) == 2:
+                img = Image.fromarray(data)
+            else:
+                img = Image.fromarray(cv2.cvtColor(data, cv2.COLOR_BGR2RGB))
+
+            img.save(str(tmpfile_name), quality=self.config['IMAGE_FILE_COMPRESSION']['jpg'], exif=jpeg_exif)
+        elif file_type in ('png',):
+            # Pillow does not support 16-bit RGB data
+            # opencv is faster than Pillow with PNG
+            cv2.imwrite(str(tmpfile_name), data, [cv2.IMWRITE_PNG_COMPRESSION, self.config['IMAGE_FILE_COMPRESSION']['png']])
+        elif file_type in ('jp2',):
+            cv2.imwrite(str(tmpfile_name), data)
+        elif file_type in ('webp',):
+            cv2.imwrite(str(tmpfile_name), data, [cv2.IMWRITE_WEBP_QUALITY, 101])  # lossless
+        elif file_type in ('tif', 'tiff'):
+            # Pillow does not support 16-bit RGB data
+            cv2.imwrite(str(tmpfile_name), data, [cv2.IMWRITE_TIFF_COMPRESSION, 5])  # LZW
+        else:
+            raise Exception('Unknown file type: %s', file_type)
+
+        write_img_elapsed_s = time.time() - write_img_start
+        logger.info('Raw image written in %0.4f s', write_img_elapsed_s)
+
+
     def write_mask_base_img(self, data):
         logger.info('Generating new mask base')
         f_tmpfile = tempfile.NamedTemporaryFile(mode='w+b', delete=False, suffix='.png')
@@ -1278,65 +1491,24 @@ class ImageWorker(Process):
 
 
     def write_img(self, data, i_ref, camera, jpeg_exif=None):
-        f_tmpfile = tempfile.NamedTemporaryFile(mode='w+b', delete=False, suffix='.{0}'.format(self.config['IMAGE_FILE_TYPE']))
-        f_tmpfile.close()
-
-        tmpfile_name = Path(f_tmpfile.name)
-
-
-        write_img_start = time.time()
-
-        # write to temporary file
-        if self.config['IMAGE_FILE_TYPE'] in ('jpg', 'jpeg'):
-            img_rgb = Image.fromarray(cv2.cvtColor(data, cv2.COLOR_BGR2RGB))
-            img_rgb.save(str(tmpfile_name), quality=self.config['IMAGE_FILE_COMPRESSION']['jpg'], exif=jpeg_exif)
-        elif self.config['IMAGE_FILE_TYPE'] in ('png',):
-            # exif does not appear to work with png
-            #img_rgb = Image.fromarray(cv2.cvtColor(data, cv2.COLOR_BGR2RGB))
-            #img_rgb.save(str(tmpfile_name), compress_level=self.config['IMAGE_FILE_COMPRESSION']['png'])
-
-            # opencv is faster than Pillow with PNG
-            cv2.imwrite(str(tmpfile_name), data, [cv2.IMWRITE_PNG_COMPRESSION, self.config['IMAGE_FILE_COMPRESSION']['png']])
-        elif self.config['IMAGE_FILE_TYPE'] in ('webp',):
-            img_rgb = Image.fromarray(cv2.cvtColor(data, cv2.COLOR_BGR2RGB))
-            img_rgb.save(str(tmpfile_name), quality=90, lossless=False, exif=jpeg_exif)
-        elif self.config['IMAGE_FILE_TYPE'] in ('tif', 'tiff'):
-            # exif does not appear to work with tiff
-            img_rgb = Image.fromarray(cv2.cvtColor(data, cv2.COLOR_BGR2RGB))
-            img_rgb.save(str(tmpfile_name), compression='tiff_lzw')
-        else:
-            tmpfile_name.unlink()
-            raise Exception('Unknown file type: %s', self.config['IMAGE_FILE_TYPE'])
-
-        write_img_elapsed_s = time.time() - write_img_start
-        logger.info('Image compressed in %0.4f s', write_img_elapsed_s)
-
+        # Files are written by the image writer, returns the latest file, the timelapse file and the write job
 
         ### Always write the latest file for web access
         latest_file = self.image_dir.joinpath('latest.{0:s}'.format(self.config['IMAGE_FILE_TYPE']))
 
-        try:
-            latest_file.unlink()
-        except FileNotFoundError:
-            pass
-
-
-        shutil.copy2(str(tmpfile_name), str(latest_file))
-        latest_file.chmod(0o644)
-
 
         ### disable timelapse images in focus mode
         if self.config.get('FOCUS_MODE', False):
             logger.warning('Focus mode enabled, not saving timelapse image')
-            tmpfile_name.unlink()
-            return None, None
+            write_job = self._submitImage('image', data, jpeg_exif, latest_p=latest_file)
+            return None, None, write_job
 
 
         ### Do not write daytime image files if daytime timelapse is disabled
         if not self.night_v.value and not self.config['DAYTIME_TIMELAPSE']:
             logger.info('Daytime timelapse is disabled')
-            tmpfile_name.unlink()
-            return latest_file, None
+            write_job = self._submitImage('image', data, jpeg_exif, latest_p=latest_file)
+            return latest_file, None, write_job
 
 
         ### Write the timelapse file
@@ -1349,22 +1521,105 @@ class ImageWorker(Process):
 
         if filename.exists():
             logger.error('File exists: %s (skipping)', filename)
-            tmpfile_name.unlink()
-            return latest_file, None
+            write_job = self._submitImage('image', data, jpeg_exif, latest_p=latest_file)
+            return latest_file, None, write_job
 
 
-        shutil.copy2(str(tmpfile_name), str(filename))
-        filename.chmod(0o644)
+        # set mtime to original exposure time
+        #os.utime(str(filename), (i_ref['exp_date'].timestamp(), i_ref['exp_date'].timestamp()))
 
-        tmpfile_name.unlink()
+        write_job = self._submitImage('image', data, jpeg_exif, filename_p=filename, latest_p=latest_file)
 
+        return latest_file, filename, write_job
 
-        # set mtime to original exposure time
-        #os.utime(str(filename), (i_ref['exp_date'].timestamp(), i_ref['exp_date'].timestamp()))
 
-        #logger.info('Finished writing files')
+    def _submitImage(self, name, data, jpeg_exif, filename_p=None, latest_p=None):
+        return self._image_writer.submit(
+            name,
+            self._writeImageJob,
+            self._encodeImage,
+            data,
+            self.config['IMAGE_FILE_TYPE'],
+            jpeg_exif,
+            filename_p=filename_p,
+            latest_p=latest_p,
+        )
+
 
-        return latest_file, filename
+    def _writeImageJob(self, encode_func, data, file_type, jpeg_exif, filename_p=None, latest_p=None):
+        # runs in the image writer thread
+        # the temporary file is created next to the final file so it can be renamed into place
+        if latest_p:
+            tmp_dir = latest_p.parent
+        else:
+            tmp_dir = filename_p.parent
+
+        f_tmpfile = tempfile.NamedTemporaryFile(mode='w+b', delete=False, dir=str(tmp_dir), prefix='.', suffix='.{0}'.format(file_type))
+        f_tmpfile.close()
+
+        tmpfile_p = Path(f_tmpfile.name)
+
+
+        try:
+            encode_func(data, tmpfile_p, file_type, jpeg_exif)
+
+            self._image_writer.publishFile(tmpfile_p, filename_p=filename_p, latest_p=latest_p)
+        except Exception:
+            try:
+                tmpfile_p.unlink()
+            except FileNotFoundError:
+                pass
+
+            raise
+
+
+    def _writeBytesJob(self, data, filename_p):
+        # runs in the image writer thread
+        f_tmpfile = tempfile.NamedTemporaryFile(mode='w+b', delete=False, dir=str(filename_p.parent), prefix='.', suffix=filename_p.suffix)
+
+        try:
+            f_tmpfile.write(data)
+            f_tmpfile.close()
+
+            tmpfile_p = Path(f_tmpfile.name)
+            self._image_writer.publishFile(tmpfile_p, filename_p=filename_p)
+        except Exception:
+            f_tmpfile.close()
+
+            try:
+                os.unlink(f_tmpfile.name)
+            except FileNotFoundError:
+                pass
+
+            raise
+
+
+    def _encodeImage(self, data, tmpfile_name, file_type, jpeg_exif):
+        write_img_start = time.time()
+
+        # write to temporary file
+        if file_type in ('jpg', 'jpeg'):
+            img_rgb = Image.fromarray(cv2.cvtColor(data, cv2.COLOR_BGR2RGB))
+            img_rgb.save(str(tmpfile_name), quality=self.config['IMAGE_FILE_COMPRESSION']['jpg'], exif=jpeg_exif)
+        elif file_type in ('png',):
+            # exif does not appear to work with png
+            #img_rgb = Image.fromarray(cv2.cvtColor(data, cv2.COLOR_BGR2RGB))
+            #img_rgb.save(str(tmpfile_name), compress_level=self.config['IMAGE_FILE_COMPRESSION']['png'])
+
+            # opencv is faster than Pillow with PNG
+            cv2.imwrite(str(tmpfile_name), data, [cv2.IMWRITE_PNG_COMPRESSION, self.config['IMAGE_FILE_COMPRESSION']['png']])
+        elif file_type in ('webp',):
+            img_rgb = Image.fromarray(cv2.cvtColor(data, cv2.COLOR_BGR2RGB))
+            img_rgb.save(str(tmpfile_name), quality=90, lossless=False, exif=jpeg_exif)
+        elif file_type in ('tif', 'tiff'):
+            # exif does not appear to work with tiff
+            img_rgb = Image.fromarray(cv2.cvtColor(data, cv2.COLOR_BGR2RGB))
+            img_rgb.save(str(tmpfile_name), compression='tiff_lzw')
+        else:
+            raise Exception('Unknown file type: %s', file_type)
+
+        write_img_elapsed_s = time.time() - write_img_start
+        logger.info('Image compressed in %0.4f s', write_img_elapsed_s)
 
 
     def write_status_json(self, i_ref, adu, adu_average):
@@ -1387,6 +1642,7 @@ class ImageWorker(Process):
             'latitude'            : self.position_av[0],
             'longitude'           : self.position_av[1],
             'elevation'           : int(self.position_av[2]),
+            'calibration_cache'   : self.image_processor.calibration_cache_stats,
         }
 
 
@@ -1431,63 +1687,21 @@ class ImageWorker(Process):
     def write_panorama_img(self, pano_data, i_ref, camera, jpeg_exif=None):
         panorama_height, panorama_width = pano_data.shape[:2]
 
-        f_tmpfile = tempfile.NamedTemporaryFile(mode='w+b', delete=False, suffix='.{0}'.format(self.config['IMAGE_FILE_TYPE']))
-        f_tmpfile.close()
-
-        tmpfile_name = Path(f_tmpfile.name)
-
-
-        write_img_start = time.time()
-
-        # write to temporary file
-        if self.config['IMAGE_FILE_TYPE'] in ('jpg', 'jpeg'):
-            img_rgb = Image.fromarray(cv2.cvtColor(pano_data, cv2.COLOR_BGR2RGB))
-            img_rgb.save(str(tmpfile_name), quality=self.config['IMAGE_FILE_COMPRESSION']['jpg'], exif=jpeg_exif)
-        elif self.config['IMAGE_FILE_TYPE'] in ('png',):
-            # exif does not appear to work with png
-            #img_rgb = Image.fromarray(cv2.cvtColor(data, cv2.COLOR_BGR2RGB))
-            #img_rgb.save(str(tmpfile_name), compress_level=self.config['IMAGE_FILE_COMPRESSION']['png'])
-
-            # opencv is faster than Pillow with PNG
-            cv2.imwrite(str(tmpfile_name), pano_data, [cv2.IMWRITE_PNG_COMPRESSION, self.config['IMAGE_FILE_COMPRESSION']['png']])
-        elif self.config['IMAGE_FILE_TYPE'] in ('webp',):
-            img_rgb = Image.fromarray(cv2.cvtColor(pano_data, cv2.COLOR_BGR2RGB))
-            img_rgb.save(str(tmpfile_name), quality=90, lossless=False, exif=jpeg_exif)
-        elif self.config['IMAGE_FILE_TYPE'] in ('tif', 'tiff'):
-            # exif does not appear to work with tiff
-            img_rgb = Image.fromarray(cv2.cvtColor(pano_data, cv2.COLOR_BGR2RGB))
-            img_rgb.save(str(tmpfile_name), compression='tiff_lzw')
-        else:
-            tmpfile_name.unlink()
-            raise Exception('Unknown file type: %s', self.config['IMAGE_FILE_TYPE'])
-
-        write_img_elapsed_s = time.time() - write_img_start
-        logger.info('Panorama image compressed in %0.4f s', write_img_elapsed_s)
-
 
         ### Always write the latest file for web access
         latest_pano_file = self.image_dir.joinpath('panorama.{0:s}'.format(self.config['IMAGE_FILE_TYPE']))
 
-        try:
-            latest_pano_file.unlink()
-        except FileNotFoundError:
-            pass
-
-
-        shutil.copy2(str(tmpfile_name), str(latest_pano_file))
-        latest_pano_file.chmod(0o644)
-
 
         ### disable timelapse images in focus mode
         if self.config.get('FOCUS_MODE', False):
             logger.warning('Focus mode enabled, not saving timelapse image')
-            tmpfile_name.unlink()
+            self._submitImage('panorama', pano_data, jpeg_exif, latest_p=latest_pano_file)
             return
 
 
         ### Do not write daytime image files if daytime timelapse is disabled
         if not self.night_v.value and not self.config['DAYTIME_TIMELAPSE']:
-            tmpfile_name.unlink()
+            self._submitImage('panorama', pano_data, jpeg_exif, latest_p=latest_pano_file)
             return
 
 
@@ -1537,18 +1751,22 @@ class ImageWorker(Process):
 
         if filename.exists():
             logger.error('File exists: %s (skipping)', filename)
-            tmpfile_name.unlink()
+            self._submitImage('panorama', pano_data, jpeg_exif, latest_p=latest_pano_file)
             return
 
 
-        shutil.copy2(str(tmpfile_name), str(filename))
-        filename.chmod(0o644)
+        # set mtime to original exposure time
+        #os.utime(str(filename), (i_ref['exp_date'].timestamp(), i_ref['exp_date'].timestamp()))
 
-        tmpfile_name.unlink()
+        write_job = self._submitImage('panorama', pano_data, jpeg_exif, filename_p=filename, latest_p=latest_pano_file)
+        write_job.addCallback(self._panoramaWritten, panorama_entry.id, panorama_metadata, filename)
+        write_job.addErrback(self._removeWriteFailedEntry, IndiAllSkyDbPanoramaImageTable, panorama_entry.id)
 
 
-        # set mtime to original exposure time
-        #os.utime(str(filename), (i_ref['exp_date'].timestamp(), i_ref['exp_date'].timestamp()))
+    def _panoramaWritten(self, result, panorama_entry_id, panorama_metadata, filename):
+        panorama_entry = IndiAllSkyDbPanoramaImageTable.query.get(panorama_entry_id)
+        if not panorama_entry:
+            return
 
         self._miscUpload.syncapi_panorama(panorama_entry, panorama_metadata)  # syncapi before s3
         self._miscUpload.s3_upload_panorama(panorama_entry, panorama_metadata)
@@ -0,0 +1,194 @@
+import os
+import errno
+import time
+import shutil
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import Future
+import logging
+
+
+logger = logging.getLogger('indi_allsky')
+
+
+class IndiAllSkyImageWriterJob(object):
+
+    def __init__(self, name, future):
+        self.name = name
+        self.future = future
+
+        self.callbacks = list()
+        self.errbacks = list()
+
+
+    def addCallback(self, func, *args, **kwargs):
+        # callbacks are always called from the thread calling processCompleted()
+        self.callbacks.append((func, args, kwargs))
+
+
+    def addErrback(self, func, *args, **kwargs):
+        # called with the exception instead of the callbacks when the job fails
+        self.errbacks.append((func, args, kwargs))
+
+
+    def done(self):
+        return self.future.done()
+
+
+    def wait(self):
+        # returns False if the job failed, errors are logged by processCompleted()
+        try:
+            self.future.result()
+        except Exception:
+            return False
+
+        return True
+
+
+class IndiAllSkyImageWriter(object):
+    # Encoding and writing files is done in a single background thread so files are
+    # always published in order.  The number of outstanding jobs is limited, submit()
+    # blocks when the queue is full.
+
+    def __init__(self, config):
+        self.config = config
+
+        self._queue_max = int(self.config.get('IMAGE_WRITER_QUEUE', 3))
+
+        if self._queue_max > 0:
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='ImageWriter')
+            self._slots = threading.BoundedSemaphore(self._queue_max)
+        else:
+            # synchronous
+            self._executor = None
+            self._slots = None
+
+        self._pending = deque()
+
+        self.wait_elapsed_s = 0  # time spent blocked on a full queue
+
+
+    @property
+    def pending(self):
+        return len(self._pending)
+
+    @pending.setter
+    def pending(self, *args):
+        pass  # read only
+
+
+    def submit(self, name, func, *args, **kwargs):
+        if isinstance(self._executor, type(None)):
+            # run now, callbacks are still called from processCompleted()
+            future = Future()
+
+            try:
+                future.set_result(func(*args, **kwargs))
+            except Exception as e:
+                future.set_exception(e)
+
+            job = IndiAllSkyImageWriterJob(name, future)
+            self._pending.append(job)
+            return job
+
+
+        if not self._slots.acquire(blocking=False):
+            logger.warning('Image writer queue full (%d), waiting', self._queue_max)
+
+            wait_start = time.time()
+            self._slots.acquire()
+
+            wait_elapsed_s = time.time() - wait_start
+            self.wait_elapsed_s += wait_elapsed_s
+            logger.warning('Waited %0.4f s for image writer', wait_elapsed_s)
+
+
+        future = self._executor.submit(self._run, name, func, *args, **kwargs)
+
+        job = IndiAllSkyImageWriterJob(name, future)
+        self._pending.append(job)
+
+        return job
+
+
+    def _run(self, name, func, *args, **kwargs):
+        try:
+            write_start = time.time()
+
+            result = func(*args, **kwargs)
+
+            write_elapsed_s = time.time() - write_start
+            logger.info('Image writer %s in %0.4f s', name, write_elapsed_s)
+
+            return result
+        finally:
+            self._slots.release()
+
+
+    def processCompleted(self, wait=False):
+        # Completed jobs are handled in submission order
+        while self._pending:
+            job = self._pending[0]
+
+            if not wait and not job.done():
+                break
+
+            self._pending.popleft()
+
+
+            try:
+                result = job.future.result()
+            except Exception as e:
+                logger.exception('Image writer %s failed: %s', job.name, str(e))
+
+                for func, args, kwargs in job.errbacks:
+                    func(e, *args, **kwargs)
+
+                continue
+
+
+            for func, args, kwargs in job.callbacks:
+                func(result, *args, **kwargs)
+
+
+    def shutdown(self):
+        self.processCompleted(wait=True)
+
+        if self._executor:
+            self._executor.shutdown(wait=True)
+
+
+    def publishFile(self, tmpfile_p, filename_p=None, latest_p=None):
+        # tmpfile_p must be on the same filesystem as filename_p and latest_p
+        # the timelapse file is a hard link to the latest file instead of a second copy
+
+        tmpfile_p.chmod(0o644)
+
+        if filename_p:
+            if latest_p:
+                try:
+                    os.link(str(tmpfile_p), str(filename_p))
+                except FileExistsError:
+                    # never overwrite an existing timelapse file, the latest file is still updated
+                    logger.error('File already exists, not publishing: %s', filename_p)
+                    tmpfile_p.replace(latest_p)
+                    raise
+                except OSError as e:
+                    if e.errno not in (errno.EXDEV, errno.EPERM):
+                        raise
+
+                    # different filesystem or no hard link support (FAT)
+                    logger.warning('Unable to hard link %s: %s', filename_p, str(e))
+                    shutil.copy2(str(tmpfile_p), str(filename_p))
+                    filename_p.chmod(0o644)
+            else:
+                tmpfile_p.replace(filename_p)
+                return
+
+
+        if latest_p:
+            # atomic, the latest file is never missing or partially written
+            tmpfile_p.replace(latest_p)
+        else:
+            tmpfile_p.unlink()
@@ -2,7 +2,6 @@ import cv2
 import numpy
 #import PIL
 from PIL import Image
-from PIL import ImageFont
 from PIL import ImageDraw
 import piexif
 import math
@@ -14,6 +13,8 @@ from pathlib import Path
 import logging
 from pprint import pformat
 
+from .textOverlay import IndiAllSkyTextOverlay
+
 
 logger = logging.getLogger('indi_allsky')
 
@@ -41,15 +42,24 @@ class KeogramGenerator(object):
         self.rotated_width = None
         self.rotated_height = None
 
-        self.keogram_data = None
+        self.keogram_data = None  # preallocated, only the first keogram_index columns are valid
+        self.keogram_index = 0
         self.keogram_final = None  # will contain final resized keogram
 
+        self._total_frames = None
+
+        # the rotated image is only computed up to the center line
+        self._center_line_rot = None
+        self._center_line_x = None
+
         self.timestamps_list = list()
         self.image_processing_elapsed_s = 0
 
         base_path  = Path(__file__).parent
         self.font_path  = base_path.joinpath('fonts')
 
+        self._text_overlay = IndiAllSkyTextOverlay()
+
 
     @property
     def angle(self):
@@ -78,6 +88,16 @@ class KeogramGenerator(object):
         self._h_scale_factor = int(new_factor)
 
 
+    @property
+    def total_frames(self):
+        return self._total_frames
+
+    @total_frames.setter
+    def total_frames(self, new_total):
+        # used to preallocate the keogram, will grow if exceeded
+        self._total_frames = int(new_total)
+
+
     @property
     def crop_top(self):
         return self._crop_top
@@ -144,37 +164,58 @@ class KeogramGenerator(object):
         height, width = image.shape[:2]
 
 
-        rotated_image = self.rotate(image)
+        if isinstance(self.original_height, type(None)):
+            # this only happens on the first image
+            self.original_height = height
+            self.original_width = width
 
 
-        rot_height, rot_width = rotated_image.shape[:2]
-        self.rotated_height = rot_height
-        self.rotated_width = rot_width
+        if height != self.original_height or width != self.original_width:
+            # all images have to match dimensions of the first image
+            logger.error('Image with dimension mismatch: %s', filename)
+            return
 
-        rotated_center_line = rotated_image[:, [int(rot_width / 2)]]
 
-        if isinstance(self.keogram_data, type(None)):
-            # this only happens on the first image
+        if isinstance(self._center_line_rot, type(None)):
+            rot, bound_w, bound_h = self.getRotationMatrix(height, width)
+            self.rotated_height = bound_h
+            self.rotated_width = bound_w
 
-            self.original_height = height
-            self.original_width = width
+            self._center_line_rot = rot
+            self._center_line_x = int(bound_w / 2)
+
+
+        # the center line is copied out of the full rotation, a partial warp
+        # does not reproduce the same interpolated pixels
+        rotated_image = cv2.warpAffine(image, self._center_line_rot, (self.rotated_width, self.rotated_height))
+        rotated_center_line = rotated_image[:, [self._center_line_x]]
 
-            new_shape = rotated_center_line.shape
+
+        if isinstance(self.keogram_data, type(None)):
+            if self.total_frames:
+                columns = self.total_frames
+            else:
+                columns = 1000
+
+            new_shape = list(rotated_center_line.shape)
+            new_shape[1] = columns
             logger.info('New Shape: %s', pformat(new_shape))
 
             new_dtype = rotated_center_line.dtype
             logger.info('New dtype: %s', new_dtype)
 
-            self.keogram_data = numpy.empty(new_shape, dtype=new_dtype)
-
+            self.keogram_data = numpy.zeros(new_shape, dtype=new_dtype)
+        elif self.keogram_index >= self.keogram_data.shape[1]:
+            # more images than expected, double the capacity
+            new_shape = list(self.keogram_data.shape)
+            new_shape[1] = max(self.keogram_data.shape[1], 1000)
+            logger.warning('Expanding keogram capacity to %d columns', self.keogram_data.shape[1] + new_shape[1])
 
-        if height != self.original_height or width != self.original_width:
-            # all images have to match dimensions of the first image
-            logger.error('Image with dimension mismatch: %s', filename)
-            return
+            self.keogram_data = numpy.concatenate((self.keogram_data, numpy.zeros(new_shape, dtype=self.keogram_data.dtype)), axis=1)
 
 
-        self.keogram_data = numpy.append(self.keogram_data, rotated_center_line, 1)
+        self.keogram_data[:, self.keogram_index] = rotated_center_line[:, 0]
+        self.keogram_index += 1
 
         self.image_processing_elapsed_s += time.time() - image_processing_start
 
@@ -184,8 +225,11 @@ class KeogramGenerator(object):
 
         logger.info('Images processed for keogram in %0.1f s', self.image_processing_elapsed_s)
 
+        # trim off unused columns
+        keogram_data = self.keogram_data[:, :self.keogram_index]
+
         # trim off the top and bottom bars
-        keogram_trimmed = self.trimEdges(self.keogram_data)
+        keogram_trimmed = self.trimEdges(keogram_data)
         trimmed_height, trimmed_width = keogram_trimmed.shape[:2]
 
 
@@ -328,8 +372,7 @@ class KeogramGenerator(object):
         return degrees, minutes, seconds
 
 
-    def rotate(self, image):
-        height, width = image.shape[:2]
+    def getRotationMatrix(self, height, width):
         center_x = int(width / 2)
         center_y = int(height / 2)
 
@@ -344,6 +387,14 @@ class KeogramGenerator(object):
         rot[0, 2] += bound_w / 2 - center_x
         rot[1, 2] += bound_h / 2 - center_y
 
+        return rot, bound_w, bound_h
+
+
+    def rotate(self, image):
+        height, width = image.shape[:2]
+
+        rot, bound_w, bound_h = self.getRotationMatrix(height, width)
+
         rotated = cv2.warpAffine(image, rot, (bound_w, bound_h))
 
         return rotated
@@ -481,8 +532,7 @@ class KeogramGenerator(object):
 
 
     def applyLabels_pillow(self, keogram):
-        img_rgb = Image.fromarray(cv2.cvtColor(keogram, cv2.COLOR_BGR2RGB))
-        width, height  = img_rgb.size  # backwards from opencv
+        height, width = keogram.shape[:2]
 
 
         if self.config['TEXT_PROPERTIES']['PIL_FONT_FILE'] == 'custom':
@@ -493,12 +543,17 @@ class KeogramGenerator(object):
 
         pillow_font_size = self.config['TEXT_PROPERTIES']['PIL_FONT_SIZE']
 
-        font = ImageFont.truetype(str(pillow_font_file_p), pillow_font_size)
-        draw = ImageDraw.Draw(img_rgb)
-
         color_rgb = list(self.config['TEXT_PROPERTIES']['FONT_COLOR'])  # RGB for pillow
 
 
+        # only the bottom of the keogram is converted for the hour lines
+        strip_y = max(height - (self.line_length + 10), 0)
+        strip_height = height - strip_y
+
+        strip_rgb = Image.fromarray(cv2.cvtColor(keogram[strip_y:height], cv2.COLOR_BGR2RGB))
+        draw = ImageDraw.Draw(strip_rgb)
+
+
         # starting point
         last_time = datetime.fromtimestamp(self.timestamps_list[0])
         last_hour_str = last_time.strftime('%H')
@@ -511,6 +566,7 @@ class KeogramGenerator(object):
             stroke_width = 0
 
 
+        label_list = list()
         for i, u_ts in enumerate(self.timestamps_list):
             ts = datetime.fromtimestamp(u_ts)
             hour_str = ts.strftime('%H')
@@ -522,8 +578,8 @@ class KeogramGenerator(object):
 
             line_x = int(i * width / len(self.timestamps_list))
 
-            line_start = (line_x, height)
-            line_end = (line_x, height - self.line_length)
+            line_start = (line_x, strip_height)
+            line_end = (line_x, strip_height - self.line_length)
 
 
             if self.config['TEXT_PROPERTIES']['FONT_OUTLINE']:
@@ -539,16 +595,23 @@ class KeogramGenerator(object):
             )
 
 
-            draw.text(
-                (line_x + 5, height - (pillow_font_size + 3)),
+            label_list.append((line_x, hour_str))
+
+
+        keogram[strip_y:height] = cv2.cvtColor(numpy.array(strip_rgb), cv2.COLOR_RGB2BGR)
+
+
+        for line_x, hour_str in label_list:
+            self._text_overlay.drawText(
+                keogram,
                 hour_str,
-                fill=tuple(color_rgb),
-                font=font,
+                pillow_font_file_p,
+                pillow_font_size,
+                (line_x + 5, height - (pillow_font_size + 3)),
+                color_rgb,
                 stroke_width=stroke_width,
-                stroke_fill=(0, 0, 0),
                 anchor='la',  # left-ascender
             )
 
 
-        # convert back to numpy array
-        return cv2.cvtColor(numpy.array(img_rgb), cv2.COLOR_RGB2BGR)
+        return keogram
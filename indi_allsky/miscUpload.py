@@ -19,11 +19,53 @@ class miscUpload(object):
         self,
         config,
         upload_q,
+        batch=False,
+        syncapi_check=False,
     ):
 
         self.config = config
         self.upload_q = upload_q
 
+        # when batching, tasks are queued by flush()
+        self._batch = batch
+        self._pending_tasks = list()
+
+        # syncapi uploads ask the server for existing files first (backfill)
+        self._syncapi_check = syncapi_check
+
+
+    def addTask(self, jobdata):
+        if self._syncapi_check and jobdata['action'] == constants.TRANSFER_SYNC_V1:
+            jobdata['check'] = True
+
+        upload_task = IndiAllSkyDbTaskQueueTable(
+            queue=TaskQueueQueue.UPLOAD,
+            state=TaskQueueState.QUEUED,
+            data=jobdata,
+        )
+        db.session.add(upload_task)
+
+        self._pending_tasks.append(upload_task)
+
+        if not self._batch:
+            self.flush()
+
+
+    def flush(self):
+        # pending tasks are committed in a single transaction before they are queued
+        if not self._pending_tasks:
+            return
+
+        db.session.flush()  # assign ids
+
+        task_id_list = [t.id for t in self._pending_tasks]
+        self._pending_tasks.clear()
+
+        db.session.commit()
+
+        for task_id in task_id_list:
+            self.upload_q.put({'task_id' : task_id})
+
 
     def upload_image(self, image_entry):
         ### upload images
@@ -75,15 +117,7 @@ class miscUpload(object):
             'remote_file' : str(remote_file_p),
         }
 
-        upload_task = IndiAllSkyDbTaskQueueTable(
-            queue=TaskQueueQueue.UPLOAD,
-            state=TaskQueueState.QUEUED,
-            data=jobdata,
-        )
-        db.session.add(upload_task)
-        db.session.commit()
-
-        self.upload_q.put({'task_id' : upload_task.id})
+        self.addTask(jobdata)
 
 
     def upload_video(self, video_entry):
@@ -117,15 +151,7 @@ class miscUpload(object):
             'remote_file' : str(remote_file_p),
         }
 
-        upload_task = IndiAllSkyDbTaskQueueTable(
-            queue=TaskQueueQueue.UPLOAD,
-            state=TaskQueueState.QUEUED,
-            data=jobdata,
-        )
-        db.session.add(upload_task)
-        db.session.commit()
-
-        self.upload_q.put({'task_id' : upload_task.id})
+        self.addTask(jobdata)
 
 
     def upload_panorama_video(self, video_entry):
@@ -159,15 +185,7 @@ class miscUpload(object):
             'remote_file' : str(remote_file_p),
         }
 
-        upload_task = IndiAllSkyDbTaskQueueTable(
-            queue=TaskQueueQueue.UPLOAD,
-            state=TaskQueueState.QUEUED,
-            data=jobdata,
-        )
-        db.session.add(upload_task)
-        db.session.commit()
-
-        self.upload_q.put({'task_id' : upload_task.id})
+        self.addTask(jobdata)
 
 
     def upload_keogram(self, keogram_entry):
@@ -203,15 +221,7 @@ class miscUpload(object):
             'remote_file' : str(remote_file_p),
         }
 
-        upload_task = IndiAllSkyDbTaskQueueTable(
-            queue=TaskQueueQueue.UPLOAD,
-            state=TaskQueueState.QUEUED,
-            data=jobdata,
-        )
-        db.session.add(upload_task)
-        db.session.commit()
-
-        self.upload_q.put({'task_id' : upload_task.id})
+        self.addTask(jobdata)
 
 
     def upload_startrail(self, startrail_entry):
@@ -246,15 +256,7 @@ class miscUpload(object):
             'remote_file' : str(remote_file_p),
         }
 
-        upload_task = IndiAllSkyDbTaskQueueTable(
-            queue=TaskQueueQueue.UPLOAD,
-            state=TaskQueueState.QUEUED,
-            data=jobdata,
-        )
-        db.session.add(upload_task)
-        db.session.commit()
-
-        self.upload_q.put({'task_id' : upload_task.id})
+        self.addTask(jobdata)
 
 
     def upload_startrail_video(self, startrail_video_entry):
@@ -289,15 +291,7 @@ class miscUpload(object):
             'remote_file' : str(remote_file_p),
         }
 
-        upload_task = IndiAllSkyDbTaskQueueTable(
-            queue=TaskQueueQueue.UPLOAD,
-            state=TaskQueueState.QUEUED,
-            data=jobdata,
-        )
-        db.session.add(upload_task)
-        db.session.commit()
-
-        self.upload_q.put({'task_id' : upload_task.id})
+        self.addTask(jobdata)
 
 
     def upload_panorama(self, panorama_entry):
@@ -345,15 +339,7 @@ class miscUpload(object):
             'remote_file' : str(remote_file_p),
         }
 
-        upload_task = IndiAllSkyDbTaskQueueTable(
-            queue=TaskQueueQueue.UPLOAD,
-            state=TaskQueueState.QUEUED,
-            data=jobdata,
-        )
-        db.session.add(upload_task)
-        db.session.commit()
-
-        self.upload_q.put({'task_id' : upload_task.id})
+        self.addTask(jobdata)
 
 
     def upload_raw_image(self, raw_image_entry):
@@ -388,15 +374,7 @@ class miscUpload(object):
             'remote_file' : str(remote_file_p),
         }
 
-        upload_task = IndiAllSkyDbTaskQueueTable(
-            queue=TaskQueueQueue.UPLOAD,
-            state=TaskQueueState.QUEUED,
-            data=jobdata,
-        )
-        db.session.add(upload_task)
-        db.session.commit()
-
-        self.upload_q.put({'task_id' : upload_task.id})
+        self.addTask(jobdata)
 
 
     def upload_fits_image(self, fits_image_entry):
@@ -431,15 +409,7 @@ class miscUpload(object):
             'remote_file' : str(remote_file_p),
         }
 
-        upload_task = IndiAllSkyDbTaskQueueTable(
-            queue=TaskQueueQueue.UPLOAD,
-            state=TaskQueueState.QUEUED,
-            data=jobdata,
-        )
-        db.session.add(upload_task)
-        db.session.commit()
-
-        self.upload_q.put({'task_id' : upload_task.id})
+        self.addTask(jobdata)
 
 
     def mqtt_publish_image(self, upload_filename, image_topic, mq_data):
@@ -455,15 +425,7 @@ class miscUpload(object):
             'metadata'    : mq_data,
         }
 
-        mqtt_task = IndiAllSkyDbTaskQueueTable(
-            queue=TaskQueueQueue.UPLOAD,
-            state=TaskQueueState.QUEUED,
-            data=jobdata,
-        )
-        db.session.add(mqtt_task)
-        db.session.commit()
-
-        self.upload_q.put({'task_id' : mqtt_task.id})
+        self.addTask(jobdata)
 
 
     def s3_upload_asset(self, asset_entry, asset_metadata):
@@ -485,15 +447,7 @@ class miscUpload(object):
             'metadata'    : asset_metadata,
         }
 
-        s3_task = IndiAllSkyDbTaskQueueTable(
-            queue=TaskQueueQueue.UPLOAD,
-            state=TaskQueueState.QUEUED,
-            data=jobdata,
-        )
-        db.session.add(s3_task)
-        db.session.commit()
-
-        self.upload_q.put({'task_id' : s3_task.id})
+        self.addTask(jobdata)
 
 
     def s3_upload_image(self, *args):
@@ -587,15 +541,7 @@ class miscUpload(object):
             'metadata'    : asset_metadata,
         }
 
-        upload_task = IndiAllSkyDbTaskQueueTable(
-            queue=TaskQueueQueue.UPLOAD,
-            state=TaskQueueState.QUEUED,
-            data=jobdata,
-        )
-        db.session.add(upload_task)
-        db.session.commit()
-
-        self.upload_q.put({'task_id' : upload_task.id})
+        self.addTask(jobdata)
 
 
     def syncapi_video(self, asset_entry, metadata):
@@ -622,15 +568,7 @@ class miscUpload(object):
             'metadata'    : metadata,
         }
 
-        upload_task = IndiAllSkyDbTaskQueueTable(
-            queue=TaskQueueQueue.UPLOAD,
-            state=TaskQueueState.QUEUED,
-            data=jobdata,
-        )
-        db.session.add(upload_task)
-        db.session.commit()
-
-        self.upload_q.put({'task_id' : upload_task.id})
+        self.addTask(jobdata)
 
 
     def syncapi_keogram(self, *args):
@@ -692,15 +630,7 @@ class miscUpload(object):
             'metadata'    : asset_metadata,
         }
 
-        upload_task = IndiAllSkyDbTaskQueueTable(
-            queue=TaskQueueQueue.UPLOAD,
-            state=TaskQueueState.QUEUED,
-            data=jobdata,
-        )
-        db.session.add(upload_task)
-        db.session.commit()
-
-        self.upload_q.put({'task_id' : upload_task.id})
+        self.addTask(jobdata)
 
 
     def _youtube_upload(self, video_entry, metadata):
@@ -716,16 +646,7 @@ class miscUpload(object):
         }
 
 
-        upload_task = IndiAllSkyDbTaskQueueTable(
-            queue=TaskQueueQueue.UPLOAD,
-            state=TaskQueueState.QUEUED,
-            data=jobdata,
-        )
-
-        db.session.add(upload_task)
-        db.session.commit()
-
-        self.upload_q.put({'task_id' : upload_task.id})
+        self.addTask(jobdata)
 
 
     def youtube_upload_video(self, video_entry, metadata):
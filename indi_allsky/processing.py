@@ -1,5 +1,7 @@
 import io
 import re
+import base64
+import zlib
 from pathlib import Path
 from datetime import datetime
 #from datetime import timedelta
@@ -11,8 +13,6 @@ import numpy
 import cv2
 import PIL
 from PIL import Image
-from PIL import ImageFont
-from PIL import ImageDraw
 from fractions import Fraction
 import logging
 
@@ -29,11 +29,17 @@ from .draw import IndiAllSkyDraw
 from .scnr import IndiAllskyScnr
 from .stack import IndiAllskyStacker
 from .cardinalDirsLabel import IndiAllskyCardinalDirsLabel
+from .detectionMask import IndiAllSkyDetectionMask
+from .calibrationCache import IndiAllSkyCalibrationCache
+from .sharedFrame import IndiAllSkySharedFrame
+from .astrometry import IndiAllSkyAstrometry
+from .textOverlay import IndiAllSkyTextOverlay
+from .alphaComposite import IndiAllSkyAlphaComposite
+from .frameAnalysis import IndiAllSkyFrameAnalysis
 from .utils import IndiAllSkyDateCalcs
 
 from .flask.models import IndiAllSkyDbBadPixelMapTable
 from .flask.models import IndiAllSkyDbDarkFrameTable
-from .flask.models import IndiAllSkyDbTleDataTable
 
 from sqlalchemy.sql.expression import true as sa_true
 
@@ -72,22 +78,6 @@ class ImageProcessor(object):
     }
 
 
-    satellite_dict = {
-        'iss' : {
-            'title' : 'ISS (ZARYA)',
-            'group' : constants.SATELLITE_VISUAL,
-        },
-        'hst' : {
-            'title' : 'HST',
-            'group' : constants.SATELLITE_VISUAL,
-        },
-        'tiangong' : {
-            'title' : 'CSS (TIANHE)',
-            'group' : constants.SATELLITE_VISUAL,
-        },
-    }
-
-
     wind_directions = ('N', 'NNE', 'NE', 'ENE', 'E', 'ESE', 'SE', 'SSE', 'S', 'SSW', 'SW', 'WSW', 'W', 'WNW', 'NW', 'NNW', 'N')
 
 
@@ -120,11 +110,14 @@ class ImageProcessor(object):
 
         self._detection_mask = self._load_detection_mask()
         self._adu_mask = self._detection_mask  # reuse detection mask for ADU mask (if defined)
+        self._histogram_mask = None  # post-processed mask for the final image
 
         self._image_circle_alpha_mask = None
 
+        self._fish2pano_maps_key = None
+        self._fish2pano_maps = None
+
         self._overlay = None
-        self._alpha_mask = None
 
         self.focus_mode = self.config.get('FOCUS_MODE', False)
 
@@ -139,6 +132,8 @@ class ImageProcessor(object):
 
         self._libcamera_raw = False
 
+        self._analysis = IndiAllSkyFrameAnalysis()  # replaced for every frame
+
         # contains the current stacked image
         self._image = None
         self._non_stacked_image = None  # used when raw exports are enabled
@@ -148,6 +143,12 @@ class ImageProcessor(object):
 
         self._dateCalcs = IndiAllSkyDateCalcs(self.config, self.position_av)
 
+        self._astrometry = IndiAllSkyAstrometry(self.config, self.position_av)
+
+        self._calibration_cache = IndiAllSkyCalibrationCache(self.config)
+
+        self._shared_frame = IndiAllSkySharedFrame(self.config)
+
         self._stretch = IndiAllSkyStretch(self.config, self.bin_v, self.night_v, self.moonmode_v, mask=self._detection_mask)
 
         self._sqm = IndiAllskySqm(self.config, self.bin_v, mask=None)
@@ -156,6 +157,7 @@ class ImageProcessor(object):
         self._draw = IndiAllSkyDraw(self.config, self.bin_v, mask=self._detection_mask)
         self._scnr = IndiAllskyScnr(self.config)
         self._cardinal_dirs_label = IndiAllskyCardinalDirsLabel(self.config)
+        self._text_overlay = IndiAllSkyTextOverlay()
 
         self._orb = IndiAllskyOrbGenerator(self.config)
         self._orb.sun_alt_deg = self.config['NIGHT_SUN_ALT_DEG']
@@ -210,6 +212,15 @@ class ImageProcessor(object):
         self._max_bit_depth = int(new_max_bit_depth)
 
 
+    @property
+    def calibration_cache_stats(self):
+        return self._calibration_cache.stats
+
+    @calibration_cache_stats.setter
+    def calibration_cache_stats(self, *args):
+        pass  # read only
+
+
     @property
     def libcamera_raw(self):
         return self._libcamera_raw
@@ -219,6 +230,15 @@ class ImageProcessor(object):
         self._libcamera_raw = bool(new_libcamera_raw)
 
 
+    @property
+    def analysis(self):
+        return self._analysis
+
+    @analysis.setter
+    def analysis(self, new_analysis):
+        self._analysis = new_analysis
+
+
     @property
     def text_color_rgb(self):
         return self._text_color_rgb
@@ -302,7 +322,7 @@ class ImageProcessor(object):
         self._text_font_height = int(new_height)
 
 
-    def add(self, filename, exposure, exp_date, exp_elapsed, camera):
+    def add(self, filename, exposure, exp_date, exp_elapsed, camera, shared_frame=None):
         from astropy.io import fits
 
         filename_p = Path(filename)
@@ -316,14 +336,29 @@ class ImageProcessor(object):
         if self.night_v.value and not self.moonmode_v.value:
             # just in case the array grows beyond the desired size
             while len(self.image_list) >= self.stack_count:
-                self.image_list.pop()
+                # the stacker subtracts the frame from the running sum
+                self._stacker.ringRemove(self.image_list.pop())
         else:
             # disable stacking during daytime and moonmode
             self.image_list.clear()
+            self._stacker.ringReset()
 
 
         ### Open file
-        if filename_p.suffix in ['.fit']:
+        if shared_frame:
+            # raw data in shared memory, no parsing or copying
+            try:
+                hdulist = self._shared_frame.load(filename_p, shared_frame)
+            except (OSError, ValueError) as e:
+                raise BadImage(str(e)) from e
+
+            image_bitpix = hdulist[0].header['BITPIX']
+            image_bayerpat = hdulist[0].header.get('BAYERPAT')
+
+            aperture = camera.lensFocalLength / camera.lensFocalRatio
+            hdulist[0].header['FOCALLEN'] = round(camera.lensFocalLength, 2)
+            hdulist[0].header['APTDIA'] = round(aperture, 2)
+        elif filename_p.suffix in ['.fit']:
             try:
                 hdulist = fits.open(filename_p)
             except OSError as e:
@@ -698,8 +733,37 @@ class ImageProcessor(object):
 
 
     def _apply_calibration(self, data, exposure, camera_id, image_bitpix):
-        from astropy.io import fits
+        # flush cached darks if the calibration frames have been updated
+        self._calibration_cache.checkVersion()
+
+        bpm_entry, dark_frame_entry = self._select_calibration_frames(exposure, camera_id, image_bitpix)
 
+        # the selected frames identify the master dark
+        cache_key = self._calibration_cache.key(bpm_entry, dark_frame_entry)
+
+        found, master_dark = self._calibration_cache.get(cache_key)
+
+        if found:
+            logger.info('Using cached master dark')
+        else:
+            master_dark = self._load_master_dark(bpm_entry, dark_frame_entry)
+            self._calibration_cache.put(cache_key, master_dark)
+
+
+        self._calibration_cache.logStats()
+
+
+        if master_dark.shape != data.shape:
+            logger.error('Dark frame calibration dimensions mismatch')
+            raise CalibrationNotFound('Dark frame calibration dimension mismatch')
+
+
+        data_calibrated = cv2.subtract(data, master_dark)
+
+        return data_calibrated
+
+
+    def _select_calibration_frames(self, exposure, camera_id, image_bitpix):
         # pick a bad pixel map that is closest to the exposure and temperature
         logger.info('Searching for bad pixel map: gain %d, exposure >= %0.1f, temp >= %0.1fc', self.gain_v.value, exposure, self.sensors_temp_av[0])
         bpm_entry = IndiAllSkyDbBadPixelMapTable.query\
@@ -800,6 +864,12 @@ class ImageProcessor(object):
                 raise CalibrationNotFound('Dark not found')
 
 
+        return bpm_entry, dark_frame_entry
+
+
+    def _load_master_dark(self, bpm_entry, dark_frame_entry):
+        from astropy.io import fits
+
         if bpm_entry:
             p_bpm = Path(bpm_entry.getFilesystemPath())
             if p_bpm.exists():
@@ -829,17 +899,14 @@ class ImageProcessor(object):
             # merge bad pixel map and dark
             master_dark = numpy.maximum(bpm, dark)
         else:
-            master_dark = dark
+            # detach from the FITS file for caching
+            master_dark = numpy.array(dark)
 
 
-        if master_dark.shape != data.shape:
-            logger.error('Dark frame calibration dimensions mismatch')
-            raise CalibrationNotFound('Dark frame calibration dimension mismatch')
-
-
-        data_calibrated = cv2.subtract(data, master_dark)
+        # cached data is shared between frames
+        master_dark.flags.writeable = False
 
-        return data_calibrated
+        return master_dark
 
 
     def calculate_8bit_adu(self):
@@ -862,12 +929,11 @@ class ImageProcessor(object):
             logger.error('Detection mask dimensions do not match image')
 
 
-        if len(self.image.shape) == 2:
-            # mono
-            adu = cv2.mean(src=self.image, mask=self._adu_mask)[0]
-        else:
-            data_mono = cv2.cvtColor(self.image, cv2.COLOR_BGR2GRAY)
-            adu = cv2.mean(src=data_mono, mask=self._adu_mask)[0]
+        adu_start = time.time()
+
+        adu = self._analysis.mean(self.image, mask=self._adu_mask)
+
+        self._analysis.addStageTime('adu', time.time() - adu_start)
 
 
         if i_ref['image_bitpix'] == 8:
@@ -894,7 +960,11 @@ class ImageProcessor(object):
             i_ref['sqm_value'] = 0
             return
 
-        i_ref['sqm_value'] = self._sqm.calculate(i_ref['opencv_data'], i_ref['exposure'], self.gain_v.value)
+        sqm_start = time.time()
+
+        i_ref['sqm_value'] = self._sqm.calculate(i_ref['opencv_data'], i_ref['exposure'], self.gain_v.value, analysis=self._analysis)
+
+        self._analysis.addStageTime('sqm', time.time() - sqm_start)
 
 
     def stack(self):
@@ -927,6 +997,9 @@ class ImageProcessor(object):
         if stack_list_len == 1:
             # no reason to stack a single image
             self.image = i_ref['opencv_data']
+
+            # release the running sum when not stacking
+            self._stacker.ringReset()
             return
 
 
@@ -956,24 +1029,35 @@ class ImageProcessor(object):
             except TimeOutException:
                 # stack unaligned images
                 logger.error('Registration exceeded the exposure period, cancel alignment')
-                stack_data_list = [x['opencv_data'] for x in stack_i_ref_list]
+                stack_data_list = None
 
             signal.alarm(0)
         else:
             # stack unaligned images
-            stack_data_list = [x['opencv_data'] for x in stack_i_ref_list]
+            stack_data_list = None
 
 
         stack_start = time.time()
 
 
-        try:
-            stacker_method = getattr(self._stacker, self.stack_method)
+        if isinstance(stack_data_list, type(None)) and self.stack_method in ('average', 'mean'):
+            # unaligned frames do not change, only the newest frame is added to the running sum
+            self.image = self._stacker.ringAverage(stack_i_ref_list, numpy_type)
+            stack_count = len(stack_i_ref_list)
+        else:
+            try:
+                stacker_method = getattr(self._stacker, self.stack_method)
+            except AttributeError:
+                logger.error('Unknown stacking method: %s', self.stack_method)
+                self.image = i_ref['opencv_data']
+                return
+
+
+            if isinstance(stack_data_list, type(None)):
+                stack_data_list = [x['opencv_data'] for x in stack_i_ref_list]
+
             self.image = stacker_method(stack_data_list, numpy_type)
-        except AttributeError:
-            logger.error('Unknown stacking method: %s', self.stack_method)
-            self.image = i_ref['opencv_data']
-            return
+            stack_count = len(stack_data_list)
 
 
         if self.config.get('IMAGE_STACK_SPLIT'):
@@ -981,7 +1065,7 @@ class ImageProcessor(object):
 
 
         stack_elapsed_s = time.time() - stack_start
-        logger.info('Stacked %d images (%s) in %0.4f s', len(stack_data_list), self.stack_method, stack_elapsed_s)
+        logger.info('Stacked %d images (%s) in %0.4f s', stack_count, self.stack_method, stack_elapsed_s)
 
 
     def debayer(self):
@@ -1081,6 +1165,10 @@ class ImageProcessor(object):
         if image_bitpix == 8:
             return
 
+        if self.image.dtype == numpy.uint8:
+            # already converted during stretch
+            return
+
         logger.info('Resampling image from %d to 8 bits', image_bitpix)
 
         # shifting is 5x faster than division
@@ -1159,7 +1247,11 @@ class ImageProcessor(object):
             i_ref['lines'] = list
             return
 
-        i_ref['lines'] = self._lineDetect.detectLines(self.image)
+        lines_start = time.time()
+
+        i_ref['lines'] = self._lineDetect.detectLines(self.image, analysis=self._analysis)
+
+        self._analysis.addStageTime('lines', time.time() - lines_start)
 
 
     def detectStars(self):
@@ -1170,7 +1262,11 @@ class ImageProcessor(object):
             i_ref['stars'] = list()
             return
 
-        i_ref['stars'] = self._stars_detect.detectObjects(self.image)
+        stars_start = time.time()
+
+        i_ref['stars'] = self._stars_detect.detectObjects(self.image, analysis=self._analysis)
+
+        self._analysis.addStageTime('stars', time.time() - stars_start)
 
 
     def drawDetections(self):
@@ -1303,10 +1399,7 @@ class ImageProcessor(object):
             return
 
         ### This seems to work
-        b, g, r = cv2.split(self.image)
-        b_avg = cv2.mean(b)[0]
-        g_avg = cv2.mean(g)[0]
-        r_avg = cv2.mean(r)[0]
+        b_avg, g_avg, r_avg = self._analysis.channelMeans(self.image)
 
         # Find the gain of each channel
         k = (b_avg + g_avg + r_avg) / 3
@@ -1326,6 +1419,8 @@ class ImageProcessor(object):
         except ZeroDivisionError:
             kr = k / 0.1
 
+        b, g, r = cv2.split(self.image)
+
         b = cv2.addWeighted(src1=b, alpha=kb, src2=0, beta=0, gamma=0)
         g = cv2.addWeighted(src1=g, alpha=kg, src2=0, beta=0, gamma=0)
         r = cv2.addWeighted(src1=r, alpha=kr, src2=0, beta=0, gamma=0)
@@ -1450,13 +1545,13 @@ class ImageProcessor(object):
         if not self.config.get('IMAGE_CIRCLE_MASK', {}).get('ENABLE'):
             return
 
-        if isinstance(self._image_circle_alpha_mask, type(None)):
+        if isinstance(self._image_circle_alpha_mask, type(None)) or self._image_circle_alpha_mask.shape[:2] != self.image.shape[:2]:
             self._image_circle_alpha_mask = self._generate_image_circle_mask(self.image)
 
 
         alpha_start = time.time()
 
-        self.image = (self.image * self._image_circle_alpha_mask).astype(numpy.uint8)
+        self._image_circle_alpha_mask.apply(self.image)
 
 
         if self.config.get('IMAGE_CIRCLE_MASK', {}).get('OUTLINE'):
@@ -1486,9 +1581,9 @@ class ImageProcessor(object):
 
 
         if isinstance(self._overlay, type(None)):
-            self._overlay, self._alpha_mask = self._load_logo_overlay(self.image)
+            self._overlay = self._load_logo_overlay(self.image)
 
-            if isinstance(self._overlay, bool):
+            if isinstance(self._overlay, (bool, type(None))):
                 return
 
         elif isinstance(self._overlay, bool):
@@ -1498,7 +1593,7 @@ class ImageProcessor(object):
 
         alpha_start = time.time()
 
-        self.image = (self.image * (1 - self._alpha_mask) + self._overlay * self._alpha_mask).astype(numpy.uint8)
+        self._overlay.apply(self.image)
 
         alpha_elapsed_s = time.time() - alpha_start
         logger.info('Alpha transparency in %0.4f s', alpha_elapsed_s)
@@ -1602,197 +1697,7 @@ class ImageProcessor(object):
 
 
     def get_astrometric_data(self):
-        utcnow = datetime.now(tz=timezone.utc)  # ephem expects UTC dates
-        #utcnow = datetime.now(tz=timezone.utc) - timedelta(hours=13)  # testing
-
-        obs = ephem.Observer()
-        obs.lon = math.radians(self.position_av[1])
-        obs.lat = math.radians(self.position_av[0])
-        obs.elevation = self.position_av[2]
-
-
-        # disable atmospheric refraction calcs
-        obs.pressure = 0
-
-
-        obs.date = utcnow
-
-        self.astrometric_data['sidereal_time'] = str(obs.sidereal_time())
-
-
-        sun = ephem.Sun()
-        sun.compute(obs)
-        self.astrometric_data['sun_alt'] = math.degrees(sun.alt)
-
-
-        moon = ephem.Moon()
-        moon.compute(obs)
-        moon_alt = math.degrees(moon.alt)
-        self.astrometric_data['moon_alt'] = moon_alt
-        self.astrometric_data['moon_phase'] = moon.moon_phase * 100.0
-
-        if moon_alt >= 0:
-            self.astrometric_data['moon_up'] = 'Yes'
-        else:
-            self.astrometric_data['moon_up'] = 'No'
-
-
-        mercury = ephem.Mercury()
-        mercury.compute(obs)
-        mercury_alt = math.degrees(mercury.alt)
-        self.astrometric_data['mercury_alt'] = mercury_alt
-
-        if mercury_alt >= 0:
-            self.astrometric_data['mercury_up'] = 'Yes'
-        else:
-            self.astrometric_data['mercury_up'] = 'No'
-
-
-        venus = ephem.Venus()
-        venus.compute(obs)
-        venus_alt = math.degrees(venus.alt)
-        self.astrometric_data['venus_alt'] = venus_alt
-        self.astrometric_data['venus_phase'] = venus.phase
-
-        if venus_alt >= 0:
-            self.astrometric_data['venus_up'] = 'Yes'
-        else:
-            self.astrometric_data['venus_up'] = 'No'
-
-
-        mars = ephem.Mars()
-        mars.compute(obs)
-        mars_alt = math.degrees(mars.alt)
-        self.astrometric_data['mars_alt'] = mars_alt
-
-        if mars_alt >= 0:
-            self.astrometric_data['mars_up'] = 'Yes'
-        else:
-            self.astrometric_data['mars_up'] = 'No'
-
-
-        jupiter = ephem.Jupiter()
-        jupiter.compute(obs)
-        jupiter_alt = math.degrees(jupiter.alt)
-        self.astrometric_data['jupiter_alt'] = jupiter_alt
-
-        if jupiter_alt >= 0:
-            self.astrometric_data['jupiter_up'] = 'Yes'
-        else:
-            self.astrometric_data['jupiter_up'] = 'No'
-
-
-        saturn = ephem.Saturn()
-        saturn.compute(obs)
-        saturn_alt = math.degrees(saturn.alt)
-        self.astrometric_data['saturn_alt'] = saturn_alt
-
-        if saturn_alt >= 0:
-            self.astrometric_data['saturn_up'] = 'Yes'
-        else:
-            self.astrometric_data['saturn_up'] = 'No'
-
-
-        # separation of 1-3 degrees means a possible eclipse
-        self.astrometric_data['sun_moon_sep'] = abs((ephem.separation(moon, sun) / (math.pi / 180)) - 180)
-
-
-        # satellites
-        satellite_data = self.populateSatelliteData()
-
-        iss = satellite_data.get('iss')
-        if iss:
-            iss.compute(obs)
-
-            iss_alt = math.degrees(iss.alt)
-            self.astrometric_data['iss_alt'] = iss_alt
-
-            if iss_alt >= 0:
-                self.astrometric_data['iss_up'] = '{0:0.0f}°'.format(iss_alt)
-            else:
-                self.astrometric_data['iss_up'] = 'No'
-
-            try:
-                iss_next_pass = obs.next_pass(iss)
-                self.astrometric_data['iss_next_h'] = (iss_next_pass[0].datetime() - utcnow.replace(tzinfo=None)).total_seconds() / 3600
-                self.astrometric_data['iss_next_alt'] = math.degrees(iss_next_pass[3])
-            except ValueError as e:
-                logger.error('ISS next pass error: %s', str(e))
-                self.astrometric_data['iss_next_h'] = 0.0
-                self.astrometric_data['iss_next_alt'] = 0.0
-
-
-        hst = satellite_data.get('hst')
-        if hst:
-            hst.compute(obs)
-
-            hst_alt = math.degrees(hst.alt)
-            self.astrometric_data['hst_alt'] = hst_alt
-
-            if hst_alt >= 0:
-                self.astrometric_data['hst_up'] = '{0:0.0f}°'.format(hst_alt)
-            else:
-                self.astrometric_data['hst_up'] = 'No'
-
-            try:
-                hst_next_pass = obs.next_pass(hst)
-                self.astrometric_data['hst_next_h'] = (hst_next_pass[0].datetime() - utcnow.replace(tzinfo=None)).total_seconds() / 3600
-                self.astrometric_data['hst_next_alt'] = math.degrees(hst_next_pass[3])
-            except ValueError as e:
-                logger.error('HST next pass error: %s', str(e))
-                self.astrometric_data['hst_next_h'] = 0.0
-                self.astrometric_data['hst_next_alt'] = 0.0
-
-
-        tiangong = satellite_data.get('tiangong')
-        if tiangong:
-            tiangong.compute(obs)
-
-            tiangong_alt = math.degrees(tiangong.alt)
-            self.astrometric_data['tiangong_alt'] = tiangong_alt
-
-            if tiangong_alt >= 0:
-                self.astrometric_data['tiangong_up'] = '{0:0.0f}°'.format(tiangong_alt)
-            else:
-                self.astrometric_data['tiangong_up'] = 'No'
-
-            try:
-                tiangong_next_pass = obs.next_pass(tiangong)
-                self.astrometric_data['tiangong_next_h'] = (tiangong_next_pass[0].datetime() - utcnow.replace(tzinfo=None)).total_seconds() / 3600
-                self.astrometric_data['tiangong_next_alt'] = math.degrees(tiangong_next_pass[3])
-            except ValueError as e:
-                logger.error('TIANGONG next pass error: %s', str(e))
-                self.astrometric_data['tiangong_next_h'] = 0.0
-                self.astrometric_data['tiangong_next_alt'] = 0.0
-
-
-    def populateSatelliteData(self):
-        satellite_data = dict()
-
-        for sat_key, sat_data in self.satellite_dict.items():
-            # there may be multiple satellites of the same name, usually pieces of the same rocket
-            sat_entry = IndiAllSkyDbTleDataTable.query\
-                .filter(IndiAllSkyDbTleDataTable.group == sat_data['group'])\
-                .filter(IndiAllSkyDbTleDataTable.title == sat_data['title'])\
-                .order_by(IndiAllSkyDbTleDataTable.id.desc())\
-                .first()
-
-
-            if not sat_entry:
-                logger.warning('Satellite data not found: %s', sat_data['title'])
-                continue
-
-            #logger.info('Found satellite data: %s', sat_name)
-
-            try:
-                sat = ephem.readtle(sat_entry.title, sat_entry.line1, sat_entry.line2)
-            except ValueError as e:
-                logger.error('Satellite TLE data error: %s', str(e))
-                continue
-
-            satellite_data[sat_key] = sat
-
-        return satellite_data
+        self._astrometry.update(self.astrometric_data)
 
 
     def get_image_label(self, i_ref):
@@ -2153,8 +2058,8 @@ class ImageProcessor(object):
 
 
     def _label_image_pillow(self, i_ref):
-        img_rgb = Image.fromarray(cv2.cvtColor(self.image, cv2.COLOR_BGR2RGB))
-        image_width, image_height  = img_rgb.size  # backwards from opencv
+        # text is drawn directly into the BGR image
+        image_height, image_width = self.image.shape[:2]
 
 
         if self.config['TEXT_PROPERTIES']['PIL_FONT_FILE'] == 'custom':
@@ -2163,16 +2068,13 @@ class ImageProcessor(object):
             pillow_font_file_p = self.font_path.joinpath(self.config['TEXT_PROPERTIES']['PIL_FONT_FILE'])
 
 
-        draw = ImageDraw.Draw(img_rgb)
-
-
         # Disabled when focus mode is enabled
         if self.config.get('FOCUS_MODE', False):
             logger.warning('Focus mode enabled, labels disabled')
 
             # indicate focus mode is enabled in indi-allsky
             self.drawText_pillow(
-                draw,
+                self.image,
                 'Focus Mode',
                 pillow_font_file_p,
                 self.text_size_pillow,
@@ -2183,7 +2085,7 @@ class ImageProcessor(object):
 
             self.text_xy = [image_width - 300, image_height - (self.text_font_height * 2)]
             self.drawText_pillow(
-                draw,
+                self.image,
                 i_ref['exp_date'].strftime('%H:%M:%S'),
                 pillow_font_file_p,
                 self.text_size_pillow,
@@ -2192,9 +2094,6 @@ class ImageProcessor(object):
                 anchor=self.text_anchor_pillow,
             )
 
-            # convert back to numpy array
-            self.image = cv2.cvtColor(numpy.array(img_rgb), cv2.COLOR_RGB2BGR)
-
             return
 
 
@@ -2208,7 +2107,7 @@ class ImageProcessor(object):
 
 
             self.drawText_pillow(
-                draw,
+                self.image,
                 line,
                 pillow_font_file_p,
                 self.text_size_pillow,
@@ -2220,26 +2119,21 @@ class ImageProcessor(object):
             self._text_next_line()
 
 
-        # convert back to numpy array
-        self.image = cv2.cvtColor(numpy.array(img_rgb), cv2.COLOR_RGB2BGR)
-
-
-    def drawText_pillow(self, draw, text, font_file, font_size, pt, color_rgb, anchor='la'):
-        font = ImageFont.truetype(str(font_file), font_size)
-
+    def drawText_pillow(self, data, text, font_file, font_size, pt, color_rgb, anchor='la'):
         if self.config['TEXT_PROPERTIES']['FONT_OUTLINE']:
             # black outline
             stroke_width = 4
         else:
             stroke_width = 0
 
-        draw.text(
-            pt,
+        self._text_overlay.drawText(
+            data,
             text,
-            fill=color_rgb,
-            font=font,
+            font_file,
+            font_size,
+            pt,
+            color_rgb,
             stroke_width=stroke_width,
-            stroke_fill=(0, 0, 0),
             anchor=anchor,
         )
 
@@ -2329,7 +2223,10 @@ class ImageProcessor(object):
             # disable processing in focus mode
             return
 
-        stretched_image, is_stretched = self._stretch.main(self.image, self.max_bit_depth)
+        # the 16-bit to 8-bit conversion is merged into the stretch when the 16-bit data is not needed later
+        output_8bit = not self.config.get('IMAGE_STRETCH', {}).get('SPLIT') and not self.config.get('CONTRAST_ENHANCE_16BIT')
+
+        stretched_image, is_stretched = self._stretch.main(self.image, self.max_bit_depth, output_8bit=output_8bit)
 
 
         if is_stretched and self.config.get('IMAGE_STRETCH', {}).get('SPLIT'):
@@ -2424,45 +2321,29 @@ class ImageProcessor(object):
         return img_pano
 
 
-    def fish2pano_module(self):
-        import fish2pano
+    def fish2pano_remap(self):
+        # Same algorithm as fish2pano_purepython(), but the coordinate maps are only
+        # generated once and each panorama is a single cv2.remap() call
 
         angle = self.config.get('FISH2PANO', {}).get('ROTATE_ANGLE', 0)
-        if angle:
-            height, width = self.image.shape[:2]
-            center_x = int(width / 2)
-            center_y = int(height / 2)
-
-            rot = cv2.getRotationMatrix2D((center_x, center_y), int(angle), 1.0)
-
-            abs_cos = abs(rot[0, 0])
-            abs_sin = abs(rot[0, 1])
-
-            bound_w = int(height * abs_sin + width * abs_cos)
-            bound_h = int(height * abs_cos + width * abs_sin)
-
-            rot[0, 2] += bound_w / 2 - center_x
-            rot[1, 2] += bound_h / 2 - center_y
-
-            rotated_image = cv2.warpAffine(self.image, rot, (bound_w, bound_h))
-        else:
-            rotated_image = self.image
-
-
-        rot_height, rot_width = rotated_image.shape[:2]
-
         x_offset = self.config.get('FISH2PANO', {}).get('OFFSET_X', 0)
         y_offset = self.config.get('FISH2PANO', {}).get('OFFSET_Y', 0)
-        center_x = int(rot_width / 2) + x_offset
-        center_y = int(rot_height / 2) - y_offset  # note minus for y
-
         radius = self.config.get('FISH2PANO', {}).get('DIAMETER', 3000) / 2
         scale = self.config.get('FISH2PANO', {}).get('SCALE', 0.3)
 
+        height, width = self.image.shape[:2]
 
         fish2pano_start = time.time()
 
-        img_pano = fish2pano.fish2pano(rotated_image, radius, [center_x, center_y], scale)
+        maps_key = (height, width, int(angle), x_offset, y_offset, radius, scale)
+        if maps_key != self._fish2pano_maps_key:
+            self._fish2pano_maps = self._generate_fish2pano_maps(height, width, int(angle), x_offset, y_offset, radius, scale)
+            self._fish2pano_maps_key = maps_key
+
+
+        map1, map2, interpolation = self._fish2pano_maps
+
+        img_pano = cv2.remap(self.image, map1, map2, interpolation, borderMode=cv2.BORDER_CONSTANT, borderValue=0)
 
 
         pano_height, pano_width = img_pano.shape[:2]
@@ -2486,54 +2367,101 @@ class ImageProcessor(object):
         return img_pano
 
 
-    def fish2pano(self):
-        return self.fish2pano_module()
+    def _generate_fish2pano_maps(self, height, width, angle, x_offset, y_offset, radius, scale):
+        maps_start = time.time()
 
+        if angle:
+            center_x = int(width / 2)
+            center_y = int(height / 2)
 
-    def fish2pano_cardinal_dirs_label(self, pano_data):
-        if not self.config.get('CARDINAL_DIRS', {}).get('ENABLE'):
-            return pano_data
+            rot = cv2.getRotationMatrix2D((center_x, center_y), angle, 1.0)
 
-        return self._cardinal_dirs_label.panorama_label(pano_data)
+            abs_cos = abs(rot[0, 0])
+            abs_sin = abs(rot[0, 1])
 
+            rot_width = int(height * abs_sin + width * abs_cos)
+            rot_height = int(height * abs_cos + width * abs_sin)
 
-    def _load_detection_mask(self):
-        detect_mask = self.config.get('DETECT_MASK', '')
+            rot[0, 2] += rot_width / 2 - center_x
+            rot[1, 2] += rot_height / 2 - center_y
+        else:
+            rot = None
+            rot_width = width
+            rot_height = height
 
-        if not detect_mask:
-            logger.warning('No detection mask defined')
-            return
 
+        center_x = int(rot_width / 2) + x_offset
+        center_y = int(rot_height / 2) - y_offset  # note minus for y
 
-        detect_mask_p = Path(detect_mask)
+        w = int(scale * 2 * math.pi * radius + 0.5)
+        h = int(scale * radius + 0.5)
 
-        try:
-            if not detect_mask_p.exists():
-                logger.error('%s does not exist', detect_mask_p)
-                return
 
+        theta = (2.0 * math.pi) * numpy.arange(w, dtype=numpy.float64) / w
+        r_0 = radius * numpy.arange(h, dtype=numpy.float64) / h
 
-            if not detect_mask_p.is_file():
-                logger.error('%s is not a file', detect_mask_p)
-                return
+        x_ = numpy.outer(r_0, numpy.cos(theta)) + center_x
+        y_ = numpy.outer(r_0, numpy.sin(theta)) + center_y
 
-        except PermissionError as e:
-            logger.error(str(e))
-            return
+        ix_ = numpy.trunc(x_ + 0.5)
+        iy_ = numpy.trunc(y_ + 0.5)
 
-        mask_data = cv2.imread(str(detect_mask_p), cv2.IMREAD_GRAYSCALE)  # mono
-        if isinstance(mask_data, type(None)):
-            logger.error('%s is not a valid image', detect_mask_p)
-            return
+        valid = (x_ > 0) & (ix_ < rot_width) & (y_ > 0) & (iy_ < rot_height)
+
+
+        if isinstance(rot, type(None)):
+            map_x = ix_
+            map_y = iy_
+            interpolation = cv2.INTER_NEAREST
+        else:
+            # fold the rotation into the map, sample the original image where the rotated pixel would be
+            inv_rot = cv2.invertAffineTransform(rot)
+
+            map_x = inv_rot[0, 0] * ix_ + inv_rot[0, 1] * iy_ + inv_rot[0, 2]
+            map_y = inv_rot[1, 0] * ix_ + inv_rot[1, 1] * iy_ + inv_rot[1, 2]
+            interpolation = cv2.INTER_LINEAR
 
 
-        logger.info('Loaded detection mask: %s', detect_mask_p)
+        # pixels outside of the image are black
+        map_x[~valid] = -10
+        map_y[~valid] = -10
+
+        # fixed point maps are faster
+        map1, map2 = cv2.convertMaps(
+            map_x.astype(numpy.float32),
+            map_y.astype(numpy.float32),
+            cv2.CV_16SC2,
+            nninterpolation=(interpolation == cv2.INTER_NEAREST),
+        )
+
+
+        maps_elapsed_s = time.time() - maps_start
+        logger.info('Panorama maps generated in %0.4f s', maps_elapsed_s)
+
+        return map1, map2, interpolation
+
+
+    def fish2pano(self):
+        return self.fish2pano_remap()
+
+
+    def fish2pano_cardinal_dirs_label(self, pano_data):
+        if not self.config.get('CARDINAL_DIRS', {}).get('ENABLE'):
+            return pano_data
+
+        return self._cardinal_dirs_label.panorama_label(pano_data)
+
+
+    def _load_detection_mask(self):
+        # pre-transform mask for the original images
+        mask_data = IndiAllSkyDetectionMask(self.config, self.bin_v).load(transform=False)
 
-        ### any compression artifacts will be set to black
-        #mask_data[mask_data < 255] = 0  # did not quite work
+        if isinstance(mask_data, type(None)):
+            return
 
 
-        return mask_data
+        # some consumers draw on the mask
+        return numpy.array(mask_data)
 
 
     def _load_logo_overlay(self, image):
@@ -2541,7 +2469,7 @@ class ImageProcessor(object):
 
         if not logo_overlay:
             logger.warning('No logo overlay defined')
-            return None, None
+            return None
 
 
         logo_overlay_p = Path(logo_overlay)
@@ -2549,45 +2477,115 @@ class ImageProcessor(object):
         try:
             if not logo_overlay_p.exists():
                 logger.error('%s does not exist', logo_overlay_p)
-                return None, None
+                return None
 
 
             if not logo_overlay_p.is_file():
                 logger.error('%s is not a file', logo_overlay_p)
-                return None, None
+                return None
 
         except PermissionError as e:
             logger.error(str(e))
-            return None, None
+            return None
 
         overlay_img = cv2.imread(str(logo_overlay_p), cv2.IMREAD_UNCHANGED)
         if isinstance(overlay_img, type(None)):
             logger.error('%s is not a valid image', logo_overlay_p)
-            return False, None  # False so the image is not retried
+            return False  # False so the image is not retried
 
 
         if overlay_img.shape[:2] != image.shape[:2]:
             logger.error('Logo dimensions do not match image')
-            return False, None  # False so the image is not retried
+            return False  # False so the image is not retried
 
 
         try:
             if overlay_img.shape[2] != 4:
                 logger.error('%s does not have an alpha channel')
-                return False, None  # False so the image is not retried
+                return False  # False so the image is not retried
         except IndexError:
             logger.error('%s does not have an alpha channel')
-            return False, None  # False so the image is not retried
+            return False  # False so the image is not retried
+
+
+        overlay_bgr = overlay_img[:, :, :3]
+        overlay_alpha = overlay_img[:, :, 3]
+
+        if overlay_img.dtype != numpy.uint8:
+            # 16-bit PNG
+            overlay_bgr = numpy.right_shift(overlay_bgr, 8).astype(numpy.uint8)
+            overlay_alpha = numpy.right_shift(overlay_alpha, 8).astype(numpy.uint8)
+
+
+        return IndiAllSkyAlphaComposite(numpy.ascontiguousarray(overlay_alpha), overlay=numpy.ascontiguousarray(overlay_bgr))
+
+
+    def calculateHistogram(self):
+        # histogram of the final image, stored with the image so the charts do not need to read the file
+        histogram_start = time.time()
+
+        if isinstance(self._histogram_mask, type(None)) or self._histogram_mask.shape[:2] != self.image.shape[:2]:
+            self._generateHistogramMask(self.image)
+
+
+        if len(self.image.shape) == 2:
+            # mono
+            channels = ['gray']
+        else:
+            channels = ['blue', 'green', 'red']
+
+
+        histogram = numpy.zeros((len(channels), 256), dtype=numpy.uint32)
+        for i in range(len(channels)):
+            histogram[i] = cv2.calcHist([self.image], [i], self._histogram_mask, [256], [0, 256]).ravel()
+
 
+        histogram_elapsed_s = time.time() - histogram_start
+        logger.info('Histogram calculated in %0.4f s', histogram_elapsed_s)
+
+        return {
+            'channels' : channels,
+            'counts'   : base64.b64encode(zlib.compress(histogram.astype('<u4').tobytes())).decode('ascii'),
+        }
+
+
+    def _generateHistogramMask(self, img):
+        image_height, image_width = img.shape[:2]
+
+        if not isinstance(self._detection_mask, type(None)):
+            # masks need to be rotated, flipped, cropped for post-processed images
+            histogram_mask = IndiAllSkyDetectionMask(self.config, self.bin_v).load()
+
+            if not isinstance(histogram_mask, type(None)) and histogram_mask.shape[:2] == (image_height, image_width):
+                self._histogram_mask = histogram_mask
+                return
+
+            logger.error('Detection mask dimensions do not match image, using SQM ROI for histogram')
 
-        overlay_rgb = overlay_img[:, :, :3]
-        overlay_alpha = (overlay_img[:, :, 3] / 255).astype(numpy.float32)
 
+        logger.info('Generating histogram mask based on SQM_ROI')
 
-        alpha_mask = numpy.dstack((overlay_alpha, overlay_alpha, overlay_alpha))
+        # create a black background
+        mask = numpy.zeros((image_height, image_width), dtype=numpy.uint8)
 
+        sqm_roi = self.config.get('SQM_ROI', [])
 
-        return overlay_rgb, alpha_mask
+        try:
+            x1 = sqm_roi[0]  # these values may be invalid due to binning
+            y1 = sqm_roi[1]
+            x2 = sqm_roi[2]
+            y2 = sqm_roi[3]
+        except IndexError:
+            sqm_fov_div = self.config.get('SQM_FOV_DIV', 4)
+            x1 = int((image_width / 2) - (image_width / sqm_fov_div))
+            y1 = int((image_height / 2) - (image_height / sqm_fov_div))
+            x2 = int((image_width / 2) + (image_width / sqm_fov_div))
+            y2 = int((image_height / 2) + (image_height / sqm_fov_div))
+
+        # The white area is what we keep
+        mask[y1:y2, x1:x2] = 255
+
+        self._histogram_mask = mask
 
 
     def _generateAduMask(self, img):
@@ -2665,10 +2663,7 @@ class ImageProcessor(object):
             )
 
 
-        channel_alpha = (channel_mask / 255).astype(numpy.float32)
-
-        alpha_mask = numpy.dstack((channel_alpha, channel_alpha, channel_alpha))
-
-        return alpha_mask
+        # the area outside of the circle is blended with black
+        return IndiAllSkyAlphaComposite(cv2.bitwise_not(channel_mask))
 
 
@@ -0,0 +1,56 @@
+import cv2
+import logging
+
+
+logger = logging.getLogger('indi_allsky')
+
+
+class IndiAllSkyResizePyramid(object):
+    # Downscaled versions of an image are made from the decoded data instead of reading
+    # the file again.  Large reductions are done in halving steps, INTER_AREA is much
+    # faster with a factor of 2, and the final resize only works on a small source.
+    #
+    # The halved levels are kept so additional sizes from the same image are cheap.
+    # Levels are not copied, do not modify the source data while the pyramid is in use.
+
+    def __init__(self, data):
+        self._levels = [data]  # decreasing size
+
+
+    @property
+    def shape(self):
+        return self._levels[0].shape
+
+    @shape.setter
+    def shape(self, *args):
+        pass  # read only
+
+
+    def resize(self, new_width):
+        height, width = self._levels[0].shape[:2]
+
+        if new_width >= width:
+            # images are not enlarged
+            return self._levels[0]
+
+
+        new_height = max(int(height * new_width / width), 1)
+
+
+        # smallest existing level that is at least twice the new width
+        source = self._levels[0]
+        for level in self._levels[1:]:
+            if level.shape[1] < new_width * 2:
+                break
+
+            source = level
+
+
+        while source.shape[1] >= new_width * 4:
+            source_height, source_width = source.shape[:2]
+
+            source = cv2.resize(source, (source_width // 2, source_height // 2), interpolation=cv2.INTER_AREA)
+            self._levels.append(source)
+
+
+        return cv2.resize(source, (new_width, new_height), interpolation=cv2.INTER_AREA)
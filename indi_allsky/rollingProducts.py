@@ -0,0 +1,629 @@
+import io
+import json
+import time
+import copy
+import fcntl
+import shutil
+from types import SimpleNamespace
+import numpy
+from pathlib import Path
+import logging
+
+from .keogram import KeogramGenerator
+from .starTrails import StarTrailGenerator
+
+
+logger = logging.getLogger('indi_allsky')
+
+
+class IndiAllSkyRollingProducts(object):
+    # Keogram and star trail data are built as images are captured.  The state is
+    # checkpointed so end of night generation does not need to read every image.
+
+    checkpoint_frames = 10  # append keogram columns every X images
+    checkpoint_period = 600  # save the star trail image and state every X seconds
+    latest_keogram_period = 600  # update the latest keogram every X seconds
+    checkpoint_expire_days = 3
+
+    state_version = 2
+
+
+    def __init__(self, config, bin_v, mask=None, image_writer=None):
+        self.config = config
+        self.bin_v = bin_v
+
+        self._mask = mask
+
+        # the latest keogram is written in the background when available
+        self._image_writer = image_writer
+
+        self._key = None  # camera id, day date, night
+        self._camera = None
+
+        self.kg = None
+        self.stg = None
+
+        self.image_id_list = list()
+        self._frames_since_checkpoint = 0
+
+        # keogram columns and frames already appended to the checkpoint files
+        self._columns_written = 0
+        self._frames_written = 0
+
+        self._checkpoint_time = 0
+        self._latest_keogram_time = 0
+
+        if self.config.get('IMAGE_FOLDER'):
+            self.image_dir = Path(self.config['IMAGE_FOLDER']).absolute()
+        else:
+            self.image_dir = Path(__file__).parent.parent.joinpath('html', 'images').absolute()
+
+
+    def buildKeogramGenerator(self):
+        kg = KeogramGenerator(
+            self.config,
+        )
+        kg.angle = self.config['KEOGRAM_ANGLE']
+        kg.h_scale_factor = self.config['KEOGRAM_H_SCALE']
+        kg.v_scale_factor = self.config['KEOGRAM_V_SCALE']
+        kg.crop_top = self.config.get('KEOGRAM_CROP_TOP', 0)
+        kg.crop_bottom = self.config.get('KEOGRAM_CROP_BOTTOM', 0)
+
+        return kg
+
+
+    def buildStarTrailGenerator(self, camera, timelapse_dir=None):
+        stg = StarTrailGenerator(
+            self.config,
+            self.bin_v,
+            mask=self._mask,
+            timelapse_dir=timelapse_dir,
+        )
+        stg.max_adu = self.config['STARTRAILS_MAX_ADU']
+        stg.mask_threshold = self.config['STARTRAILS_MASK_THOLD']
+        stg.pixel_cutoff_threshold = self.config['STARTRAILS_PIXEL_THOLD']
+        stg.min_stars = self.config.get('STARTRAILS_MIN_STARS', 0)
+        stg.latitude = camera.latitude
+        stg.longitude = camera.longitude
+        stg.sun_alt_threshold = self.config['STARTRAILS_SUN_ALT_THOLD']
+
+        if self.config['STARTRAILS_MOONMODE_THOLD']:
+            stg.moonmode_alt = self.config['NIGHT_MOONMODE_ALT_DEG']
+            stg.moonmode_phase = self.config['NIGHT_MOONMODE_PHASE']
+        else:
+            stg.moon_alt_threshold = self.config['STARTRAILS_MOON_ALT_THOLD']
+            stg.moon_phase_threshold = self.config['STARTRAILS_MOON_PHASE_THOLD']
+
+        return stg
+
+
+    def getCheckpointFolder(self, camera, day_date, night):
+        if night:
+            timeofday = 'night'
+        else:
+            timeofday = 'day'
+
+        return self.image_dir.joinpath(
+            'ccd_{0:s}'.format(camera.uuid),
+            'rolling',
+            '{0:s}_{1:s}'.format(day_date.strftime('%Y%m%d'), timeofday),
+        )
+
+
+    def getRemovedMarker(self, camera, day_date, night):
+        # created when the products are generated, the checkpoint is not written again
+        checkpoint_folder = self.getCheckpointFolder(camera, day_date, night)
+        return checkpoint_folder.with_name('{0:s}.removed'.format(checkpoint_folder.name))
+
+
+    def _lock(self, camera):
+        # serializes checkpoints, restores and removal between the image and video workers
+        rolling_folder = self.image_dir.joinpath('ccd_{0:s}'.format(camera.uuid), 'rolling')
+
+        if not rolling_folder.exists():
+            rolling_folder.mkdir(mode=0o755, parents=True)
+
+        f_lock = io.open(str(rolling_folder.joinpath('.lock')), 'w+')
+        fcntl.flock(f_lock, fcntl.LOCK_EX)
+
+        return f_lock
+
+
+    def _unlock(self, f_lock):
+        fcntl.flock(f_lock, fcntl.LOCK_UN)
+        f_lock.close()
+
+
+    def processImage(self, image_entry, image_file_p, camera, image, adu, star_count):
+        processing_start = time.time()
+
+        key = (camera.id, image_entry.dayDate, image_entry.night)
+
+        f_lock = self._lock(camera)
+
+        try:
+            if key != self._key:
+                if self._key:
+                    # final checkpoint for the previous period
+                    self._checkpoint(force=True)
+
+                self._begin(camera, image_entry.dayDate, image_entry.night)
+
+
+            if self.getRemovedMarker(camera, image_entry.dayDate, image_entry.night).exists():
+                # the products were already generated
+                return
+
+
+            self.kg.processImage(image_file_p, image)
+
+            if self.stg:
+                # ADU and star counts are always current for new images
+                self.stg.processImage(image_file_p, image, adu=adu, star_count=star_count)
+
+
+            self.image_id_list.append(image_entry.id)
+            self._frames_since_checkpoint += 1
+
+
+            if self._frames_since_checkpoint >= self.checkpoint_frames:
+                self._checkpoint()
+        finally:
+            self._unlock(f_lock)
+
+
+        if time.time() - self._latest_keogram_time >= self.latest_keogram_period:
+            self.writeLatestKeogram()
+
+
+        processing_elapsed_s = time.time() - processing_start
+        logger.info('Rolling keogram/star trails updated in %0.4f s', processing_elapsed_s)
+
+
+    def _begin(self, camera, day_date, night):
+        self._key = (camera.id, day_date, night)
+        self._camera = camera
+
+        checkpoint_folder = self.getCheckpointFolder(camera, day_date, night)
+
+        self.kg = self.buildKeogramGenerator()
+
+        if night:
+            self.stg = self.buildStarTrailGenerator(camera, timelapse_dir=checkpoint_folder.joinpath('timelapse'))
+        else:
+            self.stg = None
+
+        # resume after a restart
+        self.image_id_list = self._restore(self.kg, self.stg, camera, day_date, night)
+        self._frames_since_checkpoint = 0
+
+        # discard anything appended after the last saved state
+        self._truncateCheckpoint(checkpoint_folder, self.kg.keogram_index, len(self.image_id_list))
+
+        self._checkpoint_time = time.time()
+        self._latest_keogram_time = 0
+
+        self.expireCheckpoints(camera)
+
+
+    def checkpoint(self):
+        if not self._key:
+            return
+
+        f_lock = self._lock(self._camera)
+
+        try:
+            self._checkpoint(force=True)
+        finally:
+            self._unlock(f_lock)
+
+
+    def _checkpoint(self, force=False):
+        # Keogram columns and frames are appended, the star trail image and the state
+        # are saved every checkpoint_period seconds or when forced
+        if isinstance(self.kg.keogram_data, type(None)):
+            return
+
+
+        camera_id, day_date, night = self._key
+
+        if self.getRemovedMarker(self._camera, day_date, night).exists():
+            logger.warning('Products already generated, not writing checkpoint')
+            return
+
+
+        checkpoint_start = time.time()
+
+        checkpoint_folder = self.getCheckpointFolder(self._camera, day_date, night)
+
+        if not checkpoint_folder.exists():
+            checkpoint_folder.mkdir(mode=0o755, parents=True)
+
+
+        self._appendCheckpoint(checkpoint_folder)
+        self._frames_since_checkpoint = 0
+
+
+        if self.stg and not force:
+            if time.time() - self._checkpoint_time < self.checkpoint_period:
+                checkpoint_elapsed_s = time.time() - checkpoint_start
+                logger.info('Rolling keogram columns appended in %0.4f s', checkpoint_elapsed_s)
+                return
+
+
+        keogram_column = self.kg.keogram_data[:, 0]
+
+        state = {
+            'version'           : self.state_version,
+            'camera_id'         : camera_id,
+            'dayDate'           : day_date.strftime('%Y%m%d'),
+            'night'             : night,
+            'frames'            : self._frames_written,
+            'keogram'           : {
+                'angle'           : self.kg.angle,
+                'columns'         : self._columns_written,
+                'column_shape'    : list(keogram_column.shape),
+                'dtype'           : keogram_column.dtype.str,
+                'original_width'  : self.kg.original_width,
+                'original_height' : self.kg.original_height,
+                'rotated_width'   : self.kg.rotated_width,
+                'rotated_height'  : self.kg.rotated_height,
+            },
+        }
+
+
+        if self.stg and not isinstance(self.stg.trail_image, type(None)):
+            self._saveNumpy(checkpoint_folder.joinpath('startrail.npy'), self.stg.trail_image)
+
+            if not isinstance(self.stg.placeholder_image, type(None)):
+                self._saveNumpy(checkpoint_folder.joinpath('placeholder.npy'), self.stg.placeholder_image)
+
+            state['startrail'] = {
+                'trail_count'      : self.stg.trail_count,
+                'excluded_images'  : self.stg.excluded_images,
+                'placeholder_adu'  : self.stg.placeholder_adu,
+                'placeholder'      : not isinstance(self.stg.placeholder_image, type(None)),
+                'timelapse_frames' : self.stg.timelapse_frame_count,
+            }
+
+
+        # state file is written last
+        state_p = checkpoint_folder.joinpath('state.json')
+        state_tmp_p = checkpoint_folder.joinpath('state.json.tmp')
+
+        with io.open(str(state_tmp_p), 'w') as f_state:
+            json.dump(state, f_state)
+
+        state_tmp_p.replace(state_p)
+
+
+        self._checkpoint_time = time.time()
+
+        checkpoint_elapsed_s = time.time() - checkpoint_start
+        logger.info('Rolling keogram/star trails checkpoint in %0.4f s', checkpoint_elapsed_s)
+
+
+    def _appendCheckpoint(self, checkpoint_folder):
+        # only new keogram columns and frames are written
+        if self.kg.keogram_index > self._columns_written:
+            # column major, each column is contiguous
+            new_columns = numpy.ascontiguousarray(numpy.moveaxis(self.kg.keogram_data[:, self._columns_written:self.kg.keogram_index], 1, 0))
+
+            with io.open(str(checkpoint_folder.joinpath('keogram.bin')), 'ab') as f_keogram:
+                f_keogram.write(new_columns.data)
+
+            self._columns_written = self.kg.keogram_index
+
+
+        if len(self.image_id_list) > self._frames_written:
+            with io.open(str(checkpoint_folder.joinpath('frames.txt')), 'a') as f_frames:
+                for image_id, timestamp in zip(self.image_id_list[self._frames_written:], self.kg.timestamps_list[self._frames_written:]):
+                    f_frames.write('{0:d} {1:f}\n'.format(image_id, timestamp))
+
+            self._frames_written = len(self.image_id_list)
+
+
+    def _truncateCheckpoint(self, checkpoint_folder, columns, frames):
+        self._columns_written = columns
+        self._frames_written = frames
+
+        keogram_p = checkpoint_folder.joinpath('keogram.bin')
+        if keogram_p.exists():
+            if columns:
+                column_bytes = self.kg.keogram_data[:, 0].nbytes
+
+                with io.open(str(keogram_p), 'r+b') as f_keogram:
+                    f_keogram.truncate(columns * column_bytes)
+            else:
+                keogram_p.unlink()
+
+
+        frames_p = checkpoint_folder.joinpath('frames.txt')
+        if frames_p.exists():
+            with io.open(str(frames_p), 'r') as f_frames:
+                frame_lines = f_frames.readlines()[:frames]
+
+            with io.open(str(frames_p), 'w') as f_frames:
+                f_frames.writelines(frame_lines)
+
+
+    def _saveNumpy(self, file_p, data):
+        tmp_p = file_p.with_name('{0:s}.tmp'.format(file_p.name))
+
+        with io.open(str(tmp_p), 'w+b') as f_numpy:
+            numpy.save(f_numpy, data)
+
+        tmp_p.replace(file_p)
+
+
+    def restore(self, kg, stg, camera, day_date, night, image_id_list=None):
+        # Load the checkpoint into the generators, returns the list of image ids already processed.
+        # If image_id_list is provided, the checkpoint must match the beginning of the list.
+        f_lock = self._lock(camera)
+
+        try:
+            return self._restore(kg, stg, camera, day_date, night, image_id_list=image_id_list)
+        finally:
+            self._unlock(f_lock)
+
+
+    def _restore(self, kg, stg, camera, day_date, night, image_id_list=None):
+        checkpoint_folder = self.getCheckpointFolder(camera, day_date, night)
+        timelapse_folder = checkpoint_folder.joinpath('timelapse')
+
+        # only the image worker owns the checkpoint timelapse frames, other generators link them
+        if stg:
+            timelapse_owner = stg.timelapse_tmpdir_p == timelapse_folder
+        else:
+            timelapse_owner = False
+
+
+        if self.getRemovedMarker(camera, day_date, night).exists():
+            state = None
+        else:
+            state = self._loadState(checkpoint_folder, kg, night, image_id_list)
+
+        if not state:
+            if timelapse_owner:
+                # remove orphaned timelapse frames
+                stg.restoreTimelapseFrames(0)
+
+            return list()
+
+
+        frame_list = self._loadFrames(checkpoint_folder, state['frames'])
+        image_ids = [x[0] for x in frame_list]
+
+
+        keogram_data = self._loadKeogram(checkpoint_folder, state['keogram'])
+        keogram_columns = keogram_data.shape[1]
+
+        if kg.total_frames and kg.total_frames > keogram_columns:
+            # preallocate the remaining columns
+            new_shape = list(keogram_data.shape)
+            new_shape[1] = kg.total_frames
+
+            kg.keogram_data = numpy.zeros(new_shape, dtype=keogram_data.dtype)
+            kg.keogram_data[:, :keogram_columns] = keogram_data
+        else:
+            kg.keogram_data = keogram_data
+
+        kg.keogram_index = keogram_columns
+        kg.timestamps_list = [x[1] for x in frame_list]
+        kg.original_width = state['keogram']['original_width']
+        kg.original_height = state['keogram']['original_height']
+        kg.rotated_width = state['keogram']['rotated_width']
+        kg.rotated_height = state['keogram']['rotated_height']
+
+
+        if stg:
+            st_state = state.get('startrail')
+
+            if st_state:
+                trail_image = numpy.load(str(checkpoint_folder.joinpath('startrail.npy')))
+                image_height, image_width = trail_image.shape[:2]
+
+                stg.trail_image = trail_image
+                stg.original_height = image_height
+                stg.original_width = image_width
+                stg.pixels_cutoff = (image_height * image_width) * (stg.pixel_cutoff_threshold / 100)
+                stg.trail_count = st_state['trail_count']
+                stg.excluded_images = st_state['excluded_images']
+                stg.placeholder_adu = st_state['placeholder_adu']
+
+                if st_state['placeholder']:
+                    stg.placeholder_image = numpy.load(str(checkpoint_folder.joinpath('placeholder.npy')))
+
+                timelapse_frames = st_state['timelapse_frames']
+            else:
+                timelapse_frames = 0
+
+
+            if timelapse_owner:
+                stg.restoreTimelapseFrames(timelapse_frames)
+            else:
+                stg.linkTimelapseFrames(timelapse_folder, timelapse_frames)
+
+
+        logger.warning('Restored rolling keogram/star trails checkpoint with %d images', len(image_ids))
+
+        return image_ids
+
+
+    def _loadFrames(self, checkpoint_folder, frames):
+        # returns a list of (image id, timestamp)
+        frame_list = list()
+
+        with io.open(str(checkpoint_folder.joinpath('frames.txt')), 'r') as f_frames:
+            for line in f_frames:
+                if len(frame_list) >= frames:
+                    break
+
+                image_id, timestamp = line.split()
+                frame_list.append((int(image_id), float(timestamp)))
+
+        return frame_list
+
+
+    def _loadKeogram(self, checkpoint_folder, kg_state):
+        # columns are stored column major
+        column_shape = tuple(kg_state['column_shape'])
+        column_size = int(numpy.prod(column_shape))
+
+        keogram_columns = numpy.fromfile(
+            str(checkpoint_folder.joinpath('keogram.bin')),
+            dtype=numpy.dtype(kg_state['dtype']),
+            count=kg_state['columns'] * column_size,
+        )
+
+        keogram_columns = keogram_columns.reshape((kg_state['columns'],) + column_shape)
+
+        return numpy.ascontiguousarray(numpy.moveaxis(keogram_columns, 0, 1))
+
+
+    def _loadState(self, checkpoint_folder, kg, night, image_id_list):
+        state_p = checkpoint_folder.joinpath('state.json')
+
+        if not state_p.exists():
+            return
+
+
+        try:
+            with io.open(str(state_p), 'r') as f_state:
+                state = json.load(f_state)
+        except json.JSONDecodeError as e:
+            logger.error('Invalid checkpoint state: %s', str(e))
+            return
+
+
+        if state.get('version') != self.state_version:
+            logger.warning('Checkpoint version mismatch, ignoring')
+            return
+
+        if state['keogram']['angle'] != kg.angle:
+            logger.warning('Keogram angle changed, ignoring checkpoint')
+            return
+
+
+        try:
+            column_bytes = int(numpy.prod(state['keogram']['column_shape'])) * numpy.dtype(state['keogram']['dtype']).itemsize
+            keogram_size = checkpoint_folder.joinpath('keogram.bin').stat().st_size
+        except (FileNotFoundError, KeyError, TypeError) as e:
+            logger.error('Invalid keogram checkpoint: %s', str(e))
+            return
+
+        if keogram_size < state['keogram']['columns'] * column_bytes:
+            logger.warning('Keogram checkpoint does not match state, ignoring')
+            return
+
+
+        try:
+            frame_list = self._loadFrames(checkpoint_folder, state['frames'])
+        except (FileNotFoundError, ValueError) as e:
+            logger.error('Invalid frame checkpoint: %s', str(e))
+            return
+
+        if len(frame_list) < state['frames']:
+            logger.warning('Frame checkpoint does not match state, ignoring')
+            return
+
+
+        st_state = state.get('startrail')
+        if night and st_state:
+            if not checkpoint_folder.joinpath('startrail.npy').exists():
+                logger.warning('Star trail checkpoint missing, ignoring')
+                return
+
+            timelapse_frames = list(checkpoint_folder.joinpath('timelapse').glob('*.{0:s}'.format(self.config['IMAGE_FILE_TYPE'])))
+            if len(timelapse_frames) < st_state['timelapse_frames']:
+                logger.warning('Star trail timelapse frames missing, ignoring checkpoint')
+                return
+
+
+        if not isinstance(image_id_list, type(None)):
+            checkpoint_id_list = [x[0] for x in frame_list]
+
+            if image_id_list[:len(checkpoint_id_list)] != checkpoint_id_list:
+                logger.warning('Images have changed since checkpoint, ignoring')
+                return
+
+
+        return state
+
+
+    def writeLatestKeogram(self):
+        if self.kg.keogram_index < 2:
+            return
+
+        latest_keogram_p = self.image_dir.joinpath('latest_keogram.{0:s}'.format(self.config['IMAGE_FILE_TYPE']))
+
+        # new columns are added while the keogram is encoded, the writer gets a copy
+        kg = copy.copy(self.kg)
+        kg.keogram_data = self.kg.keogram_data[:, :self.kg.keogram_index].copy()
+        kg.timestamps_list = list(self.kg.timestamps_list)
+
+        # database objects are not used outside of the worker thread
+        camera = SimpleNamespace(
+            name=self._camera.name,
+            lensName=self._camera.lensName,
+            owner=self._camera.owner,
+            longitude=self._camera.longitude,
+            latitude=self._camera.latitude,
+        )
+
+        self._latest_keogram_time = time.time()
+
+        if self._image_writer:
+            self._image_writer.submit('latest_keogram', self._writeLatestKeogramJob, kg, camera, latest_keogram_p)
+        else:
+            self._writeLatestKeogramJob(kg, camera, latest_keogram_p)
+
+
+    def _writeLatestKeogramJob(self, kg, camera, latest_keogram_p):
+        # runs in the image writer thread
+        tmp_keogram_p = self.image_dir.joinpath('latest_keogram_tmp.{0:s}'.format(self.config['IMAGE_FILE_TYPE']))
+
+        kg.finalize(tmp_keogram_p, camera)
+
+        tmp_keogram_p.replace(latest_keogram_p)
+
+
+    def remove(self, camera, day_date, night):
+        checkpoint_folder = self.getCheckpointFolder(camera, day_date, night)
+
+        f_lock = self._lock(camera)
+
+        try:
+            # the image worker does not write the checkpoint again
+            self.getRemovedMarker(camera, day_date, night).touch()
+
+            if not checkpoint_folder.exists():
+                return
+
+            logger.info('Removing rolling checkpoint: %s', checkpoint_folder)
+            shutil.rmtree(str(checkpoint_folder))
+        finally:
+            self._unlock(f_lock)
+
+
+    def expireCheckpoints(self, camera):
+        rolling_folder = self.image_dir.joinpath('ccd_{0:s}'.format(camera.uuid), 'rolling')
+
+        if not rolling_folder.exists():
+            return
+
+        cutoff = time.time() - (self.checkpoint_expire_days * 86400)
+
+        for item in rolling_folder.iterdir():
+            if item.name == '.lock':
+                continue
+
+            if item.stat().st_mtime >= cutoff:
+                continue
+
+            if item.is_dir():
+                logger.warning('Removing expired rolling checkpoint: %s', item)
+                shutil.rmtree(str(item))
+            else:
+                # removed markers
+                item.unlink()
@@ -0,0 +1,172 @@
+import os
+import mmap
+import uuid
+from pathlib import Path
+import numpy
+import logging
+
+
+logger = logging.getLogger('indi_allsky')
+
+
+class IndiAllSkySharedFrame(object):
+    # Frames are passed to the image worker as raw pixel data in a shared memory (tmpfs)
+    # file instead of a FITS file.  Only the file name, array shape, dtype and FITS header
+    # are sent through the image queue, the image worker maps the data without copying.
+    #
+    # The image worker unlinks the file after the data is mapped, the memory is released
+    # when the last reference to the array is removed.
+
+    shm_dir = Path('/dev/shm')
+    suffix = '.frame'
+
+
+    def __init__(self, config):
+        self.config = config
+
+
+    @classmethod
+    def remove(cls, frame_p):
+        # frame of a job that was not processed
+        try:
+            Path(frame_p).unlink()
+        except FileNotFoundError:
+            pass
+
+
+    @classmethod
+    def removeStale(cls):
+        # the image queue does not survive a restart, frames from a previous run are orphans
+        if not cls.shm_dir.is_dir():
+            return
+
+        for frame_p in cls.shm_dir.glob('indi_allsky_*{0:s}'.format(cls.suffix)):
+            logger.warning('Removing orphaned shared frame: %s', frame_p)
+
+            try:
+                frame_p.unlink()
+            except OSError as e:
+                logger.error('Unable to remove shared frame: %s', str(e))
+
+
+    @property
+    def available(self):
+        return self.shm_dir.is_dir()
+
+    @available.setter
+    def available(self, *args):
+        pass  # read only
+
+
+    def export(self, hdulist, blob=None):
+        # returns the path and the frame info to send with the job data
+        hdu = hdulist[0]
+
+        raw_data = None
+        if not isinstance(blob, type(None)):
+            raw_data = self._getRawData(hdulist, blob)
+
+
+        if isinstance(raw_data, type(None)):
+            # data is scaled by astropy
+            data = hdu.data
+            shape = data.shape
+            dtype = data.dtype
+        else:
+            shape = raw_data.shape
+            dtype = numpy.dtype(numpy.uint16) if raw_data.dtype.itemsize == 2 else numpy.dtype(numpy.uint8)
+
+
+        nbytes = int(numpy.prod(shape)) * dtype.itemsize
+
+        frame_p = self.shm_dir.joinpath('indi_allsky_{0:s}{1:s}'.format(uuid.uuid4().hex, self.suffix))
+
+        fd = os.open(str(frame_p), os.O_RDWR | os.O_CREAT | os.O_EXCL, 0o600)
+
+        try:
+            # reserve the memory first, writing through mmap to a full tmpfs raises SIGBUS
+            os.posix_fallocate(fd, 0, nbytes)
+
+            with mmap.mmap(fd, nbytes) as mm:
+                frame = numpy.ndarray(shape, dtype=dtype, buffer=mm)
+
+                if isinstance(raw_data, type(None)):
+                    frame[:] = data
+                elif dtype.itemsize == 2:
+                    # signed big endian data with BZERO 32768, flipping the sign bit is the same as adding 32768
+                    numpy.bitwise_xor(raw_data.view('>u2'), 0x8000, out=frame)
+                else:
+                    frame[:] = raw_data
+
+                del frame  # release the buffer before closing
+        except (OSError, ValueError):
+            os.close(fd)
+            frame_p.unlink()
+            raise
+
+        os.close(fd)
+
+
+        frame_info = {
+            'shape'  : list(shape),
+            'dtype'  : dtype.str,
+            'header' : hdu.header.tostring(),
+        }
+
+        return frame_p, frame_info
+
+
+    def _getRawData(self, hdulist, blob):
+        # Unscaled data directly from the FITS blob, only unsigned 8 and 16 bit data is supported
+        header = hdulist[0].header
+
+        if header.get('BSCALE', 1) != 1:
+            return None
+
+        if header['BITPIX'] == 16 and header.get('BZERO') == 32768:
+            raw_dtype = '>i2'
+        elif header['BITPIX'] == 8 and not header.get('BZERO'):
+            raw_dtype = 'u1'
+        else:
+            return None
+
+
+        naxis = header['NAXIS']
+        if not naxis:
+            return None
+
+        # numpy axis order is reversed
+        shape = tuple(header['NAXIS{0:d}'.format(x)] for x in range(naxis, 0, -1))
+
+        data_offset = hdulist.fileinfo(0)['datLoc']
+
+        return numpy.frombuffer(blob, dtype=raw_dtype, count=int(numpy.prod(shape)), offset=data_offset).reshape(shape)
+
+
+    def load(self, frame_p, frame_info):
+        from astropy.io import fits
+
+        dtype = numpy.dtype(frame_info['dtype'])
+        shape = tuple(frame_info['shape'])
+
+        fd = os.open(str(frame_p), os.O_RDWR)
+
+        try:
+            mm = mmap.mmap(fd, 0)
+        finally:
+            os.close(fd)
+
+
+        if len(mm) != int(numpy.prod(shape)) * dtype.itemsize:
+            mm.close()
+            raise ValueError('Shared frame size mismatch: {0:s}'.format(str(frame_p)))
+
+
+        # the mmap is kept open by the array
+        data = numpy.frombuffer(mm, dtype=dtype).reshape(shape)
+
+        header = fits.Header.fromstring(frame_info['header'])
+
+        hdu = fits.PrimaryHDU(data, header=header)
+
+        return fits.HDUList([hdu])
@@ -2,6 +2,8 @@ import cv2
 import numpy
 import logging
 
+from .frameAnalysis import IndiAllSkyFrameAnalysis
+
 
 logger = logging.getLogger('indi_allsky')
 
@@ -17,7 +19,7 @@ class IndiAllskySqm(object):
         self._sqm_mask = None
 
 
-    def calculate(self, img, exposure, gain):
+    def calculate(self, img, exposure, gain, analysis=None):
         logger.info('Exposure: %0.6f, gain: %d', exposure, gain)
 
         if isinstance(self._sqm_mask, type(None)):
@@ -25,15 +27,11 @@ class IndiAllskySqm(object):
             self._generateSqmMask(img)
 
 
-        if len(img.shape) == 2:
-            # mono
-            img_gray = img
-        else:
-            # color
-            img_gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        if isinstance(analysis, type(None)):
+            analysis = IndiAllSkyFrameAnalysis()
 
 
-        sqm_avg = cv2.mean(src=img_gray, mask=self._sqm_mask)[0]
+        sqm_avg = analysis.mean(img, mask=self._sqm_mask)
         logger.info('Raw SQM average: %0.2f', sqm_avg)
 
         # offset the sqm based on the exposure and gain
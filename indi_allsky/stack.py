@@ -1,4 +1,6 @@
 import time
+import itertools
+from collections import deque
 import numpy
 import cv2
 import astroalign
@@ -23,6 +25,13 @@ class IndiAllskyStacker(object):
         self._rotation_dev = 3  # rotation may not exceed this deviation
         self._history_min_vals = 15
 
+        # running sum for unaligned average stacking
+        # frames are not copied, the image list already holds the data
+        self._ring_sum = None
+        self._ring_order = deque()  # (seq, data) oldest to newest
+
+        self._seq = itertools.count()
+
 
     @property
     def detection_sigma(self):
@@ -93,24 +102,92 @@ class IndiAllskyStacker(object):
 
 
     def maximum(self, stack_data_list, numpy_type):
-        image_max = stack_data_list[0]  # start with first image
+        image_max = stack_data_list[0].copy()  # start with first image
 
-        # compare with remaining images
+        # compare with remaining images, in place
         for i in stack_data_list[1:]:
-            image_max = numpy.maximum(image_max, i)
+            numpy.maximum(image_max, i, out=image_max)
 
         return image_max
 
     def minimum(self, stack_data_list, numpy_type):
-        image_min = stack_data_list[0]  # start with first image
+        image_min = stack_data_list[0].copy()  # start with first image
 
-        # compare with remaining images
+        # compare with remaining images, in place
         for i in stack_data_list[1:]:
-            image_min = numpy.minimum(image_min, i)
+            numpy.minimum(image_min, i, out=image_min)
 
         return image_min
 
 
+    def ringAverage(self, stack_i_ref_list, numpy_type):
+        # stack_i_ref_list is newest to oldest (same as the image list)
+        # only new frames are added to the running sum, frames leaving the list are subtracted
+
+        i_ref_list = list(reversed(stack_i_ref_list))  # oldest to newest
+
+        for i_ref in i_ref_list:
+            if 'stack_seq' not in i_ref:
+                i_ref['stack_seq'] = next(self._seq)
+
+
+        frame = i_ref_list[-1]['opencv_data']
+
+        if isinstance(self._ring_sum, type(None)) or self._ring_sum.shape != frame.shape:
+            self.ringReset()
+            self._ring_sum = numpy.zeros(frame.shape, dtype=numpy.uint32)
+
+
+        wanted_seq_list = [x['stack_seq'] for x in i_ref_list]
+
+        # drop frames that are no longer in the list
+        while self._ring_order and self._ring_order[0][0] not in wanted_seq_list:
+            self._ringRemoveOldest()
+
+
+        ring_seq_list = [x[0] for x in self._ring_order]
+        if ring_seq_list != wanted_seq_list[:len(ring_seq_list)]:
+            # out of order, rebuild the sum
+            self._ring_order.clear()
+            self._ring_sum.fill(0)
+
+            ring_seq_list = list()
+
+
+        for i_ref in i_ref_list[len(ring_seq_list):]:
+            self._ringAdd(i_ref['stack_seq'], i_ref['opencv_data'])
+
+
+        # integer division is the same as numpy.floor(numpy.mean())
+        return numpy.floor_divide(self._ring_sum, len(self._ring_order)).astype(numpy_type)
+
+
+    def ringRemove(self, i_ref):
+        # called before a frame is dropped from the image list
+        if not i_ref or not self._ring_order:
+            return
+
+        if self._ring_order[0][0] == i_ref.get('stack_seq'):
+            self._ringRemoveOldest()
+
+
+    def ringReset(self):
+        self._ring_sum = None
+        self._ring_order.clear()
+
+
+    def _ringAdd(self, seq, data):
+        numpy.add(self._ring_sum, data, out=self._ring_sum)
+
+        self._ring_order.append((seq, data))
+
+
+    def _ringRemoveOldest(self):
+        seq, data = self._ring_order.popleft()
+
+        numpy.subtract(self._ring_sum, data, out=self._ring_sum)
+
+
     def register(self, stack_i_ref_list):
         # first image is the reference
         reference_i_ref = stack_i_ref_list[0]
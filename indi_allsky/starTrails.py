@@ -9,12 +9,17 @@ from datetime import timezone
 from PIL import Image
 import piexif
 import time
+import shutil
 from pathlib import Path
 import tempfile
 import ephem
 import logging
 
 from .stars import IndiAllSkyStars
+from .frameAnalysis import IndiAllSkyFrameAnalysis
+from .timelapse import TimelapseGenerator
+
+from .exceptions import TimelapseException
 
 
 logger = logging.getLogger('indi_allsky')
@@ -23,7 +28,7 @@ logger = logging.getLogger('indi_allsky')
 
 class StarTrailGenerator(object):
 
-    def __init__(self, config, bin_v, mask=None):
+    def __init__(self, config, bin_v, mask=None, timelapse_dir=None):
         self.config = config
         self.bin_v = bin_v
 
@@ -75,6 +80,12 @@ class StarTrailGenerator(object):
         self._timelapse_frame_count = 0
         self._timelapse_frame_list = list()
 
+        # frames are piped to ffmpeg when a stream file is set
+        self._timelapse_stream = None
+        self._timelapse_stream_file_p = None
+        self._timelapse_stream_failed = False
+        self._timelapse_stream_partial_p = None  # frames streamed before a stream error
+
 
         if self.config['IMAGE_FOLDER']:
             self.image_dir = Path(self.config['IMAGE_FOLDER']).absolute()
@@ -82,8 +93,13 @@ class StarTrailGenerator(object):
             self.image_dir = Path(__file__).parent.parent.joinpath('html', 'images').absolute()
 
 
-        self.timelapse_tmpdir = tempfile.TemporaryDirectory(dir=self.image_dir, suffix='_startrail_timelapse')    # context manager automatically deletes files when finished
-        self.timelapse_tmpdir_p = Path(self.timelapse_tmpdir.name)
+        if timelapse_dir:
+            # persistent folder, frames are kept between restarts
+            self.timelapse_tmpdir = None
+            self.timelapse_tmpdir_p = Path(timelapse_dir)
+        else:
+            self.timelapse_tmpdir = tempfile.TemporaryDirectory(dir=self.image_dir, suffix='_startrail_timelapse')    # context manager automatically deletes files when finished
+            self.timelapse_tmpdir_p = Path(self.timelapse_tmpdir.name)
 
 
 
@@ -135,6 +151,19 @@ class StarTrailGenerator(object):
     def timelapse_frame_list(self, new_frame_list):
         return  # read only
 
+    @property
+    def timelapse_stream_file(self):
+        return self._timelapse_stream_file_p
+
+    @timelapse_stream_file.setter
+    def timelapse_stream_file(self, new_stream_file):
+        if self.timelapse_tmpdir is None:
+            # persistent frames are needed to resume after a restart
+            logger.warning('Star trail timelapse streaming not available with a persistent timelapse folder')
+            return
+
+        self._timelapse_stream_file_p = Path(new_stream_file)
+
     @property
     def latitude(self):
         return self._latitude
@@ -268,15 +297,11 @@ class StarTrailGenerator(object):
             self._stars_detect = IndiAllSkyStars(self.config, self.bin_v, mask=self._sqm_mask)
 
 
-        # need grayscale image for mask generation
-        if len(image.shape) == 2:
-            image_gray = image.copy()
-        else:
-            image_gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        analysis = IndiAllSkyFrameAnalysis()
 
 
         if isinstance(adu, type(None)):
-            m_avg = cv2.mean(image_gray, mask=self._sqm_mask)[0]
+            m_avg = analysis.mean(image, mask=self._sqm_mask)
         else:
             m_avg = adu
 
@@ -322,7 +347,7 @@ class StarTrailGenerator(object):
 
         #logger.info(' Image brightness: %0.2f', m_avg)
 
-        pixels_above_cutoff = (image_gray > self.mask_threshold).sum()
+        pixels_above_cutoff = (analysis.gray(image) > self.mask_threshold).sum()
         if pixels_above_cutoff > self.pixels_cutoff:
             #logger.warning(' Excluding image due to pixel cutoff: %d', pixels_above_cutoff)
             self.excluded_images += 1
@@ -333,7 +358,7 @@ class StarTrailGenerator(object):
 
         if self.min_stars > 0:
             if isinstance(star_count, type(None)):
-                star_count = len(self._stars_detect.detectObjects(image_gray))
+                star_count = len(self._stars_detect.detectObjects(image, analysis=analysis, draw=False))
 
             if star_count < self.min_stars:
                 #logger.warning(' Excluding image due to stars: %d', star_count)
@@ -347,39 +372,185 @@ class StarTrailGenerator(object):
 
         # Star trail timelapse processing
         if self.config.get('STARTRAILS_TIMELAPSE', True):
-            image_mtime = file_p.stat().st_mtime
-
-            f_tmp_frame = tempfile.NamedTemporaryFile(dir=self.timelapse_tmpdir_p, suffix='.{0:s}'.format(self.config['IMAGE_FILE_TYPE']), delete=False)
-            f_tmp_frame.close()
-
-            f_tmp_frame_p = Path(f_tmp_frame.name)
-
-            if self.config['IMAGE_FILE_TYPE'] in ('jpg', 'jpeg'):
-                img_rgb = Image.fromarray(cv2.cvtColor(self.trail_image, cv2.COLOR_BGR2RGB))
-                img_rgb.save(str(f_tmp_frame_p), quality=self.config['IMAGE_FILE_COMPRESSION']['jpg'])
-            elif self.config['IMAGE_FILE_TYPE'] in ('png',):
-                #img_rgb = Image.fromarray(cv2.cvtColor(self.trail_image, cv2.COLOR_BGR2RGB))
-                #img_rgb.save(str(f_tmp_frame_p), compress_level=self.config['IMAGE_FILE_COMPRESSION']['png'])
-
-                # opencv is faster than Pillow with PNG
-                cv2.imwrite(str(f_tmp_frame_p), self.trail_image, [cv2.IMWRITE_PNG_COMPRESSION, self.config['IMAGE_FILE_COMPRESSION']['png']])
-            elif self.config['IMAGE_FILE_TYPE'] in ('webp',):
-                img_rgb = Image.fromarray(cv2.cvtColor(self.trail_image, cv2.COLOR_BGR2RGB))
-                img_rgb.save(str(f_tmp_frame_p), quality=90, lossless=False)
-            elif self.config['IMAGE_FILE_TYPE'] in ('tif', 'tiff'):
-                img_rgb = Image.fromarray(cv2.cvtColor(self.trail_image, cv2.COLOR_BGR2RGB))
-                img_rgb.save(str(f_tmp_frame_p), compression='tiff_lzw')
+            if self._timelapse_stream_file_p and not self._timelapse_stream_failed:
+                self._timelapseStreamFrame(file_p)
             else:
-                raise Exception('Unknown file type: %s', self.config['IMAGE_FILE_TYPE'])
+                self._timelapseFrameFile(file_p)
 
-            # put original mtime on file
-            os.utime(f_tmp_frame_p, times=(image_mtime, image_mtime))
 
-            self._timelapse_frame_list.append(f_tmp_frame_p)
-            self._timelapse_frame_count += 1
+        self.image_processing_elapsed_s += time.time() - image_processing_start
 
 
-        self.image_processing_elapsed_s += time.time() - image_processing_start
+    def _timelapseFrameFile(self, file_p):
+        image_mtime = file_p.stat().st_mtime
+
+        if not self.timelapse_tmpdir_p.exists():
+            self.timelapse_tmpdir_p.mkdir(mode=0o755, parents=True)
+
+        # prefix keeps the frames sorted by name
+        f_tmp_frame = tempfile.NamedTemporaryFile(dir=self.timelapse_tmpdir_p, prefix='{0:06d}_'.format(self._timelapse_frame_count), suffix='.{0:s}'.format(self.config['IMAGE_FILE_TYPE']), delete=False)
+        f_tmp_frame.close()
+
+        f_tmp_frame_p = Path(f_tmp_frame.name)
+
+        if self.config['IMAGE_FILE_TYPE'] in ('jpg', 'jpeg'):
+            img_rgb = Image.fromarray(cv2.cvtColor(self.trail_image, cv2.COLOR_BGR2RGB))
+            img_rgb.save(str(f_tmp_frame_p), quality=self.config['IMAGE_FILE_COMPRESSION']['jpg'])
+        elif self.config['IMAGE_FILE_TYPE'] in ('png',):
+            #img_rgb = Image.fromarray(cv2.cvtColor(self.trail_image, cv2.COLOR_BGR2RGB))
+            #img_rgb.save(str(f_tmp_frame_p), compress_level=self.config['IMAGE_FILE_COMPRESSION']['png'])
+
+            # opencv is faster than Pillow with PNG
+            cv2.imwrite(str(f_tmp_frame_p), self.trail_image, [cv2.IMWRITE_PNG_COMPRESSION, self.config['IMAGE_FILE_COMPRESSION']['png']])
+        elif self.config['IMAGE_FILE_TYPE'] in ('webp',):
+            img_rgb = Image.fromarray(cv2.cvtColor(self.trail_image, cv2.COLOR_BGR2RGB))
+            img_rgb.save(str(f_tmp_frame_p), quality=90, lossless=False)
+        elif self.config['IMAGE_FILE_TYPE'] in ('tif', 'tiff'):
+            img_rgb = Image.fromarray(cv2.cvtColor(self.trail_image, cv2.COLOR_BGR2RGB))
+            img_rgb.save(str(f_tmp_frame_p), compression='tiff_lzw')
+        else:
+            raise Exception('Unknown file type: %s', self.config['IMAGE_FILE_TYPE'])
+
+        # put original mtime on file
+        os.utime(f_tmp_frame_p, times=(image_mtime, image_mtime))
+
+        self._timelapse_frame_list.append(f_tmp_frame_p)
+        self._timelapse_frame_count += 1
+
+
+    def _timelapseStreamFrame(self, file_p):
+        try:
+            if isinstance(self._timelapse_stream, type(None)):
+                self._timelapse_stream = TimelapseGenerator(self.config)
+                self._timelapse_stream.openStream(self._timelapse_stream_file_p, self.trail_image)
+
+            self._timelapse_stream.writeStreamFrame(self.trail_image)
+        except TimelapseException as e:
+            logger.error('Star trail timelapse stream failed after %d frames: %s', self._timelapse_frame_count, str(e))
+            self._timelapseStreamFallback()
+
+            # this frame and the remaining frames are written to files
+            self._timelapseFrameFile(file_p)
+            return
+
+        self._timelapse_frame_count += 1
+
+
+    def _timelapseStreamFallback(self):
+        self._timelapse_stream_failed = True
+
+        stream = self._timelapse_stream
+        self._timelapse_stream = None
+
+        if self._timelapse_frame_count == 0:
+            # nothing was streamed
+            if stream:
+                stream.abortStream()
+
+            return
+
+
+        # finish the video with the frames already streamed, the rest is joined later
+        logger.warning('Keeping %d streamed star trail timelapse frames', self._timelapse_frame_count)
+
+        try:
+            stream.closeStream()
+        except TimelapseException as e:
+            logger.error('Streamed star trail timelapse frames lost: %s', str(e))
+            return
+
+        self._timelapse_stream_partial_p = self._timelapse_stream_file_p
+
+
+    def generateTimelapse(self, video_file):
+        video_file_p = Path(video_file)
+
+        if self._timelapse_stream:
+            stream = self._timelapse_stream
+            self._timelapse_stream = None
+
+            try:
+                stream.closeStream()
+            except TimelapseException:
+                self.cancelTimelapse()
+                raise
+
+            self._timelapse_stream_file_p.replace(video_file_p)
+            return
+
+
+        if not self._timelapse_stream_partial_p:
+            st_tg = TimelapseGenerator(self.config)
+            st_tg.generate(video_file_p, self.timelapse_frame_list)
+            return
+
+
+        # the stream failed, the streamed video is joined with the frames written to files
+        frames_video_p = self._timelapse_stream_partial_p.with_name('.frames_{0:s}'.format(video_file_p.name))
+
+        try:
+            st_tg = TimelapseGenerator(self.config)
+            st_tg.generate(frames_video_p, self.timelapse_frame_list)
+            st_tg.concat(video_file_p, [self._timelapse_stream_partial_p, frames_video_p])
+        finally:
+            if frames_video_p.is_file():
+                frames_video_p.unlink()
+
+            self.cancelTimelapse()
+
+
+    def cancelTimelapse(self):
+        if self._timelapse_stream:
+            # removes the partial video
+            self._timelapse_stream.abortStream()
+            self._timelapse_stream = None
+
+        if self._timelapse_stream_file_p and self._timelapse_stream_file_p.is_file():
+            self._timelapse_stream_file_p.unlink()
+
+
+    def restoreTimelapseFrames(self, frame_count):
+        # reload frames from a persistent timelapse folder, frames beyond frame_count are removed
+        if not self.timelapse_tmpdir_p.exists():
+            return 0
+
+        frame_list = sorted(self.timelapse_tmpdir_p.glob('*.{0:s}'.format(self.config['IMAGE_FILE_TYPE'])))
+
+        for f in frame_list[frame_count:]:
+            f.unlink()
+
+        self._timelapse_frame_list = frame_list[:frame_count]
+        self._timelapse_frame_count = len(self._timelapse_frame_list)
+
+        return self._timelapse_frame_count
+
+
+    def linkTimelapseFrames(self, frame_dir, frame_count):
+        # use the first frame_count frames of a folder owned by another process, nothing is removed
+        frame_dir_p = Path(frame_dir)
+
+        if not frame_dir_p.exists():
+            return 0
+
+        frame_list = sorted(frame_dir_p.glob('*.{0:s}'.format(self.config['IMAGE_FILE_TYPE'])))[:frame_count]
+
+        if not self.timelapse_tmpdir_p.exists():
+            self.timelapse_tmpdir_p.mkdir(mode=0o755, parents=True)
+
+        for f in frame_list:
+            link_p = self.timelapse_tmpdir_p.joinpath(f.name)
+
+            try:
+                os.link(str(f), str(link_p))
+            except OSError:
+                # no hard link support
+                shutil.copy2(str(f), str(link_p))
+
+            self._timelapse_frame_list.append(link_p)
+
+        self._timelapse_frame_count = len(self._timelapse_frame_list)
+
+        return self._timelapse_frame_count
 
 
     def finalize(self, outfile, camera):
@@ -4,6 +4,8 @@ import cv2
 import numpy
 import logging
 
+from .frameAnalysis import IndiAllSkyFrameAnalysis
+
 
 logger = logging.getLogger('indi_allsky')
 
@@ -12,6 +14,12 @@ class IndiAllSkyStars(object):
 
     _distanceThreshold = 10
 
+    star_dtype = numpy.dtype([
+        ('x', numpy.float32),
+        ('y', numpy.float32),
+        ('flux', numpy.float32),
+    ])
+
 
     def __init__(self, config, bin_v, mask=None):
         self.config = config
@@ -19,6 +27,11 @@ class IndiAllSkyStars(object):
 
         self._sqm_mask = mask
 
+        self._mask_roi = None
+        self._mask_roi_key = None
+
+        self._star_data = numpy.zeros(0, dtype=self.star_dtype)
+
         self._detectionThreshold = self.config.get('DETECT_STARS_THOLD', 0.6)
 
         if self.config['IMAGE_FOLDER']:
@@ -48,36 +61,67 @@ class IndiAllSkyStars(object):
         self.star_template_w, self.star_template_h = self.star_template.shape[::-1]
 
 
-    def detectObjects(self, original_data):
+        # matches closer than the distance threshold are the same star
+        nms_size = (self._distanceThreshold * 2) - 1
+        self._nms_kernel = numpy.ones((nms_size, nms_size), dtype=numpy.uint8)
+
+
+    @property
+    def star_data(self):
+        # centroids and flux of the stars from the last detection
+        return self._star_data
+
+    @star_data.setter
+    def star_data(self, *args):
+        pass  # read only
+
+
+    def detectObjects(self, original_data, analysis=None, draw=True):
         if isinstance(self._sqm_mask, type(None)):
             # This only needs to be done once if a mask is not provided
             self._generateSqmMask(original_data)
 
-        masked_img = cv2.bitwise_and(original_data, original_data, mask=self._sqm_mask)
 
-        if len(original_data.shape) == 2:
-            # gray scale or bayered
-            grey_img = masked_img
-        else:
-            # assume color
-            grey_img = cv2.cvtColor(masked_img, cv2.COLOR_BGR2GRAY)
+        sep_start = time.time()
 
 
-        sep_start = time.time()
+        # only the area of the mask is searched, padded so stars on the edge of the mask are still found
+        mask_x, mask_y, mask_w, mask_h = self._maskRoi(original_data)
+
+        roi = (slice(mask_y, mask_y + mask_h), slice(mask_x, mask_x + mask_w))
+
+        if isinstance(analysis, type(None)):
+            analysis = IndiAllSkyFrameAnalysis()
+
+        grey_roi = analysis.grayRoi(original_data, (mask_x, mask_y, mask_w, mask_h))
+        grey_img = cv2.bitwise_and(grey_roi, grey_roi, mask=self._sqm_mask[roi])
+
+
+        if grey_img.shape[0] < self.star_template_h or grey_img.shape[1] < self.star_template_w:
+            logger.warning('Star detection area is smaller than the star template')
+            self._star_data = numpy.zeros(0, dtype=self.star_dtype)
+            return list()
 
 
         result = cv2.matchTemplate(grey_img, self.star_template, cv2.TM_CCOEFF_NORMED)
-        result_filter = numpy.where(result >= self._detectionThreshold)
 
-        blobs = list()
-        for pt in zip(*result_filter[::-1]):
-            for blob in blobs:
-                if (abs(pt[0] - blob[0]) < self._distanceThreshold) and (abs(pt[1] - blob[1]) < self._distanceThreshold):
-                    break
 
-            else:
-                # if none of the points are under the distance threshold, then add it
-                blobs.append(pt)
+        # non-maximum suppression, keep the local maximum of each group of matches
+        local_max = cv2.dilate(result, self._nms_kernel)
+
+        peaks = numpy.logical_and(result >= self._detectionThreshold, result >= local_max).astype(numpy.uint8)
+
+        del result, local_max  # release the full size correlation buffers before labeling
+
+        # neighboring peaks with the same value are merged
+        peak_count, peak_labels, peak_stats, peak_centroids = cv2.connectedComponentsWithStats(peaks, connectivity=8)
+        peak_xy = numpy.round(peak_centroids[1:]).astype(numpy.intp)  # label 0 is the background
+
+
+        self._star_data = self._measureStars(grey_img, peak_xy, mask_x, mask_y)
+
+
+        blobs = [(int(x) + mask_x, int(y) + mask_y) for x, y in peak_xy]
 
 
         sep_elapsed_s = time.time() - sep_start
@@ -85,11 +129,78 @@ class IndiAllSkyStars(object):
 
         logger.info('Found %d objects', len(blobs))
 
-        self._drawCircles(original_data, blobs)
+        if draw:
+            self._drawCircles(original_data, blobs)
 
         return blobs
 
 
+    def _maskRoi(self, img):
+        image_height, image_width = img.shape[:2]
+
+        mask_key = (image_height, image_width)
+        if mask_key == self._mask_roi_key:
+            return self._mask_roi
+
+
+        x, y, w, h = cv2.boundingRect(self._sqm_mask)
+
+        x1 = max(x - self.star_template_w, 0)
+        y1 = max(y - self.star_template_h, 0)
+        x2 = min(x + w + self.star_template_w, image_width)
+        y2 = min(y + h + self.star_template_h, image_height)
+
+        self._mask_roi = (x1, y1, x2 - x1, y2 - y1)
+        self._mask_roi_key = mask_key
+
+        return self._mask_roi
+
+
+    def _measureStars(self, grey_img, peak_xy, offset_x, offset_y):
+        # centroid and flux from the template sized area of each match
+        star_data = numpy.zeros(peak_xy.shape[0], dtype=self.star_dtype)
+        if not peak_xy.shape[0]:
+            return star_data
+
+
+        win_y, win_x = numpy.mgrid[0:self.star_template_h, 0:self.star_template_w]
+
+        windows = grey_img[
+            peak_xy[:, 1, numpy.newaxis, numpy.newaxis] + win_y,
+            peak_xy[:, 0, numpy.newaxis, numpy.newaxis] + win_x,
+        ].astype(numpy.float32)
+
+
+        # background from the edge of the area
+        edges = numpy.concatenate((
+            windows[:, 0, :],
+            windows[:, -1, :],
+            windows[:, 1:-1, 0],
+            windows[:, 1:-1, -1],
+        ), axis=1)
+
+        background = numpy.median(edges, axis=1)
+
+        signal = numpy.clip(windows - background[:, numpy.newaxis, numpy.newaxis], 0, None)
+
+        flux = signal.sum(axis=(1, 2))
+        flux_div = numpy.where(flux > 0, flux, 1)
+
+        centroid_x = (signal * win_x).sum(axis=(1, 2)) / flux_div
+        centroid_y = (signal * win_y).sum(axis=(1, 2)) / flux_div
+
+        # center of the template when there is no signal
+        centroid_x[flux <= 0] = self.star_template_w // 2
+        centroid_y[flux <= 0] = self.star_template_h // 2
+
+
+        star_data['x'] = peak_xy[:, 0] + offset_x + centroid_x
+        star_data['y'] = peak_xy[:, 1] + offset_y + centroid_y
+        star_data['flux'] = flux
+
+        return star_data
+
+
     def _generateSqmMask(self, img):
         logger.info('Generating mask based on SQM_ROI')
 
@@ -123,6 +234,7 @@ class IndiAllSkyStars(object):
         )
 
         self._sqm_mask = mask
+        self._mask_roi_key = None
 
 
     def _drawCircles(self, sep_data, blob_list):
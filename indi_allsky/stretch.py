@@ -1,7 +1,9 @@
 ### Mode 1 stretch is based on C code provided by a fellow astronomy enthusiast
 
+import math
 import time
 import numpy
+import cv2
 import logging
 
 
@@ -20,9 +22,13 @@ class IndiAllSkyStretch(object):
         self._sqm_mask = mask
 
         self._numpy_mask = None
+        self._cv2_mask = None
 
+        self._gamma_lut = None
+        self._gamma_lut_key = None
 
-    def main(self, data, image_bit_depth):
+
+    def main(self, data, image_bit_depth, output_8bit=False):
         if isinstance(self._numpy_mask, type(None)):
             # This only needs to be done once
             self._generateNumpyMask(data)
@@ -41,28 +47,56 @@ class IndiAllSkyStretch(object):
 
         if self.config.get('IMAGE_STRETCH', {}).get('MODE1_ENABLE'):
             logger.info('Using image stretch mode 1')
-            return self.mode1_stretch(data, image_bit_depth), True
+            return self.mode1_stretch(data, image_bit_depth, output_8bit=output_8bit), True
         else:
             logger.info('Image stretching disabled')
             return data, False
 
 
-    def mode1_stretch(self, data, image_bit_depth):
+    def mode1_stretch(self, data, image_bit_depth, output_8bit=False):
+        # The gamma, levels, and (optionally) 16 to 8 bit conversion are combined
+        # into a single lookup table which is applied to the image in one pass
+
+        stretch_start = time.time()
+
+        gamma_lut = self.mode1_getGammaLut(image_bit_depth)
+
+        mean, stddev = self._get_image_stddev(data, image_bit_depth, gamma_lut)
+        logger.info('Mean: %0.2f, StdDev: %0.2f', mean, stddev)
+
+        levels_lut = self.mode1_getLevelsLut(image_bit_depth, mean, stddev)
+
 
-        data = self.mode1_apply_gamma(data, image_bit_depth)
+        lut = levels_lut.take(gamma_lut)
 
-        data = self.mode1_adjustImageLevels(data, image_bit_depth)
+        if output_8bit and image_bit_depth > 8:
+            # shifting is 5x faster than division
+            shift_factor = image_bit_depth - 8
+            lut = numpy.right_shift(lut, shift_factor).astype(numpy.uint8)
 
-        return data
 
+        # apply lookup table
+        apply_start = time.time()
+
+        stretch_image = lut.take(data, mode='raise')
 
-    def mode1_apply_gamma(self, data, image_bit_depth):
+        apply_elapsed_s = time.time() - apply_start
+        logger.info('Stretch LUT applied in %0.4f s', apply_elapsed_s)
+
+
+        stretch_elapsed_s = time.time() - stretch_start
+        logger.info('Image stretch in %0.4f s', stretch_elapsed_s)
+
+        return stretch_image
+
+
+    def mode1_getGammaLut(self, image_bit_depth):
         gamma = self.config.get('IMAGE_STRETCH', {}).get('MODE1_GAMMA', 3.0)
 
-        if not gamma:
-            return data
+        gamma_key = (image_bit_depth, gamma)
+        if gamma_key == self._gamma_lut_key:
+            return self._gamma_lut
 
-        logger.info('Applying gamma correction')
 
         gamma_start = time.time()
 
@@ -74,26 +108,27 @@ class IndiAllSkyStretch(object):
 
 
         data_max = 2 ** image_bit_depth
-        range_array = numpy.arange(0, data_max, dtype=numpy.float32)
-        lut = (((range_array / data_max) ** (1 / float(gamma))) * data_max).astype(numpy_dtype)
 
+        if gamma:
+            range_array = numpy.arange(0, data_max, dtype=numpy.float32)
+            lut = (((range_array / data_max) ** (1 / float(gamma))) * data_max).astype(numpy_dtype)
+        else:
+            # no gamma correction
+            lut = numpy.arange(0, data_max, dtype=numpy_dtype)
 
-        # apply lookup table
-        gamma_data = lut.take(data, mode='raise')
+
+        self._gamma_lut = lut
+        self._gamma_lut_key = gamma_key
 
         gamma_elapsed_s = time.time() - gamma_start
-        logger.info('Image gamma in %0.4f s', gamma_elapsed_s)
+        logger.info('Gamma LUT generated in %0.4f s', gamma_elapsed_s)
 
-        return gamma_data
+        return lut
 
 
-    def mode1_adjustImageLevels(self, data, image_bit_depth):
+    def mode1_getLevelsLut(self, image_bit_depth, mean, stddev):
         stddevs = self.config.get('IMAGE_STRETCH', {}).get('MODE1_STDDEVS', 3.0)
 
-        mean, stddev = self._get_image_stddev(data)
-        logger.info('Mean: %0.2f, StdDev: %0.2f', mean, stddev)
-
-
         levels_start = time.time()
 
 
@@ -124,44 +159,44 @@ class IndiAllSkyStretch(object):
         lut = lut.astype(numpy_dtype)  # this must come after clipping
 
 
-        # apply lookup table
-        stretch_image = lut.take(data, mode='raise')
-
         levels_elapsed_s = time.time() - levels_start
-        logger.info('Image levels in %0.4f s', levels_elapsed_s)
+        logger.info('Levels LUT generated in %0.4f s', levels_elapsed_s)
 
-
-        return stretch_image
+        return lut
 
 
-    def _get_image_stddev(self, data):
+    def _get_image_stddev(self, data, image_bit_depth, gamma_lut):
+        # Statistics of the gamma corrected image are calculated from the masked
+        # histogram of the original image, the gamma corrected image is never built
         mean_std_start = time.time()
 
+        data_max = 2 ** image_bit_depth
+
+        lut_values = gamma_lut.astype(numpy.float64)
 
-        # mask arrays allow using the detection mask to perform calculations on
-        # arbitrary boundaries in the image
-        if len(data.shape) == 2:
-            ma = numpy.ma.masked_array(data, mask=self._numpy_mask)
 
-            # mono
-            mean = numpy.ma.mean(ma)
-            stddev = numpy.ma.std(ma)
+        if len(data.shape) == 2:
+            channels = [0]
         else:
-            # color
-            b_ma = numpy.ma.masked_array(data[:, :, 0], mask=self._numpy_mask)
-            g_ma = numpy.ma.masked_array(data[:, :, 1], mask=self._numpy_mask)
-            r_ma = numpy.ma.masked_array(data[:, :, 2], mask=self._numpy_mask)
+            channels = range(data.shape[2])
+
 
-            b_mean = numpy.ma.mean(b_ma)
-            g_mean = numpy.ma.mean(g_ma)
-            r_mean = numpy.ma.mean(r_ma)
+        mean_list = list()
+        stddev_list = list()
+        for c in channels:
+            hist = cv2.calcHist([data], [c], self._cv2_mask, [data_max], [0, data_max]).ravel().astype(numpy.float64)
 
-            b_stddev = numpy.ma.std(b_ma)
-            g_stddev = numpy.ma.std(g_ma)
-            r_stddev = numpy.ma.std(r_ma)
+            count = hist.sum()
 
-            mean = (b_mean + g_mean + r_mean) / 3
-            stddev = (b_stddev + g_stddev + r_stddev) / 3
+            c_mean = (hist * lut_values).sum() / count
+            c_var = (hist * (lut_values - c_mean) ** 2).sum() / count
+
+            mean_list.append(c_mean)
+            stddev_list.append(math.sqrt(c_var))
+
+
+        mean = sum(mean_list) / len(mean_list)
+        stddev = sum(stddev_list) / len(stddev_list)
 
 
         mean_std_elapsed_s = time.time() - mean_std_start
@@ -204,3 +239,6 @@ class IndiAllSkyStretch(object):
 
         self._numpy_mask = mask
 
+        # calcHist() uses non-zero values
+        self._cv2_mask = numpy.invert(mask).astype(numpy.uint8) * 255
+
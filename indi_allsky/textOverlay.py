@@ -0,0 +1,141 @@
+from collections import OrderedDict
+import numpy
+from PIL import Image
+from PIL import ImageFont
+from PIL import ImageDraw
+import logging
+
+
+logger = logging.getLogger('indi_allsky')
+
+
+class IndiAllSkyTextOverlay(object):
+    # Pillow text is rendered into small alpha masks that are blended directly into the
+    # BGR image, the full frame is never converted to a Pillow image.
+    #
+    # Fonts are loaded once per file and size.  Rendered masks are kept in a LRU cache
+    # keyed by the text, lines that do not change between frames (location, owner,
+    # extra text) are only rendered once.  The color is applied when the mask is
+    # blended, color changes do not invalidate the cache.
+
+    _font_cache = dict()  # shared by all instances
+
+    mask_cache_max = 100
+
+
+    def __init__(self):
+        self._mask_cache = OrderedDict()
+
+
+    @classmethod
+    def getFont(cls, font_file, font_size):
+        font_key = (str(font_file), int(font_size))
+
+        font = cls._font_cache.get(font_key)
+        if not font:
+            font = ImageFont.truetype(font_key[0], font_key[1])
+            cls._font_cache[font_key] = font
+
+        return font
+
+
+    def drawText(self, data, text, font_file, font_size, pt, color_rgb, stroke_width=0, anchor='la'):
+        # data is modified in place
+        mask_key = (text, str(font_file), int(font_size), int(stroke_width), anchor)
+
+        try:
+            masks = self._mask_cache[mask_key]
+            self._mask_cache.move_to_end(mask_key)
+        except KeyError:
+            masks = self._renderMasks(text, font_file, font_size, stroke_width, anchor)
+
+            self._mask_cache[mask_key] = masks
+            if len(self._mask_cache) > self.mask_cache_max:
+                self._mask_cache.popitem(last=False)
+
+
+        offset_x, offset_y, stroke_mask, fill_mask = masks
+        if isinstance(fill_mask, type(None)):
+            # nothing to draw
+            return
+
+
+        image_height, image_width = data.shape[:2]
+        mask_height, mask_width = fill_mask.shape[:2]
+
+        x1 = int(pt[0]) + offset_x
+        y1 = int(pt[1]) + offset_y
+        x2 = x1 + mask_width
+        y2 = y1 + mask_height
+
+
+        # clip to the image
+        roi_x1 = max(x1, 0)
+        roi_y1 = max(y1, 0)
+        roi_x2 = min(x2, image_width)
+        roi_y2 = min(y2, image_height)
+
+        if roi_x1 >= roi_x2 or roi_y1 >= roi_y2:
+            # outside of image
+            return
+
+
+        mask_slice = (
+            slice(roi_y1 - y1, roi_y2 - y1),
+            slice(roi_x1 - x1, roi_x2 - x1),
+        )
+
+
+        roi = data[roi_y1:roi_y2, roi_x1:roi_x2].astype(numpy.uint16)
+
+        if not isinstance(stroke_mask, type(None)):
+            # black outline
+            roi = self._blend(roi, stroke_mask[mask_slice], (0, 0, 0))
+
+        roi = self._blend(roi, fill_mask[mask_slice], color_rgb)
+
+        data[roi_y1:roi_y2, roi_x1:roi_x2] = roi.astype(data.dtype)
+
+
+    def _blend(self, roi, mask, color_rgb):
+        # integer blend with the same rounding as Pillow, each pass is rounded to 8 bits
+        alpha = mask.astype(numpy.uint16)
+
+        if len(roi.shape) == 2:
+            # mono
+            ink = int((sum(int(c) for c in color_rgb) / 3) + 0.5)
+        else:
+            alpha = alpha[..., numpy.newaxis]
+            ink = numpy.array([int(c) for c in reversed(color_rgb)], dtype=numpy.uint16)  # BGR
+
+        blend = (roi * (255 - alpha)) + (ink * alpha) + 128
+
+        return ((blend >> 8) + blend) >> 8
+
+
+    def _renderMasks(self, text, font_file, font_size, stroke_width, anchor):
+        font = self.getFont(font_file, font_size)
+
+        left, top, right, bottom = font.getbbox(text, stroke_width=stroke_width, anchor=anchor)
+        if right <= left or bottom <= top:
+            return left, top, None, None
+
+
+        size = (right - left, bottom - top)
+        xy = (-left, -top)
+
+
+        fill_img = Image.new('L', size)
+        ImageDraw.Draw(fill_img).text(xy, text, fill=255, font=font, anchor=anchor)
+        fill_mask = numpy.array(fill_img)
+
+
+        if stroke_width:
+            stroke_img = Image.new('L', size)
+            ImageDraw.Draw(stroke_img).text(xy, text, fill=255, font=font, anchor=anchor, stroke_width=stroke_width, stroke_fill=255)
+            stroke_mask = numpy.array(stroke_img)
+        else:
+            stroke_mask = None
+
+
+        return left, top, stroke_mask, fill_mask
@@ -3,6 +3,7 @@ import time
 import tempfile
 from pathlib import Path
 import subprocess
+import numpy
 import logging
 
 from .exceptions import TimelapseException
@@ -23,6 +24,11 @@ class TimelapseGenerator(object):
         #seqfolder = tempfile.mkdtemp(suffix='_timelapse')  # testing
         #self.seqfolder_p = Path(seqfolder)
 
+        self._stream_subproc = None
+        self._stream_video_file_p = None
+        self._stream_log = None
+        self._stream_start = None
+
 
     def generate(self, video_file, file_list, skip_frames=0):
         video_file_p = Path(video_file)
@@ -55,6 +61,99 @@ class TimelapseGenerator(object):
             #'-start_number', '0',
             #'-pattern_type', 'glob',
             '-i', '{0:s}/%05d.{1:s}'.format(str(self.seqfolder_p), self.config['IMAGE_FILE_TYPE']),
+        ]
+
+        cmd.extend(self._getOutputOptions(video_file_p))
+
+        logger.info('FFmpeg command: %s', ' '.join(cmd))
+
+        try:
+            ffmpeg_subproc = subprocess.run(
+                cmd,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                preexec_fn=lambda: os.nice(19),
+                check=True
+            )
+            elapsed_s = time.time() - start
+            logger.info('Timelapse generated in %0.4f s', elapsed_s)
+
+            logger.info('FFMPEG output: %s', ffmpeg_subproc.stdout)
+        except subprocess.CalledProcessError as e:
+            elapsed_s = time.time() - start
+
+            logger.info('FFMPEG ran for %0.4f s', elapsed_s)
+            logger.error('FFMPEG failed to generate timelapse, return code: %d', e.returncode)
+            logger.error('FFMPEG output: %s', e.stdout)
+
+            # Check if video file was created
+            if video_file_p.is_file():
+                logger.error('FFMPEG created broken video file, cleaning up')
+                video_file_p.unlink()
+
+            raise TimelapseException('FFMPEG return code %d', e.returncode)
+
+
+        # set default permissions
+        video_file_p.chmod(0o644)
+
+
+    def concat(self, video_file, segment_list):
+        # segments must be encoded with the same options, the streams are copied
+        video_file_p = Path(video_file)
+
+        concat_list_p = self.seqfolder_p.joinpath('concat.txt')
+
+        with concat_list_p.open('w') as f_concat:
+            for segment_p in segment_list:
+                f_concat.write('file \'{0:s}\'\n'.format(str(Path(segment_p).absolute())))
+
+
+        start = time.time()
+
+        cmd = [
+            'ffmpeg',
+            '-y',
+            '-loglevel', 'level+warning',
+            '-f', 'concat',
+            '-safe', '0',
+            '-i', str(concat_list_p),
+            '-c', 'copy',
+            '-movflags', '+faststart',
+            str(video_file_p),
+        ]
+
+        logger.info('FFmpeg command: %s', ' '.join(cmd))
+
+        try:
+            ffmpeg_subproc = subprocess.run(
+                cmd,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                preexec_fn=lambda: os.nice(19),
+                check=True
+            )
+            elapsed_s = time.time() - start
+            logger.info('Timelapse segments joined in %0.4f s', elapsed_s)
+
+            logger.info('FFMPEG output: %s', ffmpeg_subproc.stdout)
+        except subprocess.CalledProcessError as e:
+            logger.error('FFMPEG failed to join timelapse segments, return code: %d', e.returncode)
+            logger.error('FFMPEG output: %s', e.stdout)
+
+            if video_file_p.is_file():
+                logger.error('FFMPEG created broken video file, cleaning up')
+                video_file_p.unlink()
+
+            raise TimelapseException('FFMPEG return code %d', e.returncode)
+
+
+        # set default permissions
+        video_file_p.chmod(0o644)
+
+
+    def _getOutputOptions(self, video_file_p):
+        cmd = [
             '-vcodec', '{0:s}'.format(self.config['FFMPEG_CODEC']),
             '-b:v', '{0:s}'.format(self.config['FFMPEG_BITRATE']),
             '-pix_fmt', 'yuv420p',
@@ -78,35 +177,121 @@ class TimelapseGenerator(object):
         # finally add filename
         cmd.append('{0:s}'.format(str(video_file_p)))
 
+        return cmd
+
+
+    def openStream(self, video_file, image):
+        # Raw frames are written directly to ffmpeg's stdin, no intermediate files
+        self._stream_video_file_p = Path(video_file)
+
+        image_height, image_width = image.shape[:2]
+
+        if len(image.shape) == 2:
+            pix_fmt = 'gray'
+        else:
+            pix_fmt = 'bgr24'
+
+
+        cmd = [
+            'ffmpeg',
+            '-y',
+            '-loglevel', 'level+warning',
+            '-f', 'rawvideo',
+            '-pix_fmt', pix_fmt,
+            '-s', '{0:d}x{1:d}'.format(image_width, image_height),
+            '-r', '{0:d}'.format(self.config['FFMPEG_FRAMERATE']),
+            '-i', '-',
+        ]
+
+        cmd.extend(self._getOutputOptions(self._stream_video_file_p))
+
         logger.info('FFmpeg command: %s', ' '.join(cmd))
 
+
+        # output goes to a file, a full stdout pipe would block ffmpeg
+        self._stream_log = tempfile.TemporaryFile()
+
+        self._stream_start = time.time()
+
         try:
-            ffmpeg_subproc = subprocess.run(
+            self._stream_subproc = subprocess.Popen(
                 cmd,
-                stdout=subprocess.PIPE,
+                stdin=subprocess.PIPE,
+                stdout=self._stream_log,
                 stderr=subprocess.STDOUT,
                 preexec_fn=lambda: os.nice(19),
-                check=True
             )
-            elapsed_s = time.time() - start
-            logger.info('Timelapse generated in %0.4f s', elapsed_s)
+        except OSError as e:
+            self._stream_subproc = None
+            raise TimelapseException('Unable to start FFMPEG: {0:s}'.format(str(e))) from e
+
+
+    def writeStreamFrame(self, image):
+        if isinstance(self._stream_subproc, type(None)):
+            raise TimelapseException('FFMPEG stream is not open')
+
+
+        if self._stream_subproc.poll() is not None:
+            raise TimelapseException('FFMPEG exited early, return code {0:d}'.format(self._stream_subproc.returncode))
+
+
+        # write() blocks while ffmpeg catches up with the pipe
+        try:
+            self._stream_subproc.stdin.write(numpy.ascontiguousarray(image).data)
+        except (BrokenPipeError, OSError) as e:
+            raise TimelapseException('FFMPEG pipe error: {0:s}'.format(str(e))) from e
+
+
+    def closeStream(self):
+        if isinstance(self._stream_subproc, type(None)):
+            raise TimelapseException('FFMPEG stream is not open')
+
+
+        try:
+            self._stream_subproc.stdin.close()
+        except (BrokenPipeError, OSError):
+            pass
+
+        returncode = self._stream_subproc.wait()
+        self._stream_subproc = None
+
+        elapsed_s = time.time() - self._stream_start
 
-            logger.info('FFMPEG output: %s', ffmpeg_subproc.stdout)
-        except subprocess.CalledProcessError as e:
-            elapsed_s = time.time() - start
 
+        self._stream_log.seek(0)
+        ffmpeg_output = self._stream_log.read()
+        self._stream_log.close()
+
+
+        if returncode != 0:
             logger.info('FFMPEG ran for %0.4f s', elapsed_s)
-            logger.error('FFMPEG failed to generate timelapse, return code: %d', e.returncode)
-            logger.error('FFMPEG output: %s', e.stdout)
+            logger.error('FFMPEG failed to generate timelapse, return code: %d', returncode)
+            logger.error('FFMPEG output: %s', ffmpeg_output)
 
             # Check if video file was created
-            if video_file_p.is_file():
+            if self._stream_video_file_p.is_file():
                 logger.error('FFMPEG created broken video file, cleaning up')
-                video_file_p.unlink()
+                self._stream_video_file_p.unlink()
+
+            raise TimelapseException('FFMPEG return code %d', returncode)
 
-            raise TimelapseException('FFMPEG return code %d', e.returncode)
 
+        logger.info('Timelapse streamed in %0.4f s', elapsed_s)
+        logger.info('FFMPEG output: %s', ffmpeg_output)
 
         # set default permissions
-        video_file_p.chmod(0o644)
+        self._stream_video_file_p.chmod(0o644)
+
+
+    def abortStream(self):
+        if self._stream_subproc:
+            self._stream_subproc.kill()
+            self._stream_subproc.wait()
+            self._stream_subproc = None
+
+        if self._stream_log:
+            self._stream_log.close()
+            self._stream_log = None
 
+        if self._stream_video_file_p and self._stream_video_file_p.is_file():
+            self._stream_video_file_p.unlink()
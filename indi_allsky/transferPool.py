@@ -0,0 +1,170 @@
+import time
+import json
+import hashlib
+import logging
+
+
+logger = logging.getLogger('indi_allsky')
+
+
+class IndiAllSkyTransferPool(object):
+    # Connected file transfer clients are kept between uploads instead of connecting
+    # for every file.  Clients are keyed by the class and a hash of the connection
+    # parameters (including the credentials), so config changes create new clients.
+    #
+    # Each upload worker has its own pool, it is not thread safe.
+
+    idle_timeout = 120  # seconds
+    report_period = 3600
+
+
+    def __init__(self, config):
+        self.config = config
+
+        self._pool = dict()
+        self._in_use = dict()  # client id -> pool key
+
+        self._connect_time = dict()  # average connect time per class
+
+        self._connected = 0
+        self._reused = 0
+        self._saved_s = 0.0
+        self._report_time = time.time()
+
+
+    def connect(self, client_class, connect_kwargs, client_kwargs=None, client_settings=None):
+        # returns a connected client and whether the client was reused
+        if isinstance(client_kwargs, type(None)):
+            client_kwargs = dict()
+
+        if isinstance(client_settings, type(None)):
+            client_settings = dict()
+
+
+        self.expireIdle()
+
+
+        key = self._poolKey(client_class, connect_kwargs, client_kwargs, client_settings)
+
+        pool_entry = self._pool.pop(key, None)
+        if pool_entry:
+            client = pool_entry['client']
+
+            if client.alive():
+                self._reused += 1
+                self._saved_s += self._connect_time.get(client_class.__name__, 0.0)
+
+                self._in_use[id(client)] = key
+                return client, True
+
+
+            logger.warning('%s connection is no longer available, reconnecting', client_class.__name__)
+            self._close(client)
+
+
+        client = client_class(self.config, **client_kwargs)
+
+        for k, v in client_settings.items():
+            setattr(client, k, v)
+
+
+        start = time.time()
+
+        try:
+            client.connect(**connect_kwargs)
+        except Exception:
+            self._close(client)
+            raise
+
+        connect_elapsed_s = time.time() - start
+
+
+        # running average of the handshake time
+        avg_s = self._connect_time.get(client_class.__name__)
+        if isinstance(avg_s, type(None)):
+            self._connect_time[client_class.__name__] = connect_elapsed_s
+        else:
+            self._connect_time[client_class.__name__] = (avg_s * 0.8) + (connect_elapsed_s * 0.2)
+
+        self._connected += 1
+
+        self._in_use[id(client)] = key
+        return client, False
+
+
+    def release(self, client):
+        # return a client to the pool after a successful transfer
+        key = self._in_use.pop(id(client), None)
+
+        if not client.reusable or not key:
+            self._close(client)
+            return
+
+
+        old_entry = self._pool.pop(key, None)
+        if old_entry:
+            self._close(old_entry['client'])
+
+        self._pool[key] = {
+            'client'    : client,
+            'last_used' : time.time(),
+        }
+
+
+    def discard(self, client):
+        # clients are not reused after a failure
+        self._in_use.pop(id(client), None)
+        self._close(client)
+
+
+    def expireIdle(self):
+        now = time.time()
+
+        for key in [k for k, v in self._pool.items() if now - v['last_used'] > self.idle_timeout]:
+            pool_entry = self._pool.pop(key)
+
+            logger.info('Closing idle %s connection', pool_entry['client'].__class__.__name__)
+            self._close(pool_entry['client'])
+
+
+        if now - self._report_time > self.report_period:
+            self.report()
+
+
+    def report(self):
+        logger.info(
+            'Upload connections - new: %d, reused: %d, handshake time saved: %0.1f s',
+            self._connected,
+            self._reused,
+            self._saved_s,
+        )
+
+        self._connected = 0
+        self._reused = 0
+        self._saved_s = 0.0
+        self._report_time = time.time()
+
+
+    def closeAll(self):
+        for pool_entry in self._pool.values():
+            self._close(pool_entry['client'])
+
+        self._pool.clear()
+
+
+    def _close(self, client):
+        try:
+            client.close()
+        except Exception as e:
+            # the connection may already be broken
+            logger.warning('Error closing %s connection: %s', client.__class__.__name__, str(e))
+
+
+    def _poolKey(self, client_class, connect_kwargs, client_kwargs, client_settings):
+        key_data = json.dumps(
+            [connect_kwargs, client_kwargs, client_settings],
+            sort_keys=True,
+            default=str,
+        )
+
+        return client_class.__name__, hashlib.sha256(key_data.encode()).hexdigest()
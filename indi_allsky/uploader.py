@@ -1,4 +1,5 @@
 import time
+import math
 from datetime import timedelta
 from pathlib import Path
 #import signal
@@ -12,9 +13,12 @@ import threading
 
 from . import constants
 
+from .transferPool import IndiAllSkyTransferPool
+
 from .flask import create_app
 from .flask import db
 from .flask.miscDb import miscDb
+from .miscUpload import miscUpload
 
 from .flask import models
 
@@ -32,6 +36,10 @@ logger = logging.getLogger('indi_allsky')
 
 
 class FileUploader(Thread):
+
+    batch_size = 20  # maximum number of tasks claimed at once
+
+
     def __init__(
         self,
         idx,
@@ -45,11 +53,22 @@ class FileUploader(Thread):
 
         self.config = config
 
+        self.upload_workers = max(self.config.get('UPLOAD_WORKERS', 1), 1)
+
         self._miscDb = miscDb(self.config)
+        self._miscUpload = None
 
         self.error_q = error_q
         self.upload_q = upload_q
 
+        self._transfer_pool = IndiAllSkyTransferPool(self.config)
+
+        # follow up tasks are queued with the batch results
+        self._miscUpload = miscUpload(self.config, self.upload_q, batch=True)
+
+        # disabled if the server does not support batches
+        self._syncapi_batch = True
+
 
         self._stopper = threading.Event()
         #self._shutdown = False
@@ -117,14 +136,30 @@ class FileUploader(Thread):
 
         while True:
             if self.stopped():
+                self._transfer_pool.closeAll()
                 logger.warning('Goodbye')
                 return
 
             try:
                 u_dict = self.upload_q.get(timeout=11)  # prime number
             except queue.Empty:
+                self._transfer_pool.expireIdle()
                 continue
 
+
+            task_id_list = [u_dict['task_id']]
+
+            # claim a share of the waiting tasks, the other upload workers transfer the rest in parallel
+            claim_size = min(math.ceil((self.upload_q.qsize() + 1) / self.upload_workers), self.batch_size)
+
+            while len(task_id_list) < claim_size:
+                try:
+                    u_dict = self.upload_q.get_nowait()
+                except queue.Empty:
+                    break
+
+                task_id_list.append(u_dict['task_id'])
+
             #if u_dict.get('stop'):
             #    logger.warning('Goodbye')
             #    return
@@ -134,30 +169,163 @@ class FileUploader(Thread):
             #    return
 
 
-            # new context for every task, reduces the effects of caching
+            # new context for every batch, reduces the effects of caching
             with app.app_context():
-                self.processUpload(u_dict)
+                self.processUploadBatch(task_id_list)
 
 
-    def processUpload(self, u_dict):
-        task_id = u_dict['task_id']
+    def processUploadBatch(self, task_id_list):
+        # Tasks are claimed with a single update and the results for the batch are
+        # committed together.  Task states are still stored in the DB, orphaned tasks
+        # are expired at startup.
 
+        models.IndiAllSkyDbTaskQueueTable.query\
+            .filter(models.IndiAllSkyDbTaskQueueTable.id.in_(task_id_list))\
+            .filter(models.IndiAllSkyDbTaskQueueTable.state == models.TaskQueueState.QUEUED)\
+            .filter(models.IndiAllSkyDbTaskQueueTable.queue == models.TaskQueueQueue.UPLOAD)\
+            .update({models.IndiAllSkyDbTaskQueueTable.state : models.TaskQueueState.RUNNING}, synchronize_session=False)
+        db.session.commit()
 
-        try:
-            task = models.IndiAllSkyDbTaskQueueTable.query\
-                .filter(models.IndiAllSkyDbTaskQueueTable.id == task_id)\
-                .filter(models.IndiAllSkyDbTaskQueueTable.state == models.TaskQueueState.QUEUED)\
-                .filter(models.IndiAllSkyDbTaskQueueTable.queue == models.TaskQueueQueue.UPLOAD)\
-                .one()
 
-        except NoResultFound:
+        task_list = models.IndiAllSkyDbTaskQueueTable.query\
+            .filter(models.IndiAllSkyDbTaskQueueTable.id.in_(task_id_list))\
+            .filter(models.IndiAllSkyDbTaskQueueTable.state == models.TaskQueueState.RUNNING)\
+            .filter(models.IndiAllSkyDbTaskQueueTable.queue == models.TaskQueueQueue.UPLOAD)\
+            .order_by(models.IndiAllSkyDbTaskQueueTable.id.asc())\
+            .all()
+
+
+        for task_id in set(task_id_list) - set(t.id for t in task_list):
             logger.error('Task ID %d not found', task_id)
-            return
 
 
-        task.setRunning()
+        try:
+            if self._syncapi_batch:
+                task_list = self.processSyncApiBatch(task_list)
+
+            for task in task_list:
+                self.processUpload(task)
+        finally:
+            # task results, entry updates and follow up tasks
+            self._miscUpload.flush()
+            db.session.commit()
+
+
+    def processSyncApiBatch(self, task_list):
+        # syncapi entries are uploaded with a single request, returns the remaining tasks
+        sync_task_list = list()
+        other_task_list = list()
+
+        for task in task_list:
+            if task.data['action'] != constants.TRANSFER_SYNC_V1:
+                other_task_list.append(task)
+                continue
+
+            if not task.data.get('model') or not task.data.get('id'):
+                other_task_list.append(task)
+                continue
+
+            if task.data['metadata']['type'] not in constants.ENDPOINT_V1 or task.data['metadata']['type'] == constants.CAMERA:
+                other_task_list.append(task)
+                continue
+
+            sync_task_list.append(task)
+
+
+        if len(sync_task_list) < 2:
+            return task_list
+
+
+        empty_file = self.config.get('SYNCAPI', {}).get('EMPTY_FILE')
+
+        item_list = list()
+        batch_list = list()
+
+        for task in sync_task_list:
+            try:
+                _model = getattr(models, task.data['model'])
+
+                entry = _model.query\
+                    .filter(_model.id == task.data['id'])\
+                    .one()
+            except (AttributeError, NoResultFound):
+                # errors are handled by processUpload()
+                other_task_list.append(task)
+                continue
+
+
+            local_file_p = Path(entry.getFilesystemPath())
+
+            if not empty_file and not local_file_p.exists():
+                other_task_list.append(task)
+                continue
+
+
+            metadata = task.data['metadata']
+
+            item_list.append({
+                'type'       : metadata['type'],
+                'metadata'   : metadata,
+                'local_file' : local_file_p,
+            })
+
+            batch_list.append((task, entry))
+
+
+        if not batch_list:
+            return task_list
+
+
+        connect_kwargs, client_settings = self._syncapiParameters()
+
+        put_kwargs = {
+            'endpoint'       : constants.ENDPOINT_V1_BATCH,
+            'item_list'      : item_list,
+            'empty_file'     : empty_file,
+        }
+
+        if any(task.data.get('check') for task, entry in batch_list):
+            put_kwargs['check_endpoint'] = constants.ENDPOINT_V1_CHECK
+
+
+        start = time.time()
+
+        try:
+            result_list = self._transfer(filetransfer.requests_syncapi_v1, connect_kwargs, put_kwargs, dict(), client_settings, method='putBatch')
+        except filetransfer.exceptions.BatchNotSupported as e:
+            logger.warning('Sync API batch uploads disabled: %s', str(e))
+            self._syncapi_batch = False
+            return task_list
+        except (
+            filetransfer.exceptions.ConnectionFailure,
+            filetransfer.exceptions.AuthenticationFailure,
+            filetransfer.exceptions.CertificateValidationFailure,
+            filetransfer.exceptions.TransferFailure,
+            filetransfer.exceptions.PermissionFailure,
+        ) as e:
+            # tasks are retried individually and failures are reported there
+            logger.error('Sync API batch failure: %s', str(e))
+            return task_list
+
+
+        upload_elapsed_s = time.time() - start
+        logger.info('Sync API batch of %d entries completed in %0.4f s', len(batch_list), upload_elapsed_s)
+
+
+        for (task, entry), result in zip(batch_list, result_list):
+            if result.get('error'):
+                logger.error('Sync API batch entry failed: %s', result['error'])
+                task.setFailed('Sync error: {0:s}'.format(str(result['error'])), commit=False)
+                continue
+
+            entry.sync_id = result['id']
+            task.setSuccess('File uploaded', commit=False)
 
 
+        return other_task_list
+
+
+    def processUpload(self, task):
         action = task.data['action']
 
         local_file = task.data.get('local_file')
@@ -181,7 +349,7 @@ class FileUploader(Thread):
                 _model = getattr(models, entry_model)
             except AttributeError:
                 logger.error('Model not found: %s', entry_model)
-                task.setFailed('Model not found: {0:s}'.format(entry_model))
+                task.setFailed('Model not found: {0:s}'.format(entry_model), commit=False)
                 return
 
             try:
@@ -190,7 +358,7 @@ class FileUploader(Thread):
                     .one()
             except NoResultFound:
                 logger.error('ID %d not found in %s', entry_id, entry_model)
-                task.setFailed('ID {0:d} not found in {1:s}'.format(entry_id, entry_model))
+                task.setFailed('ID {0:d} not found in {1:s}'.format(entry_id, entry_model), commit=False)
                 return
 
             local_file_p = Path(entry.getFilesystemPath())
@@ -205,7 +373,7 @@ class FileUploader(Thread):
             entry = None
         else:
             logger.error('Entry model or filename not defined')
-            task.setFailed('Entry model or filename not defined')
+            task.setFailed('Entry model or filename not defined', commit=False)
             return
 
 
@@ -229,15 +397,17 @@ class FileUploader(Thread):
                 client_class = getattr(filetransfer, self.config['FILETRANSFER']['CLASSNAME'])
             except AttributeError:
                 logger.error('Unknown filetransfer class: %s', self.config['FILETRANSFER']['CLASSNAME'])
-                task.setFailed('Unknown filetransfer class: {0:s}'.format(self.config['FILETRANSFER']['CLASSNAME']))
+                task.setFailed('Unknown filetransfer class: {0:s}'.format(self.config['FILETRANSFER']['CLASSNAME']), commit=False)
                 return
 
-            client = client_class(self.config)
-            client.connect_timeout = self.config.get('FILETRANSFER', {}).get('CONNECT_TIMEOUT', 10)
-            client.timeout = self.config.get('FILETRANSFER', {}).get('TIMEOUT', 60)
+            client_kwargs = dict()
+            client_settings = {
+                'connect_timeout' : self.config.get('FILETRANSFER', {}).get('CONNECT_TIMEOUT', 10),
+                'timeout'         : self.config.get('FILETRANSFER', {}).get('TIMEOUT', 60),
+            }
 
             if self.config['FILETRANSFER']['PORT']:
-                client.port = self.config['FILETRANSFER']['PORT']
+                client_settings['port'] = self.config['FILETRANSFER']['PORT']
 
         elif action == constants.TRANSFER_S3:
             s3_key = local_file_p.relative_to(self.image_dir).as_posix()
@@ -267,17 +437,18 @@ class FileUploader(Thread):
                 client_class = getattr(filetransfer, self.config['S3UPLOAD']['CLASSNAME'])
             except AttributeError:
                 logger.error('Unknown filetransfer class: %s', self.config['S3UPLOAD']['CLASSNAME'])
-                task.setFailed('Unknown filetransfer class: {0:s}'.format(self.config['S3UPLOAD']['CLASSNAME']))
+                task.setFailed('Unknown filetransfer class: {0:s}'.format(self.config['S3UPLOAD']['CLASSNAME']), commit=False)
                 return
 
 
-            client = client_class(self.config)
-            client.connect_timeout = self.config.get('S3UPLOAD', {}).get('CONNECT_TIMEOUT', 10)
-            client.timeout = self.config.get('S3UPLOAD', {}).get('TIMEOUT', 60)
-
+            client_kwargs = dict()
+            client_settings = {
+                'connect_timeout' : self.config.get('S3UPLOAD', {}).get('CONNECT_TIMEOUT', 10),
+                'timeout'         : self.config.get('S3UPLOAD', {}).get('TIMEOUT', 60),
+            }
 
             if self.config['S3UPLOAD']['PORT']:
-                client.port = self.config['S3UPLOAD']['PORT']
+                client_settings['port'] = self.config['S3UPLOAD']['PORT']
 
 
         elif action == constants.DELETE_S3:
@@ -303,17 +474,20 @@ class FileUploader(Thread):
                 client_class = getattr(filetransfer, self.config['S3UPLOAD']['CLASSNAME'])
             except AttributeError:
                 logger.error('Unknown filetransfer class: %s', self.config['S3UPLOAD']['CLASSNAME'])
-                task.setFailed('Unknown filetransfer class: {0:s}'.format(self.config['S3UPLOAD']['CLASSNAME']))
+                task.setFailed('Unknown filetransfer class: {0:s}'.format(self.config['S3UPLOAD']['CLASSNAME']), commit=False)
                 return
 
 
-            client = client_class(self.config, delete=True)
-            client.connect_timeout = self.config.get('S3UPLOAD', {}).get('CONNECT_TIMEOUT', 10)
-            client.timeout = self.config.get('S3UPLOAD', {}).get('TIMEOUT', 60)
-
+            client_kwargs = {
+                'delete' : True,
+            }
+            client_settings = {
+                'connect_timeout' : self.config.get('S3UPLOAD', {}).get('CONNECT_TIMEOUT', 10),
+                'timeout'         : self.config.get('S3UPLOAD', {}).get('TIMEOUT', 60),
+            }
 
             if self.config['S3UPLOAD']['PORT']:
-                client.port = self.config['S3UPLOAD']['PORT']
+                client_settings['port'] = self.config['S3UPLOAD']['PORT']
 
 
         elif action == constants.TRANSFER_MQTT:
@@ -339,45 +513,44 @@ class FileUploader(Thread):
                 client_class = getattr(filetransfer, 'paho_mqtt')
             except AttributeError:
                 logger.error('Unknown filetransfer class: %s', 'paho_mqtt')
-                task.setFailed('Unknown filetransfer class: {0:s}'.format('paho_mqtt'))
+                task.setFailed('Unknown filetransfer class: {0:s}'.format('paho_mqtt'), commit=False)
                 return
 
-            client = client_class(self.config)
+            client_kwargs = dict()
+            client_settings = dict()
 
             if self.config['MQTTPUBLISH']['PORT']:
-                client.port = self.config['MQTTPUBLISH']['PORT']
+                client_settings['port'] = self.config['MQTTPUBLISH']['PORT']
 
         elif action == constants.TRANSFER_SYNC_V1:
             ENDPOINT_URI = constants.ENDPOINT_V1[metadata['type']]
 
-            connect_kwargs = {
-                'hostname'     : '{0:s}/{1:s}'.format(self.config['SYNCAPI']['BASEURL'], ENDPOINT_URI),
-                'username'     : self.config['SYNCAPI']['USERNAME'],
-                'apikey'       : self.config['SYNCAPI']['APIKEY'],
-                'cert_bypass'  : self.config['SYNCAPI']['CERT_BYPASS'],
-            }
+            connect_kwargs, client_settings = self._syncapiParameters()
 
             put_kwargs = {
-                'metadata'      : metadata,
-                'local_file'    : local_file_p,
-                'empty_file'    : self.config.get('SYNCAPI', {}).get('EMPTY_FILE'),
+                'endpoint'       : ENDPOINT_URI,
+                'metadata'       : metadata,
+                'local_file'     : local_file_p,
+                'empty_file'     : self.config.get('SYNCAPI', {}).get('EMPTY_FILE'),
             }
 
+            if task.data.get('check'):
+                # only backfill uploads check for existing files, new files are rarely on the server
+                put_kwargs['check_endpoint'] = constants.ENDPOINT_V1_CHECK
+
             try:
                 client_class = getattr(filetransfer, 'requests_syncapi_v1')
             except AttributeError:
                 logger.error('Unknown filetransfer class: %s', 'requests_syncapi_v1')
-                task.setFailed('Unknown filetransfer class: {0:s}'.format('requests_syncapi_v1'))
+                task.setFailed('Unknown filetransfer class: {0:s}'.format('requests_syncapi_v1'), commit=False)
                 return
 
-            client = client_class(self.config)
-            client.connect_timeout = self.config.get('SYNCAPI', {}).get('CONNECT_TIMEOUT', 10.0)
-            client.timeout = self.config.get('SYNCAPI', {}).get('TIMEOUT', 60.0)
+            client_kwargs = dict()
         elif action == constants.TRANSFER_YOUTUBE:
             try:
                 credentials_json = self._miscDb.getState('YOUTUBE_CREDENTIALS')
             except NoResultFound:
-                task.setFailed('Youtube authorization credentials not found')
+                task.setFailed('Youtube authorization credentials not found', commit=False)
                 raise Exception('Youtube authorization credentials not found')
 
 
@@ -396,23 +569,23 @@ class FileUploader(Thread):
                 client_class = getattr(filetransfer, 'youtube_oauth2')
             except AttributeError:
                 logger.error('Unknown filetransfer class: %s', 'youtube_oauth2')
-                task.setFailed('Unknown filetransfer class: {0:s}'.format('youtube_oauth2'))
+                task.setFailed('Unknown filetransfer class: {0:s}'.format('youtube_oauth2'), commit=False)
                 return
 
-            client = client_class(self.config)
+            client_kwargs = dict()
+            client_settings = dict()
         else:
-            task.setFailed('Invalid transfer action')
+            task.setFailed('Invalid transfer action', commit=False)
             raise Exception('Invalid transfer action')
 
 
         start = time.time()
 
         try:
-            client.connect(**connect_kwargs)
+            response = self._transfer(client_class, connect_kwargs, put_kwargs, client_kwargs, client_settings)
         except filetransfer.exceptions.ConnectionFailure as e:
             logger.error('Connection failure: %s', e)
-            client.close()
-            task.setFailed('Connection failure')
+            task.setFailed('Connection failure', commit=False)
 
             self._miscDb.addNotification(
                 models.NotificationCategory.UPLOAD,
@@ -424,8 +597,7 @@ class FileUploader(Thread):
             return
         except filetransfer.exceptions.AuthenticationFailure as e:
             logger.error('Authentication failure: %s', e)
-            client.close()
-            task.setFailed('Authentication failure')
+            task.setFailed('Authentication failure', commit=False)
 
             self._miscDb.addNotification(
                 models.NotificationCategory.UPLOAD,
@@ -437,51 +609,7 @@ class FileUploader(Thread):
             return
         except filetransfer.exceptions.CertificateValidationFailure as e:
             logger.error('Certificate validation failure: %s', e)
-            client.close()
-            task.setFailed('Certificate validation failure')
-
-            self._miscDb.addNotification(
-                models.NotificationCategory.UPLOAD,
-                'certificate',
-                '{0:s} file transfer certificate validation failed: {1:s}'.format(client_class.__name__, str(e)),
-                expire=timedelta(hours=1),
-            )
-
-            return
-
-        # Upload file
-        try:
-            response = client.put(**put_kwargs)
-        except filetransfer.exceptions.ConnectionFailure as e:
-            logger.error('Connection failure: %s', e)
-            client.close()
-            task.setFailed('Connection failure')
-
-            self._miscDb.addNotification(
-                models.NotificationCategory.UPLOAD,
-                'connection',
-                '{0:s} file transfer connection failure: {1:s}'.format(client_class.__name__, str(e)),
-                expire=timedelta(hours=1),
-            )
-
-            return
-        except filetransfer.exceptions.AuthenticationFailure as e:
-            logger.error('Authentication failure: %s', e)
-            client.close()
-            task.setFailed('Authentication failure')
-
-            self._miscDb.addNotification(
-                models.NotificationCategory.UPLOAD,
-                'authentication',
-                '{0:s} file transfer authentication failure: {1:s}'.format(client_class.__name__, str(e)),
-                expire=timedelta(hours=1),
-            )
-
-            return
-        except filetransfer.exceptions.CertificateValidationFailure as e:
-            logger.error('Certificate validation failure: %s', e)
-            client.close()
-            task.setFailed('Certificate validation failure')
+            task.setFailed('Certificate validation failure', commit=False)
 
             self._miscDb.addNotification(
                 models.NotificationCategory.UPLOAD,
@@ -493,8 +621,7 @@ class FileUploader(Thread):
             return
         except filetransfer.exceptions.TransferFailure as e:
             logger.error('Tranfer failure: %s', e)
-            client.close()
-            task.setFailed('Tranfer failure')
+            task.setFailed('Tranfer failure', commit=False)
 
             self._miscDb.addNotification(
                 models.NotificationCategory.UPLOAD,
@@ -506,8 +633,7 @@ class FileUploader(Thread):
             return
         except filetransfer.exceptions.PermissionFailure as e:
             logger.error('Permission failure: %s', e)
-            client.close()
-            task.setFailed('Permission failure')
+            task.setFailed('Permission failure', commit=False)
 
             self._miscDb.addNotification(
                 models.NotificationCategory.UPLOAD,
@@ -519,24 +645,19 @@ class FileUploader(Thread):
             return
 
 
-        # close file transfer client
-        client.close()
-
         upload_elapsed_s = time.time() - start
         logger.info('Upload transaction completed in %0.4f s', upload_elapsed_s)
 
 
-        task.setSuccess('File uploaded')
+        task.setSuccess('File uploaded', commit=False)
 
 
         if entry and action == constants.TRANSFER_UPLOAD:
             entry.uploaded = True
-            db.session.commit()
 
 
         if entry and action == constants.TRANSFER_S3:
             entry.s3_key = str(s3_key)
-            db.session.commit()
 
             # perform syncapi after s3 (if enabled)
             metadata['s3_key'] = str(s3_key)
@@ -545,7 +666,6 @@ class FileUploader(Thread):
 
         if entry and action == constants.TRANSFER_SYNC_V1:
             entry.sync_id = response['id']
-            db.session.commit()
 
 
         if entry and action == constants.TRANSFER_YOUTUBE:
@@ -557,8 +677,6 @@ class FileUploader(Thread):
             data_dict['youtube_id'] = response['id']
             entry.data = data_dict
 
-            db.session.commit()
-
 
         if remove_local:
             try:
@@ -574,6 +692,54 @@ class FileUploader(Thread):
         #raise Exception('Testing uncaught exception')
 
 
+    def _syncapiParameters(self):
+        connect_kwargs = {
+            'hostname'     : self.config['SYNCAPI']['BASEURL'],
+            'username'     : self.config['SYNCAPI']['USERNAME'],
+            'apikey'       : self.config['SYNCAPI']['APIKEY'],
+            'cert_bypass'  : self.config['SYNCAPI']['CERT_BYPASS'],
+        }
+
+        client_settings = {
+            'connect_timeout' : self.config.get('SYNCAPI', {}).get('CONNECT_TIMEOUT', 10.0),
+            'timeout'         : self.config.get('SYNCAPI', {}).get('TIMEOUT', 60.0),
+        }
+
+        return connect_kwargs, client_settings
+
+
+    def _transfer(self, client_class, connect_kwargs, put_kwargs, client_kwargs, client_settings, method='put'):
+        client, reused = self._transfer_pool.connect(client_class, connect_kwargs, client_kwargs=client_kwargs, client_settings=client_settings)
+
+        try:
+            response = getattr(client, method)(**put_kwargs)
+        except filetransfer.exceptions.ConnectionFailure as e:
+            self._transfer_pool.discard(client)
+
+            if not reused:
+                raise
+
+            # the server may have closed the kept alive connection
+            logger.warning('Connection failure on reused %s connection, reconnecting: %s', client_class.__name__, str(e))
+
+            client, reused = self._transfer_pool.connect(client_class, connect_kwargs, client_kwargs=client_kwargs, client_settings=client_settings)
+
+            try:
+                response = getattr(client, method)(**put_kwargs)
+            except Exception:
+                self._transfer_pool.discard(client)
+                raise
+        except Exception:
+            self._transfer_pool.discard(client)
+            raise
+
+
+        # keep the client connected for the next transfer
+        self._transfer_pool.release(client)
+
+        return response
+
+
     def _syncapi(self, asset_entry, metadata):
         ### sync camera
         if not self.config.get('SYNCAPI', {}).get('ENABLE'):
@@ -612,13 +778,5 @@ class FileUploader(Thread):
             'metadata'    : metadata,
         }
 
-        upload_task = models.IndiAllSkyDbTaskQueueTable(
-            queue=models.TaskQueueQueue.UPLOAD,
-            state=models.TaskQueueState.QUEUED,
-            data=jobdata,
-        )
-        db.session.add(upload_task)
-        db.session.commit()
-
-        self.upload_q.put({'task_id' : upload_task.id})
+        self._miscUpload.addTask(jobdata)
 
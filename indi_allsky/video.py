@@ -2,8 +2,6 @@ import os
 import time
 import math
 import json
-import cv2
-import numpy
 from datetime import datetime
 from datetime import timedelta
 from datetime import timezone
@@ -14,21 +12,19 @@ import signal
 import traceback
 import logging
 
-import PIL
-from PIL import Image
-
 import ephem
 
 from . import constants
 
 from .timelapse import TimelapseGenerator
-from .keogram import KeogramGenerator
-from .starTrails import StarTrailGenerator
+from .rollingProducts import IndiAllSkyRollingProducts
+from .frameDecoder import IndiAllSkyFrameDecoder
 from .miscUpload import miscUpload
 from .aurora import IndiAllskyAuroraUpdate
 from .smoke import IndiAllskySmokeUpdate
 from .satellite_download import IndiAllskyUpdateSatelliteData
-from .maskProcessing import MaskProcessor
+from .detectionMask import IndiAllSkyDetectionMask
+from .expireAssets import IndiAllSkyExpireAssets
 
 from .flask import create_app
 from .flask import db
@@ -74,6 +70,8 @@ class VideoWorker(Process):
     thumbnail_keogram_width = 1000
     thumbnail_startrail_width = 300
 
+    stream_stale_period = 3600  # seconds, streams are written continuously
+
 
     def __init__(
         self,
@@ -792,14 +790,14 @@ class VideoWorker(Process):
 
         processing_start = time.time()
 
-        kg = KeogramGenerator(
+        rolling = IndiAllSkyRollingProducts(
             self.config,
+            self.bin_v,
+            mask=self._detection_mask,
         )
-        kg.angle = self.config['KEOGRAM_ANGLE']
-        kg.h_scale_factor = self.config['KEOGRAM_H_SCALE']
-        kg.v_scale_factor = self.config['KEOGRAM_V_SCALE']
-        kg.crop_top = self.config.get('KEOGRAM_CROP_TOP', 0)
-        kg.crop_bottom = self.config.get('KEOGRAM_CROP_BOTTOM', 0)
+
+        kg = rolling.buildKeogramGenerator()
+        kg.total_frames = image_count
 
 
         keogram_metadata = {
@@ -882,122 +880,79 @@ class VideoWorker(Process):
             startrail_video_entry = None
 
 
-        stg = StarTrailGenerator(
-            self.config,
-            self.bin_v,
-            mask=self._detection_mask,
-        )
-        stg.max_adu = self.config['STARTRAILS_MAX_ADU']
-        stg.mask_threshold = self.config['STARTRAILS_MASK_THOLD']
-        stg.pixel_cutoff_threshold = self.config['STARTRAILS_PIXEL_THOLD']
-        stg.min_stars = self.config.get('STARTRAILS_MIN_STARS', 0)
-        stg.latitude = camera.latitude
-        stg.longitude = camera.longitude
-        stg.sun_alt_threshold = self.config['STARTRAILS_SUN_ALT_THOLD']
-
-        if self.config['STARTRAILS_MOONMODE_THOLD']:
-            stg.moonmode_alt = self.config['NIGHT_MOONMODE_ALT_DEG']
-            stg.moonmode_phase = self.config['NIGHT_MOONMODE_PHASE']
+        # checkpoint timelapse frames are linked into the temporary folder when restored
+        stg = rolling.buildStarTrailGenerator(camera)
+
+        if night and self.config.get('STARTRAILS_TIMELAPSE_STREAM', True) and not self.config.get('KEOGRAM_STARTRAILS_INCREMENTAL'):
+            # frames are piped to ffmpeg, the video is renamed when complete
+            self._removeStaleStreamFiles(camera)
+            stg.timelapse_stream_file = startrail_video_file.with_name('.{0:s}'.format(startrail_video_file.name))
+
+
+        if self.config.get('KEOGRAM_STARTRAILS_INCREMENTAL'):
+            image_id_list = [x.id for x in files_entries.with_entities(IndiAllSkyDbImageTable.id)]
+
+            if night:
+                restored_id_list = rolling.restore(kg, stg, camera, d_dayDate, night, image_id_list=image_id_list)
+            else:
+                restored_id_list = rolling.restore(kg, None, camera, d_dayDate, night, image_id_list=image_id_list)
         else:
-            stg.moon_alt_threshold = self.config['STARTRAILS_MOON_ALT_THOLD']
-            stg.moon_phase_threshold = self.config['STARTRAILS_MOON_PHASE_THOLD']
+            restored_id_list = list()
+
+        restored_count = len(restored_id_list)
+        logger.info('Reading %d images from disk', image_count - restored_count)
+
 
         if self.config.get('STARTRAILS_USE_DB_DATA', True):
             logger.warning('Re-using image data for ADU and Star counts')
         else:
             logger.warning('Recalculating values for ADU and Star counts')
 
-        # Files are presorted from the DB
-        for i, entry in enumerate(files_entries):
-            if i % 100 == 0:
-                logger.info('Processed %d of %d images', i, image_count)
-
-            image_file_p = Path(entry.getFilesystemPath())
-
-            if not image_file_p.exists():
-                logger.error('File not found: %s', image_file_p)
-                continue
-
-            if image_file_p.stat().st_size == 0:
-                continue
-
+        try:
+            decoder = IndiAllSkyFrameDecoder(self.config)
+            frame_iter = decoder.decode(
+                files_entries.offset(restored_count),
+                path_func=lambda x: Path(x.getFilesystemPath()),
+            )
 
-            #logger.info('Reading file: %s', p_entry)
-            if image_file_p.suffix in ('.png',):
-                # opencv is faster than Pillow with PNG
-                image_data = cv2.imread(str(image_file_p), cv2.IMREAD_COLOR)
+            # Files are presorted from the DB
+            for i, (entry, image_file_p, image_data) in enumerate(frame_iter, start=restored_count):
+                if i % 100 == 0:
+                    logger.info('Processed %d of %d images', i, image_count)
 
                 if isinstance(image_data, type(None)):
-                    logger.error('Unable to read %s', image_file_p)
-                    continue
-            else:
-                try:
-                    with Image.open(str(image_file_p)) as img:
-                        image_data = cv2.cvtColor(numpy.array(img), cv2.COLOR_RGB2BGR)
-                except PIL.UnidentifiedImageError:
-                    logger.error('Unable to read %s', image_file_p)
                     continue
 
 
-            kg.processImage(image_file_p, image_data)
-
-            if night:
-                if self.config.get('STARTRAILS_USE_DB_DATA', True):
-                    adu = entry.adu
-                    star_count = entry.stars  # can be None
-                else:
-                    adu, star_count = None, None
+                kg.processImage(image_file_p, image_data)
 
-                stg.processImage(image_file_p, image_data, adu=adu, star_count=star_count)
+                if night:
+                    if self.config.get('STARTRAILS_USE_DB_DATA', True):
+                        adu = entry.adu
+                        star_count = entry.stars  # can be None
+                    else:
+                        adu, star_count = None, None
 
+                    stg.processImage(image_file_p, image_data, adu=adu, star_count=star_count)
 
-        kg.finalize(keogram_file, camera)
 
+            logger.info('Waited %0.1f s for %d decoded frames (%d workers)', decoder.wait_elapsed_s, decoder.decoded_count, decoder.workers)
 
-        # add height and width
-        keogram_height, keogram_width = kg.shape[:2]
-        keogram_entry.height = keogram_height
-        keogram_entry.width = keogram_width
-        #keogram_entry['data']['height'] = keogram_height
-        #keogram_entry['data']['width'] = keogram_width
-        db.session.commit()
-
-
-        keogram_thumbnail_metadata = {
-            'type'       : constants.THUMBNAIL,
-            'origin'     : constants.KEOGRAM,
-            'createDate' : now.timestamp(),
-            'dayDate'    : d_dayDate.strftime('%Y%m%d'),
-            'utc_offset' : now.astimezone().utcoffset().total_seconds(),
-            'night'      : night,
-            'camera_uuid': camera.uuid,
-        }
-
-        keogram_thumbnail_entry = self._miscDb.addThumbnail(
-            keogram_entry,
-            keogram_metadata,
-            camera.id,
-            keogram_thumbnail_metadata,
-            new_width=self.thumbnail_keogram_width,
-        )
-
-
-        if night:
-            stg.finalize(startrail_file, camera)
+            kg.finalize(keogram_file, camera)
 
 
             # add height and width
-            st_height, st_width = stg.shape[:2]
-            startrail_entry.height = st_height
-            startrail_entry.width = st_width
-            #startrail_entry['data']['height'] = st_height
-            #startrail_entry['data']['width'] = st_width
+            keogram_height, keogram_width = kg.shape[:2]
+            keogram_entry.height = keogram_height
+            keogram_entry.width = keogram_width
+            #keogram_entry['data']['height'] = keogram_height
+            #keogram_entry['data']['width'] = keogram_width
             db.session.commit()
 
 
-            startrail_thumbnail_metadata = {
+            keogram_thumbnail_metadata = {
                 'type'       : constants.THUMBNAIL,
-                'origin'     : constants.STARTRAIL,
+                'origin'     : constants.KEOGRAM,
                 'createDate' : now.timestamp(),
                 'dayDate'    : d_dayDate.strftime('%Y%m%d'),
                 'utc_offset' : now.astimezone().utcoffset().total_seconds(),
@@ -1005,41 +960,84 @@ class VideoWorker(Process):
                 'camera_uuid': camera.uuid,
             }
 
-            startrail_thumbnail_entry = self._miscDb.addThumbnail(
-                startrail_entry,
-                startrail_metadata,
+            keogram_thumbnail_entry = self._miscDb.addThumbnail(
+                keogram_entry,
+                keogram_metadata,
                 camera.id,
-                startrail_thumbnail_metadata,
-                new_width=self.thumbnail_startrail_width,
+                keogram_thumbnail_metadata,
+                new_width=self.thumbnail_keogram_width,
+                numpy_data=kg.keogram_final,  # do not read the keogram file again
             )
 
 
-            st_frame_count = stg.timelapse_frame_count
-            if st_frame_count >= self.config.get('STARTRAILS_TIMELAPSE_MINFRAMES', 250):
-                startrail_video_entry = self._miscDb.addStarTrailVideo(
-                    startrail_video_file.relative_to(self.image_dir),
+            if night:
+                stg.finalize(startrail_file, camera)
+
+
+                # add height and width
+                st_height, st_width = stg.shape[:2]
+                startrail_entry.height = st_height
+                startrail_entry.width = st_width
+                #startrail_entry['data']['height'] = st_height
+                #startrail_entry['data']['width'] = st_width
+                db.session.commit()
+
+
+                startrail_thumbnail_metadata = {
+                    'type'       : constants.THUMBNAIL,
+                    'origin'     : constants.STARTRAIL,
+                    'createDate' : now.timestamp(),
+                    'dayDate'    : d_dayDate.strftime('%Y%m%d'),
+                    'utc_offset' : now.astimezone().utcoffset().total_seconds(),
+                    'night'      : night,
+                    'camera_uuid': camera.uuid,
+                }
+
+                startrail_thumbnail_entry = self._miscDb.addThumbnail(
+                    startrail_entry,
+                    startrail_metadata,
                     camera.id,
-                    startrail_video_metadata,
+                    startrail_thumbnail_metadata,
+                    new_width=self.thumbnail_startrail_width,
+                    numpy_data=stg.trail_image,
                 )
 
-                try:
-                    st_tg = TimelapseGenerator(self.config)
-                    st_tg.generate(startrail_video_file, stg.timelapse_frame_list)
-                except TimelapseException:
-                    logger.error('Failed to generate startrails timelapse')
-
-                    startrail_video_entry.success = False
-                    db.session.commit()
 
-                    self._miscDb.addNotification(
-                        NotificationCategory.MEDIA,
-                        'startrail_video',
-                        'Startrails timelapse video failed to generate',
-                        expire=timedelta(hours=12),
+                st_frame_count = stg.timelapse_frame_count
+                if st_frame_count >= self.config.get('STARTRAILS_TIMELAPSE_MINFRAMES', 250):
+                    startrail_video_entry = self._miscDb.addStarTrailVideo(
+                        startrail_video_file.relative_to(self.image_dir),
+                        camera.id,
+                        startrail_video_metadata,
                     )
-            else:
-                logger.error('Not enough frames to generate star trails timelapse: %d', st_frame_count)
-                startrail_video_entry = None
+
+                    try:
+                        stg.generateTimelapse(startrail_video_file)
+                    except TimelapseException:
+                        logger.error('Failed to generate startrails timelapse')
+
+                        startrail_video_entry.success = False
+                        db.session.commit()
+
+                        self._miscDb.addNotification(
+                            NotificationCategory.MEDIA,
+                            'startrail_video',
+                            'Startrails timelapse video failed to generate',
+                            expire=timedelta(hours=12),
+                        )
+                else:
+                    logger.error('Not enough frames to generate star trails timelapse: %d', st_frame_count)
+                    stg.cancelTimelapse()
+                    startrail_video_entry = None
+        except Exception:
+            # the ffmpeg stream is opened with the first star trail frame
+            stg.cancelTimelapse()
+            raise
+
+
+        if self.config.get('KEOGRAM_STARTRAILS_INCREMENTAL'):
+            # star trail timelapse frames are no longer needed
+            rolling.remove(camera, d_dayDate, night)
 
 
         processing_elapsed_s = time.time() - processing_start
@@ -1288,110 +1286,38 @@ class VideoWorker(Process):
         cutoff_age_images = datetime.now() - timedelta(days=self.config['IMAGE_EXPIRE_DAYS'])
         cutoff_age_images_date = cutoff_age_images.date()  # cutoff date based on dayDate attribute, not createDate
 
-        old_images = IndiAllSkyDbImageTable.query\
-            .join(IndiAllSkyDbImageTable.camera)\
-            .filter(IndiAllSkyDbCameraTable.id == camera.id)\
-            .filter(IndiAllSkyDbImageTable.dayDate < cutoff_age_images_date)\
-            .order_by(IndiAllSkyDbImageTable.createDate.asc())
-        old_fits_images = IndiAllSkyDbFitsImageTable.query\
-            .join(IndiAllSkyDbFitsImageTable.camera)\
-            .filter(IndiAllSkyDbCameraTable.id == camera.id)\
-            .filter(IndiAllSkyDbFitsImageTable.dayDate < cutoff_age_images_date)\
-            .order_by(IndiAllSkyDbFitsImageTable.createDate.asc())
-        old_raw_images = IndiAllSkyDbRawImageTable.query\
-            .join(IndiAllSkyDbRawImageTable.camera)\
-            .filter(IndiAllSkyDbCameraTable.id == camera.id)\
-            .filter(IndiAllSkyDbRawImageTable.dayDate < cutoff_age_images_date)\
-            .order_by(IndiAllSkyDbRawImageTable.createDate.asc())
-        old_panorama_images = IndiAllSkyDbPanoramaImageTable.query\
-            .join(IndiAllSkyDbPanoramaImageTable.camera)\
-            .filter(IndiAllSkyDbCameraTable.id == camera.id)\
-            .filter(IndiAllSkyDbPanoramaImageTable.dayDate < cutoff_age_images_date)\
-            .order_by(IndiAllSkyDbPanoramaImageTable.createDate.asc())
-
-
         cutoff_age_timelapse = datetime.now() - timedelta(days=self.config.get('TIMELAPSE_EXPIRE_DAYS', 365))
         cutoff_age_timelapse_date = cutoff_age_timelapse.date()  # cutoff date based on dayDate attribute, not createDate
 
-        old_videos = IndiAllSkyDbVideoTable.query\
-            .join(IndiAllSkyDbVideoTable.camera)\
-            .filter(IndiAllSkyDbCameraTable.id == camera.id)\
-            .filter(IndiAllSkyDbVideoTable.dayDate < cutoff_age_timelapse_date)\
-            .order_by(IndiAllSkyDbVideoTable.createDate.asc())
-        old_keograms = IndiAllSkyDbKeogramTable.query\
-            .join(IndiAllSkyDbKeogramTable.camera)\
-            .filter(IndiAllSkyDbCameraTable.id == camera.id)\
-            .filter(IndiAllSkyDbKeogramTable.dayDate < cutoff_age_timelapse_date)\
-            .order_by(IndiAllSkyDbKeogramTable.createDate.asc())
-        old_startrails = IndiAllSkyDbStarTrailsTable.query\
-            .join(IndiAllSkyDbStarTrailsTable.camera)\
-            .filter(IndiAllSkyDbCameraTable.id == camera.id)\
-            .filter(IndiAllSkyDbStarTrailsTable.dayDate < cutoff_age_timelapse_date)\
-            .order_by(IndiAllSkyDbStarTrailsTable.createDate.asc())
-        old_startrails_videos = IndiAllSkyDbStarTrailsVideoTable.query\
-            .join(IndiAllSkyDbStarTrailsVideoTable.camera)\
-            .filter(IndiAllSkyDbCameraTable.id == camera.id)\
-            .filter(IndiAllSkyDbStarTrailsVideoTable.dayDate < cutoff_age_timelapse_date)\
-            .order_by(IndiAllSkyDbStarTrailsVideoTable.createDate.asc())
-        old_panorama_videos = IndiAllSkyDbPanoramaVideoTable.query\
-            .join(IndiAllSkyDbPanoramaVideoTable.camera)\
-            .filter(IndiAllSkyDbCameraTable.id == camera.id)\
-            .filter(IndiAllSkyDbPanoramaVideoTable.dayDate < cutoff_age_timelapse_date)\
-            .order_by(IndiAllSkyDbPanoramaVideoTable.createDate.asc())
-
-
-        ### Getting IDs first then deleting each file is faster than deleting all files with
-        ### thumbnails with a single query.  Deleting associated thumbnails causes sqlalchemy
-        ### to recache after every delete which cause a 1-5 second lag for each delete
-
-
-        image_id_list = list()
-        for entry in old_images:
-            image_id_list.append(entry.id)
-
-        fits_id_list = list()
-        for entry in old_fits_images:
-            fits_id_list.append(entry.id)
-
-        raw_id_list = list()
-        for entry in old_raw_images:
-            raw_id_list.append(entry.id)
 
-        panorama_image_id_list = list()
-        for entry in old_panorama_images:
-            panorama_image_id_list.append(entry.id)
+        ### Entries are selected and deleted in batches, the files for each batch are
+        ### removed before the rows are deleted with a single statement
+        expire = IndiAllSkyExpireAssets(self.config)
 
 
-        video_id_list = list()
-        for entry in old_videos:
-            video_id_list.append(entry.id)
-
-        keogram_id_list = list()
-        for entry in old_keograms:
-            keogram_id_list.append(entry.id)
-
-        startrail_image_id_list = list()
-        for entry in old_startrails:
-            startrail_image_id_list.append(entry.id)
+        image_deleted, image_max_createDate = expire.expire(
+            IndiAllSkyDbImageTable,
+            IndiAllSkyDbImageTable.camera_id == camera.id,
+            IndiAllSkyDbImageTable.dayDate < cutoff_age_images_date,
+        )
 
-        startrail_video_id_list = list()
-        for entry in old_startrails_videos:
-            startrail_video_id_list.append(entry.id)
+        for table in (IndiAllSkyDbFitsImageTable, IndiAllSkyDbRawImageTable, IndiAllSkyDbPanoramaImageTable):
+            expire.expire(
+                table,
+                table.camera_id == camera.id,
+                table.dayDate < cutoff_age_images_date,
+            )
 
-        panorama_video_id_list = list()
-        for entry in old_panorama_videos:
-            panorama_video_id_list.append(entry.id)
+        for table in (IndiAllSkyDbVideoTable, IndiAllSkyDbKeogramTable, IndiAllSkyDbStarTrailsTable, IndiAllSkyDbStarTrailsVideoTable, IndiAllSkyDbPanoramaVideoTable):
+            expire.expire(
+                table,
+                table.camera_id == camera.id,
+                table.dayDate < cutoff_age_timelapse_date,
+            )
 
 
-        self._deleteAssets(IndiAllSkyDbImageTable, image_id_list)
-        self._deleteAssets(IndiAllSkyDbFitsImageTable, fits_id_list)
-        self._deleteAssets(IndiAllSkyDbRawImageTable, raw_id_list)
-        self._deleteAssets(IndiAllSkyDbPanoramaImageTable, panorama_image_id_list)
-        self._deleteAssets(IndiAllSkyDbVideoTable, video_id_list)
-        self._deleteAssets(IndiAllSkyDbKeogramTable, keogram_id_list)
-        self._deleteAssets(IndiAllSkyDbStarTrailsTable, startrail_image_id_list)
-        self._deleteAssets(IndiAllSkyDbStarTrailsVideoTable, startrail_video_id_list)
-        self._deleteAssets(IndiAllSkyDbPanoramaVideoTable, panorama_video_id_list)
+        if image_deleted:
+            self._miscDb.updateImageRollup(camera_id=camera.id, end_date=image_max_createDate)
 
 
         # Remove empty folders
@@ -1409,25 +1335,10 @@ class VideoWorker(Process):
             except PermissionError as e:
                 logger.error('Cannot remove folder: %s', str(e))
 
-        task.setSuccess('Expired data')
-
-
-    def _deleteAssets(self, table, entry_id_list):
-        for entry_id in entry_id_list:
-            entry = table.query\
-                .filter(table.id == entry_id)\
-                .one()
-
-            logger.info('Removing old %s entry: %s', entry.__class__.__name__, entry.filename)
-
-            try:
-                entry.deleteAsset()
-            except OSError as e:
-                logger.error('Cannot remove file: %s', str(e))
-                continue
-
-            db.session.delete(entry)
-            db.session.commit()
+        if expire.complete:
+            task.setSuccess('Expired data ({0:d} entries)'.format(expire.deleted))
+        else:
+            task.setSuccess('Expired data ({0:d} entries), expiration will continue next run'.format(expire.deleted))
 
 
     def _getVideoFolder(self, video_date, camera):
@@ -1446,6 +1357,26 @@ class VideoWorker(Process):
         return video_folder
 
 
+    def _removeStaleStreamFiles(self, camera):
+        # partial star trail timelapse streams are left behind if the worker is killed
+        timelapse_folder = self.image_dir.joinpath(
+            'ccd_{0:s}'.format(camera.uuid),
+            'timelapse',
+        )
+
+        stale_time = time.time() - self.stream_stale_period
+
+        for stream_file_p in timelapse_folder.glob('*/.allsky-startrail_timelapse_*'):
+            try:
+                if stream_file_p.stat().st_mtime > stale_time:
+                    continue
+
+                logger.warning('Removing stale timelapse stream file: %s', stream_file_p)
+                stream_file_p.unlink()
+            except FileNotFoundError:
+                pass
+
+
     def _getFolderFilesByExt(self, folder, file_list, extension_list=None):
         if not extension_list:
             extension_list = [self.config['IMAGE_FILE_TYPE']]
@@ -1469,77 +1400,7 @@ class VideoWorker(Process):
 
 
     def _load_detection_mask(self):
-        detect_mask = self.config.get('DETECT_MASK', '')
-
-        if not detect_mask:
-            logger.warning('No detection mask defined')
-            return
-
-
-        detect_mask_p = Path(detect_mask)
-
-        try:
-            if not detect_mask_p.exists():
-                logger.error('%s does not exist', detect_mask_p)
-                return
-
-
-            if not detect_mask_p.is_file():
-                logger.error('%s is not a file', detect_mask_p)
-                return
-
-        except PermissionError as e:
-            logger.error(str(e))
-            return
-
-        mask_data = cv2.imread(str(detect_mask_p), cv2.IMREAD_GRAYSCALE)  # mono
-        if isinstance(mask_data, type(None)):
-            logger.error('%s is not a valid image', detect_mask_p)
-            return
-
-        ### any compression artifacts will be set to black
-        #mask_data[mask_data < 255] = 0  # did not quite work
-
-
-        mask_processor = MaskProcessor(
-            self.config,
-            self.bin_v,
-        )
-
-
-        # masks need to be rotated, flipped, cropped for post-processed images
-        mask_processor.image = mask_data
-
-
-        if self.config.get('IMAGE_ROTATE'):
-            mask_processor.rotate_90()
-
-
-        # rotation
-        if self.config.get('IMAGE_ROTATE_ANGLE'):
-            mask_processor.rotate_angle()
-
-
-        # verticle flip
-        if self.config.get('IMAGE_FLIP_V'):
-            mask_processor.flip_v()
-
-
-        # horizontal flip
-        if self.config.get('IMAGE_FLIP_H'):
-            mask_processor.flip_h()
-
-
-        # crop
-        if self.config.get('IMAGE_CROP_ROI'):
-            mask_processor.crop_image()
-
-
-        # scale
-        if self.config['IMAGE_SCALE'] and self.config['IMAGE_SCALE'] != 100:
-            mask_processor.scale_image()
-
-
-        return mask_processor.image
+        # transformed for post-processed images
+        return IndiAllSkyDetectionMask(self.config, self.bin_v).load()
 
 
@@ -26,8 +26,9 @@ from indi_allsky.flask.models import IndiAllSkyDbPanoramaVideoTable
 from indi_allsky.flask.models import IndiAllSkyDbRawImageTable
 
 from indi_allsky.config import IndiAllSkyConfig
+from indi_allsky.flask.miscDb import miscDb
+from indi_allsky.expireAssets import IndiAllSkyExpireAssets
 
-from indi_allsky.flask import db
 from indi_allsky.flask import create_app
 
 
@@ -62,6 +63,8 @@ class ExpireImages(object):
 
         self.config = self._config_obj.config
 
+        self._miscDb = miscDb(self.config)
+
 
         self._image_days = 30
         self._video_days = 365
@@ -73,6 +76,8 @@ class ExpireImages(object):
             self.image_dir = Path(__file__).parent.parent.joinpath('html', 'images').absolute()
 
 
+        self._expire = None
+
         self._shutdown = False
 
 
@@ -100,6 +105,9 @@ class ExpireImages(object):
         # set flag for program to stop processes
         self._shutdown = True
 
+        if self._expire:
+            self._expire.stop()
+
 
 
     def main(self):
@@ -159,67 +167,46 @@ class ExpireImages(object):
         logger.info('Proceeding in 10 seconds')
 
         time.sleep(10)
-        logger.info('Building id lists...')
 
 
-        ### Getting IDs first then deleting each file is faster than deleting all files with
-        ### thumbnails with a single query.  Deleting associated thumbnails causes sqlalchemy
-        ### to recache after every delete which cause a 1-5 second lag for each delete
+        # the time budget is not used for manual runs
+        self._expire = IndiAllSkyExpireAssets(self.config, time_budget=0)
 
-        image_id_list = list()
-        for entry in old_images:
-            image_id_list.append(entry.id)
 
-        fits_id_list = list()
-        for entry in old_fits_images:
-            fits_id_list.append(entry.id)
-
-        raw_id_list = list()
-        for entry in old_raw_images:
-            raw_id_list.append(entry.id)
+        logger.warning('Deleting...')
+        time.sleep(3)
 
-        panorama_image_id_list = list()
-        for entry in old_panorama_images:
-            panorama_image_id_list.append(entry.id)
 
+        # catch signals to perform cleaner shutdown
+        signal.signal(signal.SIGINT, self.sigint_handler_main)
 
-        video_id_list = list()
-        for entry in old_videos:
-            video_id_list.append(entry.id)
 
-        keogram_id_list = list()
-        for entry in old_keograms:
-            keogram_id_list.append(entry.id)
+        image_deleted, image_max_createDate = self._expire.expire(
+            IndiAllSkyDbImageTable,
+            IndiAllSkyDbImageTable.dayDate < cutoff_age_images_date,
+        )
 
-        startrail_image_id_list = list()
-        for entry in old_startrails:
-            startrail_image_id_list.append(entry.id)
+        for table in (IndiAllSkyDbFitsImageTable, IndiAllSkyDbRawImageTable, IndiAllSkyDbPanoramaImageTable):
+            self._expire.expire(
+                table,
+                table.dayDate < cutoff_age_images_date,
+            )
 
-        startrail_video_id_list = list()
-        for entry in old_startrails_videos:
-            startrail_video_id_list.append(entry.id)
+        for table in (IndiAllSkyDbVideoTable, IndiAllSkyDbKeogramTable, IndiAllSkyDbStarTrailsTable, IndiAllSkyDbStarTrailsVideoTable, IndiAllSkyDbPanoramaVideoTable):
+            self._expire.expire(
+                table,
+                table.dayDate < cutoff_age_timelapse_date,
+            )
 
-        panorama_video_id_list = list()
-        for entry in old_panorama_videos:
-            panorama_video_id_list.append(entry.id)
 
+        if image_deleted:
+            self._miscDb.updateImageRollup(end_date=image_max_createDate)
 
-        logger.warning('Deleting...')
-        time.sleep(3)
 
+        logger.warning('Deleted %d entries, %d failed', self._expire.deleted, self._expire.failed)
 
-        # catch signals to perform cleaner shutdown
-        signal.signal(signal.SIGINT, self.sigint_handler_main)
-
-        self._deleteAssets(IndiAllSkyDbImageTable, image_id_list)
-        self._deleteAssets(IndiAllSkyDbFitsImageTable, fits_id_list)
-        self._deleteAssets(IndiAllSkyDbRawImageTable, raw_id_list)
-        self._deleteAssets(IndiAllSkyDbPanoramaImageTable, panorama_image_id_list)
-        self._deleteAssets(IndiAllSkyDbVideoTable, video_id_list)
-        self._deleteAssets(IndiAllSkyDbKeogramTable, keogram_id_list)
-        self._deleteAssets(IndiAllSkyDbStarTrailsTable, startrail_image_id_list)
-        self._deleteAssets(IndiAllSkyDbStarTrailsVideoTable, startrail_video_id_list)
-        self._deleteAssets(IndiAllSkyDbPanoramaVideoTable, panorama_video_id_list)
+        if self._shutdown:
+            sys.exit(1)
 
 
 
@@ -239,28 +226,6 @@ class ExpireImages(object):
                 logger.error('Cannot remove folder: %s', str(e))
 
 
-    def _deleteAssets(self, table, entry_id_list):
-        for entry_id in entry_id_list:
-            entry = table.query\
-                .filter(table.id == entry_id)\
-                .one()
-
-            logger.info('Removing old %s entry: %s', entry.__class__.__name__, entry.filename)
-
-            try:
-                entry.deleteAsset()
-            except OSError as e:
-                logger.error('Cannot remove file: %s', str(e))
-                continue
-
-            db.session.delete(entry)
-            db.session.commit()
-
-
-            if self._shutdown:
-                sys.exit(1)
-
-
     def _getFolderFolders(self, folder, dir_list):
         for item in Path(folder).iterdir():
             if item.is_dir():
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+#
+# Rebuild the hourly image summary used by the image viewer and gallery selectors
+#
+
+import sys
+import argparse
+from pathlib import Path
+import logging
+
+from sqlalchemy.orm.exc import NoResultFound
+
+
+sys.path.append(str(Path(__file__).parent.absolute().parent))
+
+
+from indi_allsky.config import IndiAllSkyConfig
+from indi_allsky.flask.miscDb import miscDb
+
+from indi_allsky.flask import create_app
+
+
+logger = logging.getLogger('indi_allsky')
+logger.setLevel(logging.INFO)
+
+
+# setup flask context for db access
+app = create_app()
+app.app_context().push()
+
+
+LOG_FORMATTER_STREAM = logging.Formatter('[%(levelname)s]: %(message)s')
+
+LOG_HANDLER_STREAM = logging.StreamHandler()
+LOG_HANDLER_STREAM.setFormatter(LOG_FORMATTER_STREAM)
+
+logger.handlers.clear()  # remove syslog
+logger.addHandler(LOG_HANDLER_STREAM)
+
+
+
+class RebuildImageRollup(object):
+
+    def __init__(self):
+        try:
+            self._config_obj = IndiAllSkyConfig()
+        except NoResultFound:
+            logger.error('No config file found, please import a config')
+            sys.exit(1)
+
+        self.config = self._config_obj.config
+
+        self._miscDb = miscDb(self.config)
+
+
+    def main(self, force=False):
+        self._miscDb.initImageRollup(force=force)
+
+
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument(
+        '--force',
+        help='rebuild if the summary already exists',
+        dest='force',
+        action='store_true',
+    )
+
+    args = argparser.parse_args()
+
+
+    r = RebuildImageRollup()
+    r.main(force=args.force)
@@ -94,7 +94,7 @@ class UploadSync(object):
             })
 
 
-        self._miscUpload = miscUpload(self.config, self.upload_q)
+        self._miscUpload = miscUpload(self.config, self.upload_q, syncapi_check=True)
 
 
         self._shutdown = False
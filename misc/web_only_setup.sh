@@ -1243,6 +1243,10 @@ fi
 [[ -f "$TMP_CONFIG_DUMP" ]] && rm -f "$TMP_CONFIG_DUMP"
 
 
+# build the image summary for the viewer selectors (only runs once)
+"${ALLSKY_DIRECTORY}/misc/rebuild_image_rollup.py"
+
+
 echo
 echo
 echo "The web interface may be accessed with the following URL"
@@ -249,6 +249,10 @@ TMP_CONFIG_DUMP=$(mktemp --suffix=.json)
 [[ -f "$TMP_CONFIG_DUMP" ]] && rm -f "$TMP_CONFIG_DUMP"
 
 
+# build the image summary for the viewer selectors (only runs once)
+"${ALLSKY_DIRECTORY}/misc/rebuild_image_rollup.py"
+
+
 END_TIME=$(date +%s)
 
 echo
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+
+# Image circle mask and logo overlay, float blending vs IndiAllSkyAlphaComposite
+
+
+import sys
+import timeit
+from pathlib import Path
+import numpy
+import logging
+
+sys.path.append(str(Path(__file__).parent.absolute().parent))
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging
+
+
+class AlphaCompositeBench(object):
+    rounds = 50
+
+
+    def __init__(self):
+        pass
+
+
+    def main(self):
+
+        setup = '''
+import numpy
+import cv2
+from indi_allsky.alphaComposite import IndiAllSkyAlphaComposite
+
+image = numpy.random.randint(255, size=(2160, 3840, 3), dtype=numpy.uint8)
+
+# image circle, 50% opacity, blurred
+channel_mask = numpy.full([2160, 3840], 127, dtype=numpy.uint8)
+cv2.circle(img=channel_mask, center=(1920, 1080), radius=1000, color=(255), thickness=cv2.FILLED)
+channel_mask = cv2.blur(src=channel_mask, ksize=(75, 75), borderType=cv2.BORDER_DEFAULT)
+
+channel_alpha = (channel_mask / 255).astype(numpy.float32)
+circle_mask = numpy.dstack((channel_alpha, channel_alpha, channel_alpha))
+
+circle_composite = IndiAllSkyAlphaComposite(cv2.bitwise_not(channel_mask))
+
+
+# logo in the lower right corner
+logo_bgr = numpy.zeros([2160, 3840, 3], dtype=numpy.uint8)
+logo_bgr[1900:2100, 3300:3800] = 255
+logo_alpha = numpy.zeros([2160, 3840], dtype=numpy.uint8)
+logo_alpha[1900:2100, 3300:3800] = 192
+
+overlay_alpha = (logo_alpha / 255).astype(numpy.float32)
+alpha_mask = numpy.dstack((overlay_alpha, overlay_alpha, overlay_alpha))
+
+logo_composite = IndiAllSkyAlphaComposite(logo_alpha, overlay=logo_bgr)
+'''
+
+        s_circle_float = '''
+circle_float_data = (image * circle_mask).astype(numpy.uint8)
+'''
+
+        s_circle_composite = '''
+circle_composite_data = circle_composite.apply(image.copy())
+'''
+
+        s_logo_float = '''
+logo_float_data = (image * (1 - alpha_mask) + logo_bgr * alpha_mask).astype(numpy.uint8)
+'''
+
+        s_logo_composite = '''
+logo_composite_data = logo_composite.apply(image.copy())
+'''
+
+        s_copy = '''
+image.copy()
+'''
+
+
+        t_copy = timeit.timeit(stmt=s_copy, setup=setup, number=self.rounds)
+        logger.info('Image copy (included in composite times): %0.3fms', t_copy * 1000 / self.rounds)
+
+        t_circle_float = timeit.timeit(stmt=s_circle_float, setup=setup, number=self.rounds)
+        logger.info('Circle mask float: %0.3fms', t_circle_float * 1000 / self.rounds)
+
+        t_circle_composite = timeit.timeit(stmt=s_circle_composite, setup=setup, number=self.rounds)
+        logger.info('Circle mask composite: %0.3fms', t_circle_composite * 1000 / self.rounds)
+
+        t_logo_float = timeit.timeit(stmt=s_logo_float, setup=setup, number=self.rounds)
+        logger.info('Logo float: %0.3fms', t_logo_float * 1000 / self.rounds)
+
+        t_logo_composite = timeit.timeit(stmt=s_logo_composite, setup=setup, number=self.rounds)
+        logger.info('Logo composite: %0.3fms', t_logo_composite * 1000 / self.rounds)
+
+
+        # the float blend truncates, the composite rounds
+        compare_vars = dict()
+        exec(setup + s_circle_float + s_circle_composite + s_logo_float + s_logo_composite, compare_vars)
+
+        for label, float_data, composite_data in (
+            ('Circle mask', compare_vars['circle_float_data'], compare_vars['circle_composite_data']),
+            ('Logo', compare_vars['logo_float_data'], compare_vars['logo_composite_data']),
+        ):
+            max_diff = numpy.max(numpy.abs(float_data.astype(numpy.int16) - composite_data.astype(numpy.int16)))
+
+            if max_diff <= 1:
+                logger.info('%s images match, max difference %d', label, max_diff)
+            else:
+                logger.error('%s images DO NOT match, max difference %d', label, max_diff)
+
+
+
+if __name__ == "__main__":
+    b = AlphaCompositeBench()
+    b.main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+
+# Per-frame astrometry cost.  A new IndiAllSkyAstrometry for every frame has the same
+# cost as the previous implementation (TLE queries and parsing, next pass for every
+# satellite), a single instance uses the cached TLE, pass and planet data.
+#
+# Frames are simulated 15 seconds apart for a full day.  Uses the configured
+# indi-allsky database for TLE data, run as the indi-allsky user.
+
+
+import sys
+import time
+from datetime import datetime
+from datetime import timedelta
+from datetime import timezone
+import statistics
+from pathlib import Path
+from multiprocessing import Array
+import logging
+
+sys.path.append(str(Path(__file__).parent.absolute().parent))
+
+from indi_allsky.flask import create_app
+from indi_allsky.astrometry import IndiAllSkyAstrometry
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging
+
+
+app = create_app()
+
+
+class AstrometryBench(object):
+    rounds = 200
+    frame_period = 15
+    cached_rounds = 5760  # 24 hours
+
+
+    def __init__(self):
+        self.config = {}
+
+        self.position_av = Array('f', [
+            33.0,  # latitude
+            -84.0,  # longitude
+            300.0,  # elevation
+            0.0,  # Ra
+            0.0,  # Dec
+        ])
+
+
+    def main(self):
+        start_date = datetime.now(tz=timezone.utc)
+
+        with app.app_context():
+            uncached_list = list()
+            for i in range(self.rounds):
+                utcnow = start_date + timedelta(seconds=i * self.frame_period)
+
+                start = time.time()
+                IndiAllSkyAstrometry(self.config, self.position_av).update(dict(), utcnow=utcnow)
+                uncached_list.append(time.time() - start)
+
+
+            astrometry = IndiAllSkyAstrometry(self.config, self.position_av)
+
+            cached_list = list()
+            for i in range(self.cached_rounds):
+                utcnow = start_date + timedelta(seconds=i * self.frame_period)
+
+                start = time.time()
+                astrometry.update(dict(), utcnow=utcnow)
+                cached_list.append(time.time() - start)
+
+
+        logger.info(
+            'Uncached - median: %0.3f ms, max: %0.3f ms',
+            statistics.median(uncached_list) * 1000,
+            max(uncached_list) * 1000,
+        )
+        logger.info(
+            'Cached - median: %0.3f ms, mean: %0.3f ms, max: %0.3f ms',
+            statistics.median(cached_list) * 1000,
+            statistics.mean(cached_list) * 1000,
+            max(cached_list) * 1000,
+        )
+
+
+
+if __name__ == "__main__":
+    b = AstrometryBench()
+    b.main()
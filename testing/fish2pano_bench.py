@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+
+# Compare the pure python fish2pano reference with the cached remap panorama in ImageProcessor
+
+
+import sys
+import time
+import numpy
+from pathlib import Path
+import logging
+
+sys.path.append(str(Path(__file__).parent.absolute().parent))
+
+# prevent circular import, the app and config are not needed
+import indi_allsky.flask  # noqa: F401
+from indi_allsky.processing import ImageProcessor
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging
+
+
+class FakeProcessor(object):
+    # only the panorama methods are needed, skip the ImageProcessor init
+    fish2pano_purepython = ImageProcessor.fish2pano_purepython
+    fish2pano_remap = ImageProcessor.fish2pano_remap
+    _generate_fish2pano_maps = ImageProcessor._generate_fish2pano_maps
+
+
+    def __init__(self, config, image):
+        self.config = config
+        self.image = image
+
+        self._fish2pano_maps_key = None
+        self._fish2pano_maps = None
+
+
+class Fish2PanoBench(object):
+    rounds = 25
+    purepython_rounds = 1  # about a second per panorama
+    angle = 0
+
+    ### 1k
+    #width  = 1920
+    #height = 1080
+
+    ### 4k
+    width  = 3840
+    height = 2160
+
+
+    def __init__(self):
+        self.config = {
+            'FISH2PANO' : {
+                'DIAMETER'     : 2000,
+                'OFFSET_X'     : 0,
+                'OFFSET_Y'     : 0,
+                'ROTATE_ANGLE' : self.angle,
+                'SCALE'        : 0.5,
+            },
+        }
+
+        image = numpy.random.randint(255, size=(self.height, self.width, 3), dtype=numpy.uint8)
+
+        self.processor = FakeProcessor(self.config, image)
+
+
+    def main(self):
+        ### pure python
+        start = time.time()
+        for i in range(self.purepython_rounds):
+            pano_purepython = self.processor.fish2pano_purepython()
+
+        purepython_elapsed_s = (time.time() - start) / self.purepython_rounds
+        logger.info('Pure python: %0.4fs per panorama', purepython_elapsed_s)
+
+
+        ### remap
+        start = time.time()
+        pano_remap = self.processor.fish2pano_remap()  # includes map generation
+        first_elapsed_s = time.time() - start
+        logger.info('Remap (first): %0.4fs', first_elapsed_s)
+
+        start = time.time()
+        for i in range(self.rounds):
+            pano_remap = self.processor.fish2pano_remap()
+
+        remap_elapsed_s = (time.time() - start) / self.rounds
+        logger.info('Remap (cached): %0.4fs per panorama', remap_elapsed_s)
+
+        logger.info('Speedup: %0.1fx', purepython_elapsed_s / remap_elapsed_s)
+
+
+        if pano_purepython.shape != pano_remap.shape:
+            logger.error('Shape mismatch: %s != %s', pano_purepython.shape, pano_remap.shape)
+            return
+
+
+        diff = numpy.count_nonzero(numpy.any(pano_purepython != pano_remap, axis=2))
+        if diff == 0:
+            logger.info('Panoramas match')
+        else:
+            # expected with rotation, the rotation is interpolated in a single pass
+            logger.warning('Panoramas differ in %d pixels (%0.3f%%)', diff, 100 * diff / (pano_remap.shape[0] * pano_remap.shape[1]))
+
+
+
+if __name__ == "__main__":
+    b = Fish2PanoBench()
+    b.main()
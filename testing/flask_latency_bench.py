@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+
+# Request latency for the JSON endpoints polled by the web dashboards.  Each endpoint
+# is requested with the config and sun set caches cleared (cold) and populated (warm).
+#
+# Uses the configured indi-allsky database, run as the indi-allsky user.
+
+
+import sys
+import time
+import statistics
+from pathlib import Path
+import logging
+
+sys.path.append(str(Path(__file__).parent.absolute().parent))
+
+from indi_allsky.flask import create_app
+from indi_allsky.flask.base_views import BaseView
+from indi_allsky.config import IndiAllSkyConfig
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging
+
+
+app = create_app()
+
+
+class FlaskLatencyBench(object):
+    rounds = 50
+
+    url_list = (
+        '/indi-allsky/js/latest',
+        '/indi-allsky/js/loop',
+        '/indi-allsky/js/charts',
+    )
+
+
+    def main(self):
+        with app.app_context():
+            start = time.time()
+            for i in range(self.rounds):
+                IndiAllSkyConfig()
+            uncached_s = (time.time() - start) / self.rounds
+
+            IndiAllSkyConfig(cached=True)  # populate cache
+
+            start = time.time()
+            for i in range(self.rounds):
+                IndiAllSkyConfig(cached=True)
+            cached_s = (time.time() - start) / self.rounds
+
+        logger.info('Config load - uncached: %0.2f ms, cached: %0.2f ms', uncached_s * 1000, cached_s * 1000)
+
+
+        client = app.test_client()
+
+        for url in self.url_list:
+            cold_list = list()
+            warm_list = list()
+
+            for i in range(self.rounds):
+                IndiAllSkyConfig.clearCache()
+                BaseView._sun_set_cache.clear()
+
+                cold_list.append(self.request(client, url))
+
+                warm_list.append(self.request(client, url))
+
+
+            logger.info(
+                '%s - cold: %0.2f ms (p95 %0.2f ms), warm: %0.2f ms (p95 %0.2f ms)',
+                url,
+                statistics.median(cold_list) * 1000,
+                self.p95(cold_list) * 1000,
+                statistics.median(warm_list) * 1000,
+                self.p95(warm_list) * 1000,
+            )
+
+
+    def request(self, client, url):
+        start = time.time()
+
+        r = client.get(url)
+        assert r.status_code == 200, '{0:s} returned {1:d}'.format(url, r.status_code)
+
+        return time.time() - start
+
+
+    def p95(self, value_list):
+        return sorted(value_list)[int(len(value_list) * 0.95) - 1]
+
+
+
+if __name__ == "__main__":
+    b = FlaskLatencyBench()
+    b.main()
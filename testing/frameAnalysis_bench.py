@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+
+# Analysis stages of a 4K frame (ADU, line detection, star detection) with and without
+# a shared IndiAllSkyFrameAnalysis.  The previous line detection gradient (full frame
+# float multiply) is included for comparison.
+
+
+import sys
+import time
+import statistics
+import tracemalloc
+from pathlib import Path
+from multiprocessing import Value
+import numpy
+import cv2
+import logging
+
+sys.path.append(str(Path(__file__).parent.absolute().parent))
+
+from indi_allsky.frameAnalysis import IndiAllSkyFrameAnalysis
+from indi_allsky.detectLines import IndiAllskyDetectLines
+from indi_allsky.stars import IndiAllSkyStars
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger('bench')
+
+logging.getLogger('indi_allsky').setLevel(logging.WARNING)
+
+
+class FrameAnalysisBench(object):
+    rounds = 20
+
+    width = 3840
+    height = 2160
+
+
+    def __init__(self):
+        self.config = {
+            'IMAGE_FOLDER'      : '/tmp',
+            'DETECT_STARS_THOLD': 0.6,
+            'SQM_ROI'           : [],
+            'DETECT_DRAW'       : False,
+        }
+
+        self.bin_v = Value('i', 1)
+
+        self.mask = numpy.full((self.height, self.width), 255, dtype=numpy.uint8)
+
+        self.lines = IndiAllskyDetectLines(self.config, self.bin_v, mask=None)
+        self.stars = IndiAllSkyStars(self.config, self.bin_v, mask=None)
+
+
+    def main(self):
+        image = numpy.random.normal(20, 4, (self.height, self.width, 3)).clip(0, 255).astype(numpy.uint8)
+
+
+        self.lines.detectLines(image)  # generate masks
+
+        gradient_mask = cv2.cvtColor(self.lines._sqm_gradient_mask, cv2.COLOR_GRAY2BGR)
+        self.previous_gradient_mask = (gradient_mask / 255).astype(numpy.float32)
+
+        for label, func in (
+            ('Line gradient previous', self.gradientPrevious),
+            ('Line gradient current', self.gradientCurrent),
+            ('All stages separate', self.separate),
+            ('All stages shared', self.shared),
+        ):
+            elapsed_list = list()
+            for i in range(self.rounds):
+                start = time.time()
+                func(image)
+                elapsed_list.append(time.time() - start)
+
+
+            tracemalloc.start()
+            func(image)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+
+            logger.info('%s: %0.1f ms, peak allocations %0.1f MB', label, statistics.median(elapsed_list) * 1000, peak / 1000000)
+
+
+    def gradientPrevious(self, image):
+        masked_img = (image * self.previous_gradient_mask).astype(numpy.uint8)
+        cv2.cvtColor(masked_img, cv2.COLOR_BGR2GRAY)
+
+
+    def gradientCurrent(self, image):
+        cv2.multiply(IndiAllSkyFrameAnalysis().gray(image), self.lines._sqm_gradient_mask, scale=1 / 255)
+
+
+    def separate(self, image):
+        IndiAllSkyFrameAnalysis().mean(image, mask=self.mask)
+        self.lines.detectLines(image)
+        self.stars.detectObjects(image)
+
+
+    def shared(self, image):
+        analysis = IndiAllSkyFrameAnalysis()
+
+        analysis.mean(image, mask=self.mask)
+        self.lines.detectLines(image, analysis=analysis)
+        self.stars.detectObjects(image, analysis=analysis)
+
+
+
+if __name__ == "__main__":
+    b = FrameAnalysisBench()
+    b.main()
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+
+# Wall time to decode a night of images with IndiAllSkyFrameDecoder at different worker counts
+
+
+import sys
+import time
+import tempfile
+import cv2
+import numpy
+from pathlib import Path
+import logging
+
+sys.path.append(str(Path(__file__).parent.absolute().parent))
+
+from indi_allsky.frameDecoder import IndiAllSkyFrameDecoder
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging
+
+
+class FrameDecodeBench(object):
+    frames = 200
+    workers_list = (1, 2, 4)
+    prefetch = 4
+
+    ### 1k
+    width  = 1920
+    height = 1080
+
+    ### 4k
+    #width  = 3840
+    #height = 2160
+
+
+    def __init__(self):
+        self.config = {}
+
+        self.tmpdir = tempfile.TemporaryDirectory(suffix='_decode_bench')
+        self.tmpdir_p = Path(self.tmpdir.name)
+
+
+    def main(self):
+        logger.info('Generating %d test images', self.frames)
+
+        # noise does not compress well, use a gradient with a little noise
+        gradient = numpy.tile(numpy.linspace(0, 100, self.width, dtype=numpy.uint8), (self.height, 1))
+
+        file_list = list()
+        for i in range(self.frames):
+            noise = numpy.random.randint(20, size=(self.height, self.width), dtype=numpy.uint8)
+            image = cv2.cvtColor(cv2.add(gradient, noise), cv2.COLOR_GRAY2BGR)
+
+            file_p = self.tmpdir_p.joinpath('{0:05d}.jpg'.format(i))
+            cv2.imwrite(str(file_p), image, [cv2.IMWRITE_JPEG_QUALITY, 90])
+            file_list.append(file_p)
+
+
+        for workers in self.workers_list:
+            decoder = IndiAllSkyFrameDecoder(self.config)
+            decoder.workers = workers
+            decoder.prefetch = self.prefetch
+
+            start = time.time()
+
+            for i, (entry, file_p, image) in enumerate(decoder.decode(file_list)):
+                # frames must be returned in order
+                assert file_p == file_list[i]
+
+                # simulate a little keogram work
+                image[:, int(self.width / 2)].copy()
+
+            elapsed_s = time.time() - start
+            logger.info('%d workers: %d frames in %0.2fs (%0.1f fps)', workers, self.frames, elapsed_s, self.frames / elapsed_s)
+
+
+
+if __name__ == "__main__":
+    b = FrameDecodeBench()
+    b.main()
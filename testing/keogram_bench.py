@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+
+# Compare the original keogram accumulation (full frame rotation + numpy.append)
+# with the preallocated keogram buffer in KeogramGenerator
+
+
+import sys
+import time
+import numpy
+from pathlib import Path
+import logging
+
+sys.path.append(str(Path(__file__).parent.absolute().parent))
+
+from indi_allsky.keogram import KeogramGenerator
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging
+
+
+class FakePath(object):
+    # processImage() only needs stat().st_mtime
+
+    def __init__(self, mtime):
+        self.st_mtime = mtime
+
+
+    def stat(self):
+        return self
+
+
+class KeogramBench(object):
+    frames = 3000
+    angle = 33.3
+
+    ### 1k
+    width  = 1920
+    height = 1080
+
+    ### 4k
+    #width  = 3840
+    #height = 2160
+
+
+    def __init__(self):
+        self.config = {
+            'KEOGRAM_ANGLE' : self.angle,
+        }
+
+        # a small pool of frames shifted every frame to simulate movement
+        self.frame_pool = [numpy.random.randint(255, size=(self.height, self.width, 3), dtype=numpy.uint8) for x in range(4)]
+
+        self.start_ts = time.time()
+
+
+    def getFrame(self, i):
+        return numpy.roll(self.frame_pool[i % len(self.frame_pool)], i, axis=1)
+
+
+    def main(self):
+        ### original
+        kg = KeogramGenerator(self.config)
+
+        keogram_data = None
+
+        start = time.time()
+        for i in range(self.frames):
+            image = self.getFrame(i)
+
+            rotated_image = kg.rotate(image)
+            rot_height, rot_width = rotated_image.shape[:2]
+
+            rotated_center_line = rotated_image[:, [int(rot_width / 2)]]
+
+            if isinstance(keogram_data, type(None)):
+                keogram_data = numpy.empty(rotated_center_line.shape, dtype=rotated_center_line.dtype)
+
+            keogram_data = numpy.append(keogram_data, rotated_center_line, 1)
+
+        original_elapsed_s = time.time() - start
+        logger.info('Original: %d frames in %0.3fs', self.frames, original_elapsed_s)
+
+
+        ### preallocated
+        kg = KeogramGenerator(self.config)
+        kg.total_frames = self.frames
+
+        start = time.time()
+        for i in range(self.frames):
+            image = self.getFrame(i)
+            kg.processImage(FakePath(self.start_ts + (i * 30)), image)
+
+        new_elapsed_s = time.time() - start
+        logger.info('Preallocated: %d frames in %0.3fs', self.frames, new_elapsed_s)
+
+
+        ### frame generation overhead
+        start = time.time()
+        for i in range(self.frames):
+            self.getFrame(i)
+
+        frame_elapsed_s = time.time() - start
+        logger.info('Frame generation overhead: %0.3fs', frame_elapsed_s)
+
+
+        logger.info('Speedup: %0.1fx', (original_elapsed_s - frame_elapsed_s) / (new_elapsed_s - frame_elapsed_s))
+
+
+        # the first column of the original keogram was uninitialized
+        if numpy.array_equal(keogram_data[:, 1:], kg.keogram_data[:, :kg.keogram_index]):
+            logger.info('Keograms match')
+        else:
+            logger.error('Keograms DO NOT match')
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    b = KeogramBench()
+    b.main()
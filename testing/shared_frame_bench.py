@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+
+# Compare passing a frame to another process as a temporary FITS file with the
+# shared memory frames in IndiAllSkySharedFrame
+
+
+import sys
+import io
+import time
+import tempfile
+from multiprocessing import Process
+from multiprocessing import Queue
+from pathlib import Path
+import numpy
+from astropy.io import fits
+import logging
+
+sys.path.append(str(Path(__file__).parent.absolute().parent))
+
+from indi_allsky.sharedFrame import IndiAllSkySharedFrame
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging
+
+
+class SharedFrameBench(object):
+    rounds = 10
+
+    ### 12MP
+    #width  = 4056
+    #height = 3040
+
+    ### 26MP
+    width  = 6248
+    height = 4176
+
+
+    def __init__(self):
+        self.config = {}
+
+
+    def main(self):
+        data = numpy.random.randint(4096, size=(self.height, self.width), dtype=numpy.uint16)
+
+        hdu = fits.PrimaryHDU(data)
+        hdu.header['BAYERPAT'] = 'RGGB'
+
+        blob_f = io.BytesIO()
+        fits.HDUList([hdu]).writeto(blob_f)
+        blob = blob_f.getvalue()
+
+        logger.info('Frame size: %0.1f MB', len(blob) / 1024 / 1024)
+
+
+        for method in ('file', 'shared'):
+            job_q = Queue()
+            result_q = Queue()
+
+            p = Process(target=self.consumer, args=(job_q, result_q))
+            p.start()
+
+            produce_total = 0
+            consume_total = 0
+
+            for i in range(self.rounds):
+                start = time.time()
+                job_q.put(self.produce(method, blob))
+                produce_total += time.time() - start
+
+                consume_elapsed, checksum = result_q.get()
+                consume_total += consume_elapsed
+
+                assert checksum == int(data.sum(dtype=numpy.uint64))
+
+
+            job_q.put(None)
+            p.join()
+
+            logger.info(
+                '%s - capture: %0.1f ms, image worker: %0.1f ms',
+                method,
+                produce_total / self.rounds * 1000,
+                consume_total / self.rounds * 1000,
+            )
+
+
+    def produce(self, method, blob):
+        # same steps as IndiClient.processBlob()
+        hdulist = fits.open(io.BytesIO(blob))
+
+        if method == 'shared':
+            frame_p, shared_frame = IndiAllSkySharedFrame(self.config).export(hdulist, blob)
+        else:
+            f_tmpfile = tempfile.NamedTemporaryFile(mode='w+b', delete=False, suffix='.fit')
+            frame_p = Path(f_tmpfile.name)
+
+            hdulist.writeto(f_tmpfile)
+
+            f_tmpfile.flush()
+            f_tmpfile.close()
+
+            shared_frame = None
+
+        return str(frame_p), shared_frame
+
+
+    def consumer(self, job_q, result_q):
+        shared = IndiAllSkySharedFrame(self.config)
+
+        while True:
+            job = job_q.get()
+            if not job:
+                return
+
+            filename, shared_frame = job
+            frame_p = Path(filename)
+
+            start = time.time()
+
+            # same steps as ImageProcessor.add()
+            if shared_frame:
+                hdulist = shared.load(frame_p, shared_frame)
+            else:
+                hdulist = fits.open(frame_p)
+
+            data = hdulist[0].data
+
+            frame_p.unlink()
+
+            elapsed_s = time.time() - start
+
+            result_q.put((elapsed_s, int(data.sum(dtype=numpy.uint64))))
+
+
+
+if __name__ == "__main__":
+    b = SharedFrameBench()
+    b.main()
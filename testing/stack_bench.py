@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+
+# Compare list stacking (numpy.mean over all frames) with the running sum average
+# in IndiAllskyStacker.  Each test runs in a separate process to measure peak RSS.
+
+
+import sys
+import time
+import resource
+from multiprocessing import Process
+from multiprocessing import Queue
+from multiprocessing import Value
+import numpy
+from pathlib import Path
+import logging
+
+sys.path.append(str(Path(__file__).parent.absolute().parent))
+
+from indi_allsky.stack import IndiAllskyStacker
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging
+
+
+class StackBench(object):
+    frames = 30
+    stack_counts = range(2, 11)
+
+    ### 1k
+    width  = 1920
+    height = 1080
+
+    ### 4k
+    #width  = 3840
+    #height = 2160
+
+
+    def main(self):
+        for count in self.stack_counts:
+            list_result = self.runTest(self.listStack, count)
+            ring_result = self.runTest(self.ringStack, count)
+
+            logger.info(
+                'x%d - list: %0.1f ms/frame, %d MB peak - ring: %0.1f ms/frame, %d MB peak - %s',
+                count,
+                list_result[0] * 1000,
+                list_result[1] / 1024,
+                ring_result[0] * 1000,
+                ring_result[1] / 1024,
+                'match' if list_result[2] == ring_result[2] else 'DO NOT MATCH',
+            )
+
+
+    def runTest(self, func, count):
+        q = Queue()
+
+        p = Process(target=func, args=(q, count))
+        p.start()
+        result = q.get()
+        p.join()
+
+        return result
+
+
+    def getFrames(self):
+        # 16-bit bayer data
+        numpy.random.seed(0)
+        return [numpy.random.randint(4096, size=(self.height, self.width), dtype=numpy.uint16) for x in range(self.frames)]
+
+
+    def listStack(self, q, count):
+        stacker = IndiAllskyStacker({}, Value('i', 1))
+        frame_list = self.getFrames()
+
+        rss_start = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+        image_list = list()
+
+        start = time.time()
+        for frame in frame_list:
+            image_list.insert(0, frame)
+            image_list = image_list[:count]
+
+            image = stacker.average(image_list, numpy.uint16)
+
+        elapsed_s = (time.time() - start) / self.frames
+
+        rss_peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_start
+
+        q.put((elapsed_s, rss_peak, int(image.astype(numpy.uint64).sum())))
+
+
+    def ringStack(self, q, count):
+        stacker = IndiAllskyStacker({}, Value('i', 1))
+        frame_list = self.getFrames()
+
+        rss_start = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+        i_ref_list = list()
+
+        start = time.time()
+        for frame in frame_list:
+            while len(i_ref_list) >= count:
+                stacker.ringRemove(i_ref_list.pop())
+
+            i_ref_list.insert(0, {'opencv_data' : frame})
+
+            image = stacker.ringAverage(i_ref_list, numpy.uint16)
+
+        elapsed_s = (time.time() - start) / self.frames
+
+        rss_peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_start
+
+        q.put((elapsed_s, rss_peak, int(image.astype(numpy.uint64).sum())))
+
+
+
+if __name__ == "__main__":
+    b = StackBench()
+    b.main()
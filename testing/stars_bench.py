@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+
+# Star detection on a synthetic 5000 star field.  The previous implementation
+# (full frame match, pure python deduplication) is included for comparison.
+
+
+import sys
+import time
+from pathlib import Path
+from multiprocessing import Value
+import numpy
+import cv2
+import logging
+
+sys.path.append(str(Path(__file__).parent.absolute().parent))
+
+from indi_allsky.stars import IndiAllSkyStars
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging
+
+
+class StarsBench(object):
+    rounds = 5
+
+    star_count = 5000
+    width = 3840
+    height = 2160
+
+
+    def __init__(self):
+        self.config = {
+            'IMAGE_FOLDER'      : '/tmp',
+            'DETECT_STARS_THOLD': 0.6,
+            'SQM_ROI'           : [0, 0, self.width, self.height],
+            'DETECT_DRAW'       : False,
+        }
+
+        self.bin_v = Value('i', 1)
+
+
+    def main(self):
+        image = self.starField()
+
+        stars = IndiAllSkyStars(self.config, self.bin_v)
+
+
+        previous_list = list()
+        for i in range(self.rounds):
+            start = time.time()
+            previous_blobs = self.detectObjects_previous(stars, image)
+            previous_list.append(time.time() - start)
+
+
+        current_list = list()
+        for i in range(self.rounds):
+            start = time.time()
+            blobs = stars.detectObjects(image)
+            current_list.append(time.time() - start)
+
+
+        logger.info('Previous: %d stars, %0.1f ms', len(previous_blobs), min(previous_list) * 1000)
+        logger.info('Current: %d stars, %0.1f ms', len(blobs), min(current_list) * 1000)
+        logger.info('Median flux: %0.1f', numpy.median(stars.star_data['flux']))
+
+
+    def starField(self):
+        rng = numpy.random.default_rng(0)
+
+        image = rng.normal(20, 4, (self.height, self.width)).astype(numpy.float32)
+
+        star_y, star_x = numpy.mgrid[-5:6, -5:6]
+
+        for x, y, flux in zip(
+            rng.uniform(10, self.width - 10, self.star_count),
+            rng.uniform(10, self.height - 10, self.star_count),
+            rng.uniform(30, 200, self.star_count),
+        ):
+            ix = int(x)
+            iy = int(y)
+
+            image[iy - 5:iy + 6, ix - 5:ix + 6] += flux * numpy.exp(-(((star_x - (x - ix)) ** 2) + ((star_y - (y - iy)) ** 2)) / 2.88)
+
+
+        image_8bit = numpy.clip(image, 0, 255).astype(numpy.uint8)
+
+        return cv2.cvtColor(image_8bit, cv2.COLOR_GRAY2BGR)
+
+
+    def detectObjects_previous(self, stars, original_data):
+        masked_img = cv2.bitwise_and(original_data, original_data, mask=stars._sqm_mask)
+        grey_img = cv2.cvtColor(masked_img, cv2.COLOR_BGR2GRAY)
+
+        result = cv2.matchTemplate(grey_img, stars.star_template, cv2.TM_CCOEFF_NORMED)
+        result_filter = numpy.where(result >= stars._detectionThreshold)
+
+        blobs = list()
+        for pt in zip(*result_filter[::-1]):
+            for blob in blobs:
+                if (abs(pt[0] - blob[0]) < stars._distanceThreshold) and (abs(pt[1] - blob[1]) < stars._distanceThreshold):
+                    break
+
+            else:
+                blobs.append(pt)
+
+        return blobs
+
+
+
+if __name__ == "__main__":
+    b = StarsBench()
+    b.main()
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+
+# Compare the original mode 1 stretch (gamma LUT, numpy.ma statistics, levels LUT,
+# 16 to 8 bit shift) with the fused single LUT stretch in IndiAllSkyStretch
+
+
+import sys
+import time
+import numpy
+from pathlib import Path
+from multiprocessing import Value
+import logging
+
+sys.path.append(str(Path(__file__).parent.absolute().parent))
+
+from indi_allsky.stretch import IndiAllSkyStretch
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging
+
+
+class StretchBench(object):
+    rounds = 10
+    bit_depth = 16
+
+    ### 1k
+    #width  = 1920
+    #height = 1080
+
+    ### 4k
+    width  = 3840
+    height = 2160
+
+
+    def __init__(self):
+        self.config = {
+            'IMAGE_STRETCH' : {
+                'MODE1_ENABLE'   : True,
+                'MODE1_GAMMA'    : 3.0,
+                'MODE1_STDDEVS'  : 2.25,
+                'SPLIT'          : False,
+                'MOONMODE'       : False,
+                'DAYTIME'        : False,
+            },
+            'SQM_ROI'     : [],
+            'SQM_FOV_DIV' : 4,
+        }
+
+        self.bin_v = Value('i', 1)
+        self.night_v = Value('i', 1)
+        self.moonmode_v = Value('i', 0)
+
+        # dark sky with some noise
+        self.data = numpy.random.normal(loc=3000, scale=800, size=(self.height, self.width, 3))
+        self.data = numpy.clip(self.data, 0, (2 ** self.bit_depth) - 1).astype(numpy.uint16)
+
+
+    def main(self):
+        ### original
+        stretch = IndiAllSkyStretch(self.config, self.bin_v, self.night_v, self.moonmode_v)
+        stretch._generateNumpyMask(self.data)
+
+        start = time.time()
+        for i in range(self.rounds):
+            original_data = self.original_stretch(stretch._numpy_mask, self.data)
+
+        original_elapsed_s = (time.time() - start) / self.rounds
+        logger.info('Original: %0.4fs per frame', original_elapsed_s)
+
+
+        ### fused
+        stretch = IndiAllSkyStretch(self.config, self.bin_v, self.night_v, self.moonmode_v)
+
+        start = time.time()
+        for i in range(self.rounds):
+            fused_data, is_stretched = stretch.main(self.data, self.bit_depth, output_8bit=True)
+
+        fused_elapsed_s = (time.time() - start) / self.rounds
+        logger.info('Fused: %0.4fs per frame', fused_elapsed_s)
+
+
+        logger.info('Speedup: %0.1fx', original_elapsed_s / fused_elapsed_s)
+
+
+        if numpy.array_equal(original_data, fused_data):
+            logger.info('Images match')
+        else:
+            diff = numpy.count_nonzero(original_data != fused_data)
+            logger.error('Images DO NOT match: %d values differ', diff)
+
+
+    def original_stretch(self, numpy_mask, data):
+        stage_start = time.time()
+
+        data_max = 2 ** self.bit_depth
+        range_array = numpy.arange(0, data_max, dtype=numpy.float32)
+        lut = (((range_array / data_max) ** (1 / float(self.config['IMAGE_STRETCH']['MODE1_GAMMA']))) * data_max).astype(numpy.uint16)
+        data = lut.take(data, mode='raise')
+
+        logger.info(' Gamma: %0.4fs', time.time() - stage_start)
+        stage_start = time.time()
+
+
+        mean_list = list()
+        stddev_list = list()
+        for c in range(3):
+            ma = numpy.ma.masked_array(data[:, :, c], mask=numpy_mask)
+            mean_list.append(numpy.ma.mean(ma))
+            stddev_list.append(numpy.ma.std(ma))
+
+        mean = sum(mean_list) / 3
+        stddev = sum(stddev_list) / 3
+
+        logger.info(' Mean/StdDev: %0.4fs', time.time() - stage_start)
+        stage_start = time.time()
+
+
+        low = int(mean - (self.config['IMAGE_STRETCH']['MODE1_STDDEVS'] * stddev))
+        lowIndex = int(((low / data_max) * 100 / 100) * data_max)
+        highIndex = int((100.0 / 100) * data_max)
+
+        lut = (((range_array - lowIndex) * data_max) / (highIndex - lowIndex))
+        lut[lut < 0] = 0
+        lut[lut > data_max] = data_max
+        lut = lut.astype(numpy.uint16)
+        data = lut.take(data, mode='raise')
+
+        logger.info(' Levels: %0.4fs', time.time() - stage_start)
+        stage_start = time.time()
+
+
+        data = numpy.right_shift(data, self.bit_depth - 8).astype(numpy.uint8)
+
+        logger.info(' 16 to 8 bit: %0.4fs', time.time() - stage_start)
+
+        return data
+
+
+
+if __name__ == "__main__":
+    b = StretchBench()
+    b.main()
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+
+# Star trail timelapse falls back to frame files when the ffmpeg stream fails
+# ffmpeg is replaced with a fake generator, run with: python3 -m pytest testing/test_startrail_stream_fallback.py
+
+
+import sys
+import tempfile
+import unittest
+from unittest import mock
+from multiprocessing import Value
+import numpy
+from pathlib import Path
+import logging
+
+sys.path.append(str(Path(__file__).parent.absolute().parent))
+
+from indi_allsky import starTrails
+from indi_allsky.exceptions import TimelapseException
+
+
+logging.basicConfig(level=logging.INFO)
+
+
+class FakeTimelapseGenerator(object):
+    # fail_after: number of frames accepted by the stream before failing, None never fails
+    fail_after = None
+
+    streamed = list()
+    generated = list()
+    concatenated = list()
+
+
+    def __init__(self, config):
+        self._stream_video_file_p = None
+        self._frames = 0
+
+
+    def openStream(self, video_file, image):
+        if self.fail_after == 0:
+            raise TimelapseException('Unable to start FFMPEG')
+
+        self._stream_video_file_p = Path(video_file)
+
+
+    def writeStreamFrame(self, image):
+        if self.fail_after is not None and self._frames >= self.fail_after:
+            raise TimelapseException('FFMPEG pipe error')
+
+        self._frames += 1
+
+
+    def closeStream(self):
+        self._stream_video_file_p.write_bytes(b'stream')
+        self.streamed.append(self._frames)
+
+
+    def abortStream(self):
+        pass
+
+
+    def generate(self, video_file, file_list):
+        assert all(p.is_file() for p in file_list)
+
+        Path(video_file).write_bytes(b'frames')
+        self.generated.append(len(file_list))
+
+
+    def concat(self, video_file, segment_list):
+        assert all(Path(p).is_file() for p in segment_list)
+
+        Path(video_file).write_bytes(b''.join(Path(p).read_bytes() for p in segment_list))
+        self.concatenated.append(len(segment_list))
+
+
+class TestStarTrailStreamFallback(unittest.TestCase):
+
+    frames = 10
+
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.tmpdir_p = Path(self.tmpdir.name)
+
+        FakeTimelapseGenerator.streamed = list()
+        FakeTimelapseGenerator.generated = list()
+        FakeTimelapseGenerator.concatenated = list()
+
+        config = {
+            'IMAGE_FOLDER'           : str(self.tmpdir_p),
+            'IMAGE_FILE_TYPE'        : 'jpg',
+            'IMAGE_FILE_COMPRESSION' : {'jpg' : 90},
+        }
+
+        self.stg = starTrails.StarTrailGenerator(config, Value('i', 1))
+        self.stg.sun_alt_threshold = 90.0
+        self.stg.max_adu = 255
+        self.stg.timelapse_stream_file = self.tmpdir_p.joinpath('.startrail.mp4')
+
+        self.video_file_p = self.tmpdir_p.joinpath('startrail.mp4')
+
+
+    def tearDown(self):
+        self.stg.cancelTimelapse()
+        self.tmpdir.cleanup()
+
+
+    def _run(self, fail_after):
+        FakeTimelapseGenerator.fail_after = fail_after
+
+        image = numpy.zeros((60, 80, 3), dtype=numpy.uint8)
+        image_p = self.tmpdir_p.joinpath('image.jpg')
+        image_p.write_bytes(b'')
+
+        with mock.patch.object(starTrails, 'TimelapseGenerator', FakeTimelapseGenerator):
+            for i in range(self.frames):
+                self.stg.processImage(image_p, image, adu=0, star_count=0)
+
+            self.stg.generateTimelapse(self.video_file_p)
+
+
+    def test_stream(self):
+        self._run(None)
+
+        self.assertTrue(self.video_file_p.is_file())
+        self.assertEqual(FakeTimelapseGenerator.streamed, [self.frames])
+        self.assertEqual(FakeTimelapseGenerator.generated, [])
+        self.assertEqual(self.stg.timelapse_frame_count, self.frames)
+
+
+    def test_open_failure(self):
+        self._run(0)
+
+        self.assertEqual(self.video_file_p.read_bytes(), b'frames')
+        self.assertEqual(FakeTimelapseGenerator.streamed, [])
+        self.assertEqual(FakeTimelapseGenerator.generated, [self.frames])
+        self.assertEqual(self.stg.timelapse_frame_count, self.frames)
+
+
+    def test_write_failure(self):
+        self._run(4)
+
+        # streamed frames are kept and joined with the frame files
+        self.assertEqual(self.video_file_p.read_bytes(), b'streamframes')
+        self.assertEqual(FakeTimelapseGenerator.streamed, [4])
+        self.assertEqual(FakeTimelapseGenerator.generated, [self.frames - 4])
+        self.assertEqual(FakeTimelapseGenerator.concatenated, [2])
+        self.assertEqual(self.stg.timelapse_frame_count, self.frames)
+
+        self.assertFalse(self.tmpdir_p.joinpath('.startrail.mp4').exists())
+        self.assertFalse(self.tmpdir_p.joinpath('.frames_startrail.mp4').exists())
+
+
+if __name__ == '__main__':
+    unittest.main()
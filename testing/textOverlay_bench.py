@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+
+# Pillow image labels, full frame conversion vs text overlay
+
+
+import sys
+import timeit
+from pathlib import Path
+import numpy
+import logging
+
+sys.path.append(str(Path(__file__).parent.absolute().parent))
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging
+
+
+class TextOverlayBench(object):
+    rounds = 50
+
+
+    def __init__(self):
+        pass
+
+
+    def main(self):
+
+        setup = '''
+import numpy
+import cv2
+from pathlib import Path
+from PIL import Image
+from PIL import ImageFont
+from PIL import ImageDraw
+from indi_allsky.textOverlay import IndiAllSkyTextOverlay
+
+image = numpy.random.randint(255, size=(2160, 3840, 3), dtype=numpy.uint8)
+
+font_file_p = Path('{0:s}').parent.parent.joinpath('indi_allsky', 'fonts', 'hack', 'Hack-Bold.ttf')
+
+lines = [
+    '20240101 00:00:00',
+    'Exposure 15.000000',
+    'Gain 100',
+    'Temp 10.0C',
+    'Stars 150',
+    'Lat 33.0 Long -84.0',
+    'Owner',
+]
+
+overlay = IndiAllSkyTextOverlay()
+'''.format(__file__)
+
+        s_fullframe = '''
+img_rgb = Image.fromarray(cv2.cvtColor(image, cv2.COLOR_BGR2RGB))
+draw = ImageDraw.Draw(img_rgb)
+
+for i, line in enumerate(lines):
+    font = ImageFont.truetype(str(font_file_p), 30)
+    draw.text((30, 30 + (i * 30)), line, fill=(200, 200, 200), font=font, stroke_width=4, stroke_fill=(0, 0, 0), anchor='la')
+
+fullframe_data = cv2.cvtColor(numpy.array(img_rgb), cv2.COLOR_RGB2BGR)
+'''
+
+        s_overlay = '''
+for i, line in enumerate(lines):
+    overlay.drawText(image, line, font_file_p, 30, (30, 30 + (i * 30)), (200, 200, 200), stroke_width=4, anchor='la')
+'''
+
+
+        t_fullframe = timeit.timeit(stmt=s_fullframe, setup=setup, number=self.rounds)
+        logger.info('Full frame Pillow: %0.3fms', t_fullframe * 1000 / self.rounds)
+
+        t_overlay = timeit.timeit(stmt=s_overlay, setup=setup, number=self.rounds)
+        logger.info('Text overlay: %0.3fms', t_overlay * 1000 / self.rounds)
+
+
+        # same labels on the same image, the overlay draws into the image in place
+        compare_vars = dict()
+        exec(setup + s_fullframe, compare_vars)
+        exec(s_overlay, compare_vars)
+
+        if numpy.array_equal(compare_vars['fullframe_data'], compare_vars['image']):
+            logger.info('Images match')
+        else:
+            diff = numpy.count_nonzero(compare_vars['fullframe_data'] != compare_vars['image'])
+            logger.error('Images DO NOT match: %d values differ', diff)
+
+
+
+if __name__ == "__main__":
+    b = TextOverlayBench()
+    b.main()